@@ -1,16 +1,66 @@
-from flask import Flask
+import os
+from typing import TYPE_CHECKING, Any, Optional
+
 from dotenv import load_dotenv
 
+if TYPE_CHECKING:
+    from flask import Flask
+
 load_dotenv()
 
+_app: Optional["Flask"] = None
 
-def create_app() -> Flask:
-    app = Flask(__name__)
+
+def _start_workers_default() -> bool:
+    return os.getenv("WBUY_START_WORKERS", "1").strip().lower() not in ("0", "false", "no")
+
+
+def bootstrap(start_workers: Optional[bool] = None) -> None:
+    """
+    Compila os templates e sobe os workers da fila e o reconciliador, a não
+    ser que WBUY_START_WORKERS=0 (o gunicorn com preload os sobe no
+    post_fork, ver gunicorn.conf.py). Não depende do Flask.
+    """
+
+    from .server import start_background_workers
+    from .wbuy import templates
+
+    templates.load()
+    if start_workers if start_workers is not None else _start_workers_default():
+        start_background_workers()
+
+
+def create_app(start_workers: Optional[bool] = None) -> "Flask":
+    from flask import Flask
 
     from .server import register_routes
 
+    app = Flask(__name__)
+    bootstrap(start_workers)
     register_routes(app)
     return app
 
 
-app = create_app()
+def preload() -> None:
+    """
+    Carrega no processo mestre do gunicorn o que os workers vão usar (app,
+    templates, cliente HTTP), para que as páginas sejam compartilhadas
+    por copy-on-write depois do fork.
+    """
+
+    from .wbuy import http_client
+
+    __getattr__("app")
+    http_client.preload()
+
+
+def __getattr__(name: str) -> Any:
+    # "app" é criado no primeiro acesso (gunicorn app:app), não no import do
+    # pacote: testes, CLIs e o modo ASGI não pagam pelo Flask.
+    global _app
+
+    if name == "app":
+        if _app is None:
+            _app = create_app()
+        return _app
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
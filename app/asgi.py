@@ -0,0 +1,200 @@
+"""
+Modo ASGI (WBUY_SERVER_MODE=asgi): as mesmas rotas e respostas de
+app/server.py servidas pelo uvicorn em um único event loop.
+
+    uvicorn app.asgi:app --host 0.0.0.0 --port 5000
+
+O corpo das requisições é lido de forma assíncrona; o trabalho bloqueante
+(SQLite do arquivo de webhooks e da fila) roda em um pool de threads
+limitado (WBUY_ASGI_THREADS), então um processo atende muitos webhooks
+simultâneos. Os envios ao Whaticket continuam nos workers da fila; com
+WHATICKET_ENGINE=async eles também ficam em um event loop.
+"""
+
+import asyncio
+import json
+import multiprocessing
+import os
+import signal
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+from typing import Any, Awaitable, Callable, Dict, List, Optional, Tuple
+
+from . import bootstrap
+from .server import (
+    METRICS_CONTENT_TYPE,
+    health_payload,
+    metrics_text,
+    webhook_status,
+)
+from .wbuy import jobs, metrics, polling, settings, tenants
+from .wbuy.webhook import handle_webhook
+
+Headers = List[Tuple[bytes, bytes]]
+
+
+def _env_int(name: str, default: int) -> int:
+    try:
+        return int(os.getenv(name, default))
+    except (TypeError, ValueError):
+        return default
+
+
+class _RawRequest:
+    """
+    O mínimo da interface do request do Flask usado por handle_webhook.
+    """
+
+    __slots__ = ("_body",)
+
+    def __init__(self, body: bytes) -> None:
+        self._body = body
+
+    def get_data(self) -> bytes:
+        return self._body
+
+
+def _json(payload: Any) -> bytes:
+    # Mesmo formato do jsonify do Flask (chaves ordenadas, compacto).
+    return (json.dumps(payload, sort_keys=True, separators=(",", ":")) + "\n").encode("utf-8")
+
+
+class WbuyASGI:
+    def __init__(self, threads: Optional[int] = None) -> None:
+        self._executor = ThreadPoolExecutor(
+            max_workers=threads or _env_int("WBUY_ASGI_THREADS", 32),
+            thread_name_prefix="wbuy-asgi",
+        )
+        self._routes: Dict[str, Dict[str, Callable[[bytes], Tuple[int, bytes, bytes]]]] = {
+            "/wbuy": {"GET": self._health},
+            "/wbuy/metrics": {"GET": self._metrics},
+            "/wbuy/webhook": {"POST": self._webhook},
+        }
+
+    @staticmethod
+    def _health(_: bytes) -> Tuple[int, bytes, bytes]:
+        return 200, b"application/json", _json(health_payload())
+
+    @staticmethod
+    def _metrics(_: bytes) -> Tuple[int, bytes, bytes]:
+        content_type = f"{METRICS_CONTENT_TYPE}; charset=utf-8".encode("latin-1")
+        return 200, content_type, metrics_text().encode("utf-8")
+
+    @staticmethod
+    def _webhook(body: bytes, tenant: str = tenants.DEFAULT) -> Tuple[int, bytes, bytes]:
+        response = handle_webhook(_RawRequest(body), tenant)
+        return webhook_status(response), b"application/json", _json(response)
+
+    def _route(
+        self, path: str
+    ) -> Optional[Dict[str, Callable[[bytes], Tuple[int, bytes, bytes]]]]:
+        path = path.rstrip("/") or "/"
+        methods = self._routes.get(path)
+        if methods is not None:
+            return methods
+        # /wbuy/<tenant>/webhook; tenant desconhecido responde 404 em handle_webhook.
+        parts = path.split("/")
+        if len(parts) == 4 and parts[1] == "wbuy" and parts[2] and parts[3] == "webhook":
+            return {"POST": partial(self._webhook, tenant=parts[2])}
+        return None
+
+    async def __call__(
+        self,
+        scope: Dict[str, Any],
+        receive: Callable[[], Awaitable[Dict[str, Any]]],
+        send: Callable[[Dict[str, Any]], Awaitable[None]],
+    ) -> None:
+        if scope["type"] == "lifespan":
+            await self._lifespan(receive, send)
+            return
+        if scope["type"] != "http":
+            return
+
+        methods = self._route(scope["path"])
+        if methods is None:
+            await self._send(send, 404, b"application/json", _json({"error": "not found"}))
+            return
+        handler = methods.get(scope["method"])
+        if handler is None:
+            await self._send(
+                send,
+                405,
+                b"application/json",
+                _json({"error": "method not allowed"}),
+                [(b"allow", ", ".join(methods).encode("latin-1"))],
+            )
+            return
+
+        body = await self._read_body(receive)
+        loop = asyncio.get_running_loop()
+        try:
+            status, content_type, payload = await loop.run_in_executor(
+                self._executor, handler, body
+            )
+        except Exception:
+            await self._send(send, 500, b"application/json", _json({"error": "internal error"}))
+            raise
+        await self._send(send, status, content_type, payload)
+
+    @staticmethod
+    async def _read_body(receive: Callable[[], Awaitable[Dict[str, Any]]]) -> bytes:
+        chunks = []
+        while True:
+            message = await receive()
+            if message["type"] == "http.disconnect":
+                break
+            chunks.append(message.get("body", b""))
+            if not message.get("more_body"):
+                break
+        return b"".join(chunks)
+
+    @staticmethod
+    async def _send(
+        send: Callable[[Dict[str, Any]], Awaitable[None]],
+        status: int,
+        content_type: bytes,
+        body: bytes,
+        extra_headers: Optional[Headers] = None,
+    ) -> None:
+        headers: Headers = [
+            (b"content-type", content_type),
+            (b"content-length", str(len(body)).encode("latin-1")),
+        ]
+        await send(
+            {
+                "type": "http.response.start",
+                "status": status,
+                "headers": headers + (extra_headers or []),
+            }
+        )
+        await send({"type": "http.response.body", "body": body})
+
+    async def _lifespan(
+        self,
+        receive: Callable[[], Awaitable[Dict[str, Any]]],
+        send: Callable[[Dict[str, Any]], Awaitable[None]],
+    ) -> None:
+        while True:
+            message = await receive()
+            if message["type"] == "lifespan.startup":
+                # Com uvicorn --workers N cada worker é filho do supervisor e
+                # apagaria os snapshots dos irmãos: o reset é do servidor, e
+                # nesse modo deve rodar antes do uvicorn subir.
+                if multiprocessing.parent_process() is None:
+                    metrics.reset()
+                # kill -HUP relê o .env e os templates sem derrubar o processo.
+                try:
+                    asyncio.get_running_loop().add_signal_handler(signal.SIGHUP, settings.reload)
+                except (NotImplementedError, RuntimeError, ValueError):
+                    pass
+                await send({"type": "lifespan.startup.complete"})
+            elif message["type"] == "lifespan.shutdown":
+                polling.stop_reconciler()
+                jobs.stop_workers()
+                self._executor.shutdown(wait=False)
+                await send({"type": "lifespan.shutdown.complete"})
+                return
+
+
+bootstrap()
+app = WbuyASGI()
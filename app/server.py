@@ -1,14 +1,85 @@
-from flask import jsonify, request
+from functools import partial
+from typing import Any, Dict
 
-from .wbuy.webhook import handle_webhook
+from .wbuy import (
+    batcher,
+    boleto_cache,
+    breaker,
+    delivery_log,
+    http_client,
+    jobs,
+    metrics,
+    polling,
+    scheduler,
+    storage,
+    tenants,
+)
+from .wbuy.webhook import handle_webhook, run_job
+
+METRICS_CONTENT_TYPE = "text/plain; version=0.0.4"
+
+
+def health_payload() -> Dict[str, Any]:
+    return {
+        "status": "wbuy api online",
+        "queue": jobs.depth(),
+        "deliveries": delivery_log.counts(),
+        "http": http_client.connection_stats(),
+        "boleto_cache": boleto_cache.stats(),
+        "reconciler": polling.stats(),
+        "batching": batcher.stats(),
+        "breaker": breaker.stats(),
+        "processed_cache": storage.cache_stats(),
+        "priorities": {"queue": jobs.inflight(), "sender": scheduler.stats()},
+        "tenants": {
+            name: {
+                "breaker": breaker.stats(name),
+                "sender": scheduler.stats(name),
+                "batching": batcher.stats(name),
+            }
+            for name in tenants.names()
+        },
+    }
+
+
+def metrics_text() -> str:
+    # Filas e entregas vêm do SQLite compartilhado, então já são globais.
+    return metrics.render(
+        {
+            "wbuy_queue_jobs": ("Jobs na fila por status.", jobs.depth()),
+            "wbuy_deliveries": ("Entregas por status.", delivery_log.counts()),
+        }
+    )
+
+
+def webhook_status(response: Dict[str, Any]) -> int:
+    if response.get("reason") == "unknown_tenant":
+        return 404
+    return 422 if response.get("status") == "rejected" else 202
 
 
 def register_routes(app):
+    from flask import Response, jsonify, request
+
     @app.route("/wbuy", methods=["GET"])
     def healthcheck():
-        return "wbuy api online", 200
+        return jsonify(health_payload()), 200
+
+    @app.route("/wbuy/metrics", methods=["GET"])
+    def metrics_endpoint():
+        return Response(metrics_text(), mimetype=METRICS_CONTENT_TYPE)
 
     @app.route("/wbuy/webhook", methods=["POST"])
     def webhook_receiver():
         response = handle_webhook(request)
-        return jsonify(response), 200
+        return jsonify(response), webhook_status(response)
+
+    @app.route("/wbuy/<tenant>/webhook", methods=["POST"])
+    def tenant_webhook_receiver(tenant):
+        response = handle_webhook(request, tenant)
+        return jsonify(response), webhook_status(response)
+
+
+def start_background_workers():
+    polling.start_reconciler()
+    return jobs.start_workers(partial(run_job, wait=False))
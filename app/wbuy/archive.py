@@ -0,0 +1,307 @@
+import json
+import os
+import threading
+import time
+from pathlib import Path
+from typing import Iterator, List, NamedTuple, Optional, Tuple
+
+from . import db, log, storage
+
+logger = log.get_logger("archive")
+
+SEGMENT_PREFIX = "segment-"
+SEGMENT_SUFFIX = ".log"
+PRUNE_INTERVAL_SECONDS = 3600
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS payloads (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    order_id TEXT,
+    segment TEXT NOT NULL,
+    offset INTEGER NOT NULL,
+    length INTEGER NOT NULL,
+    received_at REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS payloads_order_idx ON payloads (order_id);
+CREATE INDEX IF NOT EXISTS payloads_segment_idx ON payloads (segment);
+"""
+
+
+def _env_int(name: str, default: int) -> int:
+    try:
+        return int(os.getenv(name, default))
+    except (TypeError, ValueError):
+        return default
+
+
+def _env_float(name: str, default: float) -> float:
+    try:
+        return float(os.getenv(name, default))
+    except (TypeError, ValueError):
+        return default
+
+
+def segment_max_bytes() -> int:
+    return _env_int("WBUY_ARCHIVE_SEGMENT_BYTES", 64 * 1024 * 1024)
+
+
+def segment_seconds() -> int:
+    return max(_env_int("WBUY_ARCHIVE_SEGMENT_SECONDS", 3600), 1)
+
+
+def _retention_seconds() -> Optional[float]:
+    days = _env_float("WBUY_ARCHIVE_RETENTION_DAYS", 0)
+    return days * 86400 if days > 0 else None
+
+
+class ArchiveRef(NamedTuple):
+    segment: str
+    offset: int
+    length: int
+
+
+class ArchiveRecord(NamedTuple):
+    received_at: float
+    order_id: Optional[str]
+    payload: bytes
+    segment: str
+    offset: int
+
+
+def _archive_dir() -> Path:
+    return storage.WEBHOOK_DIR
+
+
+def _index():
+    return db.connect(_archive_dir() / "index.db", _SCHEMA)
+
+
+def _segment_name(bucket: int, sequence: int) -> str:
+    stamp = time.strftime("%Y%m%d%H%M%S", time.gmtime(bucket))
+    return f"{SEGMENT_PREFIX}{stamp}-{sequence:04d}{SEGMENT_SUFFIX}"
+
+
+def _segments() -> List[Path]:
+    directory = _archive_dir()
+    if not directory.exists():
+        return []
+    return sorted(directory.glob(f"{SEGMENT_PREFIX}*{SEGMENT_SUFFIX}"))
+
+
+def _encode(raw_bytes: bytes, order_id: Optional[str], received_at: float) -> bytes:
+    header = json.dumps(
+        {"ts": round(received_at, 6), "order_id": order_id, "length": len(raw_bytes)},
+        separators=(",", ":"),
+    )
+    return header.encode("utf-8") + b"\n" + raw_bytes + b"\n"
+
+
+class _SegmentWriter:
+    """
+    Segmento aberto em O_APPEND pelo processo atual.
+
+    Cada registro sai em um único os.write, então workers do gunicorn podem
+    anexar ao mesmo segmento sem se intercalar. O nome do segmento deriva da
+    janela de tempo (WBUY_ARCHIVE_SEGMENT_SECONDS) e de um sequencial que
+    avança quando o arquivo passa de WBUY_ARCHIVE_SEGMENT_BYTES; como todos
+    os processos calculam o mesmo nome, a rotação não precisa de coordenação.
+    """
+
+    def __init__(self) -> None:
+        self.lock = threading.Lock()
+        self.key: Optional[Tuple[int, str]] = None
+        self.fd: Optional[int] = None
+        self.bucket = -1
+        self.sequence = 0
+        self.name = ""
+
+    def _close(self) -> None:
+        if self.fd is not None:
+            try:
+                os.close(self.fd)
+            except OSError:
+                pass
+        self.fd = None
+
+    def _open(self) -> None:
+        directory = _archive_dir()
+        directory.mkdir(parents=True, exist_ok=True)
+        self.name = _segment_name(self.bucket, self.sequence)
+        self.fd = os.open(
+            directory / self.name, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644
+        )
+
+    def _latest_sequence(self, bucket: int) -> int:
+        prefix = _segment_name(bucket, 0)[: -len(f"0000{SEGMENT_SUFFIX}")]
+        sequences = [
+            int(path.name[len(prefix) : -len(SEGMENT_SUFFIX)])
+            for path in _segments()
+            if path.name.startswith(prefix)
+        ]
+        return max(sequences, default=0)
+
+    def append(self, record: bytes, now: float) -> Tuple[str, int]:
+        key = (os.getpid(), str(_archive_dir()))
+        seconds = segment_seconds()
+        bucket = int(now // seconds) * seconds
+
+        with self.lock:
+            if self.key != key or self.bucket != bucket:
+                self._close()
+                self.key = key
+                self.bucket = bucket
+                self.sequence = self._latest_sequence(bucket)
+                self._open()
+
+            if os.fstat(self.fd).st_size >= segment_max_bytes():
+                self._close()
+                self.sequence = max(self.sequence + 1, self._latest_sequence(bucket))
+                self._open()
+
+            written = os.write(self.fd, record)
+            end = os.lseek(self.fd, 0, os.SEEK_CUR)
+            name = self.name
+
+        if written != len(record):
+            raise OSError(f"gravação parcial no arquivo {name}")
+        return name, end - len(record)
+
+
+_writer = _SegmentWriter()
+_last_prune = 0.0
+
+
+def append(raw_bytes: bytes, order_id: Optional[str] = None) -> ArchiveRef:
+    """
+    Anexa o webhook cru ao segmento atual em storage/webhooks e registra no
+    índice (storage/webhooks/index.db) a posição do registro para o pedido.
+
+    Cada registro é uma linha de cabeçalho JSON (ts, order_id, length)
+    seguida do corpo original e de uma quebra de linha.
+    """
+
+    now = time.time()
+    record = _encode(raw_bytes, order_id or None, now)
+    segment, offset = _writer.append(record, now)
+    _index().execute(
+        "INSERT INTO payloads (order_id, segment, offset, length, received_at) "
+        "VALUES (?, ?, ?, ?, ?)",
+        (order_id or None, segment, offset, len(record), now),
+    )
+    _maybe_prune()
+    return ArchiveRef(segment, offset, len(record))
+
+
+def _read_record(file, segment: str) -> Optional[ArchiveRecord]:
+    offset = file.tell()
+    header_line = file.readline()
+    if not header_line.endswith(b"\n"):
+        return None
+
+    try:
+        header = json.loads(header_line)
+        length = int(header["length"])
+    except (ValueError, KeyError, TypeError):
+        return None
+
+    payload = file.read(length)
+    if len(payload) != length or file.read(1) != b"\n":
+        # Registro truncado (queda no meio da gravação): para a leitura aqui.
+        return None
+
+    return ArchiveRecord(header.get("ts", 0.0), header.get("order_id"), payload, segment, offset)
+
+
+def read(ref: ArchiveRef) -> Optional[ArchiveRecord]:
+    try:
+        with open(_archive_dir() / ref.segment, "rb") as file:
+            file.seek(ref.offset)
+            return _read_record(file, ref.segment)
+    except FileNotFoundError:
+        return None
+
+
+def lookup(order_id: str) -> Optional[ArchiveRef]:
+    """
+    Posição do webhook mais recente do pedido, ou None se não estiver no
+    arquivo (ou já tiver saído pela retenção).
+    """
+
+    row = _index().execute(
+        "SELECT segment, offset, length FROM payloads WHERE order_id = ? ORDER BY id DESC LIMIT 1",
+        (str(order_id),),
+    ).fetchone()
+    return ArchiveRef(*row) if row is not None else None
+
+
+def load(order_id: str) -> Optional[bytes]:
+    ref = lookup(order_id)
+    if ref is None:
+        return None
+    record = read(ref)
+    return record.payload if record is not None else None
+
+
+def read_segment(path: Path, since: Optional[float] = None) -> Iterator[ArchiveRecord]:
+    """
+    Registros de um segmento; não usa o índice, então serve também em outro
+    processo (replay).
+    """
+
+    with open(path, "rb") as file:
+        while True:
+            record = _read_record(file, path.name)
+            if record is None:
+                break
+            if since is None or record.received_at >= since:
+                yield record
+
+
+def iter_records(since: Optional[float] = None) -> Iterator[ArchiveRecord]:
+    """
+    Percorre todos os registros dos segmentos, do mais antigo ao mais novo.
+    """
+
+    for path in _segments():
+        yield from read_segment(path, since)
+
+
+def prune(retention_seconds: Optional[float] = None) -> int:
+    """
+    Remove segmentos modificados há mais de retention_seconds (ou
+    WBUY_ARCHIVE_RETENTION_DAYS) e suas entradas no índice. Sem retenção
+    configurada, nada é removido. Retorna quantos segmentos saíram.
+    """
+
+    retention = retention_seconds if retention_seconds is not None else _retention_seconds()
+    if not retention:
+        return 0
+
+    cutoff = time.time() - retention
+    removed = 0
+    for path in _segments():
+        if path.name == _writer.name:
+            continue
+        try:
+            if path.stat().st_mtime >= cutoff:
+                continue
+            path.unlink()
+        except FileNotFoundError:
+            pass
+        _index().execute("DELETE FROM payloads WHERE segment = ?", (path.name,))
+        removed += 1
+
+    if removed:
+        logger.info("%d segmentos de webhooks removidos pela retenção.", removed)
+    return removed
+
+
+def _maybe_prune() -> None:
+    global _last_prune
+
+    now = time.time()
+    if now - _last_prune < PRUNE_INTERVAL_SECONDS:
+        return
+
+    _last_prune = now
+    prune()
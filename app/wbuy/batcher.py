@@ -0,0 +1,218 @@
+import os
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Any, Callable, Dict, List, Optional
+
+from . import metrics
+
+SendOne = Callable[[str, str], Dict[str, Any]]
+SendBulk = Callable[[List[Dict[str, str]]], List[Dict[str, Any]]]
+
+# Resultado das mensagens que o endpoint em lote não devolveu: falha (e a
+# etapa volta para retry), nunca um envio presumido.
+MISSING_BULK_RESULT: Dict[str, Any] = {"status": "error", "reason": "missing_bulk_result"}
+
+
+def _env_int(name: str, default: int) -> int:
+    try:
+        return int(os.getenv(name, default))
+    except (TypeError, ValueError):
+        return default
+
+
+def _env_float(name: str, default: float) -> float:
+    try:
+        return float(os.getenv(name, default))
+    except (TypeError, ValueError):
+        return default
+
+
+def enabled() -> bool:
+    return os.getenv("WHATICKET_BATCHING", "1").strip().lower() not in ("0", "false", "no")
+
+
+class _Pending:
+    __slots__ = ("number", "body", "future", "queued_at")
+
+    def __init__(self, number: str, body: str) -> None:
+        self.number = number
+        self.body = body
+        self.future: Future = Future()
+        self.queued_at = time.monotonic()
+
+
+class Batcher:
+    """
+    Agrupa mensagens de texto de vários pedidos em janelas de envio.
+
+    Uma janela fecha quando junta ``max_size`` mensagens
+    (WHATICKET_BATCH_SIZE) ou quando a mais antiga espera ``window``
+    segundos (WHATICKET_BATCH_WINDOW_MS). Com ``send_bulk`` a janela vai em
+    uma única requisição; sem ele, as mensagens saem em paralelo pelo pool
+    de conexões (WHATICKET_BATCH_CONCURRENCY). Mensagens do mesmo número
+    dentro de uma janela são enviadas em ordem, uma após a outra.
+    """
+
+    def __init__(
+        self,
+        send_one: SendOne,
+        send_bulk: Optional[SendBulk] = None,
+        max_size: Optional[int] = None,
+        window: Optional[float] = None,
+        concurrency: Optional[int] = None,
+    ) -> None:
+        self.send_one = send_one
+        self.send_bulk = send_bulk
+        self.max_size = max(max_size or _env_int("WHATICKET_BATCH_SIZE", 50), 1)
+        self.window = (
+            window if window is not None else _env_float("WHATICKET_BATCH_WINDOW_MS", 20) / 1000
+        )
+        self._executor = ThreadPoolExecutor(
+            max_workers=concurrency or _env_int("WHATICKET_BATCH_CONCURRENCY", 10),
+            thread_name_prefix="wbuy-batch",
+        )
+        self._pending: List[_Pending] = []
+        self._cond = threading.Condition()
+        self._stats_lock = threading.Lock()
+        self._stats = {
+            "batches": 0,
+            "messages": 0,
+            "bulk_requests": 0,
+            "max_batch_size": 0,
+            "flush_seconds_total": 0.0,
+            "flush_seconds_max": 0.0,
+        }
+        self._thread = threading.Thread(target=self._flush_loop, name="wbuy-batcher", daemon=True)
+        self._thread.start()
+
+    def submit(self, number: str, body: str) -> Future:
+        """
+        Enfileira a mensagem na janela atual. O Future termina com a
+        resposta do Whaticket para esta mensagem.
+        """
+
+        pending = _Pending(number, body)
+        with self._cond:
+            self._pending.append(pending)
+            if len(self._pending) == 1 or len(self._pending) >= self.max_size:
+                self._cond.notify()
+        return pending.future
+
+    def _take_batch(self) -> List[_Pending]:
+        with self._cond:
+            while True:
+                if self._pending:
+                    remaining = self._pending[0].queued_at + self.window - time.monotonic()
+                    if len(self._pending) >= self.max_size or remaining <= 0:
+                        batch = self._pending[: self.max_size]
+                        del self._pending[: self.max_size]
+                        return batch
+                    self._cond.wait(remaining)
+                else:
+                    self._cond.wait()
+
+    def _flush_loop(self) -> None:
+        while True:
+            batch = self._take_batch()
+            if self.send_bulk is not None:
+                self._executor.submit(self._dispatch_bulk, batch)
+                continue
+
+            by_number: "OrderedDict[str, List[_Pending]]" = OrderedDict()
+            for item in batch:
+                by_number.setdefault(item.number, []).append(item)
+
+            remaining = [len(by_number)]
+            remaining_lock = threading.Lock()
+
+            def _group_done(_, batch=batch, remaining=remaining, remaining_lock=remaining_lock):
+                with remaining_lock:
+                    remaining[0] -= 1
+                    last = remaining[0] == 0
+                if last:
+                    self._record(batch)
+
+            for group in by_number.values():
+                self._executor.submit(self._send_group, group).add_done_callback(_group_done)
+
+    def _record(self, batch: List[_Pending]) -> None:
+        latency = time.monotonic() - batch[0].queued_at
+        mode = "bulk" if self.send_bulk is not None else "parallel"
+        metrics.observe("wbuy_batch_size", len(batch), mode=mode)
+        metrics.observe("wbuy_batch_flush_seconds", latency, mode=mode)
+        with self._stats_lock:
+            self._stats["batches"] += 1
+            self._stats["messages"] += len(batch)
+            self._stats["max_batch_size"] = max(self._stats["max_batch_size"], len(batch))
+            self._stats["flush_seconds_total"] += latency
+            self._stats["flush_seconds_max"] = max(self._stats["flush_seconds_max"], latency)
+
+    def _dispatch_bulk(self, batch: List[_Pending]) -> None:
+        with self._stats_lock:
+            self._stats["bulk_requests"] += 1
+        try:
+            results = self.send_bulk([{"number": item.number, "body": item.body} for item in batch])
+        except BaseException as exc:
+            for item in batch:
+                item.future.set_exception(exc)
+        else:
+            for index, item in enumerate(batch):
+                item.future.set_result(
+                    results[index] if index < len(results) else dict(MISSING_BULK_RESULT)
+                )
+        self._record(batch)
+
+    def _send_group(self, group: List[_Pending]) -> None:
+        for item in group:
+            try:
+                item.future.set_result(self.send_one(item.number, item.body))
+            except BaseException as exc:
+                item.future.set_exception(exc)
+
+    def stats(self) -> Dict[str, Any]:
+        with self._stats_lock:
+            stats = dict(self._stats)
+        batches = stats["batches"]
+        total = stats.pop("flush_seconds_total")
+        stats["avg_batch_size"] = round(stats["messages"] / batches, 2) if batches else 0.0
+        stats["avg_flush_seconds"] = round(total / batches, 4) if batches else 0.0
+        stats["flush_seconds_max"] = round(stats["flush_seconds_max"], 4)
+        with self._cond:
+            stats["pending"] = len(self._pending)
+        return stats
+
+
+_batchers: Dict[str, Batcher] = {}
+_batchers_pid: Optional[int] = None
+_lock = threading.Lock()
+
+
+def get_batcher(
+    send_one: SendOne, send_bulk: Optional[SendBulk] = None, key: str = ""
+) -> Batcher:
+    """
+    Batcher do processo para ``key`` (um por tenant: cada lote vai para uma
+    única conta do Whaticket), recriado após fork.
+    """
+
+    global _batchers_pid
+
+    pid = os.getpid()
+    batcher = _batchers.get(key) if _batchers_pid == pid else None
+    if batcher is None:
+        with _lock:
+            if _batchers_pid != pid:
+                _batchers.clear()
+                _batchers_pid = pid
+            batcher = _batchers.get(key)
+            if batcher is None:
+                batcher = _batchers[key] = Batcher(send_one, send_bulk)
+    return batcher
+
+
+def stats(key: str = "") -> Dict[str, Any]:
+    if _batchers_pid != os.getpid() or key not in _batchers:
+        return {}
+    return _batchers[key].stats()
@@ -0,0 +1,261 @@
+import hashlib
+import os
+import tempfile
+import threading
+import time
+from pathlib import Path
+from typing import Dict, Iterator, NamedTuple, Optional
+
+from . import db
+from .media import CHUNK_SIZE
+from .storage import BASE_DIR
+
+CACHE_DIR = BASE_DIR / "storage" / "boleto_cache"
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS boletos (
+    url TEXT PRIMARY KEY,
+    sha256 TEXT NOT NULL,
+    size INTEGER NOT NULL,
+    etag TEXT,
+    last_modified TEXT,
+    stored_at REAL NOT NULL,
+    last_access REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS boletos_sha_idx ON boletos (sha256);
+CREATE INDEX IF NOT EXISTS boletos_access_idx ON boletos (last_access);
+"""
+
+_stats_lock = threading.Lock()
+_stats = {"hits": 0, "misses": 0, "revalidated": 0, "stored": 0, "evicted": 0}
+
+
+def _env_float(name: str, default: float) -> float:
+    try:
+        return float(os.getenv(name, default))
+    except (TypeError, ValueError):
+        return default
+
+
+def enabled() -> bool:
+    return os.getenv("WBUY_BOLETO_CACHE", "1").strip().lower() not in ("0", "false", "no")
+
+
+def _conn():
+    return db.connect(CACHE_DIR / "index.db", _SCHEMA)
+
+
+def _count(name: str) -> None:
+    with _stats_lock:
+        _stats[name] += 1
+
+
+def _blob_path(sha256: str) -> Path:
+    return CACHE_DIR / sha256[:2] / f"{sha256}.pdf"
+
+
+class CacheEntry(NamedTuple):
+    url: str
+    sha256: str
+    size: int
+    etag: Optional[str]
+    last_modified: Optional[str]
+    stored_at: float
+
+    @property
+    def path(self) -> Path:
+        return _blob_path(self.sha256)
+
+    @property
+    def fresh(self) -> bool:
+        """
+        Dentro de WBUY_BOLETO_CACHE_FRESH_SECONDS (padrão 24 h) o PDF é usado
+        sem consultar a WBuy; depois disso é revalidado com ETag/Last-Modified.
+        """
+
+        ttl = _env_float("WBUY_BOLETO_CACHE_FRESH_SECONDS", 86400)
+        return time.time() - self.stored_at < ttl
+
+    def conditional_headers(self) -> Dict[str, str]:
+        headers = {}
+        if self.etag:
+            headers["If-None-Match"] = self.etag
+        if self.last_modified:
+            headers["If-Modified-Since"] = self.last_modified
+        return headers
+
+
+class CachedPdf:
+    """
+    PDF servido do cache, com a mesma interface de BoletoStream (iteração em
+    blocos e replay) para o passo de envio.
+    """
+
+    spooled = True
+
+    def __init__(self, entry: CacheEntry) -> None:
+        self.entry = entry
+        self.size = entry.size
+
+    def __iter__(self) -> Iterator[bytes]:
+        with open(self.entry.path, "rb") as file:
+            while True:
+                chunk = file.read(CHUNK_SIZE)
+                if not chunk:
+                    return
+                yield chunk
+
+    def replay(self) -> Iterator[bytes]:
+        return iter(self)
+
+    def close(self) -> None:
+        pass
+
+
+class CacheWriter:
+    """
+    Arquivo temporário dentro de storage/boleto_cache que calcula o sha256
+    enquanto recebe os blocos. Serve de spool para o BoletoStream e, ao fim
+    do download, vira a entrada do cache via commit().
+    """
+
+    def __init__(self) -> None:
+        tmp_dir = CACHE_DIR / "tmp"
+        tmp_dir.mkdir(parents=True, exist_ok=True)
+        self._file = tempfile.NamedTemporaryFile(dir=tmp_dir, suffix=".part", delete=False)
+        self._hash = hashlib.sha256()
+        self.size = 0
+
+    def write(self, chunk: bytes) -> int:
+        self._hash.update(chunk)
+        self.size += len(chunk)
+        return self._file.write(chunk)
+
+    def flush(self) -> None:
+        self._file.flush()
+
+    def tell(self) -> int:
+        return self._file.tell()
+
+    def seek(self, position: int) -> int:
+        return self._file.seek(position)
+
+    def read(self, size: int = -1) -> bytes:
+        return self._file.read(size)
+
+    def close(self) -> None:
+        if not self._file.closed:
+            self._file.close()
+
+    def discard(self) -> None:
+        self.close()
+        Path(self._file.name).unlink(missing_ok=True)
+
+    def commit(self, url: str, etag: Optional[str], last_modified: Optional[str]) -> CacheEntry:
+        self.close()
+        sha256 = self._hash.hexdigest()
+        target = _blob_path(sha256)
+        if target.exists():
+            Path(self._file.name).unlink(missing_ok=True)
+        else:
+            target.parent.mkdir(parents=True, exist_ok=True)
+            os.replace(self._file.name, target)
+
+        now = time.time()
+        _conn().execute(
+            "INSERT INTO boletos (url, sha256, size, etag, last_modified, stored_at, last_access) "
+            "VALUES (?, ?, ?, ?, ?, ?, ?) "
+            "ON CONFLICT(url) DO UPDATE SET sha256 = excluded.sha256, size = excluded.size, "
+            "etag = excluded.etag, last_modified = excluded.last_modified, "
+            "stored_at = excluded.stored_at, last_access = excluded.last_access",
+            (url, sha256, self.size, etag, last_modified, now, now),
+        )
+        _count("stored")
+        evict()
+        return CacheEntry(url, sha256, self.size, etag, last_modified, now)
+
+
+def lookup(url: str) -> Optional[CacheEntry]:
+    """
+    Retorna a entrada do cache para o link de pagamento, se o arquivo ainda
+    existir em disco.
+    """
+
+    row = _conn().execute(
+        "SELECT url, sha256, size, etag, last_modified, stored_at FROM boletos WHERE url = ?",
+        (url,),
+    ).fetchone()
+    if row is None:
+        _count("misses")
+        return None
+
+    entry = CacheEntry(*row)
+    if not entry.path.exists():
+        _conn().execute("DELETE FROM boletos WHERE url = ?", (url,))
+        _count("misses")
+        return None
+
+    return entry
+
+
+def hit(entry: CacheEntry) -> CachedPdf:
+    _conn().execute("UPDATE boletos SET last_access = ? WHERE url = ?", (time.time(), entry.url))
+    _count("hits")
+    return CachedPdf(entry)
+
+
+def revalidated(entry: CacheEntry) -> CachedPdf:
+    """
+    A WBuy respondeu 304: renova o prazo de frescor e serve do disco.
+    """
+
+    now = time.time()
+    _conn().execute(
+        "UPDATE boletos SET stored_at = ?, last_access = ? WHERE url = ?",
+        (now, now, entry.url),
+    )
+    _count("revalidated")
+    return CachedPdf(entry._replace(stored_at=now))
+
+
+def evict(max_bytes: Optional[int] = None) -> int:
+    """
+    Remove as entradas menos usadas até o cache caber em
+    WBUY_BOLETO_CACHE_MAX_BYTES (padrão 200 MB). Blobs compartilhados por
+    outro link só saem quando nenhum link aponta mais para eles.
+    """
+
+    limit = max_bytes if max_bytes is not None else int(
+        _env_float("WBUY_BOLETO_CACHE_MAX_BYTES", 200 * 1024 * 1024)
+    )
+    connection = _conn()
+    total = connection.execute(
+        "SELECT COALESCE(SUM(size), 0) FROM (SELECT DISTINCT sha256, size FROM boletos)"
+    ).fetchone()[0]
+
+    removed = 0
+    if total <= limit:
+        return removed
+
+    rows = connection.execute(
+        "SELECT url, sha256, size FROM boletos ORDER BY last_access"
+    ).fetchall()
+    for url, sha256, size in rows:
+        if total <= limit:
+            break
+        connection.execute("DELETE FROM boletos WHERE url = ?", (url,))
+        still_used = connection.execute(
+            "SELECT 1 FROM boletos WHERE sha256 = ? LIMIT 1", (sha256,)
+        ).fetchone()
+        if still_used is None:
+            _blob_path(sha256).unlink(missing_ok=True)
+            total -= size
+        removed += 1
+        _count("evicted")
+
+    return removed
+
+
+def stats() -> Dict[str, int]:
+    with _stats_lock:
+        return dict(_stats)
@@ -0,0 +1,356 @@
+import os
+import threading
+import time
+from collections import deque
+from contextlib import asynccontextmanager, contextmanager
+from typing import Any, AsyncIterator, Callable, Deque, Dict, Iterator, Optional, Tuple
+
+from . import tenants
+
+CLOSED = "closed"
+OPEN = "open"
+HALF_OPEN = "half_open"
+
+# Motivos de falha que estacionam a entrega em vez de gastar uma tentativa.
+PARK_REASONS = ("circuit_open", "upstream_saturated")
+
+
+def _env_float(name: str, default: float) -> float:
+    try:
+        return float(os.getenv(name, default))
+    except (TypeError, ValueError):
+        return default
+
+
+def is_upstream_failure(status_code: Optional[int]) -> bool:
+    """
+    429 e 5xx indicam Whaticket sobrecarregado ou fora; outros 4xx são erro
+    do pedido e não abrem o circuito.
+    """
+
+    return status_code is not None and (status_code == 429 or status_code >= 500)
+
+
+class BreakerOpen(Exception):
+    """
+    O envio não foi tentado: circuito aberto (circuit_open) ou limite de
+    concorrência esgotado por tempo demais (upstream_saturated).
+    """
+
+    def __init__(self, reason: str, retry_after: float) -> None:
+        super().__init__(reason)
+        self.reason = reason
+        self.retry_after = retry_after
+
+    def as_result(self) -> Dict[str, Any]:
+        return {"status": "error", "reason": self.reason, "retry_after": round(self.retry_after, 3)}
+
+
+class _Call:
+    __slots__ = ("failed",)
+
+    def __init__(self) -> None:
+        self.failed = False
+
+
+class CircuitBreaker:
+    """
+    Circuit breaker com limite de concorrência adaptativo para o Whaticket.
+
+    Fechado: guarda o resultado das últimas ``window`` chamadas e abre quando,
+    com pelo menos ``min_calls``, a taxa de falhas passa de ``failure_rate``
+    ou a de chamadas lentas (> ``slow_seconds``) passa de ``slow_rate``.
+    Aberto: recusa envios por ``open_seconds`` (dobrando a cada reabertura,
+    até ``max_open_seconds``). Meio-aberto: deixa passar ``probes`` chamadas
+    de teste; se todas derem certo o circuito fecha, senão reabre.
+
+    O número de envios simultâneos segue AIMD: cresce 1/limite a cada
+    sucesso rápido e cai pela metade (no máximo uma vez por segundo) em
+    falhas ou lentidão, entre ``min_limit`` e ``max_limit``.
+    """
+
+    def __init__(
+        self,
+        failure_rate: Optional[float] = None,
+        slow_rate: Optional[float] = None,
+        slow_seconds: Optional[float] = None,
+        window: Optional[int] = None,
+        min_calls: Optional[int] = None,
+        open_seconds: Optional[float] = None,
+        max_open_seconds: Optional[float] = None,
+        probes: Optional[int] = None,
+        min_limit: Optional[int] = None,
+        max_limit: Optional[int] = None,
+        clock: Callable[[], float] = time.monotonic,
+    ) -> None:
+        def pick(value, name, default):
+            return value if value is not None else _env_float(name, default)
+
+        self.failure_rate = pick(failure_rate, "WHATICKET_BREAKER_FAILURE_RATE", 0.5)
+        self.slow_rate = pick(slow_rate, "WHATICKET_BREAKER_SLOW_RATE", 0.5)
+        self.slow_seconds = pick(slow_seconds, "WHATICKET_BREAKER_SLOW_SECONDS", 5.0)
+        self.window = int(pick(window, "WHATICKET_BREAKER_WINDOW", 20))
+        self.min_calls = int(pick(min_calls, "WHATICKET_BREAKER_MIN_CALLS", 10))
+        self.base_open_seconds = pick(open_seconds, "WHATICKET_BREAKER_OPEN_SECONDS", 30.0)
+        self.max_open_seconds = pick(max_open_seconds, "WHATICKET_BREAKER_MAX_OPEN_SECONDS", 300.0)
+        self.probes = max(int(pick(probes, "WHATICKET_BREAKER_PROBES", 1)), 1)
+        self.min_limit = max(int(pick(min_limit, "WHATICKET_MIN_CONCURRENCY", 1)), 1)
+        self.max_limit = max(int(pick(max_limit, "WHATICKET_MAX_CONCURRENCY", 32)), self.min_limit)
+        self._clock = clock
+
+        self._cond = threading.Condition()
+        self._state = CLOSED
+        self._calls: Deque[Tuple[bool, bool]] = deque(maxlen=max(self.window, 1))
+        self._open_seconds = self.base_open_seconds
+        self._opened_at = 0.0
+        self._probing = 0
+        self._probe_successes = 0
+        self._limit = float(self.max_limit)
+        self._inflight = 0
+        self._last_decrease = float("-inf")
+        self._trips = 0
+        self._rejected = 0
+
+    def _refresh(self, now: float) -> None:
+        if self._state == OPEN and now - self._opened_at >= self._open_seconds:
+            self._state = HALF_OPEN
+            self._probing = 0
+            self._probe_successes = 0
+
+    def _trip(self, now: float) -> None:
+        if self._state == HALF_OPEN:
+            self._open_seconds = min(self._open_seconds * 2, self.max_open_seconds)
+        else:
+            self._open_seconds = self.base_open_seconds
+        self._state = OPEN
+        self._opened_at = now
+        self._calls.clear()
+        self._trips += 1
+
+    def retry_after(self) -> float:
+        """
+        Segundos até o circuito aceitar uma chamada de teste; 0 se aceita agora.
+        """
+
+        with self._cond:
+            now = self._clock()
+            self._refresh(now)
+            if self._state == OPEN:
+                return max(self._opened_at + self._open_seconds - now, 0.0)
+            return 0.0
+
+    def try_acquire(self) -> float:
+        """
+        Reserva uma vaga de envio e retorna 0, ou retorna quantos segundos
+        esperar pelo limite de concorrência. Levanta BreakerOpen com o
+        circuito aberto ou com as chamadas de teste já em andamento.
+        """
+
+        with self._cond:
+            now = self._clock()
+            self._refresh(now)
+            if self._state == OPEN:
+                self._rejected += 1
+                raise BreakerOpen(
+                    "circuit_open", max(self._opened_at + self._open_seconds - now, 0.0)
+                )
+            if self._state == HALF_OPEN:
+                if self._probing >= self.probes:
+                    self._rejected += 1
+                    raise BreakerOpen("circuit_open", min(self.base_open_seconds, 1.0))
+                self._probing += 1
+            elif self._inflight >= int(self._limit):
+                return 0.05
+            self._inflight += 1
+            return 0.0
+
+    def acquire(self, timeout: Optional[float] = None) -> None:
+        """
+        Versão bloqueante para as threads de envio: espera a vaga por até
+        ``timeout`` (WHATICKET_BREAKER_WAIT_SECONDS) e então desiste com
+        upstream_saturated.
+        """
+
+        timeout = timeout if timeout is not None else _env_float("WHATICKET_BREAKER_WAIT_SECONDS", 10.0)
+        deadline = self._clock() + timeout
+        while True:
+            wait = self.try_acquire()
+            if wait <= 0:
+                return
+            remaining = deadline - self._clock()
+            if remaining <= 0:
+                with self._cond:
+                    self._rejected += 1
+                raise BreakerOpen("upstream_saturated", min(self.base_open_seconds, 5.0))
+            with self._cond:
+                self._cond.wait(min(wait, remaining))
+
+    def release(self, failed: bool, elapsed: float) -> None:
+        slow = elapsed > self.slow_seconds
+        with self._cond:
+            now = self._clock()
+            self._inflight = max(self._inflight - 1, 0)
+
+            if failed or slow:
+                if now - self._last_decrease >= 1.0:
+                    self._limit = max(self.min_limit, self._limit / 2)
+                    self._last_decrease = now
+            else:
+                self._limit = min(self.max_limit, self._limit + 1 / self._limit)
+
+            if self._state == HALF_OPEN:
+                self._probing = max(self._probing - 1, 0)
+                if failed or slow:
+                    self._trip(now)
+                else:
+                    self._probe_successes += 1
+                    if self._probe_successes >= self.probes:
+                        self._state = CLOSED
+                        self._open_seconds = self.base_open_seconds
+                        self._calls.clear()
+            elif self._state == CLOSED:
+                self._calls.append((failed, slow))
+                if len(self._calls) >= self.min_calls:
+                    total = len(self._calls)
+                    failures = sum(1 for call_failed, _ in self._calls if call_failed)
+                    slows = sum(1 for _, call_slow in self._calls if call_slow)
+                    if failures / total >= self.failure_rate or slows / total >= self.slow_rate:
+                        self._trip(now)
+            self._cond.notify()
+
+    @contextmanager
+    def guard(self, timeout: Optional[float] = None) -> Iterator[_Call]:
+        """
+        Envolve um envio síncrono. Marque ``call.failed`` para respostas
+        429/5xx; exceções contam como falha.
+        """
+
+        self.acquire(timeout)
+        call = _Call()
+        started = self._clock()
+        try:
+            yield call
+        except Exception:
+            call.failed = True
+            raise
+        finally:
+            self.release(call.failed, self._clock() - started)
+
+    @asynccontextmanager
+    async def async_guard(self) -> AsyncIterator[_Call]:
+        """
+        Igual a guard, para o DeliveryEngine: espera a vaga sem bloquear o
+        event loop.
+        """
+
+        import asyncio
+
+        while True:
+            wait = self.try_acquire()
+            if wait <= 0:
+                break
+            await asyncio.sleep(wait)
+        call = _Call()
+        started = self._clock()
+        try:
+            yield call
+        except Exception:
+            call.failed = True
+            raise
+        finally:
+            self.release(call.failed, self._clock() - started)
+
+    @property
+    def state(self) -> str:
+        with self._cond:
+            self._refresh(self._clock())
+            return self._state
+
+    def stats(self) -> Dict[str, Any]:
+        with self._cond:
+            now = self._clock()
+            self._refresh(now)
+            total = len(self._calls)
+            failures = sum(1 for failed, _ in self._calls if failed)
+            slows = sum(1 for _, slow in self._calls if slow)
+            return {
+                "state": self._state,
+                "failure_rate": round(failures / total, 3) if total else 0.0,
+                "slow_rate": round(slows / total, 3) if total else 0.0,
+                "window_calls": total,
+                "concurrency_limit": round(self._limit, 2),
+                "inflight": self._inflight,
+                "retry_after": round(
+                    max(self._opened_at + self._open_seconds - now, 0.0), 3
+                )
+                if self._state == OPEN
+                else 0.0,
+                "trips": self._trips,
+                "rejected": self._rejected,
+            }
+
+
+_breakers: Dict[str, CircuitBreaker] = {}
+_breakers_pid: Optional[int] = None
+_lock = threading.Lock()
+
+
+def enabled() -> bool:
+    return os.getenv("WHATICKET_BREAKER", "1").strip().lower() not in ("0", "false", "no")
+
+
+def get_breaker(tenant: Optional[str] = None) -> CircuitBreaker:
+    """
+    Breaker do tenant (padrão: o em atendimento) neste processo, recriado
+    após fork. Cada worker do gunicorn observa o Whaticket por conta própria
+    e cada conta do Whaticket tem o seu: uma conta lenta não abre o
+    circuito das outras.
+    """
+
+    global _breakers_pid
+
+    name = tenants.current() if tenant is None else tenant
+    pid = os.getpid()
+    breaker = _breakers.get(name) if _breakers_pid == pid else None
+    if breaker is None:
+        with _lock:
+            if _breakers_pid != pid:
+                _breakers.clear()
+                _breakers_pid = pid
+            breaker = _breakers.get(name)
+            if breaker is None:
+                breaker = _breakers[name] = CircuitBreaker()
+    return breaker
+
+
+def stats(tenant: Optional[str] = None) -> Dict[str, Any]:
+    if not enabled():
+        return {"state": "disabled"}
+    return get_breaker(tenant).stats()
+
+
+@contextmanager
+def guard() -> Iterator[_Call]:
+    """
+    Guard do breaker do processo para um envio síncrono; com
+    WHATICKET_BREAKER=0 só devolve a marcação, sem limitar nada.
+    """
+
+    if not enabled():
+        yield _Call()
+        return
+    with get_breaker().guard() as call:
+        yield call
+
+
+@asynccontextmanager
+async def async_guard() -> AsyncIterator[_Call]:
+    if not enabled():
+        yield _Call()
+        return
+    async with get_breaker().async_guard() as call:
+        yield call
+
+
+def retry_after() -> float:
+    return get_breaker().retry_after() if enabled() else 0.0
@@ -0,0 +1,64 @@
+import os
+import sqlite3
+import threading
+from pathlib import Path
+from typing import Callable, Dict, Optional, Tuple, Union
+
+
+_local = threading.local()
+
+
+def connect(
+    path: Union[str, Path],
+    schema: Optional[str] = None,
+    migrate: Optional[Callable[[sqlite3.Connection], None]] = None,
+) -> sqlite3.Connection:
+    """
+    Retorna uma conexão SQLite reaproveitada por thread e por processo.
+
+    Os bancos ficam no volume storage/ e são compartilhados entre os workers
+    do gunicorn, por isso usamos WAL e busy_timeout para que leitores não
+    bloqueiem escritores. O ``schema`` (DDL idempotente) roda apenas na
+    primeira abertura da conexão, seguido de ``migrate`` (ajustes em bancos
+    criados por versões anteriores).
+    """
+
+    key: Tuple[int, str] = (os.getpid(), str(path))
+    connections: Dict[Tuple[int, str], sqlite3.Connection] = getattr(
+        _local, "connections", None
+    )
+    if connections is None:
+        connections = _local.connections = {}
+
+    connection = connections.get(key)
+    if connection is not None:
+        return connection
+
+    Path(path).parent.mkdir(parents=True, exist_ok=True)
+    connection = sqlite3.connect(str(path), timeout=30, isolation_level=None)
+    connection.row_factory = sqlite3.Row
+    connection.execute("PRAGMA journal_mode=WAL")
+    connection.execute("PRAGMA synchronous=NORMAL")
+    connection.execute("PRAGMA busy_timeout=30000")
+    if schema:
+        connection.executescript(schema)
+    if migrate:
+        migrate(connection)
+    connections[key] = connection
+    return connection
+
+
+def add_column(connection: sqlite3.Connection, table: str, column: str, ddl: str) -> None:
+    """
+    Acrescenta a coluna à tabela se ela ainda não existir.
+    """
+
+    columns = {row["name"] for row in connection.execute(f"PRAGMA table_info({table})")}
+    if column in columns:
+        return
+    try:
+        connection.execute(f"ALTER TABLE {table} ADD COLUMN {column} {ddl}")
+    except sqlite3.OperationalError as exc:
+        # Outro worker pode ter migrado o banco entre a consulta e o ALTER.
+        if "duplicate column" not in str(exc):
+            raise
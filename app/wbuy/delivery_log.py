@@ -0,0 +1,349 @@
+import json
+import os
+import threading
+import time
+from typing import Any, Dict, List, NamedTuple, Optional, Set
+
+from . import db
+from .storage import BASE_DIR
+
+DELIVERY_DB = BASE_DIR / "storage" / "delivery.db"
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS deliveries (
+    order_id TEXT PRIMARY KEY,
+    phone TEXT NOT NULL,
+    status TEXT NOT NULL DEFAULT 'running',
+    attempts INTEGER NOT NULL DEFAULT 0,
+    next_attempt_at REAL,
+    last_error TEXT,
+    created_at REAL NOT NULL,
+    updated_at REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS deliveries_status_idx ON deliveries (status, updated_at);
+CREATE TABLE IF NOT EXISTS delivery_steps (
+    order_id TEXT NOT NULL,
+    position INTEGER NOT NULL,
+    step TEXT NOT NULL,
+    status TEXT NOT NULL DEFAULT 'pending',
+    attempts INTEGER NOT NULL DEFAULT 0,
+    last_error TEXT,
+    updated_at REAL NOT NULL,
+    PRIMARY KEY (order_id, position)
+);
+"""
+
+# Estados da entrega: running (em envio), retry (aguardando nova tentativa),
+# done (todos os passos enviados) e dead (esgotou as tentativas).
+# Estados de cada passo: pending, sending, sent e failed.
+
+
+def _env_int(name: str, default: int) -> int:
+    try:
+        return int(os.getenv(name, default))
+    except (TypeError, ValueError):
+        return default
+
+
+def _env_float(name: str, default: float) -> float:
+    try:
+        return float(os.getenv(name, default))
+    except (TypeError, ValueError):
+        return default
+
+
+def _conn():
+    return db.connect(DELIVERY_DB, _SCHEMA)
+
+
+def is_failure(result: Any) -> bool:
+    """
+    True para os dicts de erro/skip devolvidos pelos envios ao Whaticket.
+    """
+
+    return isinstance(result, dict) and result.get("status") in ("error", "skipped")
+
+
+class Delivery(NamedTuple):
+    order_id: str
+    phone: str
+    status: str
+    attempts: int
+    steps: List[Dict[str, Any]]
+
+
+def start(order_id: str, phone: str, steps: List[Dict[str, Any]]) -> None:
+    """
+    Grava a sequência renderizada do pedido antes do primeiro envio. As
+    retomadas usam exatamente estes passos, mesmo que o template mude.
+    """
+
+    now = time.time()
+    connection = _conn()
+    with connection:
+        connection.execute("BEGIN IMMEDIATE")
+        connection.execute("DELETE FROM delivery_steps WHERE order_id = ?", (order_id,))
+        connection.execute(
+            "INSERT OR REPLACE INTO deliveries "
+            "(order_id, phone, status, attempts, created_at, updated_at) "
+            "VALUES (?, ?, 'running', 0, ?, ?)",
+            (order_id, phone, now, now),
+        )
+        connection.executemany(
+            "INSERT INTO delivery_steps (order_id, position, step, updated_at) VALUES (?, ?, ?, ?)",
+            [
+                (order_id, position, json.dumps(step, ensure_ascii=False), now)
+                for position, step in enumerate(steps)
+            ],
+        )
+
+
+def load(order_id: str) -> Optional[Delivery]:
+    """
+    Entrega do pedido com os passos ainda não enviados (cada um com a chave
+    "position"), na ordem original.
+    """
+
+    connection = _conn()
+    row = connection.execute(
+        "SELECT order_id, phone, status, attempts FROM deliveries WHERE order_id = ?",
+        (order_id,),
+    ).fetchone()
+    if row is None:
+        return None
+
+    steps = []
+    for position, step, status in connection.execute(
+        "SELECT position, step, status FROM delivery_steps WHERE order_id = ? ORDER BY position",
+        (order_id,),
+    ):
+        if status != "sent":
+            steps.append({**json.loads(step), "position": position})
+    return Delivery(row["order_id"], row["phone"], row["status"], row["attempts"], steps)
+
+
+def step_started(order_id: str, position: int) -> None:
+    now = time.time()
+    connection = _conn()
+    connection.execute(
+        "UPDATE delivery_steps SET status = 'sending', attempts = attempts + 1, updated_at = ? "
+        "WHERE order_id = ? AND position = ?",
+        (now, order_id, position),
+    )
+    connection.execute(
+        "UPDATE deliveries SET updated_at = ? WHERE order_id = ?", (now, order_id)
+    )
+
+
+def step_finished(order_id: str, position: int, error: Optional[str] = None) -> None:
+    _conn().execute(
+        "UPDATE delivery_steps SET status = ?, last_error = ?, updated_at = ? "
+        "WHERE order_id = ? AND position = ?",
+        ("failed" if error else "sent", error, time.time(), order_id, position),
+    )
+
+
+class StepTracker:
+    """
+    Registra o início e o fim de cada passo de uma entrega; usado tanto pelo
+    scheduler com threads quanto pelo DeliveryEngine.
+    """
+
+    __slots__ = ("order_id",)
+
+    def __init__(self, order_id: str) -> None:
+        self.order_id = order_id
+
+    def start(self, step: Dict[str, Any]) -> None:
+        step_started(self.order_id, step["position"])
+
+    def finish(
+        self,
+        step: Dict[str, Any],
+        result: Any = None,
+        error: Optional[BaseException] = None,
+    ) -> None:
+        message = None
+        if error is not None:
+            message = repr(error)
+        elif is_failure(result):
+            message = json.dumps(result, ensure_ascii=False, default=str)
+        step_finished(self.order_id, step["position"], message)
+
+
+def complete(order_id: str) -> None:
+    _conn().execute(
+        "UPDATE deliveries SET status = 'done', next_attempt_at = NULL, last_error = NULL, "
+        "updated_at = ? WHERE order_id = ?",
+        (time.time(), order_id),
+    )
+
+
+def fail(order_id: str, error: str) -> Optional[float]:
+    """
+    Registra a falha da tentativa. Retorna em quantos segundos a próxima
+    tentativa deve acontecer (backoff exponencial a partir de
+    WBUY_DELIVERY_RETRY_BACKOFF) ou None quando a entrega excedeu
+    WBUY_DELIVERY_MAX_ATTEMPTS e foi para a lista de dead letters.
+    """
+
+    connection = _conn()
+    row = connection.execute(
+        "UPDATE deliveries SET attempts = attempts + 1, last_error = ?, updated_at = ? "
+        "WHERE order_id = ? RETURNING attempts",
+        (error, time.time(), order_id),
+    ).fetchone()
+    attempts = row[0] if row is not None else 1
+
+    if attempts >= _env_int("WBUY_DELIVERY_MAX_ATTEMPTS", 5):
+        connection.execute(
+            "UPDATE deliveries SET status = 'dead', next_attempt_at = NULL WHERE order_id = ?",
+            (order_id,),
+        )
+        return None
+
+    delay = _env_float("WBUY_DELIVERY_RETRY_BACKOFF", 30.0) * (2 ** (attempts - 1))
+    connection.execute(
+        "UPDATE deliveries SET status = 'retry', next_attempt_at = ? WHERE order_id = ?",
+        (time.time() + delay, order_id),
+    )
+    return delay
+
+
+def park(order_id: str, delay: float, error: str) -> None:
+    """
+    Estaciona a entrega em 'retry' por ``delay`` segundos sem gastar uma
+    tentativa (circuito do Whaticket aberto: o envio nem foi feito).
+    """
+
+    now = time.time()
+    _conn().execute(
+        "UPDATE deliveries SET status = 'retry', next_attempt_at = ?, last_error = ?, "
+        "updated_at = ? WHERE order_id = ?",
+        (now + delay, error, now, order_id),
+    )
+
+
+def begin_retry(order_id: str) -> bool:
+    """
+    Passa a entrega de 'retry' para 'running'. Só um worker consegue.
+    """
+
+    cursor = _conn().execute(
+        "UPDATE deliveries SET status = 'running', updated_at = ? "
+        "WHERE order_id = ? AND status = 'retry'",
+        (time.time(), order_id),
+    )
+    return cursor.rowcount == 1
+
+
+# Entregas submetidas por este processo e ainda não resolvidas (inclusive
+# as que esperam a vez no scheduler): heartbeat() mantém o updated_at delas
+# em dia para que recover_stale não as retome em dobro.
+_held: Set[str] = set()
+_held_lock = threading.Lock()
+
+
+def hold(order_id: str) -> None:
+    with _held_lock:
+        _held.add(order_id)
+    _conn().execute(
+        "UPDATE deliveries SET updated_at = ? WHERE order_id = ?", (time.time(), order_id)
+    )
+
+
+def drop(order_id: str) -> None:
+    with _held_lock:
+        _held.discard(order_id)
+
+
+def heartbeat() -> int:
+    """
+    Renova o updated_at das entregas em andamento neste processo. Retorna
+    quantas foram renovadas.
+    """
+
+    with _held_lock:
+        held = list(_held)
+    if not held:
+        return 0
+
+    now = time.time()
+    _conn().executemany(
+        "UPDATE deliveries SET updated_at = ? WHERE order_id = ? AND status = 'running'",
+        [(now, order_id) for order_id in held],
+    )
+    return len(held)
+
+
+def recover_stale(order_id: str) -> bool:
+    """
+    Retoma uma entrega presa em 'running' sem atividade há mais de
+    WBUY_QUEUE_LEASE_SECONDS (worker morto no meio da sequência). Enquanto
+    o dono estiver vivo, heartbeat() mantém a entrega fora deste caso.
+    """
+
+    now = time.time()
+    cursor = _conn().execute(
+        "UPDATE deliveries SET updated_at = ? "
+        "WHERE order_id = ? AND status = 'running' AND updated_at < ?",
+        (now, order_id, now - _env_float("WBUY_QUEUE_LEASE_SECONDS", 300)),
+    )
+    return cursor.rowcount == 1
+
+
+def dead_letters(limit: int = 100) -> List[Dict[str, Any]]:
+    rows = _conn().execute(
+        "SELECT order_id, phone, attempts, last_error, updated_at FROM deliveries "
+        "WHERE status = 'dead' ORDER BY updated_at DESC LIMIT ?",
+        (limit,),
+    )
+    return [dict(row) for row in rows]
+
+
+def revive(order_id: str) -> bool:
+    """
+    Tira a entrega da lista de dead letters para uma nova rodada de
+    tentativas; quem chama deve enfileirar a retomada.
+    """
+
+    cursor = _conn().execute(
+        "UPDATE deliveries SET status = 'retry', attempts = 0, next_attempt_at = ?, "
+        "updated_at = ? WHERE order_id = ? AND status = 'dead'",
+        (time.time(), time.time(), order_id),
+    )
+    return cursor.rowcount == 1
+
+
+def prune(ttl_seconds: Optional[float] = None) -> int:
+    """
+    Remove as entregas concluídas ('done') ou mortas ('dead') sem atividade
+    há mais de ttl_seconds (ou WBUY_DELIVERY_TTL_DAYS, padrão 30), junto com
+    seus passos: telefone e mensagens dos clientes não ficam para sempre.
+    Com TTL zero, nada é removido. Retorna quantas entregas saíram.
+    """
+
+    if ttl_seconds is None:
+        ttl_seconds = _env_float("WBUY_DELIVERY_TTL_DAYS", 30) * 86400
+    if ttl_seconds <= 0:
+        return 0
+
+    connection = _conn()
+    with connection:
+        connection.execute("BEGIN IMMEDIATE")
+        removed = connection.execute(
+            "DELETE FROM deliveries WHERE status IN ('done', 'dead') AND updated_at < ? "
+            "RETURNING order_id",
+            (time.time() - ttl_seconds,),
+        ).fetchall()
+        connection.executemany(
+            "DELETE FROM delivery_steps WHERE order_id = ?", [(row[0],) for row in removed]
+        )
+    return len(removed)
+
+
+def counts() -> Dict[str, int]:
+    totals = {"running": 0, "retry": 0, "done": 0, "dead": 0}
+    for row in _conn().execute("SELECT status, COUNT(*) FROM deliveries GROUP BY status"):
+        totals[row[0]] = row[1]
+    return totals
@@ -0,0 +1,216 @@
+import os
+import threading
+import time
+from typing import TYPE_CHECKING, Any, Dict, Optional, Tuple
+
+from . import tenants
+
+if TYPE_CHECKING:
+    import requests
+
+RETRY_STATUS_CODES = (429, 500, 502, 503, 504)
+# Em POST, só respostas que garantem que o Whaticket não aceitou a mensagem.
+# Um 500/502/504 pode vir depois do envio; esses ficam para a retomada do
+# delivery_log, que sabe qual passo já saiu.
+POST_RETRY_STATUS_CODES = (429, 503)
+
+_lock = threading.Lock()
+_session: Optional["requests.Session"] = None
+_session_pid: Optional[int] = None
+_streaming_session: Optional["requests.Session"] = None
+# Sessões dos tenants do arquivo de tenants, cada uma com o próprio pool.
+_tenant_sessions: Dict[str, "requests.Session"] = {}
+_stats = {"requests": 0, "errors": 0, "seconds_total": 0.0}
+
+
+def _env_int(name: str, default: int) -> int:
+    try:
+        return int(os.getenv(name, default))
+    except (TypeError, ValueError):
+        return default
+
+
+def _env_float(name: str, default: float) -> float:
+    try:
+        return float(os.getenv(name, default))
+    except (TypeError, ValueError):
+        return default
+
+
+def timeout() -> Tuple[float, float]:
+    """
+    Timeouts separados de conexão e leitura (WHATICKET_CONNECT_TIMEOUT e
+    WHATICKET_READ_TIMEOUT), no formato aceito pelo requests.
+    """
+
+    return (
+        _env_float("WHATICKET_CONNECT_TIMEOUT", 5.0),
+        _env_float("WHATICKET_READ_TIMEOUT", 30.0),
+    )
+
+
+def _build_session(
+    retries: bool = True, pool_size: Optional[int] = None
+) -> "requests.Session":
+    # requests/urllib3 só entram na memória no primeiro envio (ou no preload
+    # do gunicorn, ver preload()).
+    import requests
+    from requests.adapters import HTTPAdapter
+    from urllib3.util.retry import Retry
+
+    class _Retry(Retry):
+        def is_retry(self, method: str, status_code: int, has_retry_after: bool = False) -> bool:
+            if method.upper() == "POST" and status_code not in POST_RETRY_STATUS_CODES:
+                return False
+            return super().is_retry(method, status_code, has_retry_after)
+
+    retry = Retry(0, read=False)
+    if retries:
+        retry = _Retry(
+            total=_env_int("WHATICKET_MAX_RETRIES", 3),
+            # Falha de conexão: a requisição nem chegou ao Whaticket.
+            connect=_env_int("WHATICKET_MAX_RETRIES", 3),
+            read=0,
+            status_forcelist=RETRY_STATUS_CODES,
+            backoff_factor=_env_float("WHATICKET_RETRY_BACKOFF", 0.5),
+            # Inclui POST, limitado a POST_RETRY_STATUS_CODES (ver _Retry).
+            allowed_methods=None,
+            respect_retry_after_header=True,
+            raise_on_status=False,
+        )
+    adapter = HTTPAdapter(
+        pool_connections=_env_int("WHATICKET_POOL_CONNECTIONS", 4),
+        pool_maxsize=pool_size or _env_int("WHATICKET_POOL_SIZE", 10),
+        max_retries=retry,
+    )
+
+    session = requests.Session()
+    session.headers["Connection"] = "keep-alive"
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    return session
+
+
+def get_session() -> "requests.Session":
+    """
+    Retorna a sessão HTTP compartilhada do processo (keep-alive + pool).
+
+    A sessão é recriada após um fork para que workers do gunicorn não
+    compartilhem sockets herdados do processo pai. Cada tenant em
+    atendimento tem sessão e pool próprios (pool_size no arquivo de
+    tenants): uma conta do Whaticket lenta não ocupa as conexões das outras.
+    """
+
+    global _session, _session_pid, _streaming_session
+
+    pid = os.getpid()
+    if _session is None or _session_pid != pid:
+        with _lock:
+            if _session is None or _session_pid != pid:
+                _session = _build_session()
+                _streaming_session = None
+                _tenant_sessions.clear()
+                _session_pid = pid
+                _stats.update(requests=0, errors=0, seconds_total=0.0)
+
+    name = tenants.current()
+    if not name:
+        return _session
+
+    session = _tenant_sessions.get(name)
+    if session is None:
+        with _lock:
+            session = _tenant_sessions.get(name)
+            if session is None:
+                tenant = tenants.get(name)
+                session = _tenant_sessions[name] = _build_session(
+                    pool_size=tenant.pool_size if tenant is not None else None
+                )
+    return session
+
+
+def _get_streaming_session() -> "requests.Session":
+    """
+    Sessão sem retry automático, para corpos enviados por gerador: o urllib3
+    não consegue rebobinar um gerador já consumido.
+    """
+
+    global _streaming_session
+
+    get_session()
+    if _streaming_session is None:
+        with _lock:
+            if _streaming_session is None:
+                _streaming_session = _build_session(retries=False)
+    return _streaming_session
+
+
+def request(method: str, url: str, retry: bool = True, **kwargs: Any) -> "requests.Response":
+    """
+    Executa a chamada pela sessão compartilhada aplicando o timeout padrão e
+    acumulando latência para connection_stats(). Com retry=False usa a
+    sessão sem retentativas (uploads em streaming).
+    """
+
+    import requests
+
+    kwargs.setdefault("timeout", timeout())
+    session = get_session() if retry else _get_streaming_session()
+    started = time.perf_counter()
+    try:
+        response = session.request(method, url, **kwargs)
+    except requests.RequestException:
+        _stats["errors"] += 1
+        raise
+    finally:
+        _stats["requests"] += 1
+        _stats["seconds_total"] += time.perf_counter() - started
+    return response
+
+
+def preload() -> None:
+    """
+    Importa o requests antes do fork para que os workers dividam essas
+    páginas com o processo pai (copy-on-write).
+    """
+
+    import requests  # noqa: F401
+
+
+def connection_stats() -> Dict[str, Any]:
+    """
+    Métricas de reaproveitamento de conexões do processo atual.
+
+    ``connections`` conta sockets abertos pelo urllib3; ``reused`` é quanto
+    das requisições saiu por uma conexão keep-alive já existente.
+    """
+
+    connections = 0
+    pool_requests = 0
+
+    sessions = []
+    if _session_pid == os.getpid():
+        sessions = [_session, _streaming_session, *_tenant_sessions.values()]
+    adapters = {
+        id(adapter): adapter
+        for session in sessions
+        if session is not None
+        for adapter in session.adapters.values()
+    }
+    for adapter in adapters.values():
+        pools = adapter.poolmanager.pools
+        for key in list(pools.keys()):
+            pool = pools.get(key)
+            if pool is None:
+                continue
+            connections += pool.num_connections
+            pool_requests += pool.num_requests
+
+    total = _stats["requests"]
+    return {
+        "requests": total,
+        "errors": _stats["errors"],
+        "connections": connections,
+        "reused": max(pool_requests - connections, 0),
+        "avg_seconds": round(_stats["seconds_total"] / total, 6) if total else 0.0,
+    }
@@ -0,0 +1,458 @@
+import json
+import os
+import threading
+import time
+import traceback
+from concurrent.futures import Future
+from typing import Any, Callable, Dict, List, NamedTuple, Optional
+
+from . import db, log, metrics, priority, tenants
+from .storage import BASE_DIR
+
+QUEUE_DB = BASE_DIR / "storage" / "queue.db"
+
+logger = log.get_logger("queue")
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS jobs (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    payload TEXT NOT NULL,
+    status TEXT NOT NULL DEFAULT 'pending',
+    attempts INTEGER NOT NULL DEFAULT 0,
+    enqueued_at REAL NOT NULL,
+    available_at REAL NOT NULL,
+    claimed_at REAL,
+    heartbeat_at REAL,
+    last_error TEXT,
+    lane TEXT NOT NULL DEFAULT 'default',
+    priority INTEGER NOT NULL DEFAULT 0,
+    tenant TEXT NOT NULL DEFAULT ''
+);
+CREATE INDEX IF NOT EXISTS jobs_pending_idx ON jobs (status, available_at, id);
+"""
+
+
+def _migrate(connection) -> None:
+    # Filas criadas antes das classes de prioridade.
+    db.add_column(connection, "jobs", "lane", "TEXT NOT NULL DEFAULT 'default'")
+    db.add_column(connection, "jobs", "priority", "INTEGER NOT NULL DEFAULT 0")
+    # ... e antes dos tenants.
+    db.add_column(connection, "jobs", "tenant", "TEXT NOT NULL DEFAULT ''")
+    db.add_column(connection, "jobs", "heartbeat_at", "REAL")
+    connection.execute(
+        "CREATE INDEX IF NOT EXISTS jobs_priority_idx "
+        "ON jobs (status, priority, available_at, id)"
+    )
+
+
+class Job(NamedTuple):
+    id: int
+    payload: Dict[str, Any]
+    attempts: int
+    enqueued_at: float
+    lane: str = priority.DEFAULT
+    tenant: str = tenants.DEFAULT
+    # Identifica a reserva: complete/fail só valem para quem ainda é o dono.
+    claimed_at: float = 0.0
+
+
+def _env_int(name: str, default: int) -> int:
+    try:
+        return int(os.getenv(name, default))
+    except (TypeError, ValueError):
+        return default
+
+
+def _env_float(name: str, default: float) -> float:
+    try:
+        return float(os.getenv(name, default))
+    except (TypeError, ValueError):
+        return default
+
+
+def _conn():
+    return db.connect(QUEUE_DB, _SCHEMA, _migrate)
+
+
+_wakeup = threading.Condition()
+
+
+def enqueue(payload: Dict[str, Any], delay: float = 0.0) -> int:
+    """
+    Persiste o payload na fila durável (storage/queue.db) e retorna o id do job.
+
+    O job entra na classe de prioridade do pedido (priority.of_payload):
+    entre jobs disponíveis, os das classes mais urgentes saem primeiro. O
+    tenant (tenants.of_payload) fica em coluna própria para o limite por
+    tenant de run_next.
+    """
+
+    now = time.time()
+    lane = priority.of_payload(payload)
+    cursor = _conn().execute(
+        "INSERT INTO jobs (payload, enqueued_at, available_at, lane, priority, tenant) "
+        "VALUES (?, ?, ?, ?, ?, ?)",
+        (
+            json.dumps(payload, ensure_ascii=False),
+            now,
+            now + delay,
+            lane,
+            priority.rank(lane),
+            tenants.of_payload(payload),
+        ),
+    )
+
+    with _wakeup:
+        _wakeup.notify()
+
+    return cursor.lastrowid
+
+
+def depth() -> Dict[str, int]:
+    """
+    Retorna a quantidade de jobs por status (pending, running, failed).
+    """
+
+    counts = {"pending": 0, "running": 0, "failed": 0}
+    rows = _conn().execute("SELECT status, COUNT(*) AS total FROM jobs GROUP BY status")
+    for row in rows:
+        counts[row["status"]] = row["total"]
+    return counts
+
+
+def lease_seconds() -> float:
+    return _env_float("WBUY_QUEUE_LEASE_SECONDS", 300)
+
+
+def _requeue_stale(now: float) -> None:
+    _conn().execute(
+        "UPDATE jobs SET status = 'pending', claimed_at = NULL, heartbeat_at = NULL "
+        "WHERE status = 'running' AND COALESCE(heartbeat_at, claimed_at) < ?",
+        (now - lease_seconds(),),
+    )
+
+
+def claim_next(
+    lanes: Optional[List[str]] = None, skip_tenants: Optional[List[str]] = None
+) -> Optional[Job]:
+    """
+    Reserva atomicamente o próximo job disponível, inclusive entre processos:
+    o da classe mais urgente e, dentro dela, o mais antigo. Com ``lanes``,
+    só considera jobs dessas classes; jobs dos tenants em ``skip_tenants``
+    ficam para depois.
+
+    Jobs que ficaram em 'running' sem heartbeat além do lease (worker morto
+    no meio do processamento) voltam para a fila antes da reserva.
+    """
+
+    now = time.time()
+    _requeue_stale(now)
+
+    where = "status = 'pending' AND available_at <= ?"
+    params: List[Any] = [now, now]
+    if lanes is not None:
+        if not lanes:
+            return None
+        lane_filter = f"lane IN ({', '.join('?' * len(lanes))})"
+        params += lanes
+        if priority.DEFAULT in lanes:
+            # Classes que saíram de WBUY_PRIORITY_CLASSES contam como "default".
+            known = priority.classes()
+            lane_filter += f" OR lane NOT IN ({', '.join('?' * len(known))})"
+            params += known
+        where += f" AND ({lane_filter})"
+    if skip_tenants:
+        where += f" AND tenant NOT IN ({', '.join('?' * len(skip_tenants))})"
+        params += skip_tenants
+
+    row = _conn().execute(
+        "UPDATE jobs SET status = 'running', claimed_at = ?, heartbeat_at = ?, "
+        "attempts = attempts + 1 "
+        "WHERE id = ("
+        f"  SELECT id FROM jobs WHERE {where} "
+        "  ORDER BY priority, available_at, id LIMIT 1"
+        ") RETURNING id, payload, attempts, enqueued_at, available_at, lane, tenant, claimed_at",
+        [now, *params],
+    ).fetchone()
+
+    if row is None:
+        return None
+
+    metrics.observe(
+        "wbuy_queue_wait_seconds", max(now - row["available_at"], 0.0), priority=row["lane"]
+    )
+    return Job(
+        row["id"],
+        json.loads(row["payload"]),
+        row["attempts"],
+        row["enqueued_at"],
+        priority.class_of(row["lane"]),
+        row["tenant"],
+        row["claimed_at"],
+    )
+
+
+def complete(job: Job) -> None:
+    """
+    Remove o job concluído, se a reserva ainda for desta execução (um job
+    cujo lease venceu pode já estar com outro worker).
+    """
+
+    _conn().execute(
+        "DELETE FROM jobs WHERE id = ? AND claimed_at = ?", (job.id, job.claimed_at)
+    )
+
+
+def fail(job: Job, error: str) -> None:
+    """
+    Devolve o job para a fila com backoff exponencial ou o marca como 'failed'
+    quando excede WBUY_QUEUE_MAX_ATTEMPTS.
+    """
+
+    max_attempts = _env_int("WBUY_QUEUE_MAX_ATTEMPTS", 5)
+    if job.attempts >= max_attempts:
+        _conn().execute(
+            "UPDATE jobs SET status = 'failed', claimed_at = NULL, heartbeat_at = NULL, "
+            "last_error = ? WHERE id = ? AND claimed_at = ?",
+            (error, job.id, job.claimed_at),
+        )
+        return
+
+    backoff = _env_float("WBUY_QUEUE_RETRY_BACKOFF", 2.0) * (2 ** (job.attempts - 1))
+    _conn().execute(
+        "UPDATE jobs SET status = 'pending', claimed_at = NULL, heartbeat_at = NULL, "
+        "available_at = ?, last_error = ? WHERE id = ? AND claimed_at = ?",
+        (time.time() + backoff, error, job.id, job.claimed_at),
+    )
+
+
+# Jobs reservados por este processo e ainda não resolvidos (inclusive os
+# que esperam um Future no scheduler): heartbeat() renova o lease deles.
+_claimed: Dict[Any, Job] = {}
+_claimed_lock = threading.Lock()
+_heartbeat_hooks: List[Callable[[], Any]] = []
+
+
+def on_heartbeat(hook: Callable[[], Any]) -> Callable[[], Any]:
+    """
+    Registra uma função chamada a cada heartbeat(), para renovar outros
+    leases no mesmo ritmo dos jobs.
+    """
+
+    _heartbeat_hooks.append(hook)
+    return hook
+
+
+def heartbeat() -> int:
+    """
+    Renova o lease dos jobs em andamento neste processo, para que um envio
+    parado no scheduler (intervalo, rate limit) não volte à fila e rode em
+    dobro. Retorna quantos jobs foram renovados.
+    """
+
+    with _claimed_lock:
+        claimed = list(_claimed.values())
+    if claimed:
+        now = time.time()
+        _conn().executemany(
+            "UPDATE jobs SET heartbeat_at = ? "
+            "WHERE id = ? AND claimed_at = ? AND status = 'running'",
+            [(now, job.id, job.claimed_at) for job in claimed],
+        )
+
+    for hook in _heartbeat_hooks:
+        hook()
+    return len(claimed)
+
+
+# Vagas de jobs em andamento por classe (WBUY_QUEUE_MAX_INFLIGHT_<CLASSE>):
+# uma rajada de boletos não ocupa as vagas do PIX.
+_inflight = priority.Budgets(
+    "WBUY_QUEUE_MAX_INFLIGHT", _env_int("WBUY_QUEUE_MAX_INFLIGHT", 100)
+)
+
+
+def inflight() -> Dict[str, Dict[str, int]]:
+    """
+    Jobs em andamento neste processo e o limite de cada classe de prioridade.
+    """
+
+    return _inflight.stats()
+
+
+# Jobs em andamento por tenant neste processo.
+_tenant_inflight: Dict[str, int] = {}
+_tenant_lock = threading.Lock()
+
+
+def tenant_limit() -> int:
+    """
+    Máximo de jobs em andamento de um mesmo tenant neste processo
+    (WBUY_QUEUE_MAX_INFLIGHT_PER_TENANT; 0 = sem limite). Com arquivo de
+    tenants, o padrão é metade de WBUY_QUEUE_MAX_INFLIGHT: uma conta do
+    Whaticket lenta não ocupa todas as vagas da fila.
+    """
+
+    default = max(_env_int("WBUY_QUEUE_MAX_INFLIGHT", 100) // 2, 1) if tenants.names() else 0
+    return _env_int("WBUY_QUEUE_MAX_INFLIGHT_PER_TENANT", default)
+
+
+def _saturated_tenants() -> List[str]:
+    limit = tenant_limit()
+    if limit <= 0:
+        return []
+    with _tenant_lock:
+        return [name for name, used in _tenant_inflight.items() if used >= limit]
+
+
+def _track_tenant(name: str, delta: int) -> None:
+    with _tenant_lock:
+        used = _tenant_inflight.get(name, 0) + delta
+        if used > 0:
+            _tenant_inflight[name] = used
+        else:
+            _tenant_inflight.pop(name, None)
+    if delta < 0:
+        # Jobs do tenant que estavam de fora podem ser reservados agora.
+        with _wakeup:
+            _wakeup.notify()
+
+
+def _release(job: Job) -> None:
+    with _claimed_lock:
+        _claimed.pop((job.id, job.claimed_at), None)
+    _inflight.release(job.lane)
+    _track_tenant(job.tenant, -1)
+
+
+def _settle(job: Job, error: Optional[BaseException]) -> None:
+    if error is None:
+        complete(job)
+        return
+
+    logger.error(
+        "Erro ao processar job %s (tentativa %s): %r",
+        job.id,
+        job.attempts,
+        error,
+        extra={"job_id": job.id},
+    )
+    fail(job, "".join(traceback.format_exception(error, limit=5)))
+
+
+def run_next(handler: Callable[[Dict[str, Any]], Any]) -> bool:
+    """
+    Processa um único job com o handler informado. Retorna False se a fila
+    estava vazia.
+
+    Se o handler devolver um Future, o job só é concluído (ou devolvido à
+    fila) quando ele terminar; até WBUY_QUEUE_MAX_INFLIGHT jobs de cada
+    classe de prioridade podem ficar nesse estado ao mesmo tempo em cada
+    processo. Classes sem vaga não são reservadas, nem jobs de tenants que
+    já estão no limite (tenant_limit). Até o job ser resolvido, heartbeat()
+    renova o lease dele.
+    """
+
+    lanes = _inflight.reserve_any()
+    job = None
+    try:
+        job = claim_next(lanes, _saturated_tenants())
+        if job is not None:
+            _track_tenant(job.tenant, 1)
+            with _claimed_lock:
+                _claimed[job.id, job.claimed_at] = job
+    finally:
+        for lane in lanes:
+            if job is None or lane != job.lane:
+                _inflight.release(lane)
+
+    if job is None:
+        return False
+
+    try:
+        result = handler(job.payload)
+    except Exception as exc:
+        _release(job)
+        _settle(job, exc)
+        return True
+
+    if not isinstance(result, Future):
+        _release(job)
+        _settle(job, None)
+        return True
+
+    def _done(future: Future) -> None:
+        try:
+            _settle(job, future.exception())
+        finally:
+            _release(job)
+
+    result.add_done_callback(_done)
+    return True
+
+
+_workers: List[threading.Thread] = []
+_stop = threading.Event()
+
+
+def _heartbeat_loop() -> None:
+    # Três renovações por lease: uma falha isolada não deixa o job vencer.
+    while not _stop.wait(max(lease_seconds() / 3, 0.1)):
+        try:
+            heartbeat()
+        except Exception:
+            logger.exception("Erro ao renovar o lease dos jobs em andamento.")
+
+
+def _worker_loop(handler: Callable[[Dict[str, Any]], Any]) -> None:
+    poll_interval = _env_float("WBUY_QUEUE_POLL_INTERVAL", 1.0)
+
+    while not _stop.is_set():
+        try:
+            processed = run_next(handler)
+        except Exception:
+            logger.exception("Erro inesperado no worker da fila.")
+            processed = False
+
+        if not processed:
+            with _wakeup:
+                _wakeup.wait(poll_interval)
+
+
+def start_workers(
+    handler: Callable[[Dict[str, Any]], Any], workers: Optional[int] = None
+) -> int:
+    """
+    Inicia o pool de workers que drena a fila neste processo.
+
+    O tamanho vem de WBUY_QUEUE_WORKERS (padrão 2); 0 desativa o consumo.
+    Chamadas repetidas no mesmo processo não criam workers adicionais.
+    """
+
+    if workers is None:
+        workers = _env_int("WBUY_QUEUE_WORKERS", 2)
+
+    alive = [thread for thread in _workers if thread.is_alive()]
+    if alive or workers <= 0:
+        return len(alive)
+
+    _stop.clear()
+    _workers.clear()
+    for index in range(workers):
+        thread = threading.Thread(
+            target=_worker_loop, args=(handler,), name=f"wbuy-queue-{index}", daemon=True
+        )
+        thread.start()
+        _workers.append(thread)
+    threading.Thread(target=_heartbeat_loop, name="wbuy-queue-heartbeat", daemon=True).start()
+
+    return len(_workers)
+
+
+def stop_workers(timeout: float = 5.0) -> None:
+    _stop.set()
+    with _wakeup:
+        _wakeup.notify_all()
+    for thread in _workers:
+        thread.join(timeout)
+    _workers.clear()
@@ -0,0 +1,293 @@
+import atexit
+import json
+import logging
+import os
+import queue
+import random
+import re
+import sys
+import threading
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+from functools import wraps
+from typing import Any, Callable, Dict, Iterator, Optional
+
+ROOT_LOGGER = "wbuy"
+
+# Id de correlação do pedido em processamento; entra em todos os registros
+# como "order_id" enquanto estiver ligado (bind/propagate).
+correlation_id: ContextVar[Optional[str]] = ContextVar("wbuy_order_id", default=None)
+
+# Atributos padrão do LogRecord; o resto veio de extra= e vira campo do JSON.
+_RECORD_ATTRS = set(vars(logging.makeLogRecord({}))) | {"message", "asctime", "sampled"}
+
+_PIX_RE = re.compile(r"000201\S*?(?:\s\S+?)*?6304[0-9A-Fa-f]{4}|000201\S+")
+_CODE_RE = re.compile(r"\d[\d. ]{38,}\d")
+# Telefones só nos formatos de telefone: internacional com "+", formatado
+# (DDD entre parênteses ou número separado em duas metades) ou celular só
+# com dígitos (DDD + 9 + 8 dígitos, com ou sem o 55). Ids, timestamps,
+# CPFs e valores com 10 a 13 dígitos ficam intactos.
+_PHONE_RE = re.compile(
+    r"(?<![\w+])(?:"
+    r"\+\d{10,13}"
+    r"|(?:\+?55[\s.-]?)?\(?[1-9]{2}\)?[\s.-]?9?\d{4}[\s.-]\d{4}"
+    r"|(?:55)?[1-9]{2}9\d{8}"
+    r")(?!\w)"
+)
+_PHONE_FIELDS = ("phone", "number")
+
+
+def _env_int(name: str, default: int) -> int:
+    try:
+        return int(os.getenv(name, default))
+    except (TypeError, ValueError):
+        return default
+
+
+def _env_float(name: str, default: float) -> float:
+    try:
+        return float(os.getenv(name, default))
+    except (TypeError, ValueError):
+        return default
+
+
+def mask_phone(value: Any) -> str:
+    digits = "".join(ch for ch in str(value or "") if ch.isdigit())
+    if len(digits) <= 4:
+        return "*" * len(digits)
+    return "*" * (len(digits) - 4) + digits[-4:]
+
+
+def _mask_phone_match(match: "re.Match[str]") -> str:
+    digits = sum(ch.isdigit() for ch in match.group(0))
+    return mask_phone(match.group(0)) if 10 <= digits <= 13 else match.group(0)
+
+
+def redact(text: str) -> str:
+    """
+    Remove códigos Pix (copia e cola), linhas digitáveis e mascara telefones,
+    deixando só os 4 últimos dígitos.
+    """
+
+    text = _PIX_RE.sub("[pix]", text)
+    text = _CODE_RE.sub("[linha_digitavel]", text)
+    return _PHONE_RE.sub(_mask_phone_match, text)
+
+
+class JsonFormatter(logging.Formatter):
+    """
+    Uma linha JSON por registro: ts, level, logger, msg, order_id e os campos
+    passados em extra=, já com a redação aplicada.
+    """
+
+    def format(self, record: logging.LogRecord) -> str:
+        entry: Dict[str, Any] = {
+            "ts": round(record.created, 3),
+            "level": record.levelname.lower(),
+            "logger": record.name,
+            "msg": redact(record.getMessage()),
+        }
+        for key, value in record.__dict__.items():
+            if key in _RECORD_ATTRS or key.startswith("_"):
+                continue
+            if key in _PHONE_FIELDS:
+                value = mask_phone(value)
+            elif isinstance(value, str):
+                value = redact(value)
+            entry[key] = value
+        if record.exc_info:
+            entry["exc"] = redact(self.formatException(record.exc_info))
+        return json.dumps(entry, ensure_ascii=False, default=str)
+
+
+class _ContextFilter(logging.Filter):
+    """
+    Preenche o order_id a partir do contexto e aplica a amostragem dos
+    eventos marcados com extra={"sampled": True} (WBUY_LOG_SAMPLE_RATE).
+    Roda na thread que loga, antes do enfileiramento.
+    """
+
+    def __init__(self, sample_rate: float) -> None:
+        super().__init__()
+        self.sample_rate = sample_rate
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        if (
+            getattr(record, "sampled", False)
+            and record.levelno < logging.WARNING
+            and random.random() >= self.sample_rate
+        ):
+            return False
+        if getattr(record, "order_id", None) is None:
+            record.order_id = correlation_id.get()
+        return True
+
+
+class AsyncHandler(logging.Handler):
+    """
+    Enfileira os registros e os escreve em uma thread própria, sem I/O no
+    caminho da requisição. Com a fila cheia (WBUY_LOG_QUEUE_SIZE) o registro
+    é descartado e contado em ``dropped``. A thread é recriada após fork;
+    close() (atexit) escreve o que restou na fila antes de encerrá-la.
+    """
+
+    def __init__(self, stream: Any = None, maxsize: Optional[int] = None) -> None:
+        super().__init__()
+        self.stream = stream
+        self.maxsize = maxsize or _env_int("WBUY_LOG_QUEUE_SIZE", 10000)
+        self.dropped = 0
+        self._pid: Optional[int] = None
+        self._queue: "queue.Queue[Optional[logging.LogRecord]]" = queue.Queue(self.maxsize)
+        self._thread: Optional[threading.Thread] = None
+        self._closed = False
+
+    def _ensure_thread(self) -> None:
+        pid = os.getpid()
+        if self._pid == pid:
+            return
+        with self.lock:
+            if self._pid == pid:
+                return
+            self._queue = queue.Queue(self.maxsize)
+            self._thread = threading.Thread(target=self._drain, name="wbuy-log", daemon=True)
+            self._thread.start()
+            self._pid = pid
+
+    def emit(self, record: logging.LogRecord) -> None:
+        if self._closed:
+            # Registros depois do close (outros hooks de atexit): escrita direta.
+            self._write(record)
+            return
+        self._ensure_thread()
+        try:
+            # Congela a mensagem e a exceção antes de a thread do chamador seguir.
+            record.msg = record.getMessage()
+            record.args = None
+            if record.exc_info and not record.exc_text:
+                record.exc_text = logging.Formatter().formatException(record.exc_info)
+            self._queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+    def _write(self, record: logging.LogRecord) -> None:
+        stream = self.stream or sys.stdout
+        try:
+            stream.write(self.format(record) + "\n")
+        except Exception:
+            self.handleError(record)
+
+    def _drain(self) -> None:
+        work = self._queue
+        while True:
+            record = work.get()
+            try:
+                if record is None:
+                    break
+                self._write(record)
+                if work.empty():
+                    try:
+                        (self.stream or sys.stdout).flush()
+                    except Exception:
+                        pass
+            finally:
+                work.task_done()
+
+    def flush(self, timeout: float = 2.0) -> None:
+        """
+        Espera a thread escrever o que já está na fila (testes, shutdown).
+        """
+
+        deadline = time.monotonic() + timeout
+        while self._queue.unfinished_tasks and time.monotonic() < deadline:
+            time.sleep(0.005)
+
+    def close(self, timeout: float = 2.0) -> None:
+        """
+        Escreve o que ainda está na fila e encerra a thread de log. Chamado
+        no atexit e quando setup() troca o handler.
+        """
+
+        with self.lock:
+            self._closed = True
+            thread = self._thread if self._pid == os.getpid() else None
+        if thread is not None and thread.is_alive():
+            try:
+                self._queue.put(None, timeout=timeout)
+            except queue.Full:
+                pass
+            thread.join(timeout)
+        super().close()
+
+
+_handler: Optional[AsyncHandler] = None
+_setup_lock = threading.Lock()
+
+
+def setup(stream: Any = None, level: Optional[str] = None) -> AsyncHandler:
+    """
+    Configura o logger "wbuy" (uma vez por processo): JSON em stdout pela
+    thread de log, nível WBUY_LOG_LEVEL (INFO) e amostragem
+    WBUY_LOG_SAMPLE_RATE (1.0 = mantém todos os eventos amostráveis).
+    """
+
+    global _handler
+
+    with _setup_lock:
+        logger = logging.getLogger(ROOT_LOGGER)
+        if _handler is not None:
+            logger.removeHandler(_handler)
+            _handler.close()
+
+        _handler = AsyncHandler(stream)
+        _handler.setFormatter(JsonFormatter())
+        _handler.addFilter(_ContextFilter(min(max(_env_float("WBUY_LOG_SAMPLE_RATE", 1.0), 0.0), 1.0)))
+        logger.addHandler(_handler)
+        logger.setLevel((level or os.getenv("WBUY_LOG_LEVEL", "INFO")).upper())
+        logger.propagate = False
+        return _handler
+
+
+def _close_at_exit() -> None:
+    # Roda antes do logging.shutdown (atexit é LIFO) e depois dos hooks de
+    # atexit dos módulos que importam este, que ainda podem logar.
+    if _handler is not None:
+        _handler.close()
+
+
+atexit.register(_close_at_exit)
+
+
+def get_logger(name: str) -> logging.Logger:
+    if _handler is None:
+        setup()
+    return logging.getLogger(f"{ROOT_LOGGER}.{name}")
+
+
+@contextmanager
+def bind(order_id: Optional[str]) -> Iterator[None]:
+    token = correlation_id.set(order_id)
+    try:
+        yield
+    finally:
+        correlation_id.reset(token)
+
+
+def propagate(function: Callable) -> Callable:
+    """
+    Leva o order_id atual para a função quando ela rodar em outra thread
+    (scheduler, batcher, event loop do DeliveryEngine).
+    """
+
+    order_id = correlation_id.get()
+
+    @wraps(function)
+    def wrapper(*args: Any, **kwargs: Any) -> Any:
+        with bind(order_id):
+            return function(*args, **kwargs)
+
+    return wrapper
+
+
+def dropped() -> int:
+    return _handler.dropped if _handler is not None else 0
@@ -0,0 +1,334 @@
+import os
+import tempfile
+from typing import (
+    Any,
+    AsyncIterable,
+    AsyncIterator,
+    BinaryIO,
+    Dict,
+    Iterable,
+    Iterator,
+    Mapping,
+    Optional,
+    Tuple,
+    Union,
+)
+from uuid import uuid4
+
+from . import http_client
+
+CHUNK_SIZE = 64 * 1024
+PDF_MAGIC = b"%PDF"
+ALLOWED_CONTENT_TYPES = {
+    "application/pdf",
+    "application/x-pdf",
+    "application/octet-stream",
+    "binary/octet-stream",
+}
+
+
+def _env_int(name: str, default: int) -> int:
+    try:
+        return int(os.getenv(name, default))
+    except (TypeError, ValueError):
+        return default
+
+
+def max_bytes() -> int:
+    """
+    Tamanho máximo aceito para o PDF do boleto (WBUY_BOLETO_MAX_BYTES, 10 MB).
+    """
+
+    return _env_int("WBUY_BOLETO_MAX_BYTES", 10 * 1024 * 1024)
+
+
+def spool_enabled() -> bool:
+    return os.getenv("WHATICKET_MEDIA_SPOOL", "1").strip().lower() not in ("0", "false", "no")
+
+
+def max_upload_retries() -> int:
+    return _env_int("WHATICKET_MEDIA_RETRIES", 2)
+
+
+def upload_retryable(result: Any) -> bool:
+    """
+    True para o upload recusado pelo Whaticket com 429/503, que vale
+    refazer a partir do spool (replay) sem baixar o boleto de novo.
+    """
+
+    return (
+        isinstance(result, dict)
+        and result.get("status") == "error"
+        and result.get("status_code") in http_client.POST_RETRY_STATUS_CODES
+    )
+
+
+def _open_spool(spool: Union[bool, BinaryIO]) -> Optional[BinaryIO]:
+    if spool is True:
+        return tempfile.SpooledTemporaryFile(
+            max_size=_env_int("WBUY_BOLETO_SPOOL_MEMORY", 256 * 1024)
+        )
+    return spool or None
+
+
+def _spooled_chunks(spool: BinaryIO) -> Iterator[bytes]:
+    # Relê o spool até a posição atual e volta para lá, para que a cópia
+    # dos próximos blocos continue no fim.
+    spool.flush()
+    position = spool.tell()
+    spool.seek(0)
+    try:
+        while spool.tell() < position:
+            chunk = spool.read(min(CHUNK_SIZE, position - spool.tell()))
+            if not chunk:
+                break
+            yield chunk
+    finally:
+        spool.seek(position)
+
+
+class BoletoError(Exception):
+    """
+    O boleto não pôde ser baixado ou não é um PDF aceitável. ``reason`` segue
+    o formato dos resultados de process_webhook.
+    """
+
+    def __init__(self, reason: str, status_code: Optional[int] = None) -> None:
+        super().__init__(reason)
+        self.reason = reason
+        self.status_code = status_code
+
+    def as_result(self) -> Dict[str, Any]:
+        result: Dict[str, Any] = {"status": "error", "reason": self.reason}
+        if self.status_code is not None:
+            result["status_code"] = self.status_code
+        return result
+
+
+def validate_headers(headers: Mapping[str, str]) -> None:
+    content_type = (headers.get("Content-Type") or "").split(";", 1)[0].strip().lower()
+    if content_type and content_type not in ALLOWED_CONTENT_TYPES:
+        raise BoletoError("boleto_invalid_content")
+
+    length = headers.get("Content-Length")
+    if length and length.isdigit() and int(length) > max_bytes():
+        raise BoletoError("boleto_too_large")
+
+
+class ChunkGuard:
+    """
+    Confere o cabeçalho %PDF no primeiro bloco e o limite de tamanho à
+    medida que os blocos passam, sem acumular o conteúdo.
+    """
+
+    def __init__(self, limit: Optional[int] = None) -> None:
+        self.limit = limit if limit is not None else max_bytes()
+        self.size = 0
+
+    def feed(self, chunk: bytes) -> bytes:
+        if self.size == 0 and chunk and not chunk.lstrip()[:4] == PDF_MAGIC:
+            raise BoletoError("boleto_invalid_content")
+        self.size += len(chunk)
+        if self.size > self.limit:
+            raise BoletoError("boleto_too_large")
+        return chunk
+
+
+class BoletoStream:
+    """
+    Iterável de blocos do PDF vindo da WBuy, validado e com limite de tamanho.
+
+    O primeiro bloco é lido na criação para rejeitar conteúdo inválido antes
+    de abrir o upload. Com spool ativo, os blocos são copiados para um
+    SpooledTemporaryFile (ou para o arquivo informado, como o CacheWriter do
+    cache de boletos) para que um novo upload (replay) não precise baixar o
+    boleto de novo.
+    """
+
+    def __init__(
+        self,
+        headers: Mapping[str, str],
+        chunks: Iterable[bytes],
+        spool: Union[bool, BinaryIO] = False,
+    ) -> None:
+        validate_headers(headers)
+        self._source = iter(chunks)
+        self._guard = ChunkGuard()
+        self.complete = False
+        self._spool = _open_spool(spool)
+        self._head = self._next_chunk()
+        if self._head is None:
+            raise BoletoError("boleto_invalid_content")
+
+    @property
+    def spooled(self) -> bool:
+        return self._spool is not None
+
+    @property
+    def size(self) -> int:
+        return self._guard.size
+
+    def _next_chunk(self) -> Optional[bytes]:
+        for chunk in self._source:
+            if not chunk:
+                continue
+            self._guard.feed(chunk)
+            if self._spool is not None:
+                self._spool.write(chunk)
+            return chunk
+        self.complete = True
+        return None
+
+    def _remaining(self) -> Iterator[bytes]:
+        while True:
+            chunk = self._next_chunk()
+            if chunk is None:
+                return
+            yield chunk
+
+    def __iter__(self) -> Iterator[bytes]:
+        head, self._head = self._head, None
+        if head is not None:
+            yield head
+        yield from self._remaining()
+
+    def replay(self) -> Iterator[bytes]:
+        """
+        Reenvia o que já está no spool e continua a leitura da origem.
+        """
+
+        if self._spool is None:
+            raise RuntimeError("replay exige spool ativo")
+
+        self._head = None
+        yield from _spooled_chunks(self._spool)
+        yield from self._remaining()
+
+    def close(self) -> None:
+        if self._spool is not None:
+            self._spool.close()
+
+
+class AsyncBoletoStream:
+    """
+    BoletoStream do motor assíncrono (sender.DeliveryEngine): os mesmos
+    limites, spool e replay sobre os blocos assíncronos do httpx. Criado
+    com ``await AsyncBoletoStream.open(...)``, que já lê o primeiro bloco.
+    """
+
+    def __init__(self, chunks: AsyncIterable[bytes], spool: Union[bool, BinaryIO] = False) -> None:
+        self._source = chunks.__aiter__()
+        self._guard = ChunkGuard()
+        self.complete = False
+        self._spool = _open_spool(spool)
+        self._head: Optional[bytes] = None
+
+    @classmethod
+    async def open(
+        cls,
+        headers: Mapping[str, str],
+        chunks: AsyncIterable[bytes],
+        spool: Union[bool, BinaryIO] = False,
+    ) -> "AsyncBoletoStream":
+        validate_headers(headers)
+        stream = cls(chunks, spool)
+        try:
+            stream._head = await stream._next_chunk()
+            if stream._head is None:
+                raise BoletoError("boleto_invalid_content")
+        except BaseException:
+            stream.close()
+            raise
+        return stream
+
+    @property
+    def spooled(self) -> bool:
+        return self._spool is not None
+
+    @property
+    def size(self) -> int:
+        return self._guard.size
+
+    async def _next_chunk(self) -> Optional[bytes]:
+        async for chunk in self._source:
+            if not chunk:
+                continue
+            self._guard.feed(chunk)
+            if self._spool is not None:
+                self._spool.write(chunk)
+            return chunk
+        self.complete = True
+        return None
+
+    async def _remaining(self) -> AsyncIterator[bytes]:
+        while True:
+            chunk = await self._next_chunk()
+            if chunk is None:
+                return
+            yield chunk
+
+    async def __aiter__(self) -> AsyncIterator[bytes]:
+        head, self._head = self._head, None
+        if head is not None:
+            yield head
+        async for chunk in self._remaining():
+            yield chunk
+
+    async def replay(self) -> AsyncIterator[bytes]:
+        """
+        Reenvia o que já está no spool e continua a leitura da origem.
+        """
+
+        if self._spool is None:
+            raise RuntimeError("replay exige spool ativo")
+
+        self._head = None
+        for chunk in _spooled_chunks(self._spool):
+            yield chunk
+        async for chunk in self._remaining():
+            yield chunk
+
+    def close(self) -> None:
+        if self._spool is not None:
+            self._spool.close()
+
+
+def multipart_frame(
+    fields: Mapping[str, str], file_field: str, filename: str, content_type: str
+) -> Tuple[str, bytes, bytes]:
+    """
+    Retorna (content_type_header, preâmbulo, epílogo) de um multipart/form-data
+    cujo arquivo será enviado em blocos entre o preâmbulo e o epílogo.
+    """
+
+    boundary = uuid4().hex
+    preamble = b"".join(
+        f'--{boundary}\r\nContent-Disposition: form-data; name="{name}"\r\n\r\n{value}\r\n'.encode(
+            "utf-8"
+        )
+        for name, value in fields.items()
+    )
+    preamble += (
+        f"--{boundary}\r\n"
+        f'Content-Disposition: form-data; name="{file_field}"; filename="{filename}"\r\n'
+        f"Content-Type: {content_type}\r\n\r\n"
+    ).encode("utf-8")
+    epilogue = f"\r\n--{boundary}--\r\n".encode("utf-8")
+    return f"multipart/form-data; boundary={boundary}", preamble, epilogue
+
+
+def iter_multipart(
+    fields: Mapping[str, str],
+    file_field: str,
+    filename: str,
+    content_type: str,
+    chunks: Iterable[bytes],
+) -> Tuple[str, Iterator[bytes]]:
+    header, preamble, epilogue = multipart_frame(fields, file_field, filename, content_type)
+
+    def body() -> Iterator[bytes]:
+        yield preamble
+        yield from chunks
+        yield epilogue
+
+    return header, body()
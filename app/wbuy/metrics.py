@@ -0,0 +1,406 @@
+import atexit
+import json
+import os
+import threading
+import time
+from bisect import bisect_left
+from concurrent.futures import Future
+from contextlib import contextmanager
+from functools import wraps
+from pathlib import Path
+from typing import Any, Callable, Dict, Iterator, List, Optional, Tuple
+
+try:
+    import fcntl
+except ImportError:  # Windows: sem flock, a agregação fica sem lock.
+    fcntl = None
+
+from . import log
+
+logger = log.get_logger("metrics")
+
+# Sem importar storage: storage usa este módulo para medir o idempotency.
+METRICS_DIR = Path(__file__).resolve().parents[2] / "storage" / "metrics"
+
+_LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+_SIZE_BUCKETS = (16e3, 64e3, 128e3, 256e3, 512e3, 1e6, 2e6, 5e6, 10e6)
+_BATCH_BUCKETS = (1, 2, 5, 10, 20, 50, 100, 200)
+_WAIT_BUCKETS = (0.01, 0.05, 0.1, 0.5, 1.0, 5.0, 15.0, 30.0, 60.0, 300.0, 900.0, 3600.0)
+
+HISTOGRAMS: Dict[str, Tuple[str, Tuple[float, ...]]] = {
+    "wbuy_webhook_seconds": ("Tempo para aceitar um webhook (arquivo + fila).", _LATENCY_BUCKETS),
+    "wbuy_idempotency_seconds": ("Tempo das consultas ao storage de processados.", _LATENCY_BUCKETS),
+    "wbuy_whaticket_send_seconds": ("Duração de cada envio ao Whaticket.", _LATENCY_BUCKETS),
+    "wbuy_boleto_download_seconds": ("Tempo para baixar e repassar o PDF do boleto.", _LATENCY_BUCKETS),
+    "wbuy_boleto_download_bytes": ("Tamanho dos PDFs de boleto baixados da WBuy.", _SIZE_BUCKETS),
+    "wbuy_queue_wait_seconds": ("Espera dos jobs na fila até serem reservados.", _WAIT_BUCKETS),
+    "wbuy_batch_size": ("Mensagens por janela do batcher, por modo (bulk/parallel).", _BATCH_BUCKETS),
+    "wbuy_batch_flush_seconds": (
+        "Tempo da primeira mensagem da janela até o fim do envio do lote.",
+        _LATENCY_BUCKETS,
+    ),
+    "wbuy_delivery_wait_seconds": (
+        "Espera de cada sequência até o primeiro envio, por classe de prioridade.",
+        _WAIT_BUCKETS,
+    ),
+}
+COUNTERS: Dict[str, str] = {
+    "wbuy_outcomes_total": "Resultados por etapa, status e reason.",
+    "wbuy_processed_cache_total": "Consultas ao cache de processados por resultado.",
+}
+
+_lock = threading.Lock()
+_counters: Dict[Tuple[str, Tuple[Tuple[str, str], ...]], float] = {}
+_histograms: Dict[Tuple[str, Tuple[Tuple[str, str], ...]], List[Any]] = {}
+_flusher_pid: Optional[int] = None
+_flushed_pid: Optional[int] = None
+_owner_pid = os.getpid()
+
+# Soma dos snapshots de processos que já morreram (worker reciclado pelo
+# max_requests, crash): os totais continuam monotônicos, como no modo
+# multiprocess do prometheus_client.
+RETIRED_FILE = "retired.json"
+
+
+def _env_float(name: str, default: float) -> float:
+    try:
+        return float(os.getenv(name, default))
+    except (TypeError, ValueError):
+        return default
+
+
+def _metrics_dir() -> Path:
+    return Path(os.getenv("WBUY_METRICS_DIR") or METRICS_DIR)
+
+
+def _key(name: str, labels: Dict[str, Any]) -> Tuple[str, Tuple[Tuple[str, str], ...]]:
+    return name, tuple(sorted((key, str(value)) for key, value in labels.items()))
+
+
+def _check_process() -> None:
+    """
+    Depois de um fork o filho começa com métricas zeradas (as do pai já
+    estão no arquivo do pai) e com seu próprio flusher.
+    """
+
+    global _owner_pid
+
+    pid = os.getpid()
+    if pid != _owner_pid:
+        _counters.clear()
+        _histograms.clear()
+        _owner_pid = pid
+    if _flusher_pid != pid:
+        _start_flusher()
+
+
+def inc(name: str, amount: float = 1.0, **labels: Any) -> None:
+    key = _key(name, labels)
+    with _lock:
+        _check_process()
+        _counters[key] = _counters.get(key, 0.0) + amount
+
+
+def observe(name: str, value: float, **labels: Any) -> None:
+    buckets = HISTOGRAMS[name][1]
+    key = _key(name, labels)
+    with _lock:
+        _check_process()
+        entry = _histograms.get(key)
+        if entry is None:
+            entry = _histograms[key] = [[0] * (len(buckets) + 1), 0.0, 0]
+        entry[0][bisect_left(buckets, value)] += 1
+        entry[1] += value
+        entry[2] += 1
+
+
+@contextmanager
+def timer(name: str, **labels: Any) -> Iterator[None]:
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        observe(name, time.perf_counter() - started, **labels)
+
+
+def timed(name: str, **labels: Any) -> Callable:
+    def decorator(function: Callable) -> Callable:
+        @wraps(function)
+        def wrapper(*args: Any, **kwargs: Any) -> Any:
+            with timer(name, **labels):
+                return function(*args, **kwargs)
+
+        return wrapper
+
+    return decorator
+
+
+def record_outcome(stage: str, result: Any) -> None:
+    if isinstance(result, dict):
+        inc(
+            "wbuy_outcomes_total",
+            stage=stage,
+            status=result.get("status", "unknown"),
+            reason=result.get("reason", ""),
+        )
+
+
+def counts_outcome(stage: str) -> Callable:
+    """
+    Decorador que conta o dict de resultado (status/reason) da função, inclusive
+    quando ela devolve um Future.
+    """
+
+    def decorator(function: Callable) -> Callable:
+        @wraps(function)
+        def wrapper(*args: Any, **kwargs: Any) -> Any:
+            try:
+                result = function(*args, **kwargs)
+            except Exception:
+                inc("wbuy_outcomes_total", stage=stage, status="exception", reason="")
+                raise
+
+            if isinstance(result, Future):
+                def _done(future: Future) -> None:
+                    if future.exception() is not None:
+                        inc("wbuy_outcomes_total", stage=stage, status="exception", reason="")
+                    else:
+                        record_outcome(stage, future.result())
+
+                result.add_done_callback(_done)
+            else:
+                record_outcome(stage, result)
+            return result
+
+        return wrapper
+
+    return decorator
+
+
+def _snapshot() -> Dict[str, Any]:
+    with _lock:
+        return {
+            "counters": [[name, labels, value] for (name, labels), value in _counters.items()],
+            "histograms": [
+                [name, labels, list(entry[0]), entry[1], entry[2]]
+                for (name, labels), entry in _histograms.items()
+            ],
+        }
+
+
+def flush() -> None:
+    """
+    Grava as métricas deste processo em storage/metrics/<pid>.json de forma
+    atômica; a rota de métricas soma os arquivos de todos os workers.
+    """
+
+    if os.getpid() != _owner_pid:
+        return
+
+    global _flushed_pid
+
+    directory = _metrics_dir()
+    directory.mkdir(parents=True, exist_ok=True)
+    target = directory / f"{os.getpid()}.json"
+    if _flushed_pid != os.getpid():
+        # Um arquivo com o nosso PID é de um processo morto que reusou o
+        # número: soma-o ao agregado antes de sobrescrevê-lo.
+        if target.exists():
+            _retire([target])
+        _flushed_pid = os.getpid()
+    _write(target, _snapshot())
+
+
+def _flush_loop() -> None:
+    interval = max(_env_float("WBUY_METRICS_FLUSH_SECONDS", 5.0), 0.1)
+    pid = os.getpid()
+    while os.getpid() == pid:
+        time.sleep(interval)
+        try:
+            flush()
+        except OSError as exc:
+            logger.warning("Falha ao gravar métricas: %s", exc)
+
+
+def _start_flusher() -> None:
+    global _flusher_pid
+
+    _flusher_pid = os.getpid()
+    threading.Thread(target=_flush_loop, name="wbuy-metrics", daemon=True).start()
+
+
+atexit.register(lambda: flush() if _counters or _histograms else None)
+
+
+def reset() -> None:
+    """
+    Remove os arquivos de métricas (início do servidor, testes). Chamado
+    uma vez por servidor, antes dos workers: no on_starting do gunicorn e
+    no startup do ASGI em processo único. O volume storage/ sobrevive aos
+    containers e os snapshots antigos não devem ser somados.
+    """
+
+    global _flushed_pid
+
+    _flushed_pid = None
+    with _lock:
+        _counters.clear()
+        _histograms.clear()
+    directory = _metrics_dir()
+    if directory.exists():
+        for path in directory.glob("*.json"):
+            path.unlink(missing_ok=True)
+
+
+def _alive(pid: int) -> bool:
+    if os.name != "posix":
+        return True
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+def _write(target: Path, snapshot: Dict[str, Any]) -> None:
+    temporary = target.with_name(f"{target.stem}.{os.getpid()}.tmp")
+    temporary.write_text(json.dumps(snapshot), encoding="utf-8")
+    os.replace(temporary, target)
+
+
+def _sum(paths: List[Path]) -> Tuple[Dict[Any, float], Dict[Any, List[Any]]]:
+    counters: Dict[Tuple[str, Tuple[Tuple[str, str], ...]], float] = {}
+    histograms: Dict[Tuple[str, Tuple[Tuple[str, str], ...]], List[Any]] = {}
+
+    for path in paths:
+        try:
+            snapshot = json.loads(path.read_text(encoding="utf-8"))
+        except (OSError, ValueError):
+            continue
+
+        for name, labels, value in snapshot.get("counters", []):
+            key = (name, tuple(tuple(pair) for pair in labels))
+            counters[key] = counters.get(key, 0.0) + value
+        for name, labels, buckets, total, count in snapshot.get("histograms", []):
+            if name not in HISTOGRAMS or len(buckets) != len(HISTOGRAMS[name][1]) + 1:
+                continue
+            key = (name, tuple(tuple(pair) for pair in labels))
+            entry = histograms.setdefault(key, [[0] * len(buckets), 0.0, 0])
+            entry[0] = [a + b for a, b in zip(entry[0], buckets)]
+            entry[1] += total
+            entry[2] += count
+
+    return counters, histograms
+
+
+@contextmanager
+def _directory_lock(directory: Path) -> Iterator[None]:
+    with open(directory / ".lock", "a") as handle:
+        if fcntl is not None:
+            fcntl.flock(handle, fcntl.LOCK_EX)
+        yield
+
+
+def _retire(paths: List[Path]) -> None:
+    """
+    Soma os snapshots de processos mortos ao RETIRED_FILE e os apaga, sob
+    um lock de arquivo: dois workers coletando ao mesmo tempo não contam
+    o mesmo snapshot duas vezes.
+    """
+
+    directory = _metrics_dir()
+    with _directory_lock(directory):
+        paths = [path for path in paths if path.exists()]
+        if not paths:
+            return
+        retired = directory / RETIRED_FILE
+        counters, histograms = _sum([retired] + paths)
+        _write(
+            retired,
+            {
+                "counters": [[name, labels, value] for (name, labels), value in counters.items()],
+                "histograms": [
+                    [name, labels, entry[0], entry[1], entry[2]]
+                    for (name, labels), entry in histograms.items()
+                ],
+            },
+        )
+        for path in paths:
+            path.unlink(missing_ok=True)
+
+
+def collect() -> Dict[str, Any]:
+    """
+    Soma os snapshots de todos os processos (contadores e buckets). Os de
+    processos que já morreram vão para o RETIRED_FILE antes de sair: o PID
+    pode ser reaproveitado e os totais não podem diminuir.
+    """
+
+    flush()
+    directory = _metrics_dir()
+    dead = [
+        path
+        for path in directory.glob("*.json")
+        if path.stem.isdigit() and int(path.stem) != os.getpid() and not _alive(int(path.stem))
+    ]
+    if dead:
+        try:
+            _retire(dead)
+        except OSError as exc:
+            logger.warning("Falha ao agregar métricas de processos encerrados: %s", exc)
+
+    counters, histograms = _sum(sorted(directory.glob("*.json")))
+    return {"counters": counters, "histograms": histograms}
+
+
+def _escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _labels(pairs: Tuple[Tuple[str, str], ...], extra: Tuple[Tuple[str, str], ...] = ()) -> str:
+    pairs = pairs + extra
+    if not pairs:
+        return ""
+    return "{" + ",".join(f'{key}="{_escape(value)}"' for key, value in pairs) + "}"
+
+
+def _number(value: float) -> str:
+    return repr(float(value)) if value != int(value) else str(int(value))
+
+
+def render(gauges: Optional[Dict[str, Tuple[str, Dict[str, float]]]] = None) -> str:
+    """
+    Texto no formato de exposição do Prometheus (0.0.4). ``gauges`` traz
+    valores lidos na hora da coleta, como {"nome": (help, {label: valor})}.
+    """
+
+    data = collect()
+    lines: List[str] = []
+
+    for name, help_text in COUNTERS.items():
+        lines += [f"# HELP {name} {help_text}", f"# TYPE {name} counter"]
+        for (metric, labels), value in sorted(data["counters"].items()):
+            if metric == name:
+                lines.append(f"{name}{_labels(labels)} {_number(value)}")
+
+    for name, (help_text, buckets) in HISTOGRAMS.items():
+        lines += [f"# HELP {name} {help_text}", f"# TYPE {name} histogram"]
+        for (metric, labels), (counts, total, count) in sorted(data["histograms"].items()):
+            if metric != name:
+                continue
+            cumulative = 0
+            for bound, bucket_count in zip(list(buckets) + ["+Inf"], counts):
+                cumulative += bucket_count
+                le = bound if isinstance(bound, str) else _number(bound)
+                lines.append(f"{name}_bucket{_labels(labels, (('le', le),))} {cumulative}")
+            lines.append(f"{name}_sum{_labels(labels)} {repr(float(total))}")
+            lines.append(f"{name}_count{_labels(labels)} {count}")
+
+    for name, (help_text, values) in (gauges or {}).items():
+        lines += [f"# HELP {name} {help_text}", f"# TYPE {name} gauge"]
+        for status, value in sorted(values.items()):
+            lines.append(f"{name}{_labels((('status', status),))} {_number(value)}")
+
+    return "\n".join(lines) + "\n"
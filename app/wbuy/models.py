@@ -0,0 +1,179 @@
+import json
+from typing import Any, Mapping, Optional, Tuple, Union
+
+try:
+    import orjson
+except ImportError:  # pragma: no cover - orjson é opcional
+    orjson = None
+
+from . import templates
+
+
+class PayloadError(ValueError):
+    """
+    Webhook malformado. ``field`` indica o caminho do campo problemático
+    (por exemplo ``data.cliente.nome``).
+    """
+
+    reason = "invalid_payload"
+
+    def __init__(self, field: str, message: str = "campo ausente ou inválido") -> None:
+        super().__init__(f"{field}: {message}")
+        self.field = field
+
+    def as_result(self) -> dict:
+        return {"status": "skipped", "reason": self.reason, "field": self.field}
+
+
+def loads(raw: Union[bytes, str]) -> Any:
+    """
+    Decodifica JSON com orjson quando instalado, ou com o json da stdlib.
+    """
+
+    if orjson is not None:
+        try:
+            return orjson.loads(raw)
+        except orjson.JSONDecodeError as exc:
+            raise PayloadError("body", "JSON inválido") from exc
+
+    try:
+        return json.loads(raw)
+    except (ValueError, UnicodeDecodeError) as exc:
+        raise PayloadError("body", "JSON inválido") from exc
+
+
+def _mapping(value: Any, field: str) -> Mapping[str, Any]:
+    if not isinstance(value, Mapping):
+        raise PayloadError(field)
+    return value
+
+
+def _text(value: Any, field: str, required: bool = True) -> str:
+    if value is None or isinstance(value, (dict, list)):
+        if required:
+            raise PayloadError(field)
+        return ""
+
+    text = str(value).strip()
+    if required and not text:
+        raise PayloadError(field)
+    return text
+
+
+class Item:
+    __slots__ = ("name", "quantity")
+
+    def __init__(self, name: str, quantity: str) -> None:
+        self.name = name
+        self.quantity = quantity
+
+    def __repr__(self) -> str:
+        return f"Item(name={self.name!r}, quantity={self.quantity!r})"
+
+
+class Payment:
+    __slots__ = ("kind", "code", "link")
+
+    def __init__(self, kind: str, code: str = "", link: str = "") -> None:
+        self.kind = kind
+        self.code = code
+        self.link = link
+
+    @classmethod
+    def from_data(cls, data: Any) -> "Payment":
+        data = _mapping(data, "data.pagamento")
+        payment = cls(
+            _text(data.get("tipo_interno"), "data.pagamento.tipo_interno"),
+            _text(data.get("linha_digitavel"), "data.pagamento.linha_digitavel", required=False),
+            _text(data.get("paymentLink"), "data.pagamento.paymentLink", required=False),
+        )
+
+        # Só exige o que o template do tipo realmente usa.
+        fields = {"code": "linha_digitavel", "link": "paymentLink"}
+        for attribute in templates.required_fields(payment.kind):
+            if not getattr(payment, attribute):
+                raise PayloadError(f"data.pagamento.{fields[attribute]}")
+        return payment
+
+    def __repr__(self) -> str:
+        return f"Payment(kind={self.kind!r}, code={self.code!r}, link={self.link!r})"
+
+
+class Order:
+    """
+    Pedido da WBuy validado a partir do webhook.
+
+    Construído uma única vez (Order.from_payload ou parse) antes de qualquer
+    acesso a disco ou rede; o restante do fluxo usa os atributos em vez de
+    percorrer o dict do payload.
+    """
+
+    __slots__ = ("id", "customer_name", "phone", "total", "items", "payment")
+
+    def __init__(
+        self,
+        id: str,
+        customer_name: str,
+        phone: str,
+        total: str,
+        items: Tuple[Item, ...],
+        payment: Payment,
+    ) -> None:
+        self.id = id
+        self.customer_name = customer_name
+        self.phone = phone
+        self.total = total
+        self.items = items
+        self.payment = payment
+
+    @property
+    def first_name(self) -> str:
+        parts = self.customer_name.split()
+        return parts[0] if parts else ""
+
+    @classmethod
+    def from_payload(cls, payload: Any) -> "Order":
+        data = _mapping(_mapping(payload, "payload").get("data"), "data")
+        cliente = _mapping(data.get("cliente"), "data.cliente")
+        valor_total = _mapping(data.get("valor_total"), "data.valor_total")
+
+        produtos = data.get("produtos") or []
+        if not isinstance(produtos, list):
+            raise PayloadError("data.produtos")
+
+        items = []
+        for index, produto in enumerate(produtos):
+            field = f"data.produtos[{index}]"
+            produto = _mapping(produto, field)
+            items.append(
+                Item(
+                    _text(produto.get("produto"), f"{field}.produto"),
+                    _text(produto.get("qtd"), f"{field}.qtd"),
+                )
+            )
+
+        return cls(
+            _text(data.get("id"), "data.id"),
+            _text(cliente.get("nome"), "data.cliente.nome"),
+            _text(cliente.get("telefone1"), "data.cliente.telefone1", required=False),
+            _text(valor_total.get("total"), "data.valor_total.total"),
+            tuple(items),
+            Payment.from_data(data.get("pagamento")),
+        )
+
+    def __repr__(self) -> str:
+        return f"Order(id={self.id!r}, payment={self.payment.kind!r})"
+
+
+def parse(raw: Union[bytes, str]) -> Order:
+    return Order.from_payload(loads(raw))
+
+
+def order_id_of(payload: Any) -> Optional[str]:
+    """
+    Extrai apenas o id do pedido, sem validar o restante do payload.
+    """
+
+    data = payload.get("data") if isinstance(payload, Mapping) else None
+    order_id = data.get("id") if isinstance(data, Mapping) else None
+    return str(order_id) if order_id not in (None, "") else None
@@ -0,0 +1,177 @@
+import os
+import re
+import time
+from functools import lru_cache
+from typing import NamedTuple, Optional
+
+from . import db, log
+from .storage import BASE_DIR
+
+NO_WHATSAPP_DB = BASE_DIR / "storage" / "no_whatsapp.db"
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS no_whatsapp (
+    number TEXT PRIMARY KEY,
+    confirmed_at REAL NOT NULL
+);
+"""
+
+logger = log.get_logger("phones")
+
+# DDDs em uso no Brasil (Anatel).
+VALID_DDDS = frozenset(
+    "11 12 13 14 15 16 17 18 19 21 22 24 27 28 31 32 33 34 35 37 38 "
+    "41 42 43 44 45 46 47 48 49 51 53 54 55 61 62 63 64 65 66 67 68 69 "
+    "71 73 74 75 77 79 81 82 83 84 85 86 87 88 89 91 92 93 94 95 96 97 98 99".split()
+)
+
+_NON_DIGITS = re.compile(r"\D+")
+# Nacional depois de tirar o 0 de longa distância: DDD + 9 dígitos (celular)
+# ou 8 dígitos (fixo, ou celular antigo sem o nono dígito).
+_MOBILE = re.compile(r"(\d{2})(9\d{8})")
+_EIGHT_DIGITS = re.compile(r"(\d{2})([2-9]\d{7})")
+# Discagem com código de operadora: 0 + operadora (2 dígitos) + DDD + número.
+_CARRIER_PREFIX = re.compile(r"0\d{2}(?=\d{10,11}$)")
+_INTERNATIONAL = re.compile(r"[1-9]\d{7,14}")
+
+# Trechos da resposta de erro do Whaticket para número sem WhatsApp.
+_NO_WHATSAPP_MARKERS = ("ERR_WAPP_INVALID_CONTACT",)
+
+
+def _env_int(name: str, default: int) -> int:
+    try:
+        return int(os.getenv(name, default))
+    except (TypeError, ValueError):
+        return default
+
+
+def _env_float(name: str, default: float) -> float:
+    try:
+        return float(os.getenv(name, default))
+    except (TypeError, ValueError):
+        return default
+
+
+class PhoneCheck(NamedTuple):
+    """
+    Resultado da validação: ``number`` em E.164 sem o "+" (vazio quando
+    inválido) e ``reason`` (missing, invalid_length, invalid_ddd, landline)
+    quando o número foi recusado.
+    """
+
+    number: str
+    reason: Optional[str] = None
+
+
+def test_number() -> str:
+    """
+    Número de teste que substitui o destino de todos os envios, se houver:
+    o primeiro valor não vazio entre WHATSAPP_TEST_NUMBER (atual),
+    NUMBER_TEST (o do .env) e NUMBER_TESTE (documentação antiga).
+    """
+
+    for name in ("WHATSAPP_TEST_NUMBER", "NUMBER_TEST", "NUMBER_TESTE"):
+        value = os.getenv(name)
+        if value:
+            return value
+    return ""
+
+
+@lru_cache(maxsize=_env_int("WBUY_PHONE_CACHE_SIZE", 4096))
+def check(phone: str) -> PhoneCheck:
+    """
+    Normaliza e valida um telefone brasileiro para o WhatsApp.
+
+    Aceita máscaras, +55, 0 de longa distância e código de operadora;
+    insere o nono dígito em celulares antigos de 8 dígitos e recusa fixos,
+    DDDs inexistentes e tamanhos errados. Números estrangeiros só passam
+    quando vêm com "+" explícito. Os resultados recentes ficam em memória.
+    """
+
+    raw = (phone or "").strip()
+    digits = _NON_DIGITS.sub("", raw)
+    if not digits:
+        return PhoneCheck("", "missing")
+
+    if raw.startswith("+") and not digits.startswith("55"):
+        if _INTERNATIONAL.fullmatch(digits) is None:
+            return PhoneCheck("", "invalid_length")
+        return PhoneCheck(digits)
+
+    if digits.startswith("0"):
+        digits = _CARRIER_PREFIX.sub("", digits, count=1).lstrip("0")
+    if digits.startswith("55") and len(digits) in (12, 13):
+        digits = digits[2:]
+
+    match = _MOBILE.fullmatch(digits)
+    if match is None:
+        eight = _EIGHT_DIGITS.fullmatch(digits)
+        if eight is None:
+            return PhoneCheck("", "invalid_length")
+        if eight.group(2)[0] in "2345":
+            return PhoneCheck("", "landline")
+        ddd, number = eight.group(1), "9" + eight.group(2)
+    else:
+        ddd, number = match.groups()
+
+    if ddd not in VALID_DDDS:
+        return PhoneCheck("", "invalid_ddd")
+    return PhoneCheck(f"55{ddd}{number}")
+
+
+def normalize(phone: str) -> str:
+    return check(phone or "").number
+
+
+def _conn():
+    return db.connect(NO_WHATSAPP_DB, _SCHEMA)
+
+
+def _no_whatsapp_ttl() -> float:
+    # 0 desliga o cache de números sem WhatsApp.
+    return _env_float("WBUY_NO_WHATSAPP_TTL", 30 * 24 * 3600)
+
+
+def is_no_whatsapp_response(status_code: Optional[int], text: str) -> bool:
+    return (
+        status_code is not None
+        and 400 <= status_code < 500
+        and any(marker in (text or "") for marker in _NO_WHATSAPP_MARKERS)
+    )
+
+
+def has_no_whatsapp(number: str) -> bool:
+    """
+    True se o Whaticket confirmou há menos de WBUY_NO_WHATSAPP_TTL segundos
+    que o número não tem WhatsApp.
+    """
+
+    ttl = _no_whatsapp_ttl()
+    if ttl <= 0 or not number:
+        return False
+    row = _conn().execute(
+        "SELECT 1 FROM no_whatsapp WHERE number = ? AND confirmed_at >= ?",
+        (number, time.time() - ttl),
+    ).fetchone()
+    return row is not None
+
+
+def record_send_failure(number: str, status_code: Optional[int], text: str) -> bool:
+    """
+    Guarda o número quando a resposta de erro do Whaticket indica que ele
+    não tem WhatsApp. Retorna True nesse caso.
+    """
+
+    if _no_whatsapp_ttl() <= 0 or not number or not is_no_whatsapp_response(status_code, text):
+        return False
+    _conn().execute(
+        "INSERT INTO no_whatsapp (number, confirmed_at) VALUES (?, ?) "
+        "ON CONFLICT(number) DO UPDATE SET confirmed_at = excluded.confirmed_at",
+        (number, time.time()),
+    )
+    logger.info("Número sem WhatsApp registrado.", extra={"phone": number})
+    return True
+
+
+def forget(number: str) -> None:
+    _conn().execute("DELETE FROM no_whatsapp WHERE number = ?", (number,))
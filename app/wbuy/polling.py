@@ -1,8 +1,332 @@
-def list_pending_orders():
-    """Faz GET na API da WBuy e retorna pedidos aguardando pagamento."""
-    pass
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Dict, List, Optional
 
+from . import db, http_client, jobs, log, models, storage, tenants
 
-def get_order_details(order_id: int):
-    """Retorna o JSON completo do pedido."""
-    pass
+DEFAULT_API_URL = "https://sistema.sistemawbuy.com.br/api/v1"
+POLL_DB = storage.BASE_DIR / "storage" / "polling.db"
+CURSOR_NAME = "pending_orders"
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS poll_cursor (
+    name TEXT PRIMARY KEY,
+    high_water INTEGER NOT NULL DEFAULT 0,
+    lease_until REAL NOT NULL DEFAULT 0,
+    updated_at REAL NOT NULL DEFAULT 0,
+    resume_page INTEGER NOT NULL DEFAULT 0,
+    resume_below INTEGER NOT NULL DEFAULT 0,
+    resume_target INTEGER NOT NULL DEFAULT 0
+);
+"""
+
+logger = log.get_logger("polling")
+
+_lock = threading.Lock()
+_thread: Optional[threading.Thread] = None
+_thread_pid: Optional[int] = None
+_stop = threading.Event()
+_stats: Dict[str, Any] = {"runs": 0, "queued": 0, "errors": 0, "last_run": None, "last_result": None}
+
+
+def _env_int(name: str, default: int) -> int:
+    try:
+        return int(os.getenv(name, default))
+    except (TypeError, ValueError):
+        return default
+
+
+def _env_float(name: str, default: float) -> float:
+    try:
+        return float(os.getenv(name, default))
+    except (TypeError, ValueError):
+        return default
+
+
+def _api_url() -> str:
+    return os.getenv("WBUY_API_URL", DEFAULT_API_URL).rstrip("/")
+
+
+def _headers() -> Dict[str, str]:
+    return {"Authorization": f"Bearer {os.getenv('WBUY_API_TOKEN', '')}"}
+
+
+def _migrate(connection) -> None:
+    # Cursores criados antes da retomada entre rodadas.
+    db.add_column(connection, "poll_cursor", "resume_page", "INTEGER NOT NULL DEFAULT 0")
+    db.add_column(connection, "poll_cursor", "resume_below", "INTEGER NOT NULL DEFAULT 0")
+    db.add_column(connection, "poll_cursor", "resume_target", "INTEGER NOT NULL DEFAULT 0")
+
+
+def _conn():
+    connection = db.connect(POLL_DB, _SCHEMA, _migrate)
+    connection.execute("INSERT OR IGNORE INTO poll_cursor (name) VALUES (?)", (CURSOR_NAME,))
+    return connection
+
+
+def _order_number(order: Dict[str, Any]) -> Optional[int]:
+    try:
+        return int(str(order.get("id")).strip())
+    except (TypeError, ValueError):
+        return None
+
+
+def list_pending_orders(page: int = 1, limit: Optional[int] = None) -> List[Dict[str, Any]]:
+    """
+    Faz GET na API da WBuy e retorna uma página de pedidos aguardando
+    pagamento (WBUY_POLL_STATUS), do mais novo para o mais antigo.
+    """
+
+    response = http_client.request(
+        "GET",
+        f"{_api_url()}/order",
+        headers=_headers(),
+        params={
+            "status": os.getenv("WBUY_POLL_STATUS", "aguardando_pagamento"),
+            "page": page,
+            "limit": limit or _env_int("WBUY_POLL_PAGE_SIZE", 50),
+        },
+    )
+    response.raise_for_status()
+    data = response.json().get("data") or []
+    return data if isinstance(data, list) else []
+
+
+def get_order_details(order_id: int) -> Optional[Dict[str, Any]]:
+    """Retorna o JSON completo do pedido (o mesmo conteúdo de data no webhook)."""
+
+    response = http_client.request("GET", f"{_api_url()}/order/{order_id}", headers=_headers())
+    if response.status_code == 404:
+        return None
+    response.raise_for_status()
+    data = response.json().get("data")
+    if isinstance(data, list):
+        data = data[0] if data else None
+    return data if isinstance(data, dict) else None
+
+
+def get_cursor() -> int:
+    row = _conn().execute(
+        "SELECT high_water FROM poll_cursor WHERE name = ?", (CURSOR_NAME,)
+    ).fetchone()
+    return row[0]
+
+
+def set_cursor(high_water: int) -> None:
+    _conn().execute(
+        "UPDATE poll_cursor SET high_water = ?, updated_at = ?, resume_page = 0, "
+        "resume_below = 0, resume_target = 0 WHERE name = ?",
+        (high_water, time.time(), CURSOR_NAME),
+    )
+
+
+def _save_resume(page: int, below: int, target: int) -> None:
+    """
+    Guarda onde a varredura parou ao esgotar WBUY_POLL_MAX_PAGES: a próxima
+    rodada continua da página ``page`` com os pedidos abaixo de ``below`` e,
+    ao terminar, leva o cursor a ``target``.
+    """
+
+    _conn().execute(
+        "UPDATE poll_cursor SET resume_page = ?, resume_below = ?, resume_target = ?, "
+        "updated_at = ? WHERE name = ?",
+        (page, below, target, time.time(), CURSOR_NAME),
+    )
+
+
+def _acquire_lease(seconds: float) -> bool:
+    """
+    Garante que só um worker do gunicorn rode a reconciliação a cada
+    intervalo: o lease fica com quem rodou até expirar.
+    """
+
+    now = time.time()
+    cursor = _conn().execute(
+        "UPDATE poll_cursor SET lease_until = ? WHERE name = ? AND lease_until < ?",
+        (now + seconds, CURSOR_NAME, now),
+    )
+    return cursor.rowcount == 1
+
+
+def reconcile(full: bool = False) -> Dict[str, int]:
+    """
+    Percorre os pedidos pendentes mais novos que o cursor persistido e
+    coloca na fila de envio os que não estão no storage de processados.
+
+    As páginas vêm do mais novo para o mais antigo; a leitura para ao
+    alcançar o cursor ou no fim da lista. Se WBUY_POLL_MAX_PAGES acabar
+    antes, o cursor não avança: a próxima rodada retoma da página seguinte
+    e só então move o cursor.
+    Os detalhes são buscados em paralelo (WBUY_POLL_CONCURRENCY) e seguem o
+    mesmo caminho do webhook: job na fila → process_webhook. O cursor só
+    avança até antes do primeiro pedido cuja busca falhou. full=True ignora
+    o cursor.
+
+    Só atende o tenant padrão: a API da WBuy (WBUY_API_URL/WBUY_API_TOKEN)
+    e o cursor são de uma loja, e o arquivo de tenants não traz credenciais
+    da WBuy. Os pedidos são validados com os templates do tenant padrão e
+    entram na fila sem tenants.PAYLOAD_KEY, como os da rota /wbuy/webhook.
+    """
+
+    state = _conn().execute(
+        "SELECT high_water, resume_page, resume_below, resume_target FROM poll_cursor "
+        "WHERE name = ?",
+        (CURSOR_NAME,),
+    ).fetchone()
+    resuming = not full and state["resume_page"] > 0
+    cursor = 0 if full else state["high_water"]
+    limit = _env_int("WBUY_POLL_PAGE_SIZE", 50)
+    result = {"pages": 0, "listed": 0, "missing": 0, "queued": 0, "invalid": 0, "errors": 0}
+
+    # Na retomada só interessam os pedidos abaixo do último já visto; os
+    # mais novos ficam para a rodada seguinte, que recomeça da página 1.
+    # Relê a página anterior à salva, caso a lista tenha andado.
+    ceiling = state["resume_below"] if resuming else None
+    page = max(state["resume_page"] - 1, 1) if resuming else 1
+    high_water = state["resume_target"] if resuming else cursor
+    low_water = ceiling
+    backtracking = resuming
+    finished = False
+    missing: List[int] = []
+    while result["pages"] < _env_int("WBUY_POLL_MAX_PAGES", 20):
+        orders = list_pending_orders(page, limit)
+        result["pages"] += 1
+        numbers = [number for number in map(_order_number, orders) if number is not None]
+
+        # Pedidos pagos saem da lista e puxam os demais para páginas
+        # anteriores: volta até reencontrar o ponto onde a última rodada parou.
+        if backtracking and page > 1 and numbers and max(numbers) < ceiling:
+            page -= 1
+            continue
+        backtracking = False
+
+        result["listed"] += len(orders)
+        newer = [
+            number
+            for number in numbers
+            if number > cursor and (ceiling is None or number < ceiling)
+        ]
+        high_water = max([high_water, *newer])
+        if newer:
+            low_water = min(newer) if low_water is None else min(low_water, *newer)
+        missing.extend(
+            number for number in newer if not storage.is_order_processed(str(number))
+        )
+        # Páginas em ordem decrescente: um pedido no cursor ou abaixo dele
+        # indica que o restante já foi visto.
+        if len(orders) < limit or any(number <= cursor for number in numbers):
+            finished = True
+            break
+        page += 1
+
+    result["missing"] = len(missing)
+    failed: List[int] = []
+    if missing:
+        with ThreadPoolExecutor(
+            max_workers=max(_env_int("WBUY_POLL_CONCURRENCY", 4), 1),
+            thread_name_prefix="wbuy-polling",
+        ) as executor:
+            futures = [(number, executor.submit(get_order_details, number)) for number in missing]
+            for number, future in futures:
+                try:
+                    detail = future.result()
+                except Exception as exc:
+                    logger.warning(
+                        "Erro ao buscar o pedido: %s", exc, extra={"order_id": str(number)}
+                    )
+                    failed.append(number)
+                    continue
+
+                payload = {"data": detail}
+                try:
+                    with tenants.bind(tenants.DEFAULT):
+                        models.Order.from_payload(payload)
+                except models.PayloadError as exc:
+                    logger.warning(
+                        "Pedido ignorado: %s", exc, extra={"order_id": str(number)}
+                    )
+                    result["invalid"] += 1
+                    continue
+
+                jobs.enqueue(payload)
+                result["queued"] += 1
+
+    result["errors"] = len(failed)
+    if failed:
+        high_water = min(high_water, min(failed) - 1)
+    if full:
+        return result
+    if finished:
+        set_cursor(high_water)
+    else:
+        _save_resume(page, low_water if low_water is not None else cursor + 1, high_water)
+    return result
+
+
+def stats() -> Dict[str, Any]:
+    with _lock:
+        return dict(_stats)
+
+
+def run_once() -> Optional[Dict[str, int]]:
+    """
+    Uma rodada do reconciliador, se este processo obtiver o lease.
+    """
+
+    interval = _env_float("WBUY_POLL_INTERVAL", 300)
+    if not _acquire_lease(max(interval - 1.0, 1.0)):
+        return None
+
+    try:
+        result = reconcile()
+    except Exception as exc:
+        logger.error("Falha na reconciliação: %s", exc)
+        with _lock:
+            _stats["errors"] += 1
+        return None
+
+    if result["queued"]:
+        logger.info("%d pedidos sem webhook colocados na fila.", result["queued"])
+    with _lock:
+        _stats["runs"] += 1
+        _stats["queued"] += result["queued"]
+        _stats["errors"] += result["errors"]
+        _stats["last_run"] = time.time()
+        _stats["last_result"] = result
+    return result
+
+
+def _loop(interval: float) -> None:
+    while not _stop.wait(interval):
+        run_once()
+
+
+def start_reconciler() -> bool:
+    """
+    Inicia a thread do reconciliador (WBUY_POLL_INTERVAL segundos entre
+    rodadas). Fica desligado sem WBUY_API_TOKEN ou com intervalo 0.
+    """
+
+    global _thread, _thread_pid
+
+    interval = _env_float("WBUY_POLL_INTERVAL", 300)
+    if interval <= 0 or not os.getenv("WBUY_API_TOKEN"):
+        return False
+
+    pid = os.getpid()
+    with _lock:
+        if _thread is not None and _thread_pid == pid and _thread.is_alive():
+            return True
+        _stop.clear()
+        _thread = threading.Thread(target=_loop, args=(interval,), name="wbuy-polling", daemon=True)
+        _thread.start()
+        _thread_pid = pid
+    return True
+
+
+def stop_reconciler() -> None:
+    _stop.set()
+    if _thread is not None:
+        _thread.join(timeout=5)
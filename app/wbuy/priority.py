@@ -0,0 +1,114 @@
+import os
+import threading
+from typing import Any, Dict, List, Optional
+
+DEFAULT = "default"
+
+
+def _env_int(name: str, default: int) -> int:
+    try:
+        return int(os.getenv(name, default))
+    except (TypeError, ValueError):
+        return default
+
+
+def classes() -> List[str]:
+    """
+    Classes de prioridade, da mais urgente para a menos urgente.
+
+    WBUY_PRIORITY_CLASSES lista os tipo_interno da WBuy com classe própria
+    (padrão "pix,bank_billet": o código PIX expira rápido e o boleto ainda
+    baixa e envia o PDF). Os demais tipos caem na classe "default", sempre
+    a última.
+    """
+
+    names: List[str] = []
+    for name in os.getenv("WBUY_PRIORITY_CLASSES", "pix,bank_billet").split(","):
+        name = name.strip().lower()
+        if name and name not in names and name != DEFAULT:
+            names.append(name)
+    names.append(DEFAULT)
+    return names
+
+
+def class_of(kind: Optional[str]) -> str:
+    kind = (kind or "").strip().lower()
+    return kind if kind in classes() else DEFAULT
+
+
+def rank(name: str) -> int:
+    """
+    Posição da classe em classes(): 0 é a mais urgente.
+    """
+
+    names = classes()
+    return names.index(name) if name in names else len(names) - 1
+
+
+def of_payload(payload: Any) -> str:
+    """
+    Classe de um job da fila: o tipo_interno do webhook ou a classe gravada
+    no job de retomada ({"delivery_retry": ..., "priority": ...}).
+    """
+
+    if not isinstance(payload, dict):
+        return DEFAULT
+    if "delivery_retry" in payload:
+        return class_of(payload.get("priority"))
+
+    data = payload.get("data")
+    payment = data.get("pagamento") if isinstance(data, dict) else None
+    return class_of(payment.get("tipo_interno") if isinstance(payment, dict) else None)
+
+
+def budget(prefix: str, name: str, default: int) -> int:
+    """
+    Orçamento da classe lido de <prefix>_<CLASSE> (ex.:
+    WHATICKET_SENDER_THREADS_BANK_BILLET), com ``default`` quando ausente.
+    """
+
+    return max(_env_int(f"{prefix}_{name.upper()}", default), 1)
+
+
+class Budgets:
+    """
+    Vagas separadas por classe: uma rajada de uma classe esgota apenas as
+    próprias vagas e nunca segura as das outras.
+    """
+
+    def __init__(self, prefix: str, default: int) -> None:
+        self._prefix = prefix
+        self._default = default
+        self._used: Dict[str, int] = {}
+        self._cond = threading.Condition()
+
+    def limit(self, name: str) -> int:
+        return budget(self._prefix, name, self._default)
+
+    def reserve_any(self, timeout: Optional[float] = None) -> List[str]:
+        """
+        Reserva uma vaga em cada classe que tem espaço, esperando até haver
+        ao menos uma. Quem chama devolve (release) as que não usar.
+        """
+
+        with self._cond:
+            free: List[str] = []
+            while True:
+                free = [name for name in classes() if self._used.get(name, 0) < self.limit(name)]
+                if free or not self._cond.wait(timeout):
+                    break
+            for name in free:
+                self._used[name] = self._used.get(name, 0) + 1
+            return free
+
+    def release(self, name: str) -> None:
+        with self._cond:
+            self._used[name] = max(self._used.get(name, 0) - 1, 0)
+            self._cond.notify_all()
+
+    def stats(self) -> Dict[str, Dict[str, int]]:
+        with self._cond:
+            return {
+                name: {"used": self._used.get(name, 0), "limit": self.limit(name)}
+                for name in classes()
+            }
@@ -0,0 +1,212 @@
+import hashlib
+import math
+import os
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Dict, Iterable, Optional
+
+
+def _env_int(name: str, default: int) -> int:
+    try:
+        return int(os.getenv(name, default))
+    except (TypeError, ValueError):
+        return default
+
+
+def _env_float(name: str, default: float) -> float:
+    try:
+        return float(os.getenv(name, default))
+    except (TypeError, ValueError):
+        return default
+
+
+def enabled() -> bool:
+    return os.getenv("WBUY_PROCESSED_CACHE", "1").strip().lower() not in ("0", "false", "no")
+
+
+_MASK_64 = (1 << 64) - 1
+
+
+class BloomFilter:
+    """
+    Filtro de Bloom em um bytearray: ``capacity`` itens com taxa de falso
+    positivo ``error_rate``. Não há remoção; um id removido do store continua
+    "talvez presente" até o filtro ser reconstruído.
+    """
+
+    def __init__(self, capacity: int, error_rate: float) -> None:
+        self.capacity = max(capacity, 1)
+        self.error_rate = min(max(error_rate, 1e-9), 0.5)
+        bits = -self.capacity * math.log(self.error_rate) / (math.log(2) ** 2)
+        self.size = max(int(math.ceil(bits / 8)) * 8, 64)
+        self.hashes = max(int(round(self.size / self.capacity * math.log(2))), 1)
+        self.count = 0
+        self._bits = bytearray(self.size // 8)
+
+    def _positions(self, item: str) -> Iterable[int]:
+        # Double hashing (Kirsch-Mitzenmacher) com um único blake2b de 128 bits.
+        digest = hashlib.blake2b(item.encode(), digest_size=16).digest()
+        digest = int.from_bytes(digest, "little")
+        position, step, size = digest & _MASK_64, (digest >> 64) | 1, self.size
+        for _ in range(self.hashes):
+            yield position % size
+            position += step
+
+    def add(self, item: str) -> None:
+        bits = self._bits
+        for position in self._positions(item):
+            bits[position >> 3] |= 1 << (position & 7)
+        self.count += 1
+
+    def __contains__(self, item: str) -> bool:
+        bits = self._bits
+        for position in self._positions(item):
+            if not bits[position >> 3] & (1 << (position & 7)):
+                return False
+        return True
+
+
+class ProcessedCache:
+    """
+    Cache por processo na frente do storage de pedidos processados.
+
+    - Bloom: todos os ids processados; "não está" é resposta definitiva, sem I/O.
+    - LRU: ids confirmados recentemente; "está" sem ir ao banco.
+    - Demais casos (possível falso positivo do Bloom) vão ao store.
+
+    O estado acompanha o log de mudanças compartilhado (processed_changes)
+    pelo número de sequência ``last_seq``; ver storage._sync_cache.
+    """
+
+    def __init__(
+        self,
+        capacity: Optional[int] = None,
+        error_rate: Optional[float] = None,
+        lru_size: Optional[int] = None,
+    ) -> None:
+        self.capacity = capacity or _env_int("WBUY_PROCESSED_BLOOM_CAPACITY", 1_000_000)
+        self.error_rate = error_rate or _env_float("WBUY_PROCESSED_BLOOM_ERROR_RATE", 0.01)
+        self.lru_size = lru_size if lru_size is not None else _env_int(
+            "WBUY_PROCESSED_LRU_SIZE", 10_000
+        )
+        self.sync_interval = _env_float("WBUY_PROCESSED_CACHE_SYNC_SECONDS", 0.5)
+        self.lock = threading.RLock()
+        self.bloom = BloomFilter(self.capacity, self.error_rate)
+        self.removed = 0
+        self.last_seq = -1
+        self.synced_at = 0.0
+        self._recent: "OrderedDict[str, None]" = OrderedDict()
+        self._stats = {"negative": 0, "lru": 0, "store_hit": 0, "store_miss": 0, "reloads": 0}
+        self._reported = dict(self._stats)
+
+    @property
+    def loaded(self) -> bool:
+        return self.last_seq >= 0
+
+    def sync_due(self) -> bool:
+        return not self.loaded or time.monotonic() - self.synced_at >= self.sync_interval
+
+    def needs_reload(self) -> bool:
+        """
+        Filtro cheio ou com muitos ids já removidos do store: a taxa de falso
+        positivo passou da configurada e vale reconstruí-lo.
+        """
+
+        return (
+            not self.loaded
+            or self.bloom.count > self.capacity
+            or self.removed > max(self.bloom.count // 2, 1000)
+        )
+
+    def reset(self, order_ids: Iterable[str], seq: int, total: int) -> None:
+        while total > self.capacity:
+            self.capacity *= 2
+        self.bloom = BloomFilter(self.capacity, self.error_rate)
+        for order_id in order_ids:
+            self.bloom.add(order_id)
+        self.removed = 0
+        self._recent.clear()
+        self.last_seq = seq
+        self.synced_at = time.monotonic()
+        self._stats["reloads"] += 1
+
+    def apply(self, changes: Iterable[Any]) -> None:
+        """
+        Aplica em ordem as mudanças (seq, order_id, op) lidas do log.
+        """
+
+        for seq, order_id, op in changes:
+            if op == "add":
+                self.bloom.add(order_id)
+                self._remember(order_id)
+            else:
+                self._recent.pop(order_id, None)
+                self.removed += 1
+            self.last_seq = seq
+        self.synced_at = time.monotonic()
+
+    def _remember(self, order_id: str) -> None:
+        if self.lru_size <= 0:
+            return
+        self._recent[order_id] = None
+        self._recent.move_to_end(order_id)
+        while len(self._recent) > self.lru_size:
+            self._recent.popitem(last=False)
+
+    def lookup(self, order_id: str) -> Optional[bool]:
+        """
+        True/False quando a memória basta para responder; None quando é
+        preciso confirmar no store.
+        """
+
+        with self.lock:
+            if order_id in self._recent:
+                self._recent.move_to_end(order_id)
+                self._stats["lru"] += 1
+                return True
+            if order_id not in self.bloom:
+                self._stats["negative"] += 1
+                return False
+            return None
+
+    def confirm(self, order_id: str, processed: bool) -> None:
+        """
+        Resultado da consulta ao store para um id que o Bloom não descartou.
+        """
+
+        with self.lock:
+            if processed:
+                self._stats["store_hit"] += 1
+                self._remember(order_id)
+            else:
+                self._stats["store_miss"] += 1
+
+    def unreported(self) -> Dict[str, int]:
+        """
+        Contagens desde a última chamada, para as métricas do processo (que
+        assim não pagam um lock por consulta).
+        """
+
+        with self.lock:
+            delta = {key: value - self._reported[key] for key, value in self._stats.items()}
+            self._reported = dict(self._stats)
+            return {key: value for key, value in delta.items() if value}
+
+    def stats(self) -> Dict[str, Any]:
+        with self.lock:
+            stats: Dict[str, Any] = dict(self._stats)
+            memory = stats["negative"] + stats["lru"]
+            store = stats["store_hit"] + stats["store_miss"]
+            lookups = memory + store
+            stats.update(
+                lookups=lookups,
+                hit_rate=round(memory / lookups, 4) if lookups else 0.0,
+                false_positive_rate=round(stats["store_miss"] / store, 4) if store else 0.0,
+                bloom_items=self.bloom.count,
+                bloom_capacity=self.capacity,
+                bloom_bytes=self.bloom.size // 8,
+                lru_items=len(self._recent),
+                last_seq=self.last_seq,
+            )
+            return stats
@@ -0,0 +1,399 @@
+"""
+Reprocessa webhooks gravados: segmentos do archive (storage/webhooks) e os
+raw_*.txt do formato antigo.
+
+    python -m app.wbuy.replay --since 2026-10-01 --until 2026-10-02 --rate 20
+    python -m app.wbuy.replay --dry-run
+
+Os arquivos são lidos e validados em paralelo em um pool de processos; de
+cada pedido vale o webhook mais recente. Pedidos já no processed store
+ficam de fora (com --revive-dead, os que foram para dead letters voltam a
+ser tentados). Os demais passam por process_webhook com no máximo --rate
+pedidos/s e até --concurrency sequências em andamento. Cada pedido
+tratado é anotado em storage/replay.db sob o nome da rodada (--run), então
+rodar de novo o mesmo comando continua de onde parou.
+"""
+
+import argparse
+import os
+import sys
+import threading
+import time
+from concurrent.futures import Future, ProcessPoolExecutor
+from datetime import datetime, timezone
+from functools import partial
+from pathlib import Path
+from typing import Any, Dict, Iterable, Iterator, List, NamedTuple, Optional, Tuple
+
+from . import archive, db, delivery_log, log, models, priority, storage, tenants
+from .scheduler import TokenBucket
+
+REPLAY_DB = storage.BASE_DIR / "storage" / "replay.db"
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS replayed (
+    run TEXT NOT NULL,
+    order_id TEXT NOT NULL,
+    status TEXT NOT NULL,
+    replayed_at REAL NOT NULL,
+    PRIMARY KEY (run, order_id)
+);
+"""
+
+LEGACY_PREFIX = "raw_"
+LEGACY_BATCH = 500
+
+logger = log.get_logger("replay")
+
+
+class Candidate(NamedTuple):
+    received_at: float
+    order_id: str
+    payload: Dict[str, Any]
+
+
+class Source(NamedTuple):
+    # kind: "segment" (um arquivo) ou "legacy" (lote de raw_*.txt)
+    kind: str
+    paths: Tuple[str, ...]
+
+
+def _conn():
+    return db.connect(REPLAY_DB, _SCHEMA)
+
+
+def parse_date(value: str) -> float:
+    """
+    Data ou data e hora ISO (horário local), para --since/--until.
+    """
+
+    return datetime.fromisoformat(value).timestamp()
+
+
+def legacy_received_at(path: Path) -> Optional[float]:
+    # raw_<%Y%m%d%H%M%S%f em UTC>.txt, gravado pelo save_raw_payload antigo.
+    stamp = path.stem[len(LEGACY_PREFIX):]
+    try:
+        parsed = datetime.strptime(stamp, "%Y%m%d%H%M%S%f")
+    except ValueError:
+        return None
+    return parsed.replace(tzinfo=timezone.utc).timestamp()
+
+
+def _segment_start(path: Path) -> Optional[float]:
+    stamp = path.name[len(archive.SEGMENT_PREFIX):].split("-", 1)[0]
+    try:
+        parsed = datetime.strptime(stamp, "%Y%m%d%H%M%S")
+    except ValueError:
+        return None
+    return parsed.replace(tzinfo=timezone.utc).timestamp()
+
+
+def discover(source: Path, until: Optional[float] = None) -> List[Source]:
+    """
+    Unidades de trabalho do pool: um segmento por vez e os raw_*.txt em
+    lotes de LEGACY_BATCH arquivos.
+    """
+
+    sources = []
+    for path in sorted(source.glob(f"{archive.SEGMENT_PREFIX}*{archive.SEGMENT_SUFFIX}")):
+        start = _segment_start(path)
+        if until is not None and start is not None and start > until:
+            continue
+        sources.append(Source("segment", (str(path),)))
+
+    legacy = [str(path) for path in sorted(source.glob(f"{LEGACY_PREFIX}*.txt"))]
+    for index in range(0, len(legacy), LEGACY_BATCH):
+        sources.append(Source("legacy", tuple(legacy[index:index + LEGACY_BATCH])))
+    return sources
+
+
+def _in_range(received_at: float, since: Optional[float], until: Optional[float]) -> bool:
+    return (since is None or received_at >= since) and (until is None or received_at < until)
+
+
+def _records(unit: Source) -> Iterator[Tuple[float, str, bytes]]:
+    # O tenant vem da chave gravada no cabeçalho do archive (tenants.scoped);
+    # os raw_*.txt antigos são todos do tenant padrão.
+    if unit.kind == "segment":
+        for record in archive.read_segment(Path(unit.paths[0])):
+            yield record.received_at, tenants.split(record.order_id or "")[0], record.payload
+        return
+    for name in unit.paths:
+        path = Path(name)
+        received_at = legacy_received_at(path)
+        if received_at is None:
+            received_at = path.stat().st_mtime
+        yield received_at, tenants.DEFAULT, path.read_bytes()
+
+
+def parse_source(
+    unit: Source, since: Optional[float], until: Optional[float]
+) -> Tuple[List[Candidate], int]:
+    """
+    Lê e valida os webhooks de uma unidade (roda nos processos do pool).
+    Retorna os pedidos válidos e quantos payloads foram recusados.
+    """
+
+    candidates, invalid = [], 0
+    for received_at, tenant, raw in _records(unit):
+        if not _in_range(received_at, since, until):
+            continue
+        try:
+            payload = models.loads(raw)
+            order = models.Order.from_payload(payload)
+        except models.PayloadError:
+            invalid += 1
+            continue
+        if tenant:
+            payload = {**payload, tenants.PAYLOAD_KEY: tenant}
+        candidates.append(Candidate(received_at, tenants.scoped(order.id, tenant), payload))
+    return candidates, invalid
+
+
+def collect(
+    units: List[Source],
+    since: Optional[float],
+    until: Optional[float],
+    processes: int,
+) -> Tuple[List[Candidate], int]:
+    """
+    Junta o resultado do pool guardando, por pedido, o webhook mais recente.
+    Os pedidos saem na ordem em que chegaram.
+    """
+
+    latest: Dict[str, Candidate] = {}
+    invalid = 0
+
+    def merge(results: Iterable[Tuple[List[Candidate], int]]) -> None:
+        nonlocal invalid
+        for candidates, rejected in results:
+            invalid += rejected
+            for candidate in candidates:
+                current = latest.get(candidate.order_id)
+                if current is None or candidate.received_at >= current.received_at:
+                    latest[candidate.order_id] = candidate
+
+    if processes <= 1 or len(units) <= 1:
+        merge(parse_source(unit, since, until) for unit in units)
+    else:
+        with ProcessPoolExecutor(max_workers=processes) as pool:
+            merge(pool.map(parse_source, units, [since] * len(units), [until] * len(units)))
+
+    return sorted(latest.values(), key=lambda candidate: candidate.received_at), invalid
+
+
+def replayed(run: str) -> Dict[str, str]:
+    rows = _conn().execute("SELECT order_id, status FROM replayed WHERE run = ?", (run,))
+    return {row["order_id"]: row["status"] for row in rows}
+
+
+def _record(run: str, order_id: str, status: str) -> None:
+    _conn().execute(
+        "INSERT INTO replayed (run, order_id, status, replayed_at) VALUES (?, ?, ?, ?) "
+        "ON CONFLICT(run, order_id) DO UPDATE SET status = excluded.status, "
+        "replayed_at = excluded.replayed_at",
+        (run, order_id, status, time.time()),
+    )
+
+
+def plan(
+    candidates: List[Candidate], run: str, revive_dead: bool
+) -> Tuple[List[Tuple[str, Candidate]], Dict[str, int]]:
+    """
+    Decide o que fazer com cada pedido: "process" (process_webhook),
+    "revive" (dead letter de volta à fila) ou pular. Retorna as ações e a
+    contagem dos pulos por motivo.
+    """
+
+    done = replayed(run)
+    actions: List[Tuple[str, Candidate]] = []
+    skipped = {"already_replayed": 0, "already_processed": 0}
+    for candidate in candidates:
+        if candidate.order_id in done:
+            skipped["already_replayed"] += 1
+            continue
+        if not storage.is_order_processed(candidate.order_id):
+            actions.append(("process", candidate))
+            continue
+        if revive_dead:
+            delivery = delivery_log.load(candidate.order_id)
+            if delivery is not None and delivery.status == "dead":
+                actions.append(("revive", candidate))
+                continue
+        skipped["already_processed"] += 1
+    return actions, skipped
+
+
+class Progress:
+    """
+    Linha de progresso em stderr a cada ``interval`` segundos.
+    """
+
+    def __init__(self, total: int, stream: Any = None, interval: float = 2.0) -> None:
+        self.total = total
+        self.stream = stream or sys.stderr
+        self.interval = interval
+        self.counts: Dict[str, int] = {}
+        self.done = 0
+        self.started = time.monotonic()
+        self._last = 0.0
+
+    def update(self, status: str) -> None:
+        self.done += 1
+        self.counts[status] = self.counts.get(status, 0) + 1
+        now = time.monotonic()
+        if now - self._last >= self.interval or self.done == self.total:
+            self._last = now
+            self.write(now)
+
+    def write(self, now: Optional[float] = None) -> None:
+        elapsed = max((now or time.monotonic()) - self.started, 1e-6)
+        rate = self.done / elapsed
+        remaining = (self.total - self.done) / rate if rate > 0 else 0.0
+        detail = " ".join(f"{status}={count}" for status, count in sorted(self.counts.items()))
+        self.stream.write(
+            f"replay {self.done}/{self.total} {rate:6.1f} pedidos/s "
+            f"faltam {remaining:5.0f}s  {detail}\n"
+        )
+        self.stream.flush()
+
+
+def _status_of(result: Any) -> str:
+    if isinstance(result, dict):
+        status = result.get("status")
+        if status == "skipped":
+            return f"skipped:{result.get('reason')}"
+        return str(status or "ok")
+    return "ok"
+
+
+def run_actions(
+    actions: List[Tuple[str, Candidate]],
+    run: str,
+    rate: float,
+    concurrency: int,
+    progress: Optional[Progress] = None,
+) -> Dict[str, int]:
+    """
+    Executa as ações respeitando ``rate`` pedidos/s (0 = sem limite) e no
+    máximo ``concurrency`` sequências de envio em andamento. Os envios
+    seguem pelo scheduler (ou DeliveryEngine), como nos workers da fila.
+    """
+
+    from .webhook import process_webhook, resume_delivery
+
+    bucket = TokenBucket(rate, max(rate, 1.0))
+    slots = threading.BoundedSemaphore(max(concurrency, 1))
+    progress = progress or Progress(len(actions))
+    lock = threading.Lock()
+
+    def finish(order_id: str, status: str) -> None:
+        # Exceções não são anotadas: a próxima rodada tenta de novo.
+        if status != "exception":
+            _record(run, order_id, status)
+        with lock:
+            progress.update(status)
+        slots.release()
+
+    def on_done(order_id: str, done: Future) -> None:
+        try:
+            status = _status_of(done.result())
+        except Exception:
+            logger.exception("Falha no replay do pedido.", extra={"order_id": order_id})
+            status = "exception"
+        finish(order_id, status)
+
+    for action, candidate in actions:
+        while True:
+            wait = bucket.try_acquire()
+            if wait <= 0:
+                break
+            time.sleep(wait)
+        slots.acquire()
+        try:
+            if action == "revive":
+                delivery_log.revive(candidate.order_id)
+                result = resume_delivery(
+                    candidate.order_id, wait=False, lane=priority.of_payload(candidate.payload)
+                )
+            else:
+                result = process_webhook(candidate.payload, wait=False)
+        except Exception:
+            logger.exception("Falha no replay do pedido.", extra={"order_id": candidate.order_id})
+            finish(candidate.order_id, "exception")
+            continue
+        if isinstance(result, Future):
+            result.add_done_callback(partial(on_done, candidate.order_id))
+        else:
+            finish(candidate.order_id, _status_of(result))
+
+    # Espera as últimas sequências terminarem.
+    for _ in range(max(concurrency, 1)):
+        slots.acquire()
+    return progress.counts
+
+
+def default_run_name(since: Optional[str], until: Optional[str]) -> str:
+    return f"{since or 'inicio'}..{until or 'fim'}"
+
+
+def build_parser() -> argparse.ArgumentParser:
+    parser = argparse.ArgumentParser(
+        description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter
+    )
+    parser.add_argument("--source", type=Path, default=None, help="padrão: storage/webhooks")
+    parser.add_argument("--since", help="recebidos a partir de (ISO, horário local)")
+    parser.add_argument("--until", help="recebidos antes de (ISO, horário local)")
+    parser.add_argument("--rate", type=float, default=10.0, help="pedidos/s; 0 = sem limite")
+    parser.add_argument(
+        "--concurrency", type=int, default=50, help="sequências de envio em andamento"
+    )
+    parser.add_argument("--processes", type=int, default=os.cpu_count() or 1)
+    parser.add_argument("--run", help="nome da rodada para retomar (padrão: o intervalo)")
+    parser.add_argument("--revive-dead", action="store_true")
+    parser.add_argument("--dry-run", action="store_true", help="só lista o que seria feito")
+    return parser
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    args = build_parser().parse_args(argv)
+    since = parse_date(args.since) if args.since else None
+    until = parse_date(args.until) if args.until else None
+    run = args.run or default_run_name(args.since, args.until)
+    source = args.source or storage.WEBHOOK_DIR
+
+    started = time.perf_counter()
+    units = discover(source, until)
+    candidates, invalid = collect(units, since, until, args.processes)
+    actions, skipped = plan(candidates, run, args.revive_dead)
+    sys.stdout.write(
+        f"{len(candidates)} pedidos em {len(units)} arquivos/lotes "
+        f"({time.perf_counter() - started:.1f}s), {invalid} payloads inválidos; "
+        f"já reprocessados nesta rodada: {skipped['already_replayed']}, "
+        f"já processados: {skipped['already_processed']}, a reprocessar: {len(actions)}\n"
+    )
+
+    if args.dry_run:
+        for action, candidate in actions:
+            received = datetime.fromtimestamp(candidate.received_at).isoformat(timespec="seconds")
+            sys.stdout.write(f"{action:<8} {candidate.order_id:<12} {received}\n")
+        return 0
+
+    if not actions:
+        return 0
+
+    from .. import bootstrap
+
+    # Templates carregados, sem workers da fila: o replay envia direto.
+    bootstrap(start_workers=False)
+    counts = run_actions(actions, run, args.rate, args.concurrency)
+    sys.stdout.write(
+        "resultado: " + ", ".join(f"{status}={count}" for status, count in sorted(counts.items()))
+        + "\n"
+    )
+    return 1 if counts.get("exception") else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,433 @@
+import heapq
+import itertools
+import os
+import sqlite3
+import threading
+import time
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Any, Callable, Deque, Dict, List, NamedTuple, Optional, Tuple, Union
+
+from . import db, log, metrics, priority, tenants
+from .storage import BASE_DIR
+
+RATE_DB = BASE_DIR / "storage" / "ratelimit.db"
+
+_RATE_SCHEMA = """
+CREATE TABLE IF NOT EXISTS buckets (
+    name TEXT PRIMARY KEY,
+    tokens REAL NOT NULL,
+    updated_at REAL NOT NULL
+);
+"""
+
+logger = log.get_logger("scheduler")
+
+
+class Delay(NamedTuple):
+    """
+    Passo de pausa: adia o próximo passo da sequência em ``seconds`` sem
+    ocupar uma thread de envio nem consumir token do rate limit.
+    """
+
+    seconds: float
+
+
+Step = Union[Callable[[], Union[Optional[Dict[str, Any]], Future]], Delay]
+
+
+def _env_float(name: str, default: float) -> float:
+    try:
+        return float(os.getenv(name, default))
+    except (TypeError, ValueError):
+        return default
+
+
+class TokenBucket:
+    """
+    Limite de envios deste processo (rate mensagens/s, com rajada de até
+    ``capacity``). rate <= 0 desativa o limite. Para o limite da conta do
+    Whaticket entre processos, ver SharedTokenBucket.
+    """
+
+    def __init__(self, rate: float, capacity: float) -> None:
+        self.rate = rate
+        self.capacity = max(capacity, 1.0)
+        self._tokens = self.capacity
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def try_acquire(self, now: Optional[float] = None) -> float:
+        """
+        Consome um token e retorna 0, ou retorna quantos segundos faltam
+        para o próximo token ficar disponível.
+        """
+
+        if self.rate <= 0:
+            return 0.0
+
+        now = time.monotonic() if now is None else now
+        with self._lock:
+            elapsed = max(now - self._updated, 0.0)
+            self._tokens = min(self.capacity, self._tokens + elapsed * self.rate)
+            self._updated = now
+            if self._tokens >= 1.0:
+                self._tokens -= 1.0
+                return 0.0
+            return (1.0 - self._tokens) / self.rate
+
+
+class SharedTokenBucket(TokenBucket):
+    """
+    TokenBucket dividido entre todos os processos (workers do gunicorn,
+    replay) pelo SQLite em storage/ratelimit.db: WHATICKET_RATE_LIMIT vale
+    para a conta do Whaticket, não para cada processo. Se o banco falhar,
+    cai para o limite local do processo.
+    """
+
+    def __init__(self, name: str, rate: float, capacity: float) -> None:
+        super().__init__(rate, capacity)
+        self.name = name
+
+    def try_acquire(self, now: Optional[float] = None) -> float:
+        if self.rate <= 0:
+            return 0.0
+
+        # Relógio de parede: o monotonic de cada processo tem outra origem.
+        now = time.time() if now is None else now
+        try:
+            with self._lock:
+                return self._acquire_shared(now)
+        except sqlite3.Error:
+            logger.exception("Rate limit compartilhado indisponível; usando o do processo.")
+            return super().try_acquire()
+
+    def _acquire_shared(self, now: float) -> float:
+        connection = db.connect(RATE_DB, _RATE_SCHEMA)
+        connection.execute("BEGIN IMMEDIATE")
+        try:
+            row = connection.execute(
+                "SELECT tokens, updated_at FROM buckets WHERE name = ?", (self.name,)
+            ).fetchone()
+            tokens = self.capacity
+            if row is not None:
+                elapsed = max(now - row["updated_at"], 0.0)
+                tokens = min(self.capacity, row["tokens"] + elapsed * self.rate)
+
+            wait = 0.0
+            if tokens >= 1.0:
+                tokens -= 1.0
+            else:
+                wait = (1.0 - tokens) / self.rate
+            connection.execute(
+                "INSERT INTO buckets (name, tokens, updated_at) VALUES (?, ?, ?) "
+                "ON CONFLICT(name) DO UPDATE SET "
+                "tokens = excluded.tokens, updated_at = excluded.updated_at",
+                (self.name, tokens, now),
+            )
+        except BaseException:
+            connection.execute("ROLLBACK")
+            raise
+        connection.execute("COMMIT")
+        return wait
+
+
+def shared_bucket(
+    tenant: str = tenants.DEFAULT, rate: Optional[float] = None, burst: Optional[float] = None
+) -> SharedTokenBucket:
+    """
+    Token bucket da conta do Whaticket do tenant, comum ao scheduler com
+    threads e ao DeliveryEngine de todos os processos. ``rate``/``burst``
+    None usam WHATICKET_RATE_LIMIT/WHATICKET_RATE_BURST.
+    """
+
+    return SharedTokenBucket(
+        f"whaticket:{tenant}" if tenant else "whaticket",
+        rate if rate is not None else _env_float("WHATICKET_RATE_LIMIT", 5.0),
+        burst if burst is not None else _env_float("WHATICKET_RATE_BURST", 10.0),
+    )
+
+
+class _Sequence:
+    __slots__ = ("phone", "steps", "future", "index", "lane", "submitted")
+
+    def __init__(self, phone: str, steps: List[Step], future: Future, lane: str) -> None:
+        self.phone = phone
+        self.steps = steps
+        self.future = future
+        self.index = 0
+        self.lane = lane
+        self.submitted = time.monotonic()
+
+
+class Scheduler:
+    """
+    Fila de atrasos que envia as mensagens de cada telefone em ordem, com um
+    intervalo mínimo entre elas, intercalando clientes diferentes.
+
+    Cada sequência é uma lista de passos (callables). Um passo que retorna um
+    dict interrompe a sequência e esse dict vira o resultado do Future; se
+    todos retornarem None, o Future termina com None. Um passo pode também
+    retornar um Future, cujo resultado é tratado da mesma forma. Sequências do mesmo
+    telefone nunca se sobrepõem: a próxima começa depois da anterior.
+
+    Cada sequência pertence a uma classe de prioridade (priority.classes()).
+    Passos prontos das classes mais urgentes saem primeiro, e cada classe tem
+    o próprio limite de threads ocupadas (WHATICKET_SENDER_THREADS_<CLASSE>,
+    padrão WHATICKET_SENDER_THREADS): PDFs de boleto lentos não seguram o PIX.
+    """
+
+    def __init__(
+        self,
+        gap: Optional[float] = None,
+        rate: Optional[float] = None,
+        burst: Optional[float] = None,
+        threads: Optional[int] = None,
+        bucket: Optional[TokenBucket] = None,
+    ) -> None:
+        self._gap = gap
+        self.bucket = bucket or TokenBucket(
+            rate if rate is not None else _env_float("WHATICKET_RATE_LIMIT", 5.0),
+            burst if burst is not None else _env_float("WHATICKET_RATE_BURST", 10.0),
+        )
+        self._threads = threads or int(_env_float("WHATICKET_SENDER_THREADS", 8))
+        self._budgets = {
+            lane: priority.budget("WHATICKET_SENDER_THREADS", lane, self._threads)
+            for lane in priority.classes()
+        }
+        self._executor = ThreadPoolExecutor(
+            max_workers=sum(self._budgets.values()), thread_name_prefix="wbuy-sender"
+        )
+        self._heap: List[Any] = []
+        self._counter = itertools.count()
+        self._waiting: Dict[str, Deque[_Sequence]] = {}
+        self._ready: Dict[str, Deque[_Sequence]] = {lane: deque() for lane in self._budgets}
+        self._running: Dict[str, int] = {lane: 0 for lane in self._budgets}
+        self._cond = threading.Condition()
+        self._thread = threading.Thread(
+            target=self._dispatch_loop, name="wbuy-scheduler", daemon=True
+        )
+        self._thread.start()
+
+    @property
+    def gap(self) -> float:
+        if self._gap is not None:
+            return self._gap
+        return _env_float("WHATICKET_MESSAGE_GAP", 1.0)
+
+    def pending(self) -> int:
+        with self._cond:
+            return sum(len(queue) for queue in self._waiting.values())
+
+    def stats(self) -> Dict[str, Dict[str, int]]:
+        """
+        Por classe: passos prontos esperando thread/token, threads ocupadas e
+        o limite de threads.
+        """
+
+        with self._cond:
+            return {
+                lane: {
+                    "ready": len(self._ready[lane]),
+                    "running": self._running[lane],
+                    "threads": budget,
+                }
+                for lane, budget in self._budgets.items()
+            }
+
+    def submit(self, phone: str, steps: List[Step], lane: str = priority.DEFAULT) -> Future:
+        future: Future = Future()
+        if not steps:
+            future.set_result(None)
+            return future
+
+        lane = lane if lane in self._budgets else priority.DEFAULT
+        sequence = _Sequence(phone, list(steps), future, lane)
+
+        with self._cond:
+            queue = self._waiting.setdefault(phone, deque())
+            queue.append(sequence)
+            if len(queue) == 1:
+                self._push(sequence, time.monotonic())
+
+        return future
+
+    def _push(self, sequence: _Sequence, due: float) -> None:
+        heapq.heappush(self._heap, (due, next(self._counter), sequence))
+        self._cond.notify()
+
+    def _promote(self, now: float) -> List[_Sequence]:
+        """
+        Move os passos vencidos do heap para a fila de prontos da classe.
+        Pausas (Delay) são resolvidas aqui; retorna as sequências que
+        terminaram numa pausa final.
+        """
+
+        finished = []
+        while self._heap and self._heap[0][0] <= now:
+            _, _, sequence = heapq.heappop(self._heap)
+            step = sequence.steps[sequence.index]
+            if not isinstance(step, Delay):
+                self._ready[sequence.lane].append(sequence)
+                continue
+            sequence.index += 1
+            if sequence.index < len(sequence.steps):
+                self._push(sequence, now + step.seconds)
+            else:
+                finished.append(sequence)
+        return finished
+
+    def _next_ready(self) -> Tuple[Optional[_Sequence], Optional[float]]:
+        """
+        Próximo passo pronto da classe mais urgente com thread livre, ou o
+        tempo até o próximo token quando o rate limit está esgotado. O token
+        liberado vai para a classe mais urgente que estiver esperando.
+        """
+
+        for lane, ready in self._ready.items():
+            if not ready or self._running[lane] >= self._budgets[lane]:
+                continue
+            wait = self.bucket.try_acquire()
+            if wait > 0:
+                return None, wait
+            self._running[lane] += 1
+            return ready.popleft(), None
+        return None, None
+
+    def _dispatch_loop(self) -> None:
+        while True:
+            with self._cond:
+                while True:
+                    now = time.monotonic()
+                    finished = self._promote(now)
+                    if finished:
+                        break
+                    sequence, wait = self._next_ready()
+                    if sequence is not None:
+                        break
+                    timeouts = [wait] if wait is not None else []
+                    if self._heap:
+                        timeouts.append(self._heap[0][0] - now)
+                    self._cond.wait(min(timeouts) if timeouts else None)
+
+            if finished:
+                for done in finished:
+                    self._finish(done)
+                continue
+
+            if sequence.index == 0:
+                metrics.observe(
+                    "wbuy_delivery_wait_seconds",
+                    time.monotonic() - sequence.submitted,
+                    priority=sequence.lane,
+                )
+            self._executor.submit(self._run_step, sequence)
+
+    def _run_step(self, sequence: _Sequence) -> None:
+        step = sequence.steps[sequence.index]
+        try:
+            result = step()
+        except BaseException as exc:
+            self._release(sequence.lane)
+            self._finish(sequence, exception=exc)
+            return
+
+        self._release(sequence.lane)
+
+        if isinstance(result, Future):
+            # Passo entregue a outro estágio (ex.: batcher): a sequência
+            # continua quando ele terminar, sem prender a thread de envio.
+            result.add_done_callback(lambda done: self._step_done(sequence, done))
+            return
+
+        self._advance(sequence, result)
+
+    def _release(self, lane: str) -> None:
+        with self._cond:
+            self._running[lane] -= 1
+            self._cond.notify()
+
+    def _step_done(self, sequence: _Sequence, done: Future) -> None:
+        try:
+            result = done.result()
+        except BaseException as exc:
+            self._finish(sequence, exception=exc)
+            return
+        self._advance(sequence, result)
+
+    def _advance(self, sequence: _Sequence, result: Optional[Dict[str, Any]]) -> None:
+        sequence.index += 1
+        if result is not None or sequence.index >= len(sequence.steps):
+            self._finish(sequence, result=result)
+            return
+
+        with self._cond:
+            self._push(sequence, time.monotonic() + self.gap)
+
+    def _finish(
+        self,
+        sequence: _Sequence,
+        result: Optional[Dict[str, Any]] = None,
+        exception: Optional[BaseException] = None,
+    ) -> None:
+        with self._cond:
+            queue = self._waiting.get(sequence.phone)
+            if queue:
+                queue.popleft()
+                if queue:
+                    self._push(queue[0], time.monotonic() + self.gap)
+                else:
+                    del self._waiting[sequence.phone]
+
+        if exception is not None:
+            sequence.future.set_exception(exception)
+        else:
+            sequence.future.set_result(result)
+
+
+_schedulers: Dict[str, Scheduler] = {}
+_schedulers_pid: Optional[int] = None
+_lock = threading.Lock()
+
+
+def get_scheduler(tenant: Optional[str] = None) -> Scheduler:
+    """
+    Scheduler do tenant (padrão: o em atendimento) neste processo, recriado
+    após fork. Cada tenant tem threads próprias (sender_threads) e o token
+    bucket da sua conta do Whaticket (rate_limit, rate_burst), compartilhado
+    entre os processos (shared_bucket).
+    """
+
+    global _schedulers_pid
+
+    name = tenants.current() if tenant is None else tenant
+    pid = os.getpid()
+    scheduler = _schedulers.get(name) if _schedulers_pid == pid else None
+    if scheduler is None:
+        with _lock:
+            if _schedulers_pid != pid:
+                _schedulers.clear()
+                _schedulers_pid = pid
+            scheduler = _schedulers.get(name)
+            if scheduler is None:
+                config = tenants.get(name)
+                scheduler = _schedulers[name] = (
+                    Scheduler(
+                        threads=config.sender_threads,
+                        bucket=shared_bucket(name, config.rate_limit, config.rate_burst),
+                    )
+                    if config is not None
+                    else Scheduler(bucket=shared_bucket())
+                )
+    return scheduler
+
+
+def stats(tenant: str = tenants.DEFAULT) -> Dict[str, Dict[str, int]]:
+    """
+    Estado das classes de prioridade do scheduler do tenant neste processo
+    (vazio se ele ainda não foi criado).
+    """
+
+    if _schedulers_pid != os.getpid() or tenant not in _schedulers:
+        return {}
+    return _schedulers[tenant].stats()
@@ -1,14 +1,541 @@
+import asyncio
 import os
-import requests
-from typing import Dict
+import threading
+import time
+from concurrent.futures import Future
+from typing import (
+    TYPE_CHECKING,
+    Any,
+    AsyncIterable,
+    AsyncIterator,
+    Coroutine,
+    Dict,
+    Iterable,
+    List,
+    Optional,
+    Union,
+)
+
+from . import (
+    boleto_cache,
+    breaker,
+    delivery_log,
+    log,
+    media,
+    metrics,
+    phones,
+    priority,
+    settings,
+    tenants,
+)
+from .scheduler import SharedTokenBucket, TokenBucket, shared_bucket
+
+if TYPE_CHECKING:
+    import httpx
+
+DEFAULT_API_URL = "https://api.osmardev.online/api/messages/send"
+
+logger = log.get_logger("sender")
+
+
+def _env_float(name: str, default: float) -> float:
+    try:
+        return float(os.getenv(name, default))
+    except (TypeError, ValueError):
+        return default
+
+
+def engine_enabled() -> bool:
+    """
+    True quando WHATICKET_ENGINE=async: as sequências de envio rodam no
+    DeliveryEngine em vez do scheduler com threads.
+    """
+
+    return os.getenv("WHATICKET_ENGINE", "threads").strip().lower() == "async"
+
+
+class _PhoneSlot:
+    __slots__ = ("lock", "users", "last_sent")
+
+    def __init__(self) -> None:
+        self.lock = asyncio.Lock()
+        self.users = 0
+        self.last_sent = 0.0
+
+
+class DeliveryEngine:
+    """
+    Motor assíncrono de entrega para o Whaticket.
+
+    Um único event loop (em uma thread própria) executa as sequências de
+    muitos pedidos ao mesmo tempo sobre um httpx.AsyncClient com pool
+    limitado. Mantém a ordem e o intervalo mínimo por telefone e o token
+    bucket global, como o scheduler com threads. Cada classe de prioridade
+    tem no máximo WHATICKET_ASYNC_CONCURRENCY_<CLASSE> passos em andamento
+    (padrão: metade do pool), para que boletos não ocupem todas as conexões.
+
+    Entradas assíncronas: send_message, send_media, run_sequence.
+    Entradas síncronas: submit, submit_sequence (retornam concurrent Futures).
+    """
+
+    def __init__(
+        self,
+        api_url: str,
+        token: Optional[str],
+        max_connections: Optional[int] = None,
+        gap: Optional[float] = None,
+        rate: Optional[float] = None,
+        burst: Optional[float] = None,
+        transport: Optional["httpx.AsyncBaseTransport"] = None,
+        tenant: str = tenants.DEFAULT,
+        bucket: Optional[TokenBucket] = None,
+    ) -> None:
+        # Importado aqui: com o scheduler de threads (padrão) o httpx nunca é carregado.
+        import httpx
+
+        self.api_url = api_url
+        self.token = token
+        self.tenant = tenant
+        self._gap = gap
+        self.bucket = bucket or TokenBucket(
+            rate if rate is not None else _env_float("WHATICKET_RATE_LIMIT", 5.0),
+            burst if burst is not None else _env_float("WHATICKET_RATE_BURST", 10.0),
+        )
+        max_connections = max_connections or int(
+            _env_float("WHATICKET_ASYNC_MAX_CONNECTIONS", 50)
+        )
+        self.client = httpx.AsyncClient(
+            limits=httpx.Limits(
+                max_connections=max_connections,
+                max_keepalive_connections=max_connections,
+            ),
+            timeout=httpx.Timeout(
+                _env_float("WHATICKET_READ_TIMEOUT", 30.0),
+                connect=_env_float("WHATICKET_CONNECT_TIMEOUT", 5.0),
+            ),
+            transport=transport,
+        )
+        self._slots: Dict[str, _PhoneSlot] = {}
+        self._lanes = {
+            lane: asyncio.Semaphore(
+                priority.budget(
+                    "WHATICKET_ASYNC_CONCURRENCY", lane, max(max_connections // 2, 1)
+                )
+            )
+            for lane in priority.classes()
+        }
+        self.loop = asyncio.new_event_loop()
+        self._thread = threading.Thread(
+            target=self.loop.run_forever, name="wbuy-delivery-engine", daemon=True
+        )
+        self._thread.start()
+
+    @property
+    def gap(self) -> float:
+        if self._gap is not None:
+            return self._gap
+        return _env_float("WHATICKET_MESSAGE_GAP", 1.0)
+
+    def _headers(self, token: Optional[str] = None) -> Dict[str, str]:
+        return {"Authorization": f"Bearer {token or self.token}"}
+
+    async def _throttle(self) -> None:
+        # O bucket compartilhado consulta o SQLite: fora do event loop.
+        shared = isinstance(self.bucket, SharedTokenBucket) and self.bucket.rate > 0
+        while True:
+            if shared:
+                wait = await asyncio.to_thread(self.bucket.try_acquire)
+            else:
+                wait = self.bucket.try_acquire()
+            if wait <= 0:
+                return
+            await asyncio.sleep(wait)
+
+    async def send_message(
+        self,
+        number: str,
+        body: str,
+        *,
+        api_url: Optional[str] = None,
+        token: Optional[str] = None,
+    ) -> Dict[str, Any]:
+        """
+        Envia um texto. ``api_url``/``token`` valem só para esta chamada, sem
+        alterar o motor, que é compartilhado pelos envios do tenant.
+        """
+
+        normalized_number = (number or "").strip()
+        if not normalized_number:
+            logger.warning(
+                "Número ausente ou inválido para envio de mensagem.", extra={"phone": number}
+            )
+            return {"status": "skipped", "reason": "missing_number"}
+
+        token = token or self.token
+        if not token:
+            logger.error(
+                "Token do Whaticket ausente. Configure WHATICKET_TOKEN/TOKEN_WHATS/TOKEN_DO_ENV."
+            )
+            return {"status": "error", "reason": "missing_token"}
+
+        await self._throttle()
+        try:
+            async with breaker.async_guard() as call:
+                with metrics.timer("wbuy_whaticket_send_seconds", kind="text"):
+                    response = await self.client.post(
+                        api_url or self.api_url,
+                        headers=self._headers(token),
+                        json={"number": normalized_number, "body": body},
+                    )
+                call.failed = breaker.is_upstream_failure(response.status_code)
+        except breaker.BreakerOpen as exc:
+            logger.warning("Envio de mensagem adiado: %s.", exc.reason)
+            return exc.as_result()
+        if response.is_error:
+            logger.warning(
+                "Erro ao enviar mensagem.",
+                extra={"status_code": response.status_code, "response": response.text[:500]},
+            )
+            phones.record_send_failure(normalized_number, response.status_code, response.text)
+            return {
+                "status": "error",
+                "status_code": response.status_code,
+                "response": response.text,
+            }
+
+        return response.json()
+
+    async def send_media(
+        self, number: str, file_bytes: Union[bytes, AsyncIterable[bytes]], filename: str
+    ) -> Dict[str, Any]:
+        normalized_number = (number or "").strip()
+        if not normalized_number:
+            return {"status": "skipped", "reason": "missing_number"}
+
+        if not self.token:
+            return {"status": "error", "reason": "missing_token"}
+
+        await self._throttle()
+        try:
+            async with breaker.async_guard() as call:
+                with metrics.timer("wbuy_whaticket_send_seconds", kind="media"):
+                    if isinstance(file_bytes, (bytes, bytearray)):
+                        response = await self.client.post(
+                            self.api_url,
+                            headers=self._headers(),
+                            data={"number": normalized_number},
+                            files={"medias": (filename, file_bytes, "application/pdf")},
+                        )
+                    else:
+                        content_type, preamble, epilogue = media.multipart_frame(
+                            {"number": normalized_number}, "medias", filename, "application/pdf"
+                        )
+
+                        async def body() -> AsyncIterator[bytes]:
+                            yield preamble
+                            async for chunk in file_bytes:
+                                yield chunk
+                            yield epilogue
+
+                        response = await self.client.post(
+                            self.api_url,
+                            headers={**self._headers(), "Content-Type": content_type},
+                            content=body(),
+                        )
+                call.failed = breaker.is_upstream_failure(response.status_code)
+        except breaker.BreakerOpen as exc:
+            logger.warning("Envio de mídia adiado: %s.", exc.reason)
+            return exc.as_result()
+        if response.is_error:
+            logger.warning(
+                "Erro ao enviar mídia.",
+                extra={"status_code": response.status_code, "response": response.text[:500]},
+            )
+            phones.record_send_failure(normalized_number, response.status_code, response.text)
+            return {
+                "status": "error",
+                "status_code": response.status_code,
+                "response": response.text,
+            }
+
+        return response.json()
+
+    async def _upload(self, phone: str, pdf: Any, filename: str) -> Dict[str, Any]:
+        """
+        Envia o PDF (AsyncBoletoStream ou CachedPdf). Um upload recusado com
+        429/503 é refeito do spool/cache (replay), sem novo download, até
+        WHATICKET_MEDIA_RETRIES vezes, como no caminho síncrono.
+        """
+
+        logger.debug("Enviando boleto em PDF.", extra={"phone": phone})
+        result = await self.send_media(phone, _async_chunks(pdf), filename)
+
+        attempts = media.max_upload_retries() if pdf.spooled else 0
+        while attempts > 0 and media.upload_retryable(result):
+            attempts -= 1
+            logger.info("Reenviando boleto sem novo download.", extra={"phone": phone})
+            result = await self.send_media(phone, _async_chunks(pdf.replay()), filename)
+        return result
+
+    async def _send_cached(self, phone: str, pdf: Any, filename: str) -> Optional[Dict[str, Any]]:
+        result = await self._upload(phone, pdf, filename)
+        return result if delivery_log.is_failure(result) else None
+
+    async def _send_boleto(self, phone: str, url: str, filename: str) -> Optional[Dict[str, Any]]:
+        """
+        Repassa o PDF da WBuy para o upload em blocos, com as mesmas
+        validações de tipo e tamanho, o mesmo cache de boletos e o mesmo
+        reenvio a partir do spool do caminho síncrono.
+        """
+
+        entry = boleto_cache.lookup(url) if boleto_cache.enabled() else None
+        if entry is not None and entry.fresh:
+            logger.debug("Boleto servido do cache.", extra={"phone": phone})
+            return await self._send_cached(phone, boleto_cache.hit(entry), filename)
+
+        logger.debug("Baixando boleto em streaming.", extra={"phone": phone})
+        started = time.perf_counter()
+        request_headers = entry.conditional_headers() if entry is not None else {}
+        async with self.client.stream("GET", url, headers=request_headers) as pdf_response:
+            if entry is not None and pdf_response.status_code == 304:
+                logger.debug("Boleto revalidado no cache.", extra={"phone": phone})
+                return await self._send_cached(phone, boleto_cache.revalidated(entry), filename)
+
+            if pdf_response.is_error:
+                await pdf_response.aread()
+                logger.warning(
+                    "Erro ao baixar boleto.",
+                    extra={
+                        "status_code": pdf_response.status_code,
+                        "response": pdf_response.text[:500],
+                    },
+                )
+                return {
+                    "status": "error",
+                    "reason": "boleto_download_failed",
+                    "status_code": pdf_response.status_code,
+                }
+
+            writer = boleto_cache.CacheWriter() if boleto_cache.enabled() else None
+            try:
+                pdf_source = await media.AsyncBoletoStream.open(
+                    pdf_response.headers,
+                    pdf_response.aiter_bytes(media.CHUNK_SIZE),
+                    spool=writer if writer is not None else media.spool_enabled(),
+                )
+            except media.BoletoError as exc:
+                if writer is not None:
+                    writer.discard()
+                logger.warning("Boleto rejeitado: %s", exc.reason, extra={"phone": phone})
+                return exc.as_result()
+
+            try:
+                result = await self._upload(phone, pdf_source, filename)
+
+                if pdf_source.complete:
+                    metrics.observe("wbuy_boleto_download_bytes", pdf_source.size)
+                    metrics.observe("wbuy_boleto_download_seconds", time.perf_counter() - started)
+                if writer is not None:
+                    if pdf_source.complete:
+                        writer.commit(
+                            url,
+                            pdf_response.headers.get("ETag"),
+                            pdf_response.headers.get("Last-Modified"),
+                        )
+                    else:
+                        writer.discard()
+                    writer = None
+            except media.BoletoError as exc:
+                logger.warning("Boleto rejeitado: %s", exc.reason, extra={"phone": phone})
+                return exc.as_result()
+            finally:
+                if writer is not None:
+                    writer.discard()
+                pdf_source.close()
+        return result if delivery_log.is_failure(result) else None
+
+    async def _run_step(self, phone: str, step: Dict[str, Any]) -> Optional[Dict[str, Any]]:
+        kind = step["kind"]
+
+        if kind == "text":
+            logger.debug("Enviando %s.", step["label"], extra={"phone": phone})
+            result = await self.send_message(phone, step["body"])
+            return result if delivery_log.is_failure(result) else None
+
+        if kind == "boleto":
+            return await self._send_boleto(phone, step["url"], step.get("filename", "boleto.pdf"))
+
+        raise ValueError(f"Tipo de passo desconhecido: {kind}")
+
+    async def run_sequence(
+        self,
+        phone: str,
+        steps: List[Dict[str, Any]],
+        tracker: Optional[delivery_log.StepTracker] = None,
+        lane: str = priority.DEFAULT,
+    ) -> Optional[Dict[str, Any]]:
+        """
+        Executa os passos de um pedido em ordem, respeitando o intervalo
+        mínimo por telefone e o limite da classe de prioridade ``lane``. Um
+        passo que retorna dict interrompe a sequência. Com ``tracker``, cada
+        passo é registrado no delivery_log.
+        """
+
+        lane = lane if lane in self._lanes else priority.DEFAULT
+        submitted = time.monotonic()
+        first = True
+        slot = self._slots.get(phone)
+        if slot is None:
+            slot = self._slots[phone] = _PhoneSlot()
+        slot.users += 1
+
+        try:
+            async with slot.lock:
+                for step in steps:
+                    if step["kind"] == "delay":
+                        await asyncio.sleep(step["seconds"])
+                        continue
+
+                    if slot.last_sent:
+                        delay = slot.last_sent + self.gap - time.monotonic()
+                        if delay > 0:
+                            await asyncio.sleep(delay)
+
+                    async with self._lanes[lane]:
+                        if first:
+                            first = False
+                            metrics.observe(
+                                "wbuy_delivery_wait_seconds",
+                                time.monotonic() - submitted,
+                                priority=lane,
+                            )
+                        if tracker is not None:
+                            tracker.start(step)
+                        try:
+                            result = await self._run_step(phone, step)
+                        except BaseException as exc:
+                            if tracker is not None:
+                                tracker.finish(step, error=exc)
+                            raise
+                    if tracker is not None:
+                        tracker.finish(step, result)
+                    slot.last_sent = time.monotonic()
+                    if result is not None:
+                        return result
+            return None
+        finally:
+            slot.users -= 1
+            if slot.users == 0:
+                self._slots.pop(phone, None)
+
+    def submit(self, coroutine: Coroutine[Any, Any, Any]) -> Future:
+        return asyncio.run_coroutine_threadsafe(coroutine, self.loop)
+
+    def submit_sequence(
+        self,
+        phone: str,
+        steps: List[Dict[str, Any]],
+        tracker: Optional[delivery_log.StepTracker] = None,
+        lane: str = priority.DEFAULT,
+    ) -> Future:
+        order_id = tracker.order_id if tracker is not None else log.correlation_id.get()
+        return self.submit(
+            self._bound(order_id, self.run_sequence(phone, steps, tracker, lane))
+        )
+
+    async def _bound(self, order_id: Optional[str], coroutine: Coroutine[Any, Any, Any]) -> Any:
+        # A task tem cópia própria do contexto; o order_id e o tenant valem só para ela.
+        with log.bind(order_id), tenants.bind(self.tenant):
+            return await coroutine
+
+    def close(self) -> None:
+        self.submit(self.client.aclose()).result(timeout=5)
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self._thread.join(timeout=5)
+
+
+_engines: Dict[str, DeliveryEngine] = {}
+_engines_pid: Optional[int] = None
+_lock = threading.Lock()
+
+
+def get_engine(api_url: Optional[str] = None, token: Optional[str] = None) -> DeliveryEngine:
+    """
+    DeliveryEngine do tenant em atendimento neste processo (recriado após
+    fork). Cada tenant tem event loop, pool de conexões e rate limit
+    próprios.
+    """
+
+    global _engines_pid
+
+    name = tenants.current()
+    pid = os.getpid()
+    engine = _engines.get(name) if _engines_pid == pid else None
+    if engine is None:
+        with _lock:
+            if _engines_pid != pid:
+                _engines.clear()
+                _engines_pid = pid
+            engine = _engines.get(name)
+            if engine is None:
+                tenant = tenants.get(name)
+                engine = _engines[name] = DeliveryEngine(
+                    api_url or os.getenv("WHATICKET_API_BASE_URL", DEFAULT_API_URL),
+                    token,
+                    max_connections=tenant.pool_size if tenant is not None else None,
+                    tenant=name,
+                    bucket=shared_bucket(
+                        name,
+                        tenant.rate_limit if tenant is not None else None,
+                        tenant.rate_burst if tenant is not None else None,
+                    ),
+                )
+
+    if api_url:
+        engine.api_url = api_url
+    if token:
+        engine.token = token
+    return engine
+
+
+@settings.on_reload
+def _apply_settings(config: settings.Settings) -> None:
+    # Token e URL novos valem para o motor já criado, sem recriar o event loop.
+    # Os motores dos tenants recebem os do arquivo a cada get_engine().
+    engine = _engines.get(tenants.DEFAULT) if _engines_pid == os.getpid() else None
+    if engine is not None:
+        engine.api_url = config.whaticket_api_url
+        engine.token = config.whaticket_token or None
+
+
+async def _async_chunks(
+    chunks: Union[Iterable[bytes], AsyncIterable[bytes]]
+) -> AsyncIterator[bytes]:
+    # CachedPdf lê o arquivo do cache de forma síncrona; os blocos do
+    # download já são assíncronos.
+    if hasattr(chunks, "__aiter__"):
+        async for chunk in chunks:
+            yield chunk
+    else:
+        for chunk in chunks:
+            yield chunk
 
 
 def send_whatsapp_message(number: str, message: str) -> Dict:
     """
     Envia mensagem via Whaticket (API Messages/Send)
     Usa:
-      URL_WHATS → API base (ex: https://api.osmardev.online/api/messages/send)
-      TOKEN_WHATS → Bearer token
-      NUMBER_TESTE → opcional; se existir, sobrescreve o número de destino
+      settings.get() → URL e token do tenant em atendimento (como _deliver)
+      phones.test_number() → opcional; se existir, sobrescreve o número de
+      destino, como no caminho do webhook
     """
-    pass
+
+    config = settings.get()
+    number = phones.test_number() or number
+
+    engine = get_engine()
+    return engine.submit(
+        engine.send_message(
+            number, message, api_url=config.whaticket_api_url, token=config.whaticket_token
+        )
+    ).result()
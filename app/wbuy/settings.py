@@ -0,0 +1,124 @@
+import os
+import threading
+from contextlib import contextmanager
+from contextvars import ContextVar
+from dataclasses import dataclass, replace
+from typing import Any, Callable, Iterator, List, Optional
+
+DEFAULT_WHATICKET_API_URL = "https://api.osmardev.online/api/messages/send"
+
+
+def _first_env(*names: str) -> str:
+    for name in names:
+        value = os.getenv(name)
+        if value:
+            return value
+    return ""
+
+
+@dataclass(frozen=True)
+class Settings:
+    """
+    Configuração de conexão com o Whaticket lida do ambiente (e do .env).
+
+    Os demais ajustes (filas, timeouts, caches) continuam lidos com
+    os.getenv no momento do uso, então também seguem um reload().
+    """
+
+    whaticket_api_url: str
+    whaticket_token: str
+    whaticket_bulk_url: str
+
+    @classmethod
+    def from_env(cls) -> "Settings":
+        return cls(
+            whaticket_api_url=os.getenv("WHATICKET_API_BASE_URL", DEFAULT_WHATICKET_API_URL),
+            whaticket_token=_first_env("TOKEN_DO_ENV", "WHATICKET_TOKEN", "TOKEN_WHATS"),
+            whaticket_bulk_url=os.getenv("WHATICKET_BULK_URL", ""),
+        )
+
+
+_lock = threading.Lock()
+_current: Optional[Settings] = None
+_hooks: List[Callable[[Settings], Any]] = []
+# Settings do tenant em atendimento (ver tenants.bind); None = as do processo.
+_scoped: ContextVar[Optional[Settings]] = ContextVar("wbuy_settings", default=None)
+
+
+def get() -> Settings:
+    """
+    Settings do tenant em atendimento ou, fora dele, as do processo (lidas
+    na primeira chamada).
+    """
+
+    global _current
+
+    scoped = _scoped.get()
+    if scoped is not None:
+        return scoped
+    current = _current
+    if current is None:
+        with _lock:
+            if _current is None:
+                _current = Settings.from_env()
+            current = _current
+    return current
+
+
+def on_reload(hook: Callable[[Settings], Any]) -> Callable[[Settings], Any]:
+    """
+    Registra uma função chamada com as novas Settings a cada reload().
+    """
+
+    _hooks.append(hook)
+    return hook
+
+
+def reload(dotenv: bool = True) -> Settings:
+    """
+    Relê o ambiente (e o .env, sobrescrevendo valores antigos) sem
+    reiniciar o processo e avisa os hooks registrados.
+    """
+
+    global _current
+
+    if dotenv:
+        from dotenv import load_dotenv
+
+        load_dotenv(override=True)
+    with _lock:
+        _current = Settings.from_env()
+        current = _current
+    for hook in list(_hooks):
+        hook(current)
+    return current
+
+
+@contextmanager
+def override(**changes: Any) -> Iterator[Settings]:
+    """
+    Troca campos das Settings temporariamente (testes e benchmarks).
+    """
+
+    global _current
+
+    previous = get()
+    _current = replace(previous, **changes)
+    try:
+        yield _current
+    finally:
+        _current = previous
+
+
+@contextmanager
+def use(config: Optional[Settings]) -> Iterator[None]:
+    """
+    Faz get() devolver ``config`` no contexto atual (thread ou task), sem
+    afetar os demais. None volta às Settings do processo.
+    """
+
+    token = _scoped.set(config)
+    try:
+        yield
+    finally:
+        _scoped.reset(token)
@@ -0,0 +1,127 @@
+import os
+import socket
+import threading
+import time
+import uuid
+from typing import Dict, Optional, Tuple
+
+from . import db
+from .storage import BASE_DIR
+
+SINGLEFLIGHT_DB = BASE_DIR / "storage" / "singleflight.db"
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS leases (
+    key TEXT PRIMARY KEY,
+    owner TEXT NOT NULL,
+    expires_at REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS leases_expires_idx ON leases (expires_at);
+"""
+
+PRUNE_INTERVAL_SECONDS = 3600
+
+_lock = threading.Lock()
+# (banco, chave) -> instante até o qual a chave é tratada como em andamento
+# neste processo sem consultar o SQLite.
+_local: Dict[Tuple[str, str], float] = {}
+_owner: Optional[Tuple[int, str]] = None
+_last_prune = 0.0
+
+
+def _env_float(name: str, default: float) -> float:
+    try:
+        return float(os.getenv(name, default))
+    except (TypeError, ValueError):
+        return default
+
+
+def lease_seconds() -> float:
+    return _env_float("WBUY_SINGLEFLIGHT_TTL", 300.0)
+
+
+def _local_seconds() -> float:
+    return _env_float("WBUY_SINGLEFLIGHT_LOCAL_TTL", 10.0)
+
+
+def _owner_id() -> str:
+    global _owner
+
+    pid = os.getpid()
+    if _owner is None or _owner[0] != pid:
+        _owner = (pid, f"{socket.gethostname()}:{pid}:{uuid.uuid4().hex[:8]}")
+        _local.clear()
+    return _owner[1]
+
+
+def _conn():
+    return db.connect(SINGLEFLIGHT_DB, _SCHEMA)
+
+
+def _maybe_prune(now: float) -> None:
+    global _last_prune
+
+    if now - _last_prune < PRUNE_INTERVAL_SECONDS:
+        return
+    _last_prune = now
+    _conn().execute("DELETE FROM leases WHERE expires_at < ?", (now,))
+
+
+def acquire(key: str, ttl: Optional[float] = None) -> bool:
+    """
+    Tenta ser o único dono de ``key`` entre threads, workers e processos.
+
+    Retorna False para duplicatas. Uma chave já vista neste processo é
+    resolvida só em memória (sem I/O) por até WBUY_SINGLEFLIGHT_LOCAL_TTL
+    segundos; fora disso vale o lease no SQLite, que expira sozinho após
+    WBUY_SINGLEFLIGHT_TTL segundos caso o dono morra sem liberá-lo.
+    """
+
+    owner = _owner_id()
+    local_key = (str(SINGLEFLIGHT_DB), key)
+    now = time.time()
+
+    with _lock:
+        until = _local.get(local_key)
+        if until is not None:
+            if until > now:
+                return False
+            del _local[local_key]
+
+    expires_at = now + (ttl if ttl is not None else lease_seconds())
+    connection = _conn()
+    acquired = (
+        connection.execute(
+            "INSERT INTO leases (key, owner, expires_at) VALUES (?, ?, ?) "
+            "ON CONFLICT(key) DO UPDATE SET owner = excluded.owner, expires_at = excluded.expires_at "
+            "WHERE leases.expires_at < ?",
+            (key, owner, expires_at, now),
+        ).rowcount
+        == 1
+    )
+    if not acquired:
+        row = connection.execute("SELECT expires_at FROM leases WHERE key = ?", (key,)).fetchone()
+        expires_at = row[0] if row is not None else now
+
+    with _lock:
+        _local[local_key] = min(expires_at, now + _local_seconds())
+    _maybe_prune(now)
+    return acquired
+
+
+def release(key: str) -> None:
+    """
+    Libera a chave (qualquer dono), por exemplo quando o pedido não pôde ser
+    processado e um próximo webhook deve ser aceito.
+    """
+
+    with _lock:
+        _local.pop((str(SINGLEFLIGHT_DB), key), None)
+    _conn().execute("DELETE FROM leases WHERE key = ?", (key,))
+
+
+def held(key: str) -> bool:
+    row = _conn().execute(
+        "SELECT 1 FROM leases WHERE key = ? AND expires_at >= ?", (key, time.time())
+    ).fetchone()
+    return row is not None
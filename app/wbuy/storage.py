@@ -1,28 +1,52 @@
-from datetime import datetime
+import importlib
+import os
+import pkgutil
+import threading
+import time
 from pathlib import Path
-from typing import Set
+from types import ModuleType
+from typing import Any, Dict, List, Optional, Set, Tuple, Union
 
+from . import db, log, metrics, processed_cache
+
+logger = log.get_logger("storage")
 
 BASE_DIR = Path(__file__).resolve().parents[2]
+STORAGE_DIR = BASE_DIR / "storage"
 WEBHOOK_DIR = BASE_DIR / "storage" / "webhooks"
 PROCESSED_FILE = BASE_DIR / "storage" / "processed_orders.txt"
+PROCESSED_DB = BASE_DIR / "storage" / "processed_orders.db"
 
+_PROCESSED_SCHEMA = """
+CREATE TABLE IF NOT EXISTS processed_orders (
+    order_id TEXT PRIMARY KEY,
+    processed_at REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS processed_orders_at_idx ON processed_orders (processed_at);
+CREATE TABLE IF NOT EXISTS processed_changes (
+    seq INTEGER PRIMARY KEY AUTOINCREMENT,
+    order_id TEXT NOT NULL,
+    op TEXT NOT NULL
+);
+CREATE TRIGGER IF NOT EXISTS processed_orders_added AFTER INSERT ON processed_orders
+BEGIN
+    INSERT INTO processed_changes (order_id, op) VALUES (NEW.order_id, 'add');
+END;
+CREATE TRIGGER IF NOT EXISTS processed_orders_removed AFTER DELETE ON processed_orders
+BEGIN
+    INSERT INTO processed_changes (order_id, op) VALUES (OLD.order_id, 'remove');
+END;
+"""
 
-def save_raw_payload(raw_bytes: bytes) -> str:
-    """
-    Salva o webhook cru em storage/webhooks/raw_<timestamp>.txt
-    Cria pastas se necessário.
-    Retorna o caminho salvo.
-    """
-    WEBHOOK_DIR.mkdir(parents=True, exist_ok=True)
-
-    timestamp = datetime.utcnow().strftime("%Y%m%d%H%M%S%f")
-    file_path = WEBHOOK_DIR / f"raw_{timestamp}.txt"
-
-    with open(file_path, "wb") as file:
-        file.write(raw_bytes)
+# processed_changes é o log (alimentado pelos triggers) que mantém o cache em
+# memória de cada worker (processed_cache) em dia com as gravações dos outros.
 
-    return str(file_path)
+PRUNE_INTERVAL_SECONDS = 3600
+_last_prune = 0.0
+_migration_checked: Set[str] = set()
+_cache: Optional[processed_cache.ProcessedCache] = None
+_cache_key: Optional[Tuple[int, Path]] = None
+_cache_lock = threading.Lock()
 
 
 def _read_processed_orders() -> Set[str]:
@@ -32,12 +56,226 @@ def _read_processed_orders() -> Set[str]:
     return {line.strip() for line in PROCESSED_FILE.read_text().splitlines() if line.strip()}
 
 
+def _migrate_processed_file(connection) -> None:
+    """
+    Importa uma única vez o legado storage/processed_orders.txt para o SQLite
+    e renomeia o arquivo para processed_orders.txt.migrated.
+    """
+
+    legacy = _read_processed_orders()
+    if not legacy:
+        return
+
+    now = time.time()
+    with connection:
+        connection.executemany(
+            "INSERT OR IGNORE INTO processed_orders (order_id, processed_at) VALUES (?, ?)",
+            [(order_id, now) for order_id in legacy],
+        )
+
+    try:
+        PROCESSED_FILE.rename(PROCESSED_FILE.with_name(PROCESSED_FILE.name + ".migrated"))
+    except FileNotFoundError:
+        # Outro worker já concluiu a migração.
+        pass
+
+    logger.info("%d pedidos migrados de %s para o SQLite.", len(legacy), PROCESSED_FILE.name)
+
+
+def _processed_conn():
+    connection = db.connect(PROCESSED_DB, _PROCESSED_SCHEMA)
+    key = f"{os.getpid()}:{PROCESSED_DB}"
+    if key not in _migration_checked:
+        _migration_checked.add(key)
+        if PROCESSED_FILE.exists():
+            _migrate_processed_file(connection)
+    return connection
+
+
+def _ttl_seconds() -> Optional[float]:
+    try:
+        days = float(os.getenv("WBUY_PROCESSED_TTL_DAYS", "0"))
+    except ValueError:
+        return None
+    return days * 86400 if days > 0 else None
+
+
+def prune_processed_orders(ttl_seconds: Optional[float] = None) -> int:
+    """
+    Remove pedidos processados há mais de ttl_seconds (ou WBUY_PROCESSED_TTL_DAYS)
+    e apara o log de mudanças do cache em WBUY_PROCESSED_CHANGES_KEPT. Sem
+    TTL configurado, nenhum pedido é removido, mas o log é aparado do mesmo
+    jeito. Retorna quantos pedidos saíram.
+    """
+
+    ttl = ttl_seconds if ttl_seconds is not None else _ttl_seconds()
+    connection = _processed_conn()
+    removed = 0
+    if ttl:
+        removed = connection.execute(
+            "DELETE FROM processed_orders WHERE processed_at < ?", (time.time() - ttl,)
+        ).rowcount
+    # O log só precisa cobrir o atraso dos workers; quem ficar para trás
+    # recarrega o cache inteiro.
+    connection.execute(
+        "DELETE FROM processed_changes WHERE seq <= "
+        "(SELECT MAX(seq) FROM processed_changes) - ?",
+        (_changes_kept(),),
+    )
+    _sync_cache(force=True)
+    return removed
+
+
+def _changes_kept() -> int:
+    try:
+        return int(os.getenv("WBUY_PROCESSED_CHANGES_KEPT", "100000"))
+    except ValueError:
+        return 100000
+
+
+def _front_cache() -> Optional[processed_cache.ProcessedCache]:
+    """
+    Cache em memória deste processo para o PROCESSED_DB atual (recriado
+    após fork), ou None com WBUY_PROCESSED_CACHE=0.
+    """
+
+    global _cache, _cache_key
+
+    key = (os.getpid(), PROCESSED_DB)
+    if _cache_key != key:
+        with _cache_lock:
+            if _cache_key != key:
+                _cache = processed_cache.ProcessedCache() if processed_cache.enabled() else None
+                _cache_key = key
+    return _cache
+
+
+def _reload_cache(cache: processed_cache.ProcessedCache, connection) -> None:
+    # Uma transação de leitura: ids e seq do mesmo instante.
+    connection.execute("BEGIN")
+    try:
+        seq = connection.execute(
+            "SELECT COALESCE(MAX(seq), 0) FROM processed_changes"
+        ).fetchone()[0]
+        total = connection.execute("SELECT COUNT(*) FROM processed_orders").fetchone()[0]
+        rows = connection.execute("SELECT order_id FROM processed_orders")
+        cache.reset((row[0] for row in rows), seq, total)
+    finally:
+        connection.execute("COMMIT")
+
+
+def _sync_cache(force: bool = False) -> Optional[processed_cache.ProcessedCache]:
+    """
+    Aplica ao cache as mudanças gravadas desde a última sincronização (por
+    qualquer worker). Sem ``force``, no máximo a cada
+    WBUY_PROCESSED_CACHE_SYNC_SECONDS; as gravações deste processo forçam.
+    """
+
+    cache = _front_cache()
+    if cache is None or not (force or cache.sync_due()):
+        return cache
+
+    with cache.lock:
+        if not (force or cache.sync_due()):
+            return cache
+        connection = _processed_conn()
+        if cache.needs_reload():
+            _reload_cache(cache, connection)
+            return cache
+
+        changes = connection.execute(
+            "SELECT seq, order_id, op FROM processed_changes WHERE seq > ? ORDER BY seq",
+            (cache.last_seq,),
+        ).fetchall()
+        if changes and changes[0][0] != cache.last_seq + 1:
+            # Parte do log já foi descartada: recomeça do store.
+            _reload_cache(cache, connection)
+        else:
+            cache.apply(changes)
+
+    for result, amount in cache.unreported().items():
+        if result != "reloads":
+            metrics.inc("wbuy_processed_cache_total", amount, result=result)
+    return cache
+
+
+def cache_stats() -> Dict[str, Any]:
+    """
+    Acertos do cache em memória deste processo (hit_rate: consultas
+    respondidas sem ir ao banco).
+    """
+
+    cache = _front_cache()
+    return cache.stats() if cache is not None else {"enabled": False}
+
+
+def _maybe_prune() -> None:
+    global _last_prune
+
+    now = time.time()
+    if now - _last_prune < PRUNE_INTERVAL_SECONDS:
+        return
+
+    _last_prune = now
+    prune_processed_orders()
+    # Import adiado: delivery_log importa este módulo.
+    from . import delivery_log
+
+    delivery_log.prune()
+
+
 def is_order_processed(order_id: str) -> bool:
     """
     Verifica se o pedido já foi processado anteriormente.
+
+    Pedidos novos (a maioria) são descartados pelo Bloom em memória, sem
+    I/O; só possíveis falsos positivos e ids fora do LRU vão ao banco.
+    Gravações de outros workers aparecem em até
+    WBUY_PROCESSED_CACHE_SYNC_SECONDS; o claim_order continua sendo a
+    garantia contra envios duplicados.
     """
 
-    return order_id in _read_processed_orders()
+    cache = _sync_cache()
+    if cache is not None:
+        known = cache.lookup(order_id)
+        if known is not None:
+            return known
+
+    with metrics.timer("wbuy_idempotency_seconds", op="lookup"):
+        row = _processed_conn().execute(
+            "SELECT 1 FROM processed_orders WHERE order_id = ?", (order_id,)
+        ).fetchone()
+    if cache is not None:
+        cache.confirm(order_id, row is not None)
+    return row is not None
+
+
+@metrics.timed("wbuy_idempotency_seconds", op="claim")
+def claim_order(order_id: str) -> bool:
+    """
+    Reivindica o pedido de forma atômica entre workers e processos.
+
+    Retorna True apenas para quem gravou o pedido primeiro; os demais recebem
+    False e devem tratá-lo como duplicado.
+    """
+
+    _maybe_prune()
+    cursor = _processed_conn().execute(
+        "INSERT OR IGNORE INTO processed_orders (order_id, processed_at) VALUES (?, ?)",
+        (order_id, time.time()),
+    )
+    if cursor.rowcount == 1:
+        _sync_cache(force=True)
+    return cursor.rowcount == 1
+
+
+def release_order(order_id: str) -> None:
+    """
+    Desfaz um claim_order quando o envio não pôde ser concluído.
+    """
+
+    _processed_conn().execute("DELETE FROM processed_orders WHERE order_id = ?", (order_id,))
+    _sync_cache(force=True)
 
 
 def mark_order_processed(order_id: str) -> None:
@@ -45,11 +283,31 @@ def mark_order_processed(order_id: str) -> None:
     Registra que um pedido foi processado, evitando envios duplicados.
     """
 
-    PROCESSED_FILE.parent.mkdir(parents=True, exist_ok=True)
+    claim_order(order_id)
 
-    processed = _read_processed_orders()
-    if order_id in processed:
-        return
 
-    with open(PROCESSED_FILE, "a", encoding="utf-8") as file:
-        file.write(f"{order_id}\n")
+def storage_paths() -> List[Tuple[ModuleType, str, Path]]:
+    """
+    Bancos e diretórios em storage/ declarados no nível de módulo pelo
+    pacote (QUEUE_DB, DELIVERY_DB...), achados por varredura: um módulo
+    novo entra sem ninguém manter lista.
+    """
+
+    package = importlib.import_module(__package__)
+    found = []
+    for info in pkgutil.iter_modules(package.__path__):
+        module = importlib.import_module(f"{__package__}.{info.name}")
+        for name, value in vars(module).items():
+            if name.isupper() and isinstance(value, Path) and STORAGE_DIR in value.parents:
+                found.append((module, name, value))
+    return found
+
+
+def relocate(directory: Union[str, Path]) -> None:
+    """
+    Aponta todos os caminhos de storage_paths() para ``directory``, com o
+    mesmo caminho relativo (benchmarks, ambientes descartáveis).
+    """
+
+    for module, name, path in storage_paths():
+        setattr(module, name, Path(directory) / path.relative_to(STORAGE_DIR))
@@ -0,0 +1,339 @@
+import json
+import os
+import threading
+from contextlib import contextmanager
+from contextvars import ContextVar
+from pathlib import Path
+from string import Formatter
+from typing import Any, Dict, Iterator, List, Mapping, Optional, Tuple
+
+from . import log, settings
+
+TEMPLATES_DIR = Path(__file__).resolve().parent / "templates"
+BASE_FILE = "_base.json"
+
+# Campos do pedido disponíveis nos textos, e o atributo de Payment que cada
+# campo de pagamento exige do webhook.
+ORDER_FIELDS = (
+    "first_name",
+    "customer_name",
+    "order_id",
+    "total",
+    "items",
+    "items_block",
+    "payment_kind",
+    "payment_code",
+    "payment_link",
+)
+PAYMENT_FIELDS = {"payment_code": "code", "payment_link": "link"}
+STEP_KINDS = ("text", "code", "media", "delay")
+
+_formatter = Formatter()
+logger = log.get_logger("templates")
+
+
+class TemplateError(ValueError):
+    """
+    Arquivo de template inválido: campo desconhecido, passo sem texto,
+    mensagem inexistente etc. Levantado na carga, nunca durante o envio.
+    """
+
+
+def _tokens(source: str, variables: Mapping[str, str], origin: str, depth: int = 0):
+    if depth > 5:
+        raise TemplateError(f"{origin}: variáveis aninhadas demais")
+
+    try:
+        parsed = list(_formatter.parse(source))
+    except ValueError as exc:
+        raise TemplateError(f"{origin}: {exc}") from exc
+
+    for text, field, spec, conversion in parsed:
+        yield text, None
+        if field is None:
+            continue
+        if spec or conversion:
+            raise TemplateError(f"{origin}: formatação não suportada em {{{field}}}")
+        if field in variables:
+            yield from _tokens(variables[field], variables, origin, depth + 1)
+        elif field in ORDER_FIELDS:
+            yield "", field
+        else:
+            raise TemplateError(f"{origin}: campo desconhecido {{{field}}}")
+
+
+class CompiledText:
+    """
+    Texto pré-processado em pares (literal, campo). As variáveis fixas do
+    arquivo já vêm substituídas, então renderizar é só concatenar.
+    """
+
+    __slots__ = ("parts", "fields")
+
+    def __init__(self, source: str, variables: Mapping[str, str], origin: str) -> None:
+        parts: List[Tuple[str, Optional[str]]] = []
+        literal = ""
+        for text, field in _tokens(source, variables, origin):
+            literal += text
+            if field is not None:
+                parts.append((literal, field))
+                literal = ""
+        parts.append((literal, None))
+
+        self.parts = tuple(parts)
+        self.fields = frozenset(field for _, field in parts if field)
+
+    def render(self, context: Mapping[str, str]) -> str:
+        return "".join(
+            literal + context[field] if field else literal for literal, field in self.parts
+        )
+
+
+def order_context(order: Any) -> Dict[str, str]:
+    """
+    Valores dos campos do pedido, calculados uma vez por renderização.
+    """
+
+    items = "\n".join(f"- {item.name} (qtd {item.quantity})" for item in order.items)
+    return {
+        "first_name": order.first_name,
+        "customer_name": order.customer_name,
+        "order_id": order.id,
+        "total": order.total,
+        "items": items,
+        "items_block": f"\n{items}" if items else "",
+        "payment_kind": order.payment.kind,
+        "payment_code": order.payment.code,
+        "payment_link": order.payment.link,
+    }
+
+
+class Template:
+    """
+    Sequência compilada de um tipo_interno.
+
+    Passos aceitos no arquivo:
+      text  → mensagem ("message" do _base.json ou "body" inline)
+      code  → código de pagamento (linha digitável / Pix Copia e Cola)
+      media → PDF baixado de "url" e enviado como "filename"
+      delay → pausa de "seconds" antes do próximo passo
+    """
+
+    __slots__ = ("kind", "steps", "requires")
+
+    def __init__(self, kind: str, steps: List[Dict[str, Any]]) -> None:
+        self.kind = kind
+        self.steps = steps
+        fields = set()
+        for step in steps:
+            for value in step.values():
+                if isinstance(value, CompiledText):
+                    fields |= value.fields
+        self.requires = tuple(
+            sorted(PAYMENT_FIELDS[field] for field in fields if field in PAYMENT_FIELDS)
+        )
+
+    def render(self, order: Any) -> List[Dict[str, Any]]:
+        """
+        Passos prontos para o scheduler/DeliveryEngine: "text", "boleto" e
+        "delay".
+        """
+
+        context = order_context(order)
+        rendered = []
+        for step in self.steps:
+            kind = step["kind"]
+            if kind == "text":
+                rendered.append(
+                    {"kind": "text", "body": step["body"].render(context), "label": step["label"]}
+                )
+            elif kind == "media":
+                rendered.append(
+                    {
+                        "kind": "boleto",
+                        "url": step["url"].render(context),
+                        "filename": step["filename"],
+                    }
+                )
+            else:
+                rendered.append(dict(step))
+        return rendered
+
+
+def _read(path: Path) -> Dict[str, Any]:
+    try:
+        with open(path, encoding="utf-8") as file:
+            data = json.load(file)
+    except ValueError as exc:
+        raise TemplateError(f"{path.name}: JSON inválido ({exc})") from exc
+    if not isinstance(data, dict):
+        raise TemplateError(f"{path.name}: esperado um objeto JSON")
+    return data
+
+
+def _compile_step(
+    step: Mapping[str, Any],
+    messages: Mapping[str, str],
+    variables: Mapping[str, str],
+    origin: str,
+) -> Dict[str, Any]:
+    kind = step.get("kind")
+    if kind not in STEP_KINDS:
+        raise TemplateError(f"{origin}: tipo de passo desconhecido {kind!r}")
+
+    if kind == "delay":
+        try:
+            return {"kind": "delay", "seconds": float(step["seconds"])}
+        except (KeyError, TypeError, ValueError):
+            raise TemplateError(f"{origin}: delay exige 'seconds' numérico") from None
+
+    if kind == "media":
+        if not step.get("url"):
+            raise TemplateError(f"{origin}: media exige 'url'")
+        return {
+            "kind": "media",
+            "url": CompiledText(step["url"], variables, origin),
+            "filename": step.get("filename", "boleto.pdf"),
+        }
+
+    if kind == "code":
+        source = "{payment_code}"
+    elif "message" in step:
+        if step["message"] not in messages:
+            raise TemplateError(f"{origin}: mensagem inexistente {step['message']!r}")
+        source = messages[step["message"]]
+    elif "body" in step:
+        source = step["body"]
+    else:
+        raise TemplateError(f"{origin}: text exige 'message' ou 'body'")
+
+    return {
+        "kind": "text",
+        "body": CompiledText(source, variables, origin),
+        "label": step.get("label", "mensagem"),
+    }
+
+
+def compile_directory(directory: Path, fallback: Optional[Path] = None) -> Dict[str, Template]:
+    """
+    Compila todos os <tipo_interno>.json do diretório. Arquivos iniciados
+    por "_" não são tipos; _base.json guarda as mensagens compartilhadas.
+
+    Com ``fallback`` (diretório de um tenant sobre o padrão), tipos e
+    mensagens ausentes em ``directory`` vêm do fallback: um tenant pode
+    trocar só o _base.json.
+    """
+
+    directories = [fallback, directory] if fallback is not None else [directory]
+    messages: Dict[str, str] = {}
+    base_variables: Dict[str, str] = {}
+    paths: Dict[str, Path] = {}
+    for source in directories:
+        if (source / BASE_FILE).exists():
+            base = _read(source / BASE_FILE)
+            messages.update(base.get("messages", {}))
+            base_variables.update(base.get("variables", {}))
+        for path in source.glob("*.json"):
+            if not path.name.startswith("_"):
+                paths[path.stem] = path
+
+    compiled: Dict[str, Template] = {}
+    for _, path in sorted(paths.items()):
+        data = _read(path)
+        variables = {**base_variables, **data.get("variables", {})}
+        steps = data.get("steps")
+        if not isinstance(steps, list) or not steps:
+            raise TemplateError(f"{path.name}: 'steps' deve ser uma lista não vazia")
+
+        compiled[path.stem] = Template(
+            path.stem,
+            [
+                _compile_step(step, messages, variables, f"{path.name} passo {index + 1}")
+                for index, step in enumerate(steps)
+            ],
+        )
+    return compiled
+
+
+_templates: Optional[Dict[str, Template]] = None
+_lock = threading.Lock()
+# Sequências de tenants, por diretório, e o diretório do tenant em atendimento.
+_tenant_templates: Dict[Path, Dict[str, Template]] = {}
+_scoped_dir: ContextVar[Optional[Path]] = ContextVar("wbuy_templates_dir", default=None)
+
+
+def templates_dir() -> Path:
+    return Path(os.getenv("WBUY_TEMPLATES_DIR") or TEMPLATES_DIR)
+
+
+def load(reload: bool = False) -> Dict[str, Template]:
+    """
+    Compila os templates uma única vez por processo (chamado no create_app).
+    Use reload=True para reler os arquivos.
+    """
+
+    global _templates
+
+    if _templates is None or reload:
+        with _lock:
+            if _templates is None or reload:
+                _templates = compile_directory(templates_dir())
+                logger.info("Sequências carregadas: %s", ", ".join(sorted(_templates)))
+    return _templates
+
+
+def load_tenant(directory: Path, reload: bool = False) -> Dict[str, Template]:
+    """
+    Sequências de um tenant: ``directory`` sobre o diretório padrão,
+    compiladas uma vez por processo.
+    """
+
+    compiled = _tenant_templates.get(directory)
+    if compiled is None or reload:
+        with _lock:
+            compiled = _tenant_templates.get(directory)
+            if compiled is None or reload:
+                compiled = compile_directory(directory, fallback=templates_dir())
+                _tenant_templates[directory] = compiled
+                logger.info(
+                    "Sequências carregadas de %s: %s", directory, ", ".join(sorted(compiled))
+                )
+    return compiled
+
+
+@contextmanager
+def use(directory: Optional[Path]) -> Iterator[None]:
+    """
+    Faz get() usar as sequências do diretório do tenant no contexto atual.
+    """
+
+    token = _scoped_dir.set(directory)
+    try:
+        yield
+    finally:
+        _scoped_dir.reset(token)
+
+
+@settings.on_reload
+def _reload(_: settings.Settings) -> None:
+    if _templates is not None:
+        load(reload=True)
+    for directory in list(_tenant_templates):
+        load_tenant(directory, reload=True)
+
+
+def get(kind: str) -> Optional[Template]:
+    directory = _scoped_dir.get()
+    if directory is not None:
+        return load_tenant(directory).get(kind)
+    return load().get(kind)
+
+
+def required_fields(kind: str) -> Tuple[str, ...]:
+    """
+    Atributos de Payment que o template do tipo usa e que, portanto, o
+    webhook precisa trazer.
+    """
+
+    template = get(kind)
+    return template.requires if template is not None else ()
@@ -0,0 +1,241 @@
+import json
+import os
+import threading
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+from dataclasses import dataclass
+from functools import wraps
+from pathlib import Path
+from typing import Any, Callable, Dict, Iterator, List, Optional, Tuple
+
+from . import log, settings, templates
+from .storage import BASE_DIR
+
+TENANTS_FILE = BASE_DIR / "tenants.json"
+
+# Tenant padrão: configuração do ambiente, rota /wbuy/webhook e chaves de
+# pedido sem prefixo (compatível com as instalações de uma loja só).
+DEFAULT = ""
+PAYLOAD_KEY = "_tenant"
+
+logger = log.get_logger("tenants")
+
+_current: ContextVar[str] = ContextVar("wbuy_tenant", default=DEFAULT)
+
+
+class TenantError(ValueError):
+    """
+    Arquivo de tenants inválido. Levantado na carga, com o nome do tenant.
+    """
+
+
+def _env_float(name: str, default: float) -> float:
+    try:
+        return float(os.getenv(name, default))
+    except (TypeError, ValueError):
+        return default
+
+
+@dataclass(frozen=True)
+class Tenant:
+    """
+    Uma loja WBuy com a própria conta do Whaticket.
+
+    Os limites (rate_limit, rate_burst, sender_threads, pool_size) valem
+    só para o tenant; None usa o padrão do ambiente.
+    """
+
+    name: str
+    settings: settings.Settings
+    templates_dir: Optional[Path] = None
+    rate_limit: Optional[float] = None
+    rate_burst: Optional[float] = None
+    sender_threads: Optional[int] = None
+    pool_size: Optional[int] = None
+
+    @classmethod
+    def from_config(cls, name: str, data: Dict[str, Any], root: Path) -> "Tenant":
+        if not isinstance(data, dict):
+            raise TenantError(f"{name}: esperado um objeto JSON")
+        if not name or "/" in name or ":" in name:
+            raise TenantError(f"{name!r}: nome de tenant inválido")
+
+        token = data.get("whaticket_token") or os.getenv(data.get("whaticket_token_env") or "", "")
+        if not token:
+            raise TenantError(f"{name}: whaticket_token ou whaticket_token_env obrigatório")
+        default = settings.Settings.from_env()
+        templates_dir = data.get("templates_dir")
+        try:
+            return cls(
+                name=name,
+                settings=settings.Settings(
+                    whaticket_api_url=data.get("whaticket_api_url") or default.whaticket_api_url,
+                    whaticket_token=token,
+                    whaticket_bulk_url=data.get("whaticket_bulk_url", ""),
+                ),
+                templates_dir=(root / templates_dir).resolve() if templates_dir else None,
+                rate_limit=_optional(data, "rate_limit", float),
+                rate_burst=_optional(data, "rate_burst", float),
+                sender_threads=_optional(data, "sender_threads", int),
+                pool_size=_optional(data, "pool_size", int),
+            )
+        except (TypeError, ValueError) as exc:
+            raise TenantError(f"{name}: {exc}") from exc
+
+
+def _optional(data: Dict[str, Any], key: str, cast: Callable[[Any], Any]) -> Any:
+    value = data.get(key)
+    return cast(value) if value is not None else None
+
+
+def tenants_file() -> Path:
+    return Path(os.getenv("WBUY_TENANTS_FILE") or TENANTS_FILE)
+
+
+def parse(path: Path) -> Dict[str, Tenant]:
+    """
+    Lê o arquivo de tenants: {"<tenant>": {"whaticket_token_env": ..., ...}}.
+    Caminhos (templates_dir) são relativos ao arquivo.
+    """
+
+    try:
+        with open(path, encoding="utf-8") as file:
+            data = json.load(file)
+    except ValueError as exc:
+        raise TenantError(f"{path.name}: JSON inválido ({exc})") from exc
+    if not isinstance(data, dict):
+        raise TenantError(f"{path.name}: esperado um objeto JSON")
+    return {
+        name: Tenant.from_config(name, config, path.parent) for name, config in data.items()
+    }
+
+
+_lock = threading.Lock()
+_tenants: Dict[str, Tenant] = {}
+_source: Optional[Tuple[Path, float]] = None
+_checked_at = 0.0
+
+
+def load(reload: bool = False) -> Dict[str, Tenant]:
+    """
+    Tenants do arquivo (WBUY_TENANTS_FILE), em cache. O arquivo é relido
+    quando muda, conferido no máximo a cada WBUY_TENANTS_CHECK_SECONDS,
+    ou no reload das settings (SIGHUP). Sem arquivo, não há tenants além
+    do padrão; um arquivo inválido mantém a última versão boa.
+    """
+
+    global _tenants, _source, _checked_at
+
+    now = time.monotonic()
+    if not reload and now - _checked_at < _env_float("WBUY_TENANTS_CHECK_SECONDS", 5.0):
+        return _tenants
+
+    with _lock:
+        _checked_at = now
+        path = tenants_file()
+        try:
+            source: Optional[Tuple[Path, float]] = (path, path.stat().st_mtime)
+        except FileNotFoundError:
+            source = None
+        if source == _source and not reload:
+            return _tenants
+
+        if source is None:
+            _tenants = {}
+        else:
+            try:
+                _tenants = parse(path)
+            except (OSError, TenantError) as exc:
+                logger.error("Arquivo de tenants inválido, mantendo o anterior: %s", exc)
+                return _tenants
+            logger.info("Tenants carregados: %s", ", ".join(sorted(_tenants)) or "-")
+        _source = source
+    return _tenants
+
+
+@settings.on_reload
+def _reload(_: settings.Settings) -> None:
+    load(reload=True)
+
+
+def get(name: str) -> Optional[Tenant]:
+    return load().get(name) if name else None
+
+
+def names() -> List[str]:
+    return sorted(load())
+
+
+def current() -> str:
+    return _current.get()
+
+
+@contextmanager
+def bind(name: str) -> Iterator[Optional[Tenant]]:
+    """
+    Atende o tenant no contexto atual: settings.get() devolve a conta do
+    Whaticket dele e templates.get() as sequências dele. Tenant inexistente
+    levanta KeyError.
+    """
+
+    tenant = get(name)
+    if name and tenant is None:
+        raise KeyError(name)
+
+    token = _current.set(name)
+    try:
+        with settings.use(tenant.settings if tenant else None), templates.use(
+            tenant.templates_dir if tenant else None
+        ):
+            yield tenant
+    finally:
+        _current.reset(token)
+
+
+def propagate(function: Callable) -> Callable:
+    """
+    Leva o tenant atual para a função quando ela rodar em outra thread
+    (batcher, event loop do DeliveryEngine).
+    """
+
+    name = current()
+
+    @wraps(function)
+    def wrapper(*args: Any, **kwargs: Any) -> Any:
+        with bind(name):
+            return function(*args, **kwargs)
+
+    return wrapper
+
+
+def scoped(order_id: str, name: Optional[str] = None) -> str:
+    """
+    Chave do pedido no storage, singleflight, delivery_log e fila: o mesmo
+    id em lojas diferentes são pedidos diferentes.
+    """
+
+    name = current() if name is None else name
+    return f"{name}:{order_id}" if name else order_id
+
+
+def split(key: str) -> Tuple[str, str]:
+    """
+    Inverso de scoped(): (tenant, order_id).
+    """
+
+    name, sep, order_id = key.partition(":")
+    return (name, order_id) if sep else (DEFAULT, key)
+
+
+def of_payload(payload: Any) -> str:
+    """
+    Tenant de um job da fila: a chave PAYLOAD_KEY dos webhooks ou o prefixo
+    do pedido nas retomadas ({"delivery_retry": "<tenant>:<id>"}).
+    """
+
+    if not isinstance(payload, dict):
+        return DEFAULT
+    if "delivery_retry" in payload:
+        return split(str(payload["delivery_retry"]))[0]
+    return str(payload.get(PAYLOAD_KEY) or DEFAULT)
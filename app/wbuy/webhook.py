@@ -1,120 +1,103 @@
-import os
-import sys
+import json
 import time
-from typing import Any, Dict, List
-
-import requests
-
-from . import storage
-
-WHATICKET_API_URL = os.getenv(
-    "WHATICKET_API_BASE_URL", "https://api.osmardev.online/api/messages/send"
-)
-WHATICKET_TOKEN = (
-    os.getenv("TOKEN_DO_ENV")
-    or os.getenv("WHATICKET_TOKEN")
-    or os.getenv("TOKEN_WHATS")
+from concurrent.futures import Future
+from functools import partial
+from typing import Any, Dict, Iterable, List, Optional, Union
+
+from . import (
+    archive,
+    batcher,
+    boleto_cache,
+    breaker,
+    delivery_log,
+    http_client,
+    jobs,
+    log,
+    media,
+    metrics,
+    models,
+    phones,
+    priority,
+    scheduler,
+    settings,
+    singleflight,
+    storage,
+    templates,
+    tenants,
 )
+from .models import Order
 
+logger = log.get_logger("webhook")
+whatsapp_logger = log.get_logger("whatsapp")
 
-def _get_test_number() -> str:
-    """
-    Return the configured test phone number, if any.
-
-    The value is read from the first non-empty environment variable among:
-    - WHATSAPP_TEST_NUMBER (current)
-    - NUMBER_TEST (value present in the repo's .env)
-    - NUMBER_TESTE (legacy documentation)
-    """
-
-    for env_key in ("WHATSAPP_TEST_NUMBER", "NUMBER_TEST", "NUMBER_TESTE"):
-        value = os.getenv(env_key)
-        if value:
-            return value
-
-    return ""
+# Entregas esperando no scheduler renovam o lease junto com os jobs.
+jobs.on_heartbeat(delivery_log.heartbeat)
 
 
 def normalize_phone(phone: str) -> str:
-    digits = "".join(ch for ch in (phone or "") if ch.isdigit())
-
-    while digits.startswith("0"):
-        digits = digits[1:]
-
-    if digits.startswith("55"):
-        return digits
-
-    if len(digits) == 11:
-        return f"55{digits}"
-
-    return digits
-
-
-def extract_first_name(full_name: str) -> str:
-    full_name = (full_name or "").strip()
-    return full_name.split()[0] if full_name else ""
-
-
-def build_msg_1(
-    nome_cliente: str,
-    numero_do_pedido: str,
-    valor_total: str,
-    lista_itens: str,
-    payment_instruction: str,
-) -> str:
-    itens_formatados = f"\n{lista_itens}" if lista_itens else ""
-
-    return (
-        f"Oi, {nome_cliente}! 🌺✨\n"
-        "Aqui é a Carol da Sarat.\n"
-        "Espero que esteja tudo bem?\n"
-        "Que alegria ver seu pedido chegando pra gente 💛\n"
-        f"Aqui estão os dados certinhos do seu pedido {numero_do_pedido}:\n\n"
-        f"📦 Pedido: {numero_do_pedido}\n"
-        f"🧾 Valor total: R$ {valor_total}\n"
-        f"🛍️ Itens:{itens_formatados}\n\n"
-        f"{payment_instruction}"
-    )
-
-
-def build_msg_2(pix_copia_cola: str) -> str:
-    return pix_copia_cola
+    """
+    Telefone em E.164 (sem "+") pronto para o Whaticket, ou "" quando o
+    número é inválido (ver phones.check).
+    """
 
+    return phones.normalize(phone)
 
-def build_closing_message() -> str:
-    return (
-        "E se tiver qualquer dúvida ou dificuldade pode chamar a gente por aqui mesmo.\n"
-        "🙏🏻🙏🏻🙏🏻"
-    )
 
+def send_whats_media(
+    number: str, file_bytes: Union[bytes, Iterable[bytes]], filename: str
+) -> Dict[str, Any]:
+    """
+    Envia um PDF ao Whaticket. ``file_bytes`` pode ser o conteúdo inteiro ou
+    um iterável de blocos; neste caso o multipart é montado em streaming,
+    sem carregar o arquivo todo em memória.
+    """
 
-def send_whats_media(number: str, file_bytes: bytes, filename: str) -> Dict[str, Any]:
     normalized_number = (number or "").strip()
     if not normalized_number:
-        print(
-            f"[whatsapp-media] Número ausente ou inválido para envio de mídia. Recebido: '{number}'"
+        whatsapp_logger.warning(
+            "Número ausente ou inválido para envio de mídia.", extra={"phone": number}
         )
         return {"status": "skipped", "reason": "missing_number"}
 
-    if not WHATICKET_TOKEN:
-        print("[whatsapp-media] Token do Whaticket ausente. Configure WHATICKET_TOKEN/TOKEN_WHATS/TOKEN_DO_ENV.")
+    config = settings.get()
+    if not config.whaticket_token:
+        whatsapp_logger.error(
+            "Token do Whaticket ausente. Configure WHATICKET_TOKEN/TOKEN_WHATS/TOKEN_DO_ENV."
+        )
         return {"status": "error", "reason": "missing_token"}
 
-    headers = {"Authorization": f"Bearer {WHATICKET_TOKEN}"}
+    headers = {"Authorization": f"Bearer {config.whaticket_token}"}
     data = {"number": normalized_number}
-    files = {"medias": (filename, file_bytes, "application/pdf")}
 
-    print(
-        f"[whatsapp-media] Payload construído para Whaticket: número={normalized_number}, arquivo={filename}"
+    whatsapp_logger.debug(
+        "Enviando mídia ao Whaticket.", extra={"phone": normalized_number, "filename": filename}
     )
 
-    response = requests.post(
-        WHATICKET_API_URL, headers=headers, data=data, files=files, timeout=30
-    )
+    try:
+        with breaker.guard() as call, metrics.timer("wbuy_whaticket_send_seconds", kind="media"):
+            if isinstance(file_bytes, (bytes, bytearray)):
+                files = {"medias": (filename, file_bytes, "application/pdf")}
+                response = http_client.request(
+                    "POST", config.whaticket_api_url, headers=headers, data=data, files=files
+                )
+            else:
+                content_type, body = media.iter_multipart(
+                    data, "medias", filename, "application/pdf", file_bytes
+                )
+                headers["Content-Type"] = content_type
+                response = http_client.request(
+                    "POST", config.whaticket_api_url, retry=False, headers=headers, data=body
+                )
+            call.failed = breaker.is_upstream_failure(response.status_code)
+    except breaker.BreakerOpen as exc:
+        whatsapp_logger.warning("Envio de mídia adiado: %s.", exc.reason)
+        return exc.as_result()
     if not response.ok:
-        print(
-            f"[whatsapp-media] Erro ao enviar mídia. Status: {response.status_code}. Corpo: {response.text}"
+        whatsapp_logger.warning(
+            "Erro ao enviar mídia.",
+            extra={"status_code": response.status_code, "response": response.text[:500]},
         )
+        phones.record_send_failure(normalized_number, response.status_code, response.text)
         return {
             "status": "error",
             "status_code": response.status_code,
@@ -127,29 +110,40 @@ def send_whats_media(number: str, file_bytes: bytes, filename: str) -> Dict[str,
 def send_whats_message(number: str, body: str) -> Dict[str, Any]:
     normalized_number = (number or "").strip()
     if not normalized_number:
-        print(
-            f"[whatsapp] Número ausente ou inválido para envio de mensagem. Recebido: '{number}'"
+        whatsapp_logger.warning(
+            "Número ausente ou inválido para envio de mensagem.", extra={"phone": number}
         )
         return {"status": "skipped", "reason": "missing_number"}
 
-    if not WHATICKET_TOKEN:
-        print("[whatsapp] Token do Whaticket ausente. Configure WHATICKET_TOKEN/TOKEN_WHATS/TOKEN_DO_ENV.")
+    config = settings.get()
+    if not config.whaticket_token:
+        whatsapp_logger.error(
+            "Token do Whaticket ausente. Configure WHATICKET_TOKEN/TOKEN_WHATS/TOKEN_DO_ENV."
+        )
         return {"status": "error", "reason": "missing_token"}
 
     headers = {
-        "Authorization": f"Bearer {WHATICKET_TOKEN}",
+        "Authorization": f"Bearer {config.whaticket_token}",
         "Content-Type": "application/json",
     }
 
     payload = {"number": normalized_number, "body": body}
 
-    print(f"[whatsapp] Payload construído para Whaticket: {payload}")
-
-    response = requests.post(WHATICKET_API_URL, headers=headers, json=payload, timeout=30)
+    try:
+        with breaker.guard() as call, metrics.timer("wbuy_whaticket_send_seconds", kind="text"):
+            response = http_client.request(
+                "POST", config.whaticket_api_url, headers=headers, json=payload
+            )
+            call.failed = breaker.is_upstream_failure(response.status_code)
+    except breaker.BreakerOpen as exc:
+        whatsapp_logger.warning("Envio de mensagem adiado: %s.", exc.reason)
+        return exc.as_result()
     if not response.ok:
-        print(
-            f"[whatsapp] Erro ao enviar mensagem. Status: {response.status_code}. Corpo: {response.text}"
+        whatsapp_logger.warning(
+            "Erro ao enviar mensagem.",
+            extra={"status_code": response.status_code, "response": response.text[:500]},
         )
+        phones.record_send_failure(normalized_number, response.status_code, response.text)
         return {
             "status": "error",
             "status_code": response.status_code,
@@ -159,117 +153,565 @@ def send_whats_message(number: str, body: str) -> Dict[str, Any]:
     return response.json()
 
 
-def _parse_lista_itens(produtos: List[Dict[str, Any]]) -> str:
-    return "\n".join(
-        f"- {produto['produto']} (qtd {produto['qtd']})" for produto in produtos
-    )
-
+@metrics.counts_outcome("process_webhook")
+def process_webhook(
+    payload: Union[Dict[str, Any], Order], wait: bool = True
+) -> Union[Dict[str, Any], Future]:
+    """
+    Valida o pedido, reivindica-o e agenda a sequência de mensagens.
+
+    Aceita o dict do webhook ou um Order já validado; payloads malformados
+    são recusados antes de qualquer acesso ao banco ou ao Whaticket.
+    Com wait=False retorna um Future com o resultado final, para que o worker
+    da fila fique livre enquanto o scheduler espaça os envios. O pedido é do
+    tenant gravado no job (tenants.PAYLOAD_KEY) ou, sem ele, do tenant em
+    atendimento. A validação já usa os templates desse tenant.
+    """
 
-def process_webhook(payload: Dict[str, Any]) -> None:
-    nome_cliente = payload["data"]["cliente"]["nome"]
-    telefone = payload["data"]["cliente"].get("telefone1", "")
-    numero_do_pedido = str(payload["data"]["id"])
-    valor_total = payload["data"]["valor_total"]["total"]
-    lista_itens = _parse_lista_itens(payload["data"].get("produtos", []))
-    pagamento = payload["data"]["pagamento"]
-    tipo_pagamento = pagamento["tipo_interno"]
+    name = tenants.current()
+    if isinstance(payload, dict) and payload.get(tenants.PAYLOAD_KEY):
+        name = tenants.of_payload(payload)
+    if name and tenants.get(name) is None:
+        logger.error("Tenant '%s' não está no arquivo de tenants. Ignorando envio.", name)
+        order_id = payload.id if isinstance(payload, Order) else models.order_id_of(payload)
+        if order_id:
+            singleflight.release(tenants.scoped(order_id, name))
+        return {"status": "skipped", "reason": "unknown_tenant"}
+
+    with tenants.bind(name):
+        try:
+            order = payload if isinstance(payload, Order) else Order.from_payload(payload)
+        except models.PayloadError as exc:
+            logger.warning("Payload inválido (%s). Ignorando envio.", exc)
+            return exc.as_result()
+
+        with log.bind(tenants.scoped(order.id)):
+            return _process_order(order, wait)
+
+
+def _process_order(order: Order, wait: bool) -> Union[Dict[str, Any], Future]:
+    # Storage, singleflight e delivery_log usam a chave com o tenant.
+    numero_do_pedido = tenants.scoped(order.id)
+    lane = priority.class_of(order.payment.kind)
+    template = templates.get(order.payment.kind)
+    if template is None:
+        logger.warning(
+            "Sem template para o pagamento '%s'. Ignorando envio.", order.payment.kind
+        )
+        singleflight.release(numero_do_pedido)
+        return {"status": "skipped", "reason": "unsupported_payment"}
 
     if storage.is_order_processed(numero_do_pedido):
-        print(f"[webhook] Pedido {numero_do_pedido} já processado. Ignorando envio duplicado.")
+        if delivery_log.recover_stale(numero_do_pedido):
+            logger.info("Retomando entrega interrompida do pedido.")
+            return _deliver(numero_do_pedido, wait, lane)
+        logger.info("Pedido já processado. Ignorando envio duplicado.", extra={"sampled": True})
         return {"status": "skipped", "reason": "already_processed"}
 
-    primeiro_nome = extract_first_name(nome_cliente)
-
-    test_number = _get_test_number()
-    normalized_phone = normalize_phone(test_number or telefone)
+    test_number = phones.test_number()
+    phone = phones.check(test_number or order.phone)
+    normalized_phone = phone.number
 
     if not normalized_phone:
-        print(
-            f"[webhook] Número de telefone ausente ou inválido para o pedido {numero_do_pedido}. Ignorando envio."
+        singleflight.release(numero_do_pedido)
+        if phone.reason == "missing":
+            logger.warning("Número de telefone ausente. Ignorando envio.")
+            return {"status": "skipped", "reason": "missing_phone"}
+        logger.warning(
+            "Número de telefone inválido (%s). Ignorando envio.",
+            phone.reason,
+            extra={"phone": test_number or order.phone},
         )
-        return {"status": "skipped", "reason": "missing_phone"}
+        return {"status": "skipped", "reason": "invalid_phone", "detail": phone.reason}
+
+    if phones.has_no_whatsapp(normalized_phone):
+        logger.info("Número sem WhatsApp. Ignorando envio.", extra={"phone": normalized_phone})
+        singleflight.release(numero_do_pedido)
+        return {"status": "skipped", "reason": "no_whatsapp"}
+
+    if not storage.claim_order(numero_do_pedido):
+        logger.info("Pedido já processado. Ignorando envio duplicado.", extra={"sampled": True})
+        return {"status": "skipped", "reason": "already_processed"}
+
+    try:
+        delivery_log.start(numero_do_pedido, normalized_phone, template.render(order))
+    except Exception:
+        storage.release_order(numero_do_pedido)
+        singleflight.release(numero_do_pedido)
+        raise
+
+    return _deliver(numero_do_pedido, wait, lane)
+
+
+def _deliver(
+    order_id: str, wait: bool = True, lane: str = priority.DEFAULT
+) -> Union[Dict[str, Any], Future]:
+    """
+    Envia os passos ainda não enviados da entrega registrada no
+    delivery_log, na classe de prioridade ``lane``. Em caso de falha agenda
+    a retomada na fila com backoff exponencial, a partir do primeiro passo
+    não enviado, ou manda o pedido para a lista de dead letters.
+    """
+
+    delivery = delivery_log.load(order_id)
+    if delivery is None:
+        return {"status": "skipped", "reason": "not_pending"}
 
-    payment_instruction_pix = "Para concluir rapidinho, é só pagar usando o Pix Copia e Cola abaixo:"
-    payment_instruction_boleto = (
-        "Para concluir rapidinho, é só pagar usando o código de barras abaixo:"
+    tracker = delivery_log.StepTracker(order_id)
+    outcome: Future = Future()
+    # Dono vivo: recover_stale não retoma a entrega enquanto ela espera a vez.
+    delivery_log.hold(order_id)
+
+    def _settle(result: Optional[Dict[str, Any]], error: Optional[BaseException]) -> None:
+        delivery_log.drop(order_id)
+        if error is None and result is None:
+            delivery_log.complete(order_id)
+            logger.info("Sequência entregue.", extra={"order_id": order_id})
+            outcome.set_result({"status": "ok"})
+            return
+
+        failure = dict(result) if result is not None else {
+            "status": "error",
+            "reason": "delivery_failed",
+            "error": repr(error),
+        }
+        if failure.get("reason") in breaker.PARK_REASONS:
+            _park(order_id, failure, lane)
+            outcome.set_result(failure)
+            return
+
+        retry_in = delivery_log.fail(order_id, json.dumps(failure, ensure_ascii=False, default=str))
+        if retry_in is None:
+            logger.error(
+                "Pedido esgotou as tentativas e foi para dead letters.",
+                extra={"order_id": order_id},
+            )
+            failure["dead_letter"] = True
+        else:
+            logger.warning(
+                "Falha no envio. Nova tentativa em %.0fs.", retry_in, extra={"order_id": order_id}
+            )
+            jobs.enqueue({"delivery_retry": order_id, "priority": lane}, delay=retry_in)
+            failure["retry_in"] = retry_in
+        outcome.set_result(failure)
+
+    def _on_delivered(done: Future) -> None:
+        try:
+            result = done.result()
+        except Exception as exc:
+            _settle(None, exc)
+        else:
+            _settle(result, None)
+
+    # Retomadas para um número já confirmado sem WhatsApp falham sem rede
+    # até irem para dead letters.
+    if phones.has_no_whatsapp(delivery.phone):
+        _settle({"status": "skipped", "reason": "no_whatsapp"}, None)
+        return outcome if not wait else outcome.result()
+
+    # Com o circuito aberto o pedido volta para a fila sem ocupar o scheduler.
+    wait_open = breaker.retry_after()
+    if wait_open > 0:
+        _settle({"status": "error", "reason": "circuit_open", "retry_after": wait_open}, None)
+        return outcome if not wait else outcome.result()
+
+    try:
+        _submit_steps(delivery.phone, delivery.steps, tracker, lane).add_done_callback(
+            _on_delivered
+        )
+    except Exception as exc:
+        _settle(None, exc)
+
+    if not wait:
+        return outcome
+
+    return outcome.result()
+
+
+def _park(order_id: str, failure: Dict[str, Any], lane: str = priority.DEFAULT) -> None:
+    """
+    Estaciona a entrega enquanto o Whaticket está indisponível: volta para
+    a fila depois do tempo indicado pelo breaker, sem contar tentativa.
+    """
+
+    delay = max(float(failure.get("retry_after") or 0.0), 1.0)
+    delivery_log.park(order_id, delay, json.dumps(failure, ensure_ascii=False, default=str))
+    logger.warning(
+        "Whaticket indisponível (%s). Entrega estacionada por %.0fs.",
+        failure["reason"],
+        delay,
+        extra={"order_id": order_id},
     )
+    jobs.enqueue({"delivery_retry": order_id, "priority": lane}, delay=delay)
+    failure["status"] = "parked"
+    failure["retry_in"] = delay
+
 
-    if tipo_pagamento == "pix":
-        pix_copia_cola = pagamento["linha_digitavel"]
-        mensagem_1 = build_msg_1(
-            primeiro_nome,
-            numero_do_pedido,
-            valor_total,
-            lista_itens,
-            payment_instruction_pix,
+@metrics.counts_outcome("resume_delivery")
+def resume_delivery(
+    order_id: str, wait: bool = True, lane: Optional[str] = None
+) -> Union[Dict[str, Any], Future]:
+    """
+    Retoma uma entrega agendada para nova tentativa (job delivery_retry) ou
+    tirada da lista de dead letters, na classe de prioridade original. O
+    tenant vem do prefixo da chave (tenants.scoped).
+    """
+
+    name = tenants.split(order_id)[0]
+    if name and tenants.get(name) is None:
+        logger.error("Tenant '%s' não está no arquivo de tenants. Retomada ignorada.", name)
+        return {"status": "skipped", "reason": "unknown_tenant"}
+
+    if not delivery_log.begin_retry(order_id):
+        return {"status": "skipped", "reason": "not_pending"}
+
+    with tenants.bind(name), log.bind(order_id):
+        logger.info("Retomando envio do primeiro passo pendente.")
+        return _deliver(order_id, wait, priority.class_of(lane))
+
+
+def run_job(payload: Dict[str, Any], wait: bool = True) -> Union[Dict[str, Any], Future]:
+    """
+    Handler dos jobs da fila: webhooks (process_webhook) e retomadas de
+    entrega ({"delivery_retry": order_id}).
+    """
+
+    if isinstance(payload, dict) and "delivery_retry" in payload:
+        return resume_delivery(str(payload["delivery_retry"]), wait, payload.get("priority"))
+    return process_webhook(payload, wait)
+
+
+def send_whats_bulk(messages: List[Dict[str, str]]) -> List[Dict[str, Any]]:
+    """
+    Envia uma janela do batcher em uma única requisição para o endpoint de
+    envio em lote (WHATICKET_BULK_URL). Retorna um resultado por mensagem.
+    """
+
+    config = settings.get()
+    if not config.whaticket_token:
+        whatsapp_logger.error(
+            "Token do Whaticket ausente. Configure WHATICKET_TOKEN/TOKEN_WHATS/TOKEN_DO_ENV."
         )
-        mensagem_2 = build_msg_2(pix_copia_cola)
-        mensagem_final = build_closing_message()
-
-        print(f"[webhook] Enviando mensagem 1 para {normalized_phone}")
-        send_whats_message(normalized_phone, mensagem_1)
-
-        time.sleep(1)
-
-        print(f"[webhook] Enviando mensagem 2 (PIX) para {normalized_phone}")
-        send_whats_message(normalized_phone, mensagem_2)
-
-        time.sleep(1)
-
-        print(f"[webhook] Enviando mensagem final (PIX) para {normalized_phone}")
-        send_whats_message(normalized_phone, mensagem_final)
-    elif tipo_pagamento == "bank_billet":
-        codigo_barras = pagamento["linha_digitavel"]
-        pdf_url = pagamento["paymentLink"]
-        mensagem_1 = build_msg_1(
-            primeiro_nome,
-            numero_do_pedido,
-            valor_total,
-            lista_itens,
-            payment_instruction_boleto,
+        return [{"status": "error", "reason": "missing_token"}] * len(messages)
+
+    try:
+        with breaker.guard() as call, metrics.timer("wbuy_whaticket_send_seconds", kind="bulk"):
+            response = http_client.request(
+                "POST",
+                config.whaticket_bulk_url,
+                headers={"Authorization": f"Bearer {config.whaticket_token}"},
+                json={"messages": messages},
+            )
+            call.failed = breaker.is_upstream_failure(response.status_code)
+    except breaker.BreakerOpen as exc:
+        whatsapp_logger.warning("Lote de %d mensagens adiado: %s.", len(messages), exc.reason)
+        return [exc.as_result()] * len(messages)
+    if not response.ok:
+        whatsapp_logger.warning(
+            "Erro ao enviar lote de %d mensagens.",
+            len(messages),
+            extra={"status_code": response.status_code, "response": response.text[:500]},
+        )
+        error = {"status": "error", "status_code": response.status_code, "response": response.text}
+        return [error] * len(messages)
+
+    body = response.json()
+    results = body.get("results") if isinstance(body, dict) else body
+    if not isinstance(results, list):
+        whatsapp_logger.warning(
+            "Resposta do lote de %d mensagens sem resultados por mensagem.",
+            len(messages),
+            extra={"response": response.text[:500]},
         )
-        mensagem_2 = build_msg_2(codigo_barras)
-        mensagem_final = build_closing_message()
+        results = []
+    missing = len(messages) - len(results)
+    return results + [dict(batcher.MISSING_BULK_RESULT) for _ in range(missing)]
+
+
+def _get_batcher() -> batcher.Batcher:
+    # Lambdas para que o batcher use sempre as funções atuais do módulo. Um
+    # batcher por tenant: as janelas rodam na thread do batcher com a conta
+    # do Whaticket do tenant.
+    send_bulk = None
+    if settings.get().whaticket_bulk_url:
+        send_bulk = tenants.propagate(lambda messages: send_whats_bulk(messages))
+    send_one = tenants.propagate(lambda number, body: send_whats_message(number, body))
+    return batcher.get_batcher(send_one, send_bulk, key=tenants.current())
 
-        print(f"[webhook] Enviando mensagem 1 para {normalized_phone}")
-        send_whats_message(normalized_phone, mensagem_1)
 
-        time.sleep(1)
+def _send_step(number: str, body: str, label: str) -> Union[None, Dict[str, Any], Future]:
+    """
+    Envia uma mensagem de texto. Falhas do Whaticket voltam como dict de
+    erro, o que interrompe a sequência para retomada posterior.
+    """
 
-        print(f"[webhook] Enviando mensagem 2 (BOLETO) para {normalized_phone}")
-        send_whats_message(normalized_phone, mensagem_2)
+    logger.debug("Enviando %s.", label, extra={"phone": number})
+    if not batcher.enabled():
+        result = send_whats_message(number, body)
+        return result if delivery_log.is_failure(result) else None
 
-        time.sleep(1)
+    sent = _get_batcher().submit(number, body)
+    done: Future = Future()
 
-        print(f"[webhook] Baixando boleto em memória para {normalized_phone}")
-        pdf_response = requests.get(pdf_url, stream=True, timeout=30)
-        if not pdf_response.ok:
-            print(
-                f"[webhook] Erro ao baixar boleto. Status: {pdf_response.status_code}. Corpo: {pdf_response.text}"
-            )
-            return {
-                "status": "error",
-                "reason": "boleto_download_failed",
-                "status_code": pdf_response.status_code,
-            }
-        pdf_bytes = pdf_response.content
+    def _on_sent(future: Future) -> None:
+        exception = future.exception()
+        if exception is not None:
+            done.set_exception(exception)
+        else:
+            result = future.result()
+            done.set_result(result if delivery_log.is_failure(result) else None)
+
+    sent.add_done_callback(_on_sent)
+    return done
+
+
+def _open_boleto(number: str, pdf_url: str):
+    """
+    Retorna a origem do PDF para o upload: o cache local quando há entrada
+    fresca ou revalidada (304), ou um BoletoStream da WBuy que, com o cache
+    ativo, grava os blocos em um CacheWriter enquanto o upload acontece.
+    Em caso de erro retorna o dict de resultado.
+    """
+
+    entry = boleto_cache.lookup(pdf_url) if boleto_cache.enabled() else None
+    if entry is not None and entry.fresh:
+        logger.debug("Boleto servido do cache.", extra={"phone": number})
+        return boleto_cache.hit(entry), None
+
+    logger.debug("Baixando boleto em streaming.", extra={"phone": number})
+    request_headers = entry.conditional_headers() if entry is not None else {}
+    pdf_response = http_client.request("GET", pdf_url, stream=True, headers=request_headers)
+
+    if entry is not None and pdf_response.status_code == 304:
+        pdf_response.close()
+        logger.debug("Boleto revalidado no cache.", extra={"phone": number})
+        return boleto_cache.revalidated(entry), None
+
+    if not pdf_response.ok:
+        logger.warning(
+            "Erro ao baixar boleto.",
+            extra={"status_code": pdf_response.status_code, "response": pdf_response.text[:500]},
+        )
+        pdf_response.close()
+        return {
+            "status": "error",
+            "reason": "boleto_download_failed",
+            "status_code": pdf_response.status_code,
+        }, None
+
+    writer = boleto_cache.CacheWriter() if boleto_cache.enabled() else None
+    try:
+        pdf_stream = media.BoletoStream(
+            pdf_response.headers,
+            pdf_response.iter_content(media.CHUNK_SIZE),
+            spool=writer if writer is not None else media.spool_enabled(),
+        )
+    except media.BoletoError:
+        pdf_response.close()
+        if writer is not None:
+            writer.discard()
+        raise
+
+    return pdf_stream, (pdf_response, writer)
+
+
+def _observe_download(size: int, started: float) -> None:
+    metrics.observe("wbuy_boleto_download_bytes", size)
+    metrics.observe("wbuy_boleto_download_seconds", time.perf_counter() - started)
 
-        print(f"[webhook] Enviando boleto em PDF para {normalized_phone}")
-        send_whats_media(normalized_phone, pdf_bytes, "boleto.pdf")
 
-        time.sleep(1)
+def _send_boleto_step(
+    number: str, pdf_url: str, filename: str = "boleto.pdf"
+) -> Optional[Dict[str, Any]]:
+    """
+    Envia o boleto repassando os blocos direto para o upload do Whaticket.
+    Um upload recusado com 429/5xx é refeito a partir do spool/cache, sem
+    novo download.
+    """
+
+    started = time.perf_counter()
+    try:
+        pdf_source, download = _open_boleto(number, pdf_url)
+    except media.BoletoError as exc:
+        logger.warning("Boleto rejeitado: %s", exc.reason, extra={"phone": number})
+        return exc.as_result()
+
+    if isinstance(pdf_source, dict):
+        return pdf_source
+
+    pdf_response, writer = download or (None, None)
+    try:
+        logger.debug("Enviando boleto em PDF.", extra={"phone": number})
+        result = send_whats_media(number, pdf_source, filename)
+
+        attempts = media.max_upload_retries() if pdf_source.spooled else 0
+        while attempts > 0 and media.upload_retryable(result):
+            attempts -= 1
+            logger.info("Reenviando boleto sem novo download.", extra={"phone": number})
+            result = send_whats_media(number, pdf_source.replay(), filename)
+
+        if pdf_response is not None and pdf_source.complete:
+            _observe_download(pdf_source.size, started)
+
+        if writer is not None:
+            if pdf_source.complete:
+                writer.commit(
+                    pdf_url,
+                    pdf_response.headers.get("ETag"),
+                    pdf_response.headers.get("Last-Modified"),
+                )
+            else:
+                writer.discard()
+            writer = None
+    except media.BoletoError as exc:
+        logger.warning("Boleto rejeitado: %s", exc.reason, extra={"phone": number})
+        return exc.as_result()
+    finally:
+        if writer is not None:
+            writer.discard()
+        pdf_source.close()
+        if pdf_response is not None:
+            pdf_response.close()
+
+    return result if delivery_log.is_failure(result) else None
+
+
+def _step_callable(number: str, step: Dict[str, Any]) -> scheduler.Step:
+    if step["kind"] == "delay":
+        return scheduler.Delay(step["seconds"])
+    if step["kind"] == "text":
+        return partial(_send_step, number, step["body"], step["label"])
+    if step["kind"] == "boleto":
+        return partial(
+            _send_boleto_step, number, step["url"], step.get("filename", "boleto.pdf")
+        )
+    raise ValueError(f"Tipo de passo desconhecido: {step['kind']}")
+
+
+def _tracked(
+    tracker: delivery_log.StepTracker, step: Dict[str, Any], run: scheduler.Step
+) -> scheduler.Step:
+    """
+    Envolve o passo para registrar no delivery_log o início e o resultado
+    antes de a sequência seguir para o próximo.
+    """
 
-        print(f"[webhook] Enviando mensagem final (BOLETO) para {normalized_phone}")
-        send_whats_message(normalized_phone, mensagem_final)
+    if isinstance(run, scheduler.Delay):
+        return run
 
-    storage.mark_order_processed(numero_do_pedido)
+    def _run():
+        tracker.start(step)
+        try:
+            result = run()
+        except BaseException as exc:
+            tracker.finish(step, error=exc)
+            raise
 
-    sys.stdout.flush()
+        if not isinstance(result, Future):
+            tracker.finish(step, result)
+            return result
 
+        tracked: Future = Future()
 
-def handle_webhook(request) -> Dict[str, Any]:
-    payload = request.get_json(silent=True) or {}
+        def _on_done(done: Future) -> None:
+            exception = done.exception()
+            if exception is not None:
+                tracker.finish(step, error=exception)
+                tracked.set_exception(exception)
+            else:
+                tracker.finish(step, done.result())
+                tracked.set_result(done.result())
+
+        result.add_done_callback(_on_done)
+        return tracked
+
+    return _run
+
+
+def _submit_steps(
+    number: str,
+    steps: List[Dict[str, Any]],
+    tracker: Optional[delivery_log.StepTracker] = None,
+    lane: str = priority.DEFAULT,
+) -> Future:
+    """
+    Entrega a sequência ao motor assíncrono (WHATICKET_ENGINE=async) ou ao
+    scheduler com threads (padrão), na classe de prioridade ``lane``.
+    """
+
+    # Import adiado: asyncio e o motor assíncrono ficam fora da partida do worker.
+    from . import sender
+
+    if sender.engine_enabled():
+        config = settings.get()
+        engine = sender.get_engine(config.whaticket_api_url, config.whaticket_token)
+        return engine.submit_sequence(number, steps, tracker, lane)
+
+    callables = [_step_callable(number, step) for step in steps]
+    if tracker is not None:
+        callables = [_tracked(tracker, step, run) for step, run in zip(steps, callables)]
+    # Os passos rodam na thread do scheduler; o order_id (logs) e o tenant
+    # (conta do Whaticket, templates) seguem junto.
+    callables = [
+        run if isinstance(run, scheduler.Delay) else tenants.propagate(log.propagate(run))
+        for run in callables
+    ]
+    return scheduler.get_scheduler().submit(number, callables, lane)
+
+
+@metrics.timed("wbuy_webhook_seconds")
+@metrics.counts_outcome("webhook")
+def handle_webhook(request, tenant: str = tenants.DEFAULT) -> Dict[str, Any]:
+    """
+    Persiste o webhook e o coloca na fila de envio, sem esperar o Whaticket.
+
+    O processamento (process_webhook) acontece nos workers da fila; a rota
+    responde 202 assim que o job estiver gravado em storage/queue.db. O corpo
+    cru vai para o arquivo segmentado de webhooks (archive) e payloads
+    malformados são recusados sem entrar na fila. Webhooks repetidos de um
+    pedido que já está na fila ou em envio, vindos de qualquer worker, são
+    agrupados ao primeiro (singleflight) e não geram outro job.
+
+    ``tenant`` vem da rota /wbuy/<tenant>/webhook; o job leva o nome dele
+    e o pedido tem chave própria (tenants.scoped) no archive, singleflight
+    e storage. A validação usa os templates do tenant.
+    """
+
+    if tenant and tenants.get(tenant) is None:
+        logger.warning("Webhook para tenant desconhecido recusado.", extra={"tenant": tenant})
+        return {"status": "rejected", "reason": "unknown_tenant"}
+
+    with tenants.bind(tenant):
+        return _accept_webhook(request, tenant)
+
+
+def _accept_webhook(request, tenant: str) -> Dict[str, Any]:
+    raw = request.get_data()
+    payload = None
+    try:
+        payload = models.loads(raw)
+        order = models.Order.from_payload(payload)
+    except models.PayloadError as exc:
+        archive.append(raw, models.order_id_of(payload))
+        logger.warning(
+            "Payload inválido recusado (%s).", exc, extra={"order_id": models.order_id_of(payload)}
+        )
+        return {"status": "rejected", "reason": exc.reason, "field": exc.field}
+
+    order_id = order.id
+    key = tenants.scoped(order_id, tenant)
+    archive.append(raw, key)
+    if not singleflight.acquire(key):
+        logger.info(
+            "Webhook repetido agrupado ao pedido em andamento.",
+            extra={"order_id": key, "sampled": True},
+        )
+        return {"status": "coalesced", "order_id": order_id}
 
-    process_webhook(payload)
+    try:
+        job_id = jobs.enqueue({**payload, tenants.PAYLOAD_KEY: tenant} if tenant else payload)
+    except Exception:
+        singleflight.release(key)
+        raise
 
-    return {"status": "ok"}
+    return {"status": "queued", "job_id": job_id}
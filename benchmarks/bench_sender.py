@@ -0,0 +1,68 @@
+"""
+Compara o scheduler com threads e o DeliveryEngine assíncrono contra um
+Whaticket local de mentira (latência configurável).
+
+    python -m benchmarks.bench_sender --orders 300 --latency 0.05
+"""
+
+import argparse
+import os
+import sys
+import time
+
+from app.wbuy import log, scheduler, sender, settings, webhook
+
+from .stub_servers import stub_server
+
+
+def _steps():
+    return [
+        {"kind": "text", "body": "mensagem 1", "label": "mensagem 1"},
+        {"kind": "text", "body": "PIXCODE", "label": "mensagem 2 (PIX)"},
+        {"kind": "text", "body": "encerramento", "label": "mensagem final (PIX)"},
+    ]
+
+
+def _run(label: str, submit, orders: int) -> float:
+    started = time.perf_counter()
+    futures = [submit(f"55119{index:08d}", _steps()) for index in range(orders)]
+    for future in futures:
+        future.result()
+    elapsed = time.perf_counter() - started
+    sys.stdout.write(
+        f"{label:<10} {orders} pedidos em {elapsed:6.2f}s -> {orders / elapsed:8.1f} pedidos/s\n"
+    )
+    return elapsed
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--orders", type=int, default=300)
+    parser.add_argument("--latency", type=float, default=0.05)
+    args = parser.parse_args()
+
+    os.environ.setdefault("WHATICKET_MESSAGE_GAP", "0")
+    os.environ.setdefault("WHATICKET_RATE_LIMIT", "0")
+    log.setup(level="WARNING")
+
+    with stub_server(args.latency) as base_url, settings.override(
+        whaticket_api_url=base_url + "/api/messages/send", whaticket_token="TOKEN"
+    ) as config:
+        threaded = scheduler.Scheduler()
+        thread_time = _run(
+            "threads",
+            lambda phone, steps: threaded.submit(
+                phone, [webhook._step_callable(phone, step) for step in steps]
+            ),
+            args.orders,
+        )
+
+        engine = sender.DeliveryEngine(config.whaticket_api_url, "TOKEN")
+        async_time = _run("async", engine.submit_sequence, args.orders)
+        engine.close()
+
+    sys.stdout.write(f"ganho: {thread_time / async_time:.1f}x\n")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,176 @@
+"""
+Mede a partida de um worker: tempo de import do app (processo novo), RSS
+depois do import e memória própria (USS) de workers criados por fork com e
+sem o app pré-carregado no processo pai, como o gunicorn faz com
+preload_app.
+
+    python -m benchmarks.bench_startup --runs 10 --workers 4
+"""
+
+import argparse
+import os
+import re
+import statistics
+import subprocess
+import sys
+import time
+from typing import Dict, List, Tuple
+
+_ENV = {
+    "WBUY_QUEUE_WORKERS": "0",
+    "WBUY_POLL_INTERVAL": "0",
+    "WBUY_LOG_LEVEL": "WARNING",
+}
+
+_IMPORT_TIME_RE = re.compile(r"import time:\s+\d+ \|\s+(\d+) \|\s+(\S.*)$")
+
+_CHILD = """
+import os, sys, time
+started = time.perf_counter()
+import app
+app.app
+elapsed = time.perf_counter() - started
+rss = 0
+with open("/proc/self/status") as status:
+    for line in status:
+        if line.startswith("VmRSS:"):
+            rss = int(line.split()[1])
+print(f"{elapsed:.6f} {rss}")
+"""
+
+
+def _env() -> Dict[str, str]:
+    return {**os.environ, **_ENV}
+
+
+def cold_start(runs: int) -> Tuple[List[float], List[int], List[float]]:
+    """
+    Import do app em ``runs`` processos novos: tempo do import, RSS (KiB) e
+    tempo total do processo (interpretador incluído).
+    """
+
+    imports, rss, totals = [], [], []
+    for _ in range(runs):
+        started = time.perf_counter()
+        output = subprocess.run(
+            [sys.executable, "-c", _CHILD], env=_env(), capture_output=True, text=True, check=True
+        ).stdout.split()
+        totals.append(time.perf_counter() - started)
+        imports.append(float(output[-2]))
+        rss.append(int(output[-1]))
+    return imports, rss, totals
+
+
+def slowest_imports(limit: int) -> List[Tuple[int, str]]:
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", "import app; app.app"],
+        env=_env(),
+        capture_output=True,
+        text=True,
+        check=True,
+    )
+    entries = []
+    for line in result.stderr.splitlines():
+        match = _IMPORT_TIME_RE.match(line)
+        if match and "." not in match.group(2).strip():
+            entries.append((int(match.group(1)), match.group(2).strip()))
+    return sorted(entries, reverse=True)[:limit]
+
+
+def _uss_kib(pid: int) -> int:
+    total = 0
+    with open(f"/proc/{pid}/smaps_rollup") as rollup:
+        for line in rollup:
+            if line.startswith(("Private_Clean:", "Private_Dirty:")):
+                total += int(line.split()[1])
+    return total
+
+
+_FORK = """
+import os, sys, time
+preload = sys.argv[1] == "1"
+workers = int(sys.argv[2])
+if preload:
+    import app
+    app.preload()
+pids = []
+for _ in range(workers):
+    read_fd, write_fd = os.pipe()
+    pid = os.fork()
+    if pid == 0:
+        os.close(read_fd)
+        if not preload:
+            import app
+            app.app
+        else:
+            from app.server import start_background_workers
+            start_background_workers()
+        os.write(write_fd, b"1")
+        time.sleep(60)
+        os._exit(0)
+    os.close(write_fd)
+    os.read(read_fd, 1)
+    pids.append(pid)
+print(" ".join(map(str, pids)), flush=True)
+sys.stdin.readline()
+for pid in pids:
+    os.kill(pid, 9)
+"""
+
+
+def forked_uss(preload: bool, workers: int) -> List[int]:
+    """
+    Sobe ``workers`` processos por fork (com o app importado antes ou depois
+    do fork) e mede a memória própria de cada um.
+    """
+
+    env = _env()
+    if preload:
+        # Como no gunicorn.conf.py: o mestre não sobe threads antes do fork.
+        env["WBUY_START_WORKERS"] = "0"
+    process = subprocess.Popen(
+        [sys.executable, "-c", _FORK, "1" if preload else "0", str(workers)],
+        env=env,
+        stdin=subprocess.PIPE,
+        stdout=subprocess.PIPE,
+        text=True,
+    )
+    try:
+        pids = [int(pid) for pid in process.stdout.readline().split()]
+        return [_uss_kib(pid) for pid in pids]
+    finally:
+        process.stdin.write("\n")
+        process.stdin.flush()
+        process.wait(timeout=10)
+
+
+def build_parser() -> argparse.ArgumentParser:
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--runs", type=int, default=10)
+    parser.add_argument("--workers", type=int, default=4)
+    parser.add_argument("--top", type=int, default=10, help="imports mais lentos a listar")
+    return parser
+
+
+def main() -> None:
+    args = build_parser().parse_args()
+
+    imports, rss, totals = cold_start(args.runs)
+    sys.stdout.write(
+        f"import do app    mediana {statistics.median(imports) * 1000:7.1f} ms "
+        f"(processo {statistics.median(totals) * 1000:.1f} ms)\n"
+        f"RSS após import  mediana {statistics.median(rss) / 1024:7.1f} MiB\n"
+    )
+    for label, preload in (("sem preload", False), ("com preload", True)):
+        uss = forked_uss(preload, args.workers)
+        sys.stdout.write(
+            f"USS por worker   {label:<12} {statistics.mean(uss) / 1024:7.1f} MiB "
+            f"({args.workers} workers)\n"
+        )
+    sys.stdout.write("imports mais lentos (acumulado):\n")
+    for micros, module in slowest_imports(args.top):
+        sys.stdout.write(f"  {micros / 1000:8.1f} ms  {module}\n")
+
+
+if __name__ == "__main__":
+    main()
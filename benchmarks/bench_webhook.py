@@ -0,0 +1,415 @@
+"""
+Teste de carga do app Flask: reenvia webhooks gravados (arquivo segmentado
+ou raw_*.txt legados) ou sintéticos para POST /wbuy/webhook, com Whaticket e
+boleto locais de mentira, e mede vazão, latência p50/p95/p99, RSS e
+descritores/conexões do processo do servidor.
+
+    python -m benchmarks.bench_webhook --orders 500 --concurrency 16
+    python -m benchmarks.bench_webhook --payloads storage/webhooks --json report.json
+    python -m benchmarks.bench_webhook --baseline report.json --tolerance 0.2   # CI
+
+Sai com código 1 quando algum limite (--max-p99-ms, --min-orders-per-second,
+--max-rss-mb, --max-fds) ou a comparação com --baseline falha.
+"""
+
+import argparse
+import json
+import math
+import multiprocessing
+import os
+import socket
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from typing import Any, Dict, Iterator, List, Optional, Tuple
+
+import requests
+
+from .stub_servers import stub_server
+
+
+def percentile(values: List[float], fraction: float) -> float:
+    """Percentil por posição mais próxima; ``values`` já ordenado."""
+
+    if not values:
+        return 0.0
+    index = min(max(math.ceil(fraction * len(values)) - 1, 0), len(values) - 1)
+    return values[index]
+
+
+def synthetic_payloads(count: int) -> Iterator[bytes]:
+    for index in range(count):
+        boleto = index % 3 == 2
+        payment = {"tipo_interno": "bank_billet" if boleto else "pix"}
+        if boleto:
+            payment["linha_digitavel"] = "23793381286000000000300000000400184340000010000"
+            payment["paymentLink"] = "http://boleto.invalid/boleto.pdf"
+        else:
+            payment["linha_digitavel"] = "00020126580014BR.GOV.BCB.PIX0136chave6304ABCD"
+        yield json.dumps(
+            {
+                "data": {
+                    "id": str(index + 1),
+                    "cliente": {"nome": f"Cliente {index}", "telefone1": "(11)98888-7777"},
+                    "valor_total": {"total": "99.9"},
+                    "produtos": [{"produto": "Produto", "qtd": "1"}],
+                    "pagamento": payment,
+                }
+            }
+        ).encode("utf-8")
+
+
+def recorded_payloads(source: Path) -> List[bytes]:
+    """
+    Corpos gravados em ``source``: segmentos do archive (segment-*.log) e os
+    raw_*.txt do formato antigo.
+    """
+
+    from app.wbuy import archive
+
+    payloads: List[bytes] = []
+    for path in sorted(source.glob(f"{archive.SEGMENT_PREFIX}*{archive.SEGMENT_SUFFIX}")):
+        payloads.extend(record.payload for record in archive.read_segment(path))
+    payloads.extend(path.read_bytes() for path in sorted(source.glob("raw_*.txt")))
+    return payloads
+
+
+def prepare(raw_payloads: List[bytes], orders: int, boleto_url: str, keep_ids: bool) -> List[bytes]:
+    """
+    Repete os payloads até ``orders``, troca o link do boleto pelo servidor
+    de mentira e, salvo ``keep_ids``, dá a cada envio um id de pedido único.
+    """
+
+    prepared = []
+    for index in range(orders):
+        raw = raw_payloads[index % len(raw_payloads)]
+        try:
+            payload = json.loads(raw)
+        except ValueError:
+            prepared.append(raw)
+            continue
+        data = payload.get("data") if isinstance(payload, dict) else None
+        if isinstance(data, dict):
+            if not keep_ids:
+                # Telefones distintos: o mesmo número serializa os envios.
+                data["id"] = str(900000000 + index)
+                cliente = data.get("cliente")
+                if isinstance(cliente, dict):
+                    cliente["telefone1"] = f"(11)9{index:08d}"
+            pagamento = data.get("pagamento")
+            if isinstance(pagamento, dict) and pagamento.get("paymentLink"):
+                pagamento["paymentLink"] = f"{boleto_url}/boleto/{data.get('id')}.pdf"
+        prepared.append(json.dumps(payload).encode("utf-8"))
+    return prepared
+
+
+def _serve_app(port: int, storage_dir: str, env: Dict[str, str], workers: int) -> None:
+    # Os workers da fila só sobem depois que os bancos apontam para o
+    # diretório temporário (create_app abaixo).
+    os.environ.update(env)
+    os.environ["WBUY_QUEUE_WORKERS"] = "0"
+    os.environ["WBUY_POLL_INTERVAL"] = "0"
+
+    import logging
+
+    from werkzeug.serving import make_server
+
+    from app import create_app
+    from app.wbuy import storage
+
+    # Todos os bancos de storage/ (fila, leases, rate limit...), não só os
+    # que o benchmark conhece: uma rodada não enxerga a anterior.
+    storage.relocate(storage_dir)
+
+    os.environ["WBUY_QUEUE_WORKERS"] = str(workers)
+    logging.getLogger("werkzeug").setLevel(logging.WARNING)
+    make_server("127.0.0.1", port, create_app(), threaded=True).serve_forever()
+
+
+class ResourceSampler:
+    """
+    Lê /proc/<pid> periodicamente: RSS, descritores abertos e sockets.
+    Fora do Linux os valores ficam em None.
+    """
+
+    def __init__(self, pid: int, interval: float = 0.1) -> None:
+        self.pid = pid
+        self.interval = interval
+        self.samples: List[Tuple[Optional[float], Optional[int], Optional[int]]] = []
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._loop, daemon=True)
+
+    def sample(self) -> Tuple[Optional[float], Optional[int], Optional[int]]:
+        rss = fds = sockets = None
+        try:
+            with open(f"/proc/{self.pid}/status") as status:
+                for line in status:
+                    if line.startswith("VmRSS:"):
+                        rss = int(line.split()[1]) / 1024
+            links = []
+            for name in os.listdir(f"/proc/{self.pid}/fd"):
+                try:
+                    links.append(os.readlink(f"/proc/{self.pid}/fd/{name}"))
+                except OSError:
+                    continue
+            fds = len(links)
+            sockets = sum(link.startswith("socket:") for link in links)
+        except OSError:
+            pass
+        return rss, fds, sockets
+
+    def _loop(self) -> None:
+        while not self._stop.is_set():
+            self.samples.append(self.sample())
+            self._stop.wait(self.interval)
+
+    def __enter__(self) -> "ResourceSampler":
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc_info: Any) -> None:
+        self._stop.set()
+        self._thread.join()
+
+    def peak(self, position: int) -> Optional[float]:
+        values = [sample[position] for sample in self.samples if sample[position] is not None]
+        return max(values) if values else None
+
+
+def _free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def _wait_ready(base_url: str, timeout: float = 30.0) -> None:
+    deadline = time.time() + timeout
+    while True:
+        try:
+            if requests.get(f"{base_url}/wbuy", timeout=1).ok:
+                return
+        except requests.RequestException:
+            pass
+        if time.time() > deadline:
+            raise RuntimeError("servidor do benchmark não respondeu")
+        time.sleep(0.1)
+
+
+def _delivery_counts(base_url: str) -> Dict[str, int]:
+    return requests.get(f"{base_url}/wbuy", timeout=5).json()["deliveries"]
+
+
+def run(args: argparse.Namespace) -> Dict[str, Any]:
+    if args.payloads:
+        raw_payloads = recorded_payloads(Path(args.payloads))
+        if not raw_payloads:
+            raise SystemExit(f"nenhum payload gravado em {args.payloads}")
+    else:
+        raw_payloads = list(synthetic_payloads(min(args.orders, 50)))
+
+    env = {
+        "WHATICKET_TOKEN": "TOKEN",
+        "WHATICKET_MESSAGE_GAP": "0",
+        "WHATICKET_RATE_LIMIT": "0",
+        "WBUY_LOG_LEVEL": "WARNING",
+        "WBUY_DELIVERY_RETRY_BACKOFF": "1",
+    }
+    env.update(dict(item.split("=", 1) for item in args.env))
+
+    with stub_server(
+        args.whaticket_latency, args.whaticket_error_rate, args.jitter
+    ) as whaticket_url, stub_server(
+        args.boleto_latency, args.boleto_error_rate, args.jitter, args.pdf_size
+    ) as boleto_url, tempfile.TemporaryDirectory() as storage_dir:
+        env["WHATICKET_API_BASE_URL"] = whaticket_url + "/api/messages/send"
+        env["WBUY_METRICS_DIR"] = os.path.join(storage_dir, "metrics")
+        bodies = prepare(raw_payloads, args.orders, boleto_url, args.keep_ids)
+        expected = len({json.loads(body).get("data", {}).get("id") for body in bodies})
+
+        port = _free_port()
+        server = multiprocessing.get_context("spawn").Process(
+            target=_serve_app, args=(port, storage_dir, env, args.workers), daemon=True
+        )
+        server.start()
+        base_url = f"http://127.0.0.1:{port}"
+        try:
+            _wait_ready(base_url)
+            report = _load(base_url, server.pid, bodies, expected, args)
+        finally:
+            server.terminate()
+            server.join(5)
+    return report
+
+
+def _load(
+    base_url: str, pid: int, bodies: List[bytes], expected: int, args: argparse.Namespace
+) -> Dict[str, Any]:
+    local = threading.local()
+    latencies: List[float] = []
+    statuses: Dict[int, int] = {}
+    lock = threading.Lock()
+    interval = 1.0 / args.rate if args.rate else 0.0
+
+    def post(index_body: Tuple[int, bytes]) -> None:
+        index, body = index_body
+        if interval:
+            delay = started + index * interval - time.perf_counter()
+            if delay > 0:
+                time.sleep(delay)
+        session = getattr(local, "session", None)
+        if session is None:
+            session = local.session = requests.Session()
+        sent = time.perf_counter()
+        try:
+            status = session.post(
+                f"{base_url}/wbuy/webhook",
+                data=body,
+                headers={"Content-Type": "application/json"},
+                timeout=30,
+            ).status_code
+        except requests.RequestException:
+            status = 0
+        elapsed = time.perf_counter() - sent
+        with lock:
+            latencies.append(elapsed)
+            statuses[status] = statuses.get(status, 0) + 1
+
+    with ResourceSampler(pid) as sampler:
+        started = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=args.concurrency) as executor:
+            list(executor.map(post, enumerate(bodies)))
+        ingest_seconds = time.perf_counter() - started
+
+        delivered = 0
+        counts: Dict[str, int] = {}
+        deadline = time.perf_counter() + args.drain_timeout
+        while time.perf_counter() < deadline:
+            counts = _delivery_counts(base_url)
+            delivered = counts.get("done", 0) + counts.get("dead", 0)
+            if delivered >= expected and not counts.get("running"):
+                break
+            time.sleep(0.05)
+        delivery_seconds = time.perf_counter() - started
+        metrics_text = requests.get(f"{base_url}/wbuy/metrics", timeout=5).text
+
+    latencies.sort()
+    accepted = sum(count for status, count in statuses.items() if 200 <= status < 300)
+    return {
+        "requests": len(bodies),
+        "accepted": accepted,
+        "statuses": {str(status): count for status, count in sorted(statuses.items())},
+        "ingest_seconds": round(ingest_seconds, 3),
+        "requests_per_second": round(len(bodies) / ingest_seconds, 1),
+        "latency_ms": {
+            "p50": round(percentile(latencies, 0.50) * 1000, 2),
+            "p95": round(percentile(latencies, 0.95) * 1000, 2),
+            "p99": round(percentile(latencies, 0.99) * 1000, 2),
+            "max": round(latencies[-1] * 1000, 2) if latencies else 0.0,
+        },
+        "orders": expected,
+        "delivered": delivered,
+        "deliveries": counts,
+        "delivery_seconds": round(delivery_seconds, 3),
+        "orders_per_second": round(delivered / delivery_seconds, 1),
+        "rss_mb_max": sampler.peak(0),
+        "fds_max": sampler.peak(1),
+        "sockets_max": sampler.peak(2),
+        "whaticket_sends": _metric_count(metrics_text, "wbuy_whaticket_send_seconds_count"),
+    }
+
+
+def _metric_count(text: str, name: str) -> int:
+    total = 0
+    for line in text.splitlines():
+        if line.startswith(name):
+            total += int(float(line.rsplit(" ", 1)[1]))
+    return total
+
+
+def check(report: Dict[str, Any], args: argparse.Namespace) -> List[str]:
+    """
+    Lista de violações dos limites absolutos e da regressão contra o
+    relatório de referência (--baseline, com --tolerance relativa).
+    """
+
+    failures = []
+    limits = [
+        ("latency_ms.p99", report["latency_ms"]["p99"], args.max_p99_ms, "max"),
+        ("orders_per_second", report["orders_per_second"], args.min_orders_per_second, "min"),
+        ("rss_mb_max", report["rss_mb_max"], args.max_rss_mb, "max"),
+        ("fds_max", report["fds_max"], args.max_fds, "max"),
+    ]
+    for name, value, limit, kind in limits:
+        if limit is None or value is None:
+            continue
+        if (kind == "max" and value > limit) or (kind == "min" and value < limit):
+            failures.append(f"{name}={value} fora do limite {kind} {limit}")
+
+    if report["delivered"] < report["orders"]:
+        failures.append(f"apenas {report['delivered']} de {report['orders']} pedidos entregues")
+
+    if args.baseline:
+        baseline = json.loads(Path(args.baseline).read_text())
+        tolerance = args.tolerance
+        if report["orders_per_second"] < baseline["orders_per_second"] * (1 - tolerance):
+            failures.append(
+                f"orders_per_second caiu de {baseline['orders_per_second']} para {report['orders_per_second']}"
+            )
+        if report["requests_per_second"] < baseline["requests_per_second"] * (1 - tolerance):
+            failures.append(
+                f"requests_per_second caiu de {baseline['requests_per_second']} para {report['requests_per_second']}"
+            )
+        if report["latency_ms"]["p99"] > baseline["latency_ms"]["p99"] * (1 + tolerance):
+            failures.append(
+                f"p99 subiu de {baseline['latency_ms']['p99']}ms para {report['latency_ms']['p99']}ms"
+            )
+    return failures
+
+
+def build_parser() -> argparse.ArgumentParser:
+    parser = argparse.ArgumentParser(
+        description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter
+    )
+    parser.add_argument("--orders", type=int, default=300)
+    parser.add_argument("--concurrency", type=int, default=8)
+    parser.add_argument("--rate", type=float, default=0.0, help="requisições/s (0 = sem limite)")
+    parser.add_argument("--workers", type=int, default=2, help="workers da fila no servidor")
+    parser.add_argument("--payloads", help="diretório com segment-*.log e/ou raw_*.txt")
+    parser.add_argument("--keep-ids", action="store_true", help="reenvia os ids originais")
+    parser.add_argument("--whaticket-latency", type=float, default=0.02)
+    parser.add_argument("--whaticket-error-rate", type=float, default=0.0)
+    parser.add_argument("--boleto-latency", type=float, default=0.02)
+    parser.add_argument("--boleto-error-rate", type=float, default=0.0)
+    parser.add_argument("--jitter", type=float, default=0.0)
+    parser.add_argument("--pdf-size", type=int, default=64 * 1024)
+    parser.add_argument("--drain-timeout", type=float, default=120.0)
+    parser.add_argument("--env", action="append", default=[], help="KEY=VALUE para o servidor")
+    parser.add_argument("--json", help="grava o relatório neste arquivo")
+    parser.add_argument("--baseline", help="relatório de referência para comparar")
+    parser.add_argument("--tolerance", type=float, default=0.2)
+    parser.add_argument("--max-p99-ms", type=float)
+    parser.add_argument("--min-orders-per-second", type=float)
+    parser.add_argument("--max-rss-mb", type=float)
+    parser.add_argument("--max-fds", type=int)
+    return parser
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    args = build_parser().parse_args(argv)
+    report = run(args)
+
+    sys.stdout.write(json.dumps(report, indent=2) + "\n")
+    if args.json:
+        Path(args.json).write_text(json.dumps(report, indent=2))
+
+    failures = check(report, args)
+    for failure in failures:
+        sys.stdout.write(f"FALHA: {failure}\n")
+    return 1 if failures else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
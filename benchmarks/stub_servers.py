@@ -0,0 +1,129 @@
+"""
+Servidores HTTP de mentira para benchmarks, rodando em outro processo para
+não disputar o GIL com o código medido.
+"""
+
+import asyncio
+import multiprocessing
+import random
+import socket
+import time
+from contextlib import contextmanager
+from typing import Iterator
+
+def _pdf(size: int) -> bytes:
+    head, tail = b"%PDF-1.4\n", b"\n%%EOF\n"
+    return head + b"0" * max(size - len(head) - len(tail), 0) + tail
+
+
+async def _read_chunked(reader) -> None:
+    while True:
+        size = int((await reader.readuntil(b"\r\n")).split(b";", 1)[0], 16)
+        await reader.readexactly(size + 2)
+        if size == 0:
+            return
+
+
+async def _handle(
+    reader, writer, latency: float, error_rate: float, jitter: float, pdf: bytes
+) -> None:
+    try:
+        while True:
+            head = await reader.readuntil(b"\r\n\r\n")
+            request_line, *header_lines = head.decode("latin-1").split("\r\n")
+            method = request_line.split(" ", 1)[0]
+            length = 0
+            chunked = False
+            for line in header_lines:
+                name, _, value = line.partition(":")
+                name = name.strip().lower()
+                if name == "content-length":
+                    length = int(value.strip())
+                elif name == "transfer-encoding" and "chunked" in value.lower():
+                    chunked = True
+            if chunked:
+                await _read_chunked(reader)
+            elif length:
+                await reader.readexactly(length)
+
+            delay = latency + (random.uniform(0, jitter) if jitter else 0.0)
+            if delay:
+                await asyncio.sleep(delay)
+
+            if error_rate and random.random() < error_rate:
+                status, content_type, body = "503 Service Unavailable", "text/plain", b"erro"
+            elif method == "GET":
+                status, content_type, body = "200 OK", "application/pdf", pdf
+            else:
+                status, content_type, body = "200 OK", "application/json", b'{"ok": true}'
+
+            writer.write(
+                f"HTTP/1.1 {status}\r\nContent-Type: {content_type}\r\n"
+                f"Content-Length: {len(body)}\r\n\r\n".encode("latin-1")
+                + body
+            )
+            await writer.drain()
+    except (asyncio.IncompleteReadError, ConnectionError):
+        pass
+    finally:
+        writer.close()
+
+
+def _serve(port: int, latency: float, error_rate: float, jitter: float, pdf_size: int) -> None:
+    pdf = _pdf(pdf_size)
+
+    async def main():
+        server = await asyncio.start_server(
+            lambda r, w: _handle(r, w, latency, error_rate, jitter, pdf),
+            "127.0.0.1",
+            port,
+            backlog=4096,
+        )
+        async with server:
+            await server.serve_forever()
+
+    asyncio.run(main())
+
+
+def _free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+@contextmanager
+def stub_server(
+    latency: float = 0.0,
+    error_rate: float = 0.0,
+    jitter: float = 0.0,
+    pdf_size: int = 2048,
+) -> Iterator[str]:
+    """
+    Sobe um servidor que responde POST (Whaticket) com JSON e GET (boleto)
+    com um PDF de ``pdf_size`` bytes. Cada resposta espera ``latency`` mais
+    até ``jitter`` segundos e falha com 503 na proporção ``error_rate``.
+    Retorna a URL base, ex.: http://127.0.0.1:PORT
+    """
+
+    port = _free_port()
+    process = multiprocessing.Process(
+        target=_serve, args=(port, latency, error_rate, jitter, pdf_size), daemon=True
+    )
+    process.start()
+
+    deadline = time.time() + 10
+    while True:
+        try:
+            socket.create_connection(("127.0.0.1", port), timeout=0.2).close()
+            break
+        except OSError:
+            if time.time() > deadline:
+                process.terminate()
+                raise
+            time.sleep(0.05)
+
+    try:
+        yield f"http://127.0.0.1:{port}"
+    finally:
+        process.terminate()
+        process.join(5)
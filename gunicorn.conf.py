@@ -0,0 +1,49 @@
+"""
+Configuração do gunicorn (modo WSGI, padrão do Dockerfile).
+
+    gunicorn -c gunicorn.conf.py app:app
+
+Com preload_app o mestre importa o app, os templates e o requests uma vez
+e os workers nascem por fork dividindo essas páginas (copy-on-write): a
+partida de cada worker, inclusive nos reciclos de max_requests, fica mais
+rápida e cada um ocupa menos memória. Threads não sobrevivem ao fork,
+então os workers da fila e o reconciliador só sobem no post_fork, e cada
+worker relê o .env (settings.reload): um kill -HUP no mestre aplica
+mudanças de configuração sem reiniciar o container.
+"""
+
+import os
+
+# Lido pelo create_app durante o preload, no processo mestre.
+os.environ["WBUY_START_WORKERS"] = "0"
+
+bind = os.getenv("GUNICORN_BIND", "0.0.0.0:5000")
+workers = int(os.getenv("GUNICORN_WORKERS", "2"))
+worker_class = "sync"
+timeout = 120
+keepalive = 5
+loglevel = "info"
+preload_app = True
+max_requests = int(os.getenv("GUNICORN_MAX_REQUESTS", "0"))
+max_requests_jitter = int(os.getenv("GUNICORN_MAX_REQUESTS_JITTER", "0"))
+
+
+def on_starting(server):
+    # Snapshots de métricas de execuções anteriores ficam no volume storage/.
+    from app.wbuy import metrics
+
+    metrics.reset()
+
+
+def when_ready(server):
+    import app
+
+    app.preload()
+
+
+def post_fork(server, worker):
+    from app.server import start_background_workers
+    from app.wbuy import settings
+
+    settings.reload()
+    start_background_workers()
@@ -0,0 +1,49 @@
+import os
+import tempfile
+from contextlib import ExitStack, contextmanager
+from pathlib import Path
+from typing import Iterator
+from unittest import mock
+
+# Os testes drenam a fila manualmente; nada de workers em background.
+os.environ["WBUY_QUEUE_WORKERS"] = "0"
+os.environ["WHATICKET_MESSAGE_GAP"] = "0"
+os.environ["WHATICKET_RATE_LIMIT"] = "0"
+os.environ["WBUY_POLL_INTERVAL"] = "0"
+os.environ["WBUY_METRICS_DIR"] = tempfile.mkdtemp(prefix="wbuy-metrics-")
+
+_DEVNULL = open(os.devnull, "w", encoding="utf-8")
+
+
+def quiet_logging() -> None:
+    """
+    Manda os registros JSON do app para os.devnull em vez do stdout dos
+    testes. Vale na importação do pacote; testes que trocam o handler
+    (test_log) voltam para cá no tearDown.
+    """
+
+    from app.wbuy import log
+
+    log.setup(_DEVNULL)
+
+
+quiet_logging()
+
+
+@contextmanager
+def isolated_storage() -> Iterator[Path]:
+    """
+    Aponta os bancos e diretórios de storage/ (storage.storage_paths) para
+    um diretório temporário, com os mesmos nomes, e o devolve. Uso:
+    self.enterContext(isolated_storage()).
+    """
+
+    # Import adiado: o ambiente acima precisa valer antes dos módulos do app.
+    from app.wbuy import storage
+
+    with tempfile.TemporaryDirectory() as temp_dir, ExitStack() as stack:
+        base = Path(temp_dir)
+        for module, name, path in storage.storage_paths():
+            target = base / path.relative_to(storage.STORAGE_DIR)
+            stack.enter_context(mock.patch.object(module, name, target))
+        yield base
@@ -0,0 +1,63 @@
+import os
+import tempfile
+import time
+import unittest
+from pathlib import Path
+from unittest import mock
+
+from app.wbuy import archive, storage
+
+
+class TestArchive(unittest.TestCase):
+    def setUp(self):
+        self.temp_dir = tempfile.TemporaryDirectory()
+        self.webhook_dir = Path(self.temp_dir.name) / "webhooks"
+        self.patcher = mock.patch.object(storage, "WEBHOOK_DIR", self.webhook_dir)
+        self.patcher.start()
+
+    def tearDown(self):
+        self.patcher.stop()
+        self.temp_dir.cleanup()
+
+    def test_append_and_load_by_order_id(self):
+        archive.append(b'{"data": {"id": "1"}}', "1")
+        archive.append(b"nao e json\n\xff", "2")
+        archive.append(b'{"data": {"id": "1", "v": 2}}', "1")
+
+        self.assertEqual(archive.load("1"), b'{"data": {"id": "1", "v": 2}}')
+        self.assertEqual(archive.load("2"), b"nao e json\n\xff")
+        self.assertIsNone(archive.load("3"))
+        self.assertEqual(len(archive._segments()), 1)
+
+    def test_rotates_segments_by_size(self):
+        with mock.patch.dict("os.environ", {"WBUY_ARCHIVE_SEGMENT_BYTES": "100"}):
+            for index in range(5):
+                archive.append(b"x" * 80, str(index))
+
+        self.assertEqual(len(archive._segments()), 5)
+        self.assertEqual(archive.load("3"), b"x" * 80)
+        self.assertEqual(
+            [record.order_id for record in archive.iter_records()], ["0", "1", "2", "3", "4"]
+        )
+
+    def test_truncated_tail_is_ignored(self):
+        ref = archive.append(b"ok", "1")
+        with open(self.webhook_dir / ref.segment, "ab") as file:
+            file.write(b'{"ts":1,"order_id":"2","length":50}\nparcial')
+
+        self.assertEqual([record.payload for record in archive.iter_records()], [b"ok"])
+
+    def test_prune_removes_old_segments_and_index_entries(self):
+        with mock.patch.dict("os.environ", {"WBUY_ARCHIVE_SEGMENT_BYTES": "1"}):
+            old = archive.append(b"antigo", "1")
+            archive.append(b"novo", "2")
+        past = time.time() - 10 * 86400
+        os.utime(self.webhook_dir / old.segment, (past, past))
+
+        self.assertEqual(archive.prune(retention_seconds=86400), 1)
+        self.assertIsNone(archive.load("1"))
+        self.assertEqual(archive.load("2"), b"novo")
+
+
+if __name__ == "__main__":
+    unittest.main()
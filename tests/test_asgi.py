@@ -0,0 +1,108 @@
+import asyncio
+import json
+import unittest
+from unittest import mock
+
+import httpx
+
+from app import create_app
+from app.asgi import WbuyASGI
+from app.wbuy import jobs
+from tests import isolated_storage
+
+
+class TestAsgi(unittest.TestCase):
+    def setUp(self):
+        self.enterContext(isolated_storage())
+        self.asgi = WbuyASGI(threads=4)
+        self.flask = create_app().test_client()
+
+    def _request(self, method, path, body=b""):
+        async def call():
+            transport = httpx.ASGITransport(app=self.asgi)
+            async with httpx.AsyncClient(transport=transport, base_url="http://test") as client:
+                return await client.request(method, path, content=body)
+
+        return asyncio.run(call())
+
+    def test_webhook_contract_matches_flask(self):
+        payload = {
+            "data": {
+                "id": "1",
+                "cliente": {"nome": "Cliente", "telefone1": "(11)98888-7777"},
+                "valor_total": {"total": "10.0"},
+                "pagamento": {"linha_digitavel": "PIXCODE", "tipo_interno": "pix"},
+            }
+        }
+        invalid = {"data": {"id": "2", "cliente": {}}}
+
+        queued = self._request("POST", "/wbuy/webhook", json.dumps(payload).encode())
+        rejected = self._request("POST", "/wbuy/webhook", json.dumps(invalid).encode())
+        flask_rejected = self.flask.post("/wbuy/webhook", json=invalid)
+
+        self.assertEqual(queued.status_code, 202)
+        self.assertEqual(queued.json()["status"], "queued")
+        self.assertEqual(jobs.depth()["pending"], 1)
+        self.assertEqual(rejected.status_code, flask_rejected.status_code)
+        self.assertEqual(rejected.content, flask_rejected.get_data())
+
+    def test_healthcheck_and_metrics(self):
+        health = self._request("GET", "/wbuy")
+        metrics = self._request("GET", "/wbuy/metrics")
+
+        self.assertEqual(health.status_code, 200)
+        self.assertEqual(health.json()["status"], "wbuy api online")
+        self.assertEqual(set(health.json()), set(self.flask.get("/wbuy").get_json()))
+        self.assertEqual(metrics.status_code, 200)
+        self.assertIn("# TYPE wbuy_webhook_seconds histogram", metrics.text)
+
+    def _run_lifespan(self):
+        messages = [{"type": "lifespan.startup"}, {"type": "lifespan.shutdown"}]
+        sent = []
+
+        async def receive():
+            return messages.pop(0)
+
+        async def send(message):
+            sent.append(message["type"])
+
+        with mock.patch("app.asgi.jobs.stop_workers"), mock.patch(
+            "app.asgi.polling.stop_reconciler"
+        ):
+            asyncio.run(self.asgi({"type": "lifespan"}, receive, send))
+        return sent
+
+    def test_startup_resets_metrics_from_previous_runs(self):
+        with mock.patch("app.asgi.metrics.reset") as reset:
+            sent = self._run_lifespan()
+
+        reset.assert_called_once_with()
+        self.assertEqual(sent, ["lifespan.startup.complete", "lifespan.shutdown.complete"])
+
+    def test_worker_startup_keeps_sibling_metrics(self):
+        with mock.patch("app.asgi.metrics.reset") as reset, mock.patch(
+            "app.asgi.multiprocessing.parent_process", return_value=object()
+        ):
+            sent = self._run_lifespan()
+
+        reset.assert_not_called()
+        self.assertEqual(sent, ["lifespan.startup.complete", "lifespan.shutdown.complete"])
+
+    def test_unknown_route_and_wrong_method(self):
+        self.assertEqual(self._request("GET", "/outra").status_code, 404)
+        response = self._request("GET", "/wbuy/webhook")
+        self.assertEqual(response.status_code, 405)
+        self.assertEqual(response.headers["allow"], "POST")
+
+    def test_tenant_webhook_route(self):
+        response = self._request("POST", "/wbuy/desconhecida/webhook", b"{}")
+        flask_response = self.flask.post("/wbuy/desconhecida/webhook", data=b"{}")
+
+        self.assertEqual(response.status_code, 404)
+        self.assertEqual(response.json(), {"status": "rejected", "reason": "unknown_tenant"})
+        self.assertEqual(response.json(), flask_response.get_json())
+        self.assertEqual(self._request("GET", "/wbuy/loja/webhook").status_code, 405)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,121 @@
+import threading
+import time
+import unittest
+from concurrent.futures import Future
+
+from app.wbuy import metrics
+from app.wbuy.batcher import Batcher
+from app.wbuy.scheduler import Scheduler
+
+
+class TestBatcher(unittest.TestCase):
+    def setUp(self):
+        self.sent = []
+        self.lock = threading.Lock()
+
+    def _send_one(self, number, body):
+        time.sleep(0.01)
+        with self.lock:
+            self.sent.append((number, body))
+        return {"number": number, "body": body}
+
+    def test_flushes_when_window_is_full(self):
+        batcher = Batcher(self._send_one, max_size=4, window=10, concurrency=4)
+
+        futures = [batcher.submit(f"55119{index:08d}", "m") for index in range(4)]
+
+        for future in futures:
+            self.assertEqual(future.result(timeout=2)["body"], "m")
+        stats = batcher.stats()
+        self.assertEqual(stats["batches"], 1)
+        self.assertEqual(stats["max_batch_size"], 4)
+
+    def test_flushes_after_window_time(self):
+        batcher = Batcher(self._send_one, max_size=100, window=0.05)
+        started = time.monotonic()
+
+        batcher.submit("5511988887777", "m").result(timeout=2)
+
+        self.assertGreaterEqual(time.monotonic() - started, 0.05)
+        self.assertGreater(batcher.stats()["avg_flush_seconds"], 0)
+
+    def test_keeps_order_for_same_recipient_inside_window(self):
+        batcher = Batcher(self._send_one, max_size=6, window=10, concurrency=6)
+
+        futures = [batcher.submit("A", "a1"), batcher.submit("B", "b1"), batcher.submit("A", "a2")]
+        futures += [batcher.submit("A", "a3"), batcher.submit("B", "b2"), batcher.submit("C", "c1")]
+        for future in futures:
+            future.result(timeout=2)
+
+        self.assertEqual([body for number, body in self.sent if number == "A"], ["a1", "a2", "a3"])
+        self.assertEqual([body for number, body in self.sent if number == "B"], ["b1", "b2"])
+
+    def test_bulk_endpoint_receives_whole_window(self):
+        calls = []
+
+        def send_bulk(messages):
+            calls.append(messages)
+            return [{"id": index} for index in range(len(messages))]
+
+        batcher = Batcher(self._send_one, send_bulk, max_size=3, window=10)
+
+        futures = [batcher.submit(str(index), f"m{index}") for index in range(3)]
+
+        self.assertEqual([future.result(timeout=2) for future in futures], [{"id": 0}, {"id": 1}, {"id": 2}])
+        self.assertEqual(calls, [[{"number": str(i), "body": f"m{i}"} for i in range(3)]])
+        self.assertEqual(self.sent, [])
+        self.assertEqual(batcher.stats()["bulk_requests"], 1)
+
+    def test_bulk_messages_without_result_resolve_as_errors(self):
+        batcher = Batcher(self._send_one, lambda messages: [{"id": 0}], max_size=3, window=10)
+
+        futures = [batcher.submit(str(index), f"m{index}") for index in range(3)]
+
+        results = [future.result(timeout=2) for future in futures]
+        self.assertEqual(results[0], {"id": 0})
+        self.assertEqual(results[1:], [{"status": "error", "reason": "missing_bulk_result"}] * 2)
+
+    def test_batches_are_exported_as_histograms(self):
+        before = metrics.collect()["histograms"].get(
+            ("wbuy_batch_size", (("mode", "bulk"),)), [None, 0.0, 0]
+        )
+        batcher = Batcher(self._send_one, lambda messages: messages, max_size=3, window=10)
+
+        for future in [batcher.submit(str(index), "m") for index in range(3)]:
+            future.result(timeout=2)
+        deadline = time.monotonic() + 2
+        while batcher.stats()["batches"] == 0 and time.monotonic() < deadline:
+            time.sleep(0.01)
+
+        histograms = metrics.collect()["histograms"]
+        size = histograms[("wbuy_batch_size", (("mode", "bulk"),))]
+        self.assertEqual(size[2] - before[2], 1)
+        self.assertEqual(size[1] - before[1], 3)
+        self.assertIn(("wbuy_batch_flush_seconds", (("mode", "bulk"),)), histograms)
+
+    def test_scheduler_waits_for_future_steps_without_holding_threads(self):
+        batcher = Batcher(self._send_one, max_size=20, window=0.05, concurrency=10)
+        scheduler = Scheduler(gap=0, rate=0, threads=1)
+
+        def step(number, body):
+            def run():
+                done = Future()
+                batcher.submit(number, body).add_done_callback(lambda _: done.set_result(None))
+                return done
+
+            return run
+
+        futures = [
+            scheduler.submit(str(index), [step(str(index), "m1"), step(str(index), "m2")])
+            for index in range(10)
+        ]
+        for future in futures:
+            future.result(timeout=5)
+
+        self.assertEqual(len(self.sent), 20)
+        # Com uma única thread de envio, só o batcher permite juntar pedidos.
+        self.assertGreaterEqual(batcher.stats()["max_batch_size"], 10)
+
+
+if __name__ == "__main__":
+    unittest.main()
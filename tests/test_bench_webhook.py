@@ -0,0 +1,67 @@
+import json
+import tempfile
+import unittest
+from pathlib import Path
+
+from benchmarks import bench_webhook
+
+
+class TestBenchWebhook(unittest.TestCase):
+    def _args(self, **overrides):
+        args = bench_webhook.build_parser().parse_args([])
+        for key, value in overrides.items():
+            setattr(args, key, value)
+        return args
+
+    def _report(self, **overrides):
+        report = {
+            "orders": 10,
+            "delivered": 10,
+            "requests_per_second": 100.0,
+            "orders_per_second": 50.0,
+            "latency_ms": {"p50": 5.0, "p95": 9.0, "p99": 10.0, "max": 12.0},
+            "rss_mb_max": 80.0,
+            "fds_max": 40,
+        }
+        report.update(overrides)
+        return report
+
+    def test_percentile_uses_nearest_rank(self):
+        values = [float(value) for value in range(1, 101)]
+
+        self.assertEqual(bench_webhook.percentile(values, 0.50), 50.0)
+        self.assertEqual(bench_webhook.percentile(values, 0.99), 99.0)
+        self.assertEqual(bench_webhook.percentile([7.0], 0.95), 7.0)
+        self.assertEqual(bench_webhook.percentile([], 0.5), 0.0)
+
+    def test_prepare_gives_unique_ids_and_points_boleto_to_stub(self):
+        raw = list(bench_webhook.synthetic_payloads(3))
+
+        prepared = [json.loads(body) for body in bench_webhook.prepare(raw, 6, "http://stub", False)]
+
+        ids = {payload["data"]["id"] for payload in prepared}
+        self.assertEqual(len(ids), 6)
+        boleto = prepared[2]["data"]["pagamento"]
+        self.assertEqual(boleto["paymentLink"], f"http://stub/boleto/{prepared[2]['data']['id']}.pdf")
+
+        kept = bench_webhook.prepare(raw, 6, "http://stub", True)
+        self.assertEqual(len({json.loads(body)["data"]["id"] for body in kept}), 3)
+
+    def test_check_reports_limits_and_regressions(self):
+        with tempfile.TemporaryDirectory() as directory:
+            baseline = Path(directory) / "baseline.json"
+            baseline.write_text(json.dumps(self._report()))
+
+            self.assertEqual(bench_webhook.check(self._report(), self._args(baseline=str(baseline))), [])
+
+            slower = self._report(orders_per_second=30.0, latency_ms={"p99": 20.0})
+            failures = bench_webhook.check(
+                slower, self._args(baseline=str(baseline), max_fds=10)
+            )
+
+        self.assertEqual(len(failures), 3)
+        self.assertTrue(any("fds_max" in failure for failure in failures))
+
+
+if __name__ == "__main__":
+    unittest.main()
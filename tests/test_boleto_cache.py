@@ -0,0 +1,109 @@
+import tempfile
+import unittest
+from pathlib import Path
+from unittest import mock
+
+from app.wbuy import boleto_cache, webhook
+
+PDF = b"%PDF-1.4\n" + b"x" * 100 + b"\n%%EOF"
+
+
+def _pdf_response(status_code=200, body=PDF, headers=None):
+    response = mock.Mock()
+    response.status_code = status_code
+    response.ok = 200 <= status_code < 400
+    response.text = ""
+    response.headers = headers or {"Content-Type": "application/pdf", "ETag": '"v1"'}
+    response.iter_content.return_value = iter([body[:10], body[10:]])
+    return response
+
+
+class TestBoletoCache(unittest.TestCase):
+    def setUp(self):
+        self.temp_dir = tempfile.TemporaryDirectory()
+        self.cache_dir = Path(self.temp_dir.name) / "boleto_cache"
+        self.cache_patcher = mock.patch.object(boleto_cache, "CACHE_DIR", self.cache_dir)
+        self.cache_patcher.start()
+        self.uploads = []
+        self.media_patcher = mock.patch.object(
+            webhook, "send_whats_media", side_effect=self._fake_send_media
+        )
+        self.media_patcher.start()
+
+    def tearDown(self):
+        self.media_patcher.stop()
+        self.cache_patcher.stop()
+        self.temp_dir.cleanup()
+
+    def _fake_send_media(self, number, chunks, filename):
+        self.uploads.append(b"".join(chunks))
+        return {"ok": True}
+
+    def test_second_send_skips_download(self):
+        url = "https://wbuy.example/boleto/1.pdf"
+
+        with mock.patch.object(
+            webhook.http_client, "request", return_value=_pdf_response()
+        ) as request_mock:
+            webhook._send_boleto_step("5511999999999", url)
+            webhook._send_boleto_step("5511999999999", url)
+
+        request_mock.assert_called_once()
+        self.assertEqual(self.uploads, [PDF, PDF])
+        entry = boleto_cache.lookup(url)
+        self.assertEqual(entry.etag, '"v1"')
+        self.assertEqual(entry.path.read_bytes(), PDF)
+
+    def test_stale_entry_is_revalidated_with_etag(self):
+        url = "https://wbuy.example/boleto/2.pdf"
+        with mock.patch.object(webhook.http_client, "request", return_value=_pdf_response()):
+            webhook._send_boleto_step("5511999999999", url)
+
+        with mock.patch.dict("os.environ", {"WBUY_BOLETO_CACHE_FRESH_SECONDS": "0"}), mock.patch.object(
+            webhook.http_client, "request", return_value=_pdf_response(status_code=304)
+        ) as request_mock:
+            webhook._send_boleto_step("5511999999999", url)
+
+        _, kwargs = request_mock.call_args
+        self.assertEqual(kwargs["headers"], {"If-None-Match": '"v1"'})
+        self.assertEqual(self.uploads, [PDF, PDF])
+        self.assertGreaterEqual(boleto_cache.stats()["revalidated"], 1)
+
+    def test_identical_content_is_stored_once(self):
+        with mock.patch.object(
+            webhook.http_client, "request", side_effect=[_pdf_response(), _pdf_response()]
+        ):
+            webhook._send_boleto_step("5511999999999", "https://wbuy.example/a.pdf")
+            webhook._send_boleto_step("5511999999999", "https://wbuy.example/b.pdf")
+
+        blobs = [path for path in self.cache_dir.glob("*/*.pdf")]
+        self.assertEqual(len(blobs), 1)
+
+    def test_eviction_removes_least_recently_used(self):
+        for index in range(3):
+            body = PDF + str(index).encode()
+            with mock.patch.object(
+                webhook.http_client, "request", return_value=_pdf_response(body=body)
+            ):
+                webhook._send_boleto_step("5511999999999", f"https://wbuy.example/{index}.pdf")
+
+        boleto_cache.hit(boleto_cache.lookup("https://wbuy.example/0.pdf"))
+        boleto_cache.evict(max_bytes=len(PDF) * 2 + 2)
+
+        self.assertIsNotNone(boleto_cache.lookup("https://wbuy.example/0.pdf"))
+        self.assertIsNone(boleto_cache.lookup("https://wbuy.example/1.pdf"))
+        self.assertIsNotNone(boleto_cache.lookup("https://wbuy.example/2.pdf"))
+
+    def test_failed_download_is_not_cached(self):
+        with mock.patch.object(
+            webhook.http_client, "request", return_value=_pdf_response(status_code=500)
+        ):
+            result = webhook._send_boleto_step("5511999999999", "https://wbuy.example/x.pdf")
+
+        self.assertEqual(result["reason"], "boleto_download_failed")
+        self.assertIsNone(boleto_cache.lookup("https://wbuy.example/x.pdf"))
+        self.assertEqual(list((self.cache_dir / "tmp").glob("*")), [])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,159 @@
+import json
+import unittest
+from unittest import mock
+
+from app.wbuy import breaker, delivery_log, jobs, webhook
+from tests import isolated_storage
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+class TestCircuitBreaker(unittest.TestCase):
+    def setUp(self):
+        self.clock = FakeClock()
+        self.breaker = breaker.CircuitBreaker(
+            failure_rate=0.5,
+            slow_rate=0.5,
+            slow_seconds=1.0,
+            window=4,
+            min_calls=4,
+            open_seconds=10.0,
+            max_open_seconds=25.0,
+            probes=1,
+            min_limit=1,
+            max_limit=8,
+            clock=self.clock,
+        )
+
+    def _call(self, failed=False, elapsed=0.1):
+        self.assertEqual(self.breaker.try_acquire(), 0.0)
+        self.breaker.release(failed, elapsed)
+
+    def test_opens_on_failure_rate_and_recovers_through_half_open_probe(self):
+        for failed in (False, True, False, True):
+            self._call(failed)
+        self.assertEqual(self.breaker.state, breaker.OPEN)
+
+        with self.assertRaises(breaker.BreakerOpen) as raised:
+            self.breaker.try_acquire()
+        self.assertEqual(raised.exception.reason, "circuit_open")
+        self.assertAlmostEqual(raised.exception.retry_after, 10.0)
+
+        self.clock.now += 10
+        self.assertEqual(self.breaker.state, breaker.HALF_OPEN)
+        self.assertEqual(self.breaker.try_acquire(), 0.0)
+        # Só uma chamada de teste por vez.
+        with self.assertRaises(breaker.BreakerOpen):
+            self.breaker.try_acquire()
+        self.breaker.release(False, 0.1)
+        self.assertEqual(self.breaker.state, breaker.CLOSED)
+
+    def test_slow_calls_trip_and_failed_probe_doubles_open_time(self):
+        for _ in range(4):
+            self._call(elapsed=2.0)
+        self.assertEqual(self.breaker.state, breaker.OPEN)
+
+        self.clock.now += 10
+        self._call(failed=True)
+        self.assertEqual(self.breaker.state, breaker.OPEN)
+        self.assertAlmostEqual(self.breaker.retry_after(), 20.0)
+
+        self.clock.now += 20
+        self._call(failed=True)
+        self.assertAlmostEqual(self.breaker.retry_after(), 25.0)
+        self.assertEqual(self.breaker.stats()["trips"], 3)
+
+    def test_concurrency_limit_is_aimd(self):
+        self.assertEqual(self.breaker.stats()["concurrency_limit"], 8)
+
+        self._call(failed=True)
+        self.assertEqual(self.breaker.stats()["concurrency_limit"], 4)
+        # Reduções seguidas no mesmo segundo contam uma vez só.
+        self._call(failed=True)
+        self.assertEqual(self.breaker.stats()["concurrency_limit"], 4)
+
+        for _ in range(4):
+            self.assertEqual(self.breaker.try_acquire(), 0.0)
+        self.assertGreater(self.breaker.try_acquire(), 0)
+        with self.assertRaises(breaker.BreakerOpen) as raised:
+            self.breaker.acquire(timeout=0)
+        self.assertEqual(raised.exception.reason, "upstream_saturated")
+
+        for _ in range(4):
+            self.breaker.release(False, 0.1)
+        self.assertAlmostEqual(self.breaker.stats()["concurrency_limit"], 4.92, places=2)
+
+    def test_guard_counts_exceptions_and_upstream_status(self):
+        self.assertTrue(breaker.is_upstream_failure(503))
+        self.assertTrue(breaker.is_upstream_failure(429))
+        self.assertFalse(breaker.is_upstream_failure(400))
+
+        with self.assertRaises(RuntimeError):
+            with self.breaker.guard():
+                raise RuntimeError("conexão recusada")
+        with self.breaker.guard() as call:
+            call.failed = True
+        stats = self.breaker.stats()
+        self.assertEqual(stats["failure_rate"], 1.0)
+        self.assertEqual(stats["inflight"], 0)
+
+
+class TestDeliveryParking(unittest.TestCase):
+    def setUp(self):
+        self.enterContext(isolated_storage())
+        self.enterContext(
+            mock.patch.dict(
+                "os.environ",
+                {"WHATSAPP_TEST_NUMBER": "", "NUMBER_TEST": "", "NUMBER_TESTE": ""},
+            )
+        )
+
+        self.payload = {
+            "data": {
+                "id": "777",
+                "cliente": {"nome": "Cliente Breaker", "telefone1": "(11)98888-7777"},
+                "valor_total": {"total": "10.0"},
+                "pagamento": {"linha_digitavel": "PIXCODE", "tipo_interno": "pix"},
+            }
+        }
+
+    def _delivery(self):
+        row = delivery_log._conn().execute(
+            "SELECT status, attempts, next_attempt_at FROM deliveries WHERE order_id = '777'"
+        ).fetchone()
+        return dict(row)
+
+    def test_open_circuit_parks_delivery_without_spending_attempts(self):
+        rejected = {"status": "error", "reason": "circuit_open", "retry_after": 12.0}
+        with mock.patch.object(webhook, "send_whats_message", return_value=rejected):
+            result = webhook.process_webhook(self.payload)
+
+        self.assertEqual(result["status"], "parked")
+        self.assertEqual(result["retry_in"], 12.0)
+        delivery = self._delivery()
+        self.assertEqual(delivery["status"], "retry")
+        self.assertEqual(delivery["attempts"], 0)
+        job = jobs._conn().execute("SELECT payload FROM jobs").fetchone()
+        self.assertEqual(
+            json.loads(job["payload"]), {"delivery_retry": "777", "priority": "pix"}
+        )
+
+    def test_open_circuit_parks_before_submitting_steps(self):
+        with mock.patch.object(breaker, "retry_after", return_value=30.0), mock.patch.object(
+            webhook, "_submit_steps"
+        ) as submit_mock:
+            result = webhook.process_webhook(self.payload)
+
+        submit_mock.assert_not_called()
+        self.assertEqual(result["status"], "parked")
+        self.assertEqual(self._delivery()["attempts"], 0)
+
+
+if __name__ == "__main__":
+    unittest.main()
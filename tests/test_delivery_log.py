@@ -0,0 +1,150 @@
+import time
+import unittest
+from concurrent.futures import Future
+from unittest import mock
+
+from app.wbuy import delivery_log, jobs, webhook
+from tests import isolated_storage
+
+
+class TestDeliveryLog(unittest.TestCase):
+    def setUp(self):
+        self.enterContext(isolated_storage())
+        self.enterContext(
+            mock.patch.dict(
+                "os.environ",
+                {"WHATSAPP_TEST_NUMBER": "", "NUMBER_TEST": "", "NUMBER_TESTE": ""},
+            )
+        )
+
+        self.sent = []
+        self.failing = set()
+        self.enterContext(
+            mock.patch.object(webhook, "send_whats_message", side_effect=self._send)
+        )
+
+        self.payload = {
+            "data": {
+                "id": "321",
+                "cliente": {"nome": "Cliente Log", "telefone1": "(11)98888-7777"},
+                "valor_total": {"total": "10.0"},
+                "pagamento": {"linha_digitavel": "PIXCODE", "tipo_interno": "pix"},
+            }
+        }
+
+    def _send(self, number, body):
+        if body in self.failing:
+            return {"status": "error", "status_code": 503, "response": "busy"}
+        self.sent.append(body)
+        return {"ok": True}
+
+    def test_failed_step_is_retried_without_resending_earlier_steps(self):
+        self.failing = {"PIXCODE"}
+
+        result = webhook.process_webhook(self.payload)
+
+        self.assertEqual(result["status_code"], 503)
+        self.assertEqual(result["retry_in"], 30.0)
+        self.assertEqual(len(self.sent), 1)
+        self.assertEqual(delivery_log.counts()["retry"], 1)
+        self.assertEqual([step["kind"] for step in delivery_log.load("321").steps], ["text", "text"])
+
+        job = jobs._conn().execute("SELECT payload, available_at FROM jobs").fetchone()
+        self.assertIn("delivery_retry", job["payload"])
+        self.assertGreater(job["available_at"], time.time() + 25)
+
+        self.failing = set()
+        result = webhook.run_job({"delivery_retry": "321"})
+
+        self.assertEqual(result, {"status": "ok"})
+        self.assertEqual(len(self.sent), 3)
+        self.assertEqual(self.sent[1], "PIXCODE")
+        self.assertEqual(delivery_log.counts()["done"], 1)
+        self.assertEqual(
+            webhook.run_job({"delivery_retry": "321"}),
+            {"status": "skipped", "reason": "not_pending"},
+        )
+
+    def test_exhausted_delivery_goes_to_dead_letters(self):
+        self.failing = {"PIXCODE"}
+
+        with mock.patch.dict("os.environ", {"WBUY_DELIVERY_MAX_ATTEMPTS": "2"}):
+            webhook.process_webhook(self.payload)
+            result = webhook.resume_delivery("321")
+
+        self.assertTrue(result["dead_letter"])
+        self.assertEqual([row["order_id"] for row in delivery_log.dead_letters()], ["321"])
+        steps = delivery_log._conn().execute(
+            "SELECT status, attempts FROM delivery_steps WHERE order_id = '321' ORDER BY position"
+        ).fetchall()
+        self.assertEqual([tuple(row) for row in steps], [("sent", 1), ("failed", 2), ("pending", 0)])
+
+        self.assertTrue(delivery_log.revive("321"))
+        self.failing = set()
+        self.assertEqual(webhook.resume_delivery("321"), {"status": "ok"})
+
+    def test_stale_running_delivery_is_recovered_on_redelivery(self):
+        webhook.process_webhook(self.payload)
+        delivery_log._conn().execute(
+            "UPDATE deliveries SET status = 'running', updated_at = 0 WHERE order_id = '321'"
+        )
+        delivery_log._conn().execute(
+            "UPDATE delivery_steps SET status = 'pending' WHERE order_id = '321' AND position = 2"
+        )
+
+        result = webhook.process_webhook(self.payload)
+
+        self.assertEqual(result, {"status": "ok"})
+        self.assertEqual(len(self.sent), 4)
+        self.assertEqual(
+            webhook.process_webhook(self.payload),
+            {"status": "skipped", "reason": "already_processed"},
+        )
+
+    def test_queued_delivery_is_not_recovered_while_owner_is_alive(self):
+        pending = Future()
+
+        with mock.patch.object(webhook, "_submit_steps", return_value=pending):
+            outcome = webhook.process_webhook(self.payload, wait=False)
+            # A sequência espera no scheduler além do lease; o dono segue vivo.
+            delivery_log._conn().execute(
+                "UPDATE deliveries SET updated_at = 0 WHERE order_id = '321'"
+            )
+            jobs.heartbeat()
+
+            self.assertFalse(delivery_log.recover_stale("321"))
+            self.assertEqual(
+                webhook.process_webhook(self.payload),
+                {"status": "skipped", "reason": "already_processed"},
+            )
+
+            pending.set_result(None)
+
+        self.assertEqual(outcome.result(timeout=1), {"status": "ok"})
+        self.assertEqual(delivery_log.heartbeat(), 0)
+
+    def test_prune_removes_only_old_finished_deliveries(self):
+        for order_id in ("321", "322", "323"):
+            self.payload["data"]["id"] = order_id
+            webhook.process_webhook(self.payload)
+        delivery_log._conn().execute(
+            "UPDATE deliveries SET updated_at = 0 WHERE order_id IN ('321', '322')"
+        )
+        delivery_log._conn().execute(
+            "UPDATE deliveries SET status = 'retry' WHERE order_id = '322'"
+        )
+
+        self.assertEqual(delivery_log.prune(ttl_seconds=86400), 1)
+
+        self.assertIsNone(delivery_log.load("321"))
+        self.assertIsNotNone(delivery_log.load("322"))
+        self.assertIsNotNone(delivery_log.load("323"))
+        orphans = delivery_log._conn().execute(
+            "SELECT COUNT(*) FROM delivery_steps WHERE order_id = '321'"
+        ).fetchone()[0]
+        self.assertEqual(orphans, 0)
+        self.assertEqual(delivery_log.prune(ttl_seconds=0), 0)
+
+
+if __name__ == "__main__":
+    unittest.main()
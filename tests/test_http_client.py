@@ -0,0 +1,80 @@
+import threading
+import unittest
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from unittest import mock
+
+from app.wbuy import http_client
+
+
+class _StubHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    responses = []
+
+    def do_POST(self):
+        length = int(self.headers.get("Content-Length", 0))
+        self.rfile.read(length)
+        status = self.responses.pop(0) if self.responses else 200
+        body = b'{"ok": true}'
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class TestHttpClient(unittest.TestCase):
+    def setUp(self):
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), _StubHandler)
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self.thread.start()
+        self.url = f"http://127.0.0.1:{self.server.server_address[1]}/api/messages/send"
+        self.env = mock.patch.dict("os.environ", {"WHATICKET_RETRY_BACKOFF": "0"})
+        self.env.start()
+        http_client._session = None
+
+    def tearDown(self):
+        http_client._session = None
+        self.env.stop()
+        self.server.shutdown()
+        self.server.server_close()
+
+    def test_session_is_shared_and_connections_are_reused(self):
+        self.assertIs(http_client.get_session(), http_client.get_session())
+
+        for _ in range(3):
+            response = http_client.request("POST", self.url, json={"number": "1"})
+            self.assertEqual(response.status_code, 200)
+
+        stats = http_client.connection_stats()
+        self.assertEqual(stats["requests"], 3)
+        self.assertEqual(stats["connections"], 1)
+        self.assertEqual(stats["reused"], 2)
+
+    def test_retries_on_server_errors(self):
+        _StubHandler.responses = [503, 429]
+
+        response = http_client.request("POST", self.url, json={"number": "1"})
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(_StubHandler.responses, [])
+
+    def test_post_is_not_retried_when_the_message_may_have_been_sent(self):
+        _StubHandler.responses = [502, 200]
+
+        response = http_client.request("POST", self.url, json={"number": "1"})
+
+        self.assertEqual(response.status_code, 502)
+        self.assertEqual(_StubHandler.responses, [200])
+
+    def test_timeout_has_separate_connect_and_read_values(self):
+        with mock.patch.dict(
+            "os.environ", {"WHATICKET_CONNECT_TIMEOUT": "2", "WHATICKET_READ_TIMEOUT": "15"}
+        ):
+            self.assertEqual(http_client.timeout(), (2.0, 15.0))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,174 @@
+import sqlite3
+import tempfile
+import time
+import unittest
+from concurrent.futures import Future
+from pathlib import Path
+from unittest import mock
+
+from app.wbuy import db, jobs
+
+
+class TestJobQueue(unittest.TestCase):
+    def setUp(self):
+        self.temp_dir = tempfile.TemporaryDirectory()
+        self.queue_db = Path(self.temp_dir.name) / "queue.db"
+        self.queue_patcher = mock.patch.object(jobs, "QUEUE_DB", self.queue_db)
+        self.queue_patcher.start()
+
+    def tearDown(self):
+        self.queue_patcher.stop()
+        self.temp_dir.cleanup()
+
+    def test_jobs_are_processed_in_arrival_order(self):
+        jobs.enqueue({"data": {"id": 1}})
+        jobs.enqueue({"data": {"id": 2}})
+
+        seen = []
+        while jobs.run_next(lambda payload: seen.append(payload["data"]["id"])):
+            pass
+
+        self.assertEqual(seen, [1, 2])
+        self.assertEqual(jobs.depth(), {"pending": 0, "running": 0, "failed": 0})
+
+    def test_queue_survives_new_connection(self):
+        jobs.enqueue({"data": {"id": 7}})
+        db._local.connections.clear()
+
+        job = jobs.claim_next()
+
+        self.assertEqual(job.payload, {"data": {"id": 7}})
+        self.assertEqual(job.attempts, 1)
+
+    def test_failed_job_is_retried_with_backoff_then_marked_failed(self):
+        jobs.enqueue({"data": {"id": 3}})
+
+        def boom(payload):
+            raise RuntimeError("whaticket fora do ar")
+
+        with mock.patch.dict(
+            "os.environ",
+            {"WBUY_QUEUE_MAX_ATTEMPTS": "2", "WBUY_QUEUE_RETRY_BACKOFF": "0"},
+        ):
+            self.assertTrue(jobs.run_next(boom))
+            self.assertEqual(jobs.depth()["pending"], 1)
+            self.assertTrue(jobs.run_next(boom))
+
+        self.assertEqual(jobs.depth(), {"pending": 0, "running": 0, "failed": 1})
+        self.assertFalse(jobs.run_next(boom))
+
+    def test_stale_running_job_is_reclaimed(self):
+        jobs.enqueue({"data": {"id": 4}})
+        self.assertIsNotNone(jobs.claim_next())
+        self.assertIsNone(jobs.claim_next())
+
+        with mock.patch.object(jobs.time, "time", return_value=time.time() + 3600):
+            job = jobs.claim_next()
+
+        self.assertEqual(job.payload, {"data": {"id": 4}})
+        self.assertEqual(job.attempts, 2)
+
+    def test_heartbeat_keeps_job_waiting_on_future_from_being_reclaimed(self):
+        jobs.enqueue({"data": {"id": 8}})
+        future = Future()
+        second = mock.Mock()
+
+        with mock.patch.dict("os.environ", {"WBUY_QUEUE_LEASE_SECONDS": "60"}):
+            self.assertTrue(jobs.run_next(lambda payload: future))
+            later = time.time() + 120
+            with mock.patch.object(jobs.time, "time", return_value=later):
+                self.assertEqual(jobs.heartbeat(), 1)
+                self.assertFalse(jobs.run_next(second))
+
+        second.assert_not_called()
+        future.set_result({"status": "ok"})
+        self.assertEqual(jobs.depth(), {"pending": 0, "running": 0, "failed": 0})
+        self.assertEqual(jobs.heartbeat(), 0)
+
+    def test_stale_owner_cannot_complete_or_fail_a_reclaimed_job(self):
+        jobs.enqueue({"data": {"id": 9}})
+        first = jobs.claim_next()
+
+        with mock.patch.object(jobs.time, "time", return_value=time.time() + 3600):
+            second = jobs.claim_next()
+
+        jobs.complete(first)
+        jobs.fail(first, "atrasado")
+        self.assertEqual(jobs.depth()["running"], 1)
+
+        jobs.complete(second)
+        self.assertEqual(jobs.depth(), {"pending": 0, "running": 0, "failed": 0})
+
+    def test_job_returning_future_completes_when_future_resolves(self):
+        jobs.enqueue({"data": {"id": 6}})
+        future = Future()
+
+        self.assertTrue(jobs.run_next(lambda payload: future))
+        self.assertEqual(jobs.depth()["running"], 1)
+
+        future.set_result({"status": "ok"})
+
+        self.assertEqual(jobs.depth(), {"pending": 0, "running": 0, "failed": 0})
+
+    def test_workers_drain_queue_in_background(self):
+        handled = []
+        jobs.enqueue({"data": {"id": 5}})
+
+        jobs.start_workers(handled.append, workers=2)
+        try:
+            deadline = time.time() + 5
+            while not handled and time.time() < deadline:
+                time.sleep(0.01)
+        finally:
+            jobs.stop_workers()
+
+        self.assertEqual(handled, [{"data": {"id": 5}}])
+
+    def test_urgent_class_is_claimed_first_and_has_its_own_budget(self):
+        def order(order_id, kind):
+            return {"data": {"id": order_id, "pagamento": {"tipo_interno": kind}}}
+
+        jobs.enqueue(order(1, "bank_billet"))
+        jobs.enqueue(order(2, "bank_billet"))
+        jobs.enqueue(order(3, "pix"))
+        jobs.enqueue({"delivery_retry": "4", "priority": "pix"})
+
+        pending = Future()
+        seen = []
+
+        def handler(payload):
+            seen.append(payload.get("data", {}).get("id") or payload.get("delivery_retry"))
+            return pending if payload.get("data", {}).get("id") == 1 else None
+
+        with mock.patch.dict("os.environ", {"WBUY_QUEUE_MAX_INFLIGHT_BANK_BILLET": "1"}):
+            while jobs.run_next(handler):
+                pass
+            # O boleto 2 espera a vaga da classe; o PIX não.
+            self.assertEqual(seen, [3, "4", 1])
+            self.assertEqual(jobs.inflight()["bank_billet"], {"used": 1, "limit": 1})
+
+            pending.set_result(None)
+            self.assertTrue(jobs.run_next(handler))
+
+        self.assertEqual(seen, [3, "4", 1, 2])
+        self.assertEqual(jobs.depth(), {"pending": 0, "running": 0, "failed": 0})
+
+    def test_queue_created_before_priorities_is_migrated(self):
+        connection = sqlite3.connect(self.queue_db)
+        connection.executescript(
+            "CREATE TABLE jobs (id INTEGER PRIMARY KEY AUTOINCREMENT, payload TEXT NOT NULL, "
+            "status TEXT NOT NULL DEFAULT 'pending', attempts INTEGER NOT NULL DEFAULT 0, "
+            "enqueued_at REAL NOT NULL, available_at REAL NOT NULL, claimed_at REAL, "
+            "last_error TEXT);"
+            "INSERT INTO jobs (payload, enqueued_at, available_at) VALUES ('{\"data\": {}}', 0, 0);"
+        )
+        connection.close()
+
+        jobs.enqueue({"data": {"id": 8, "pagamento": {"tipo_interno": "pix"}}})
+
+        self.assertEqual(jobs.claim_next().lane, "default")
+        self.assertEqual(jobs.claim_next().lane, "pix")
+
+
+if __name__ == "__main__":
+    unittest.main()
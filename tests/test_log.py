@@ -0,0 +1,105 @@
+import io
+import json
+import logging
+import os
+import threading
+import unittest
+from unittest import mock
+
+from app.wbuy import log
+from tests import quiet_logging
+
+
+class TestLog(unittest.TestCase):
+    def setUp(self):
+        self.stream = io.StringIO()
+        self.handler = log.setup(self.stream, level="DEBUG")
+        self.logger = log.get_logger("teste")
+
+    def tearDown(self):
+        quiet_logging()
+
+    def _records(self):
+        self.handler.flush()
+        return [json.loads(line) for line in self.stream.getvalue().splitlines()]
+
+    def test_redacts_phones_and_payment_codes(self):
+        pix = "00020126580014BR.GOV.BCB.PIX0136chave5204000053039865802BR5913LOJA EXEMPLO6009SAO PAULO62070503***6304ABCD"
+        linha = "23793.38128 60000.000003 00000.000400 1 84340000010000"
+        self.logger.info("pix %s linha %s fone +55 (11) 98888-7777", pix, linha)
+        self.logger.info("envio", extra={"phone": "5511988887777"})
+
+        first, second = self._records()
+
+        self.assertEqual(first["msg"], "pix [pix] linha [linha_digitavel] fone *********7777")
+        self.assertEqual(second["phone"], "*********7777")
+        self.assertEqual(first["logger"], "wbuy.teste")
+
+    def test_only_phone_shaped_numbers_are_masked(self):
+        self.logger.info("celular 5511988887777, 11988887777 ou (16)3333-4444")
+        self.logger.info("pedido 1234567890 em 1792289142, documento 12345678909")
+
+        first, second = self._records()
+
+        self.assertEqual(first["msg"], "celular *********7777, *******7777 ou ******4444")
+        self.assertEqual(second["msg"], "pedido 1234567890 em 1792289142, documento 12345678909")
+
+    def test_close_writes_queued_records_and_stops_thread(self):
+        handler = log.AsyncHandler(io.StringIO())
+        handler.setFormatter(log.JsonFormatter())
+        gate = threading.Event()
+        original = handler._write
+        handler._write = lambda record: (gate.wait(), original(record))
+
+        for index in range(3):
+            handler.handle(logging.makeLogRecord({"msg": f"m{index}", "levelno": 20}))
+        thread = handler._thread
+        threading.Timer(0.05, gate.set).start()
+        handler.close()
+        handler.handle(logging.makeLogRecord({"msg": "depois", "levelno": 20}))
+
+        lines = [json.loads(line)["msg"] for line in handler.stream.getvalue().splitlines()]
+        self.assertEqual(lines, ["m0", "m1", "m2", "depois"])
+        self.assertFalse(thread.is_alive())
+
+    def test_correlation_id_follows_bind_and_propagate(self):
+        with log.bind("123"):
+            self.logger.info("dentro")
+            worker = log.propagate(lambda: self.logger.info("na thread"))
+        self.logger.info("fora")
+        thread = threading.Thread(target=worker)
+        thread.start()
+        thread.join()
+
+        records = {record["msg"]: record for record in self._records()}
+
+        self.assertEqual(records["dentro"]["order_id"], "123")
+        self.assertEqual(records["na thread"]["order_id"], "123")
+        self.assertIsNone(records["fora"]["order_id"])
+
+    def test_sampling_drops_only_sampled_low_level_events(self):
+        with mock.patch.dict(os.environ, {"WBUY_LOG_SAMPLE_RATE": "0"}):
+            self.handler = log.setup(self.stream, level="DEBUG")
+
+        self.logger.info("amostrado", extra={"sampled": True})
+        self.logger.warning("aviso amostrado", extra={"sampled": True})
+        self.logger.info("normal")
+
+        self.assertEqual([r["msg"] for r in self._records()], ["aviso amostrado", "normal"])
+
+    def test_full_queue_drops_instead_of_blocking(self):
+        handler = log.AsyncHandler(io.StringIO(), maxsize=1)
+        handler.setFormatter(log.JsonFormatter())
+        gate = threading.Event()
+        original = handler._write
+        handler._write = lambda record: (gate.wait(), original(record))
+
+        for index in range(5):
+            handler.handle(logging.makeLogRecord({"msg": f"m{index}", "levelno": 20}))
+        gate.set()
+
+        self.assertGreaterEqual(handler.dropped, 3)
+
+
+if __name__ == "__main__":
+    unittest.main()
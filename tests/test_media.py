@@ -0,0 +1,127 @@
+import tempfile
+import unittest
+from email.parser import BytesParser
+from email.policy import HTTP
+from pathlib import Path
+from unittest import mock
+
+from app.wbuy import boleto_cache, media, webhook
+
+
+class TestBoletoStream(unittest.TestCase):
+    def test_streams_chunks_without_joining(self):
+        stream = media.BoletoStream(
+            {"Content-Type": "application/pdf"}, iter([b"%PDF-1.4", b"abc", b"def"])
+        )
+
+        self.assertEqual(list(stream), [b"%PDF-1.4", b"abc", b"def"])
+        self.assertEqual(stream.size, 14)
+
+    def test_rejects_unexpected_content_type(self):
+        with self.assertRaises(media.BoletoError) as ctx:
+            media.BoletoStream({"Content-Type": "text/html"}, iter([b"<html>"]))
+
+        self.assertEqual(ctx.exception.reason, "boleto_invalid_content")
+
+    def test_rejects_non_pdf_body_before_upload(self):
+        with self.assertRaises(media.BoletoError) as ctx:
+            media.BoletoStream({"Content-Type": "application/octet-stream"}, iter([b"oops"]))
+
+        self.assertEqual(ctx.exception.reason, "boleto_invalid_content")
+
+    def test_rejects_declared_length_above_limit(self):
+        with mock.patch.dict("os.environ", {"WBUY_BOLETO_MAX_BYTES": "10"}):
+            with self.assertRaises(media.BoletoError) as ctx:
+                media.BoletoStream(
+                    {"Content-Type": "application/pdf", "Content-Length": "11"},
+                    iter([b"%PDF-1.4"]),
+                )
+
+        self.assertEqual(ctx.exception.reason, "boleto_too_large")
+
+    def test_stops_stream_when_limit_is_exceeded(self):
+        with mock.patch.dict("os.environ", {"WBUY_BOLETO_MAX_BYTES": "12"}):
+            stream = media.BoletoStream({}, iter([b"%PDF-1.4", b"12345"]))
+            with self.assertRaises(media.BoletoError):
+                list(stream)
+
+    def test_replay_resends_spooled_bytes_and_continues_source(self):
+        stream = media.BoletoStream({}, iter([b"%PDF", b"-1", b".4"]), spool=True)
+        iterator = iter(stream)
+        self.assertEqual(next(iterator), b"%PDF")
+        self.assertEqual(next(iterator), b"-1")
+
+        self.assertEqual(b"".join(stream.replay()), b"%PDF-1.4")
+        stream.close()
+
+    def test_multipart_body_is_well_formed(self):
+        content_type, body = media.iter_multipart(
+            {"number": "5511999999999"}, "medias", "boleto.pdf", "application/pdf", [b"%PDF", b"-1.4"]
+        )
+
+        message = BytesParser(policy=HTTP).parsebytes(
+            f"Content-Type: {content_type}\r\n\r\n".encode() + b"".join(body)
+        )
+        parts = list(message.iter_parts())
+
+        self.assertEqual(parts[0].get_param("name", header="content-disposition"), "number")
+        self.assertEqual(parts[0].get_content().strip(), "5511999999999")
+        self.assertEqual(parts[1].get_filename(), "boleto.pdf")
+        self.assertEqual(parts[1].get_content(), b"%PDF-1.4")
+
+
+class TestBoletoStep(unittest.TestCase):
+    def setUp(self):
+        self.temp_dir = tempfile.TemporaryDirectory()
+        self.cache_patcher = mock.patch.object(
+            boleto_cache, "CACHE_DIR", Path(self.temp_dir.name) / "boleto_cache"
+        )
+        self.cache_patcher.start()
+
+    def tearDown(self):
+        self.cache_patcher.stop()
+        self.temp_dir.cleanup()
+
+    def _pdf_response(self):
+        response = mock.Mock()
+        response.ok = True
+        response.status_code = 200
+        response.headers = {"Content-Type": "application/pdf"}
+        response.iter_content.return_value = iter([b"%PDF-1.4", b"\n%%EOF"])
+        return response
+
+    def test_upload_retry_uses_spool_instead_of_downloading_again(self):
+        uploads = []
+
+        def fake_send_media(number, chunks, filename):
+            uploads.append(b"".join(chunks))
+            if len(uploads) == 1:
+                return {"status": "error", "status_code": 503, "response": "busy"}
+            return {"ok": True}
+
+        with mock.patch.object(
+            webhook.http_client, "request", return_value=self._pdf_response()
+        ) as request_mock, mock.patch.object(
+            webhook, "send_whats_media", side_effect=fake_send_media
+        ):
+            result = webhook._send_boleto_step("5511999999999", "https://example.com/b.pdf")
+
+        self.assertIsNone(result)
+        self.assertEqual(uploads, [b"%PDF-1.4\n%%EOF"] * 2)
+        request_mock.assert_called_once()
+
+    def test_invalid_pdf_aborts_step(self):
+        response = self._pdf_response()
+        response.headers = {"Content-Type": "text/html"}
+
+        with mock.patch.object(webhook.http_client, "request", return_value=response), mock.patch.object(
+            webhook, "send_whats_media"
+        ) as media_mock:
+            result = webhook._send_boleto_step("5511999999999", "https://example.com/b.pdf")
+
+        media_mock.assert_not_called()
+        self.assertEqual(result, {"status": "error", "reason": "boleto_invalid_content"})
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,136 @@
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import unittest
+from concurrent.futures import Future
+from pathlib import Path
+from unittest import mock
+
+from app import create_app
+from app.wbuy import metrics
+
+
+class TestMetrics(unittest.TestCase):
+    def setUp(self):
+        self.temp_dir = tempfile.TemporaryDirectory()
+        self.env_patcher = mock.patch.dict(os.environ, {"WBUY_METRICS_DIR": self.temp_dir.name})
+        self.env_patcher.start()
+        metrics.reset()
+
+    def tearDown(self):
+        metrics.reset()
+        self.env_patcher.stop()
+        self.temp_dir.cleanup()
+
+    def test_histogram_renders_cumulative_buckets(self):
+        metrics.observe("wbuy_webhook_seconds", 0.003)
+        metrics.observe("wbuy_webhook_seconds", 0.2)
+        metrics.observe("wbuy_webhook_seconds", 60)
+
+        text = metrics.render()
+
+        self.assertIn('wbuy_webhook_seconds_bucket{le="0.005"} 1', text)
+        self.assertIn('wbuy_webhook_seconds_bucket{le="0.25"} 2', text)
+        self.assertIn('wbuy_webhook_seconds_bucket{le="30"} 2', text)
+        self.assertIn('wbuy_webhook_seconds_bucket{le="+Inf"} 3', text)
+        self.assertIn("wbuy_webhook_seconds_count 3", text)
+        self.assertIn("# TYPE wbuy_webhook_seconds histogram", text)
+
+    def test_collect_sums_files_from_other_workers(self):
+        metrics.inc("wbuy_outcomes_total", stage="webhook", status="queued", reason="")
+        metrics.observe("wbuy_queue_wait_seconds", 0.02)
+        labels = [["reason", ""], ["stage", "webhook"], ["status", "queued"]]
+        other = {
+            "counters": [["wbuy_outcomes_total", labels, 2.0]],
+            "histograms": [
+                ["wbuy_queue_wait_seconds", [], [0, 1] + [0] * 11, 0.04, 1]
+            ],
+        }
+        Path(self.temp_dir.name, f"{os.getppid()}.json").write_text(json.dumps(other))
+
+        text = metrics.render()
+
+        self.assertIn(
+            'wbuy_outcomes_total{reason="",stage="webhook",status="queued"} 3', text
+        )
+        self.assertIn('wbuy_queue_wait_seconds_bucket{le="0.05"} 2', text)
+        self.assertIn("wbuy_queue_wait_seconds_count 2", text)
+
+    def test_collect_keeps_totals_of_dead_processes(self):
+        dead = subprocess.Popen([sys.executable, "-c", "pass"])
+        dead.wait()
+        labels = [["reason", ""], ["stage", "webhook"], ["status", "queued"]]
+        stale = Path(self.temp_dir.name, f"{dead.pid}.json")
+        snapshot = {
+            "counters": [["wbuy_outcomes_total", labels, 5.0]],
+            "histograms": [["wbuy_queue_wait_seconds", [], [0, 1] + [0] * 11, 0.04, 1]],
+        }
+        stale.write_text(json.dumps(snapshot))
+
+        first = metrics.render()
+        stale.write_text(json.dumps(snapshot))
+        second = metrics.render()
+
+        self.assertFalse(stale.exists())
+        self.assertTrue(Path(self.temp_dir.name, metrics.RETIRED_FILE).exists())
+        self.assertIn('wbuy_outcomes_total{reason="",stage="webhook",status="queued"} 5', first)
+        self.assertIn("wbuy_queue_wait_seconds_count 1", first)
+        # Um segundo processo morto com o mesmo PID soma, não substitui.
+        self.assertIn('wbuy_outcomes_total{reason="",stage="webhook",status="queued"} 10', second)
+        self.assertIn("wbuy_queue_wait_seconds_count 2", second)
+
+    def test_reused_pid_does_not_overwrite_dead_snapshot(self):
+        labels = [["reason", ""], ["stage", "webhook"], ["status", "queued"]]
+        Path(self.temp_dir.name, f"{os.getpid()}.json").write_text(
+            json.dumps({"counters": [["wbuy_outcomes_total", labels, 4.0]]})
+        )
+        metrics.inc("wbuy_outcomes_total", stage="webhook", status="queued", reason="")
+
+        text = metrics.render()
+
+        self.assertIn('wbuy_outcomes_total{reason="",stage="webhook",status="queued"} 5', text)
+
+    def test_counts_outcome_handles_futures_and_exceptions(self):
+        future: Future = Future()
+
+        @metrics.counts_outcome("teste")
+        def returns_future():
+            return future
+
+        @metrics.counts_outcome("teste")
+        def raises():
+            raise RuntimeError("boom")
+
+        returns_future()
+        with self.assertRaises(RuntimeError):
+            raises()
+        future.set_result({"status": "skipped", "reason": "missing_phone"})
+
+        text = metrics.render()
+        self.assertIn('stage="teste",status="skipped"} 1', text)
+        self.assertIn('reason="missing_phone"', text)
+        self.assertIn('stage="teste",status="exception"} 1', text)
+
+    def test_metrics_route_serves_prometheus_text(self):
+        temp_dir = Path(self.temp_dir.name)
+        with mock.patch.object(metrics, "METRICS_DIR", temp_dir), mock.patch(
+            "app.wbuy.jobs.QUEUE_DB", temp_dir / "queue.db"
+        ), mock.patch("app.wbuy.delivery_log.DELIVERY_DB", temp_dir / "delivery.db"), mock.patch(
+            "app.wbuy.storage.WEBHOOK_DIR", temp_dir / "webhooks"
+        ):
+            client = create_app().test_client()
+            client.post("/wbuy/webhook", data=b"{")
+            response = client.get("/wbuy/metrics")
+
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response.content_type.startswith("text/plain"))
+        text = response.get_data(as_text=True)
+        self.assertIn('reason="invalid_payload",stage="webhook",status="rejected"} 1', text)
+        self.assertIn("wbuy_webhook_seconds_count 1", text)
+        self.assertIn('wbuy_queue_jobs{status="pending"} 0', text)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,64 @@
+import unittest
+
+from app.wbuy import models
+
+
+class TestOrderModel(unittest.TestCase):
+    def _payload(self, **pagamento):
+        return {
+            "data": {
+                "id": 10490102,
+                "cliente": {"nome": "  Osmar TESTE ", "telefone1": "(16)99624-6673"},
+                "valor_total": {"total": 249.9},
+                "produtos": [{"produto": "Banco", "qtd": 1}],
+                "pagamento": pagamento or {"linha_digitavel": "PIXCODE", "tipo_interno": "pix"},
+            }
+        }
+
+    def test_builds_order_from_payload(self):
+        order = models.Order.from_payload(self._payload())
+
+        self.assertEqual(order.id, "10490102")
+        self.assertEqual(order.first_name, "Osmar")
+        self.assertEqual(order.total, "249.9")
+        self.assertEqual([(item.name, item.quantity) for item in order.items], [("Banco", "1")])
+        self.assertEqual(order.payment.kind, "pix")
+        self.assertEqual(order.payment.code, "PIXCODE")
+        self.assertFalse(hasattr(order, "__dict__"))
+
+    def test_missing_field_reports_its_path(self):
+        payload = self._payload()
+        del payload["data"]["cliente"]["nome"]
+
+        with self.assertRaises(models.PayloadError) as ctx:
+            models.Order.from_payload(payload)
+
+        self.assertEqual(ctx.exception.field, "data.cliente.nome")
+
+    def test_boleto_requires_payment_link(self):
+        with self.assertRaises(models.PayloadError) as ctx:
+            models.Order.from_payload(
+                self._payload(linha_digitavel="123", tipo_interno="bank_billet")
+            )
+
+        self.assertEqual(ctx.exception.field, "data.pagamento.paymentLink")
+
+    def test_parse_rejects_invalid_json(self):
+        with self.assertRaises(models.PayloadError) as ctx:
+            models.parse(b"{nao e json")
+
+        self.assertEqual(ctx.exception.field, "body")
+
+    def test_parse_reads_raw_bytes(self):
+        order = models.parse(
+            b'{"data": {"id": "1", "cliente": {"nome": "Ana"}, "valor_total": {"total": "5"}, '
+            b'"pagamento": {"tipo_interno": "credit_card"}}}'
+        )
+
+        self.assertEqual(order.phone, "")
+        self.assertEqual(order.items, ())
+        self.assertEqual(order.payment.kind, "credit_card")
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,90 @@
+import unittest
+from unittest import mock
+
+from app.wbuy import phones, storage, webhook
+from tests import isolated_storage
+
+
+class TestPhones(unittest.TestCase):
+    def setUp(self):
+        self.enterContext(isolated_storage())
+
+    def test_check_normalizes_brazilian_mobiles(self):
+        cases = {
+            "(16)99624-6673": "5516996246673",
+            "+55 (16) 99624-6673": "5516996246673",
+            "0 15 16 99624-6673": "5516996246673",
+            # Celular antigo, sem o nono dígito.
+            "(11)8888-7777": "5511988887777",
+            "+1 415 555 2671": "14155552671",
+        }
+        for raw, expected in cases.items():
+            self.assertEqual(phones.check(raw), phones.PhoneCheck(expected), raw)
+
+    def test_check_rejects_invalid_numbers(self):
+        cases = {
+            "": "missing",
+            "(16)3333-4444": "landline",
+            "(20)99999-8888": "invalid_ddd",
+            "99624-6673": "invalid_length",
+            "551699624667312": "invalid_length",
+        }
+        for raw, reason in cases.items():
+            self.assertEqual(phones.check(raw), phones.PhoneCheck("", reason), raw)
+
+    def test_test_number_prefers_whatsapp_env_then_number_test_then_legacy(self):
+        env = {"WHATSAPP_TEST_NUMBER": "5522222222222", "NUMBER_TEST": "5511111111111"}
+        with mock.patch.dict("os.environ", {**env, "NUMBER_TESTE": "5533333333333"}):
+            self.assertEqual(phones.test_number(), "5522222222222")
+            with mock.patch.dict("os.environ", {"WHATSAPP_TEST_NUMBER": ""}):
+                self.assertEqual(phones.test_number(), "5511111111111")
+                with mock.patch.dict("os.environ", {"NUMBER_TEST": ""}):
+                    self.assertEqual(phones.test_number(), "5533333333333")
+
+    def test_no_whatsapp_cache_only_records_confirmed_numbers(self):
+        self.assertFalse(phones.record_send_failure("5516996246673", 503, "ERR_WAPP_INVALID_CONTACT"))
+        self.assertFalse(phones.record_send_failure("5516996246673", 400, "ERR_SESSION_EXPIRED"))
+        self.assertFalse(phones.has_no_whatsapp("5516996246673"))
+
+        self.assertTrue(
+            phones.record_send_failure(
+                "5516996246673", 400, '{"error": "ERR_WAPP_INVALID_CONTACT"}'
+            )
+        )
+        self.assertTrue(phones.has_no_whatsapp("5516996246673"))
+
+        with mock.patch.dict("os.environ", {"WBUY_NO_WHATSAPP_TTL": "0"}):
+            self.assertFalse(phones.has_no_whatsapp("5516996246673"))
+
+        phones.forget("5516996246673")
+        self.assertFalse(phones.has_no_whatsapp("5516996246673"))
+
+    def test_process_webhook_skips_invalid_and_no_whatsapp_numbers(self):
+        payload = {
+            "data": {
+                "id": "4242",
+                "cliente": {"nome": "Cliente", "telefone1": "(16)3333-4444"},
+                "valor_total": {"total": "10.0"},
+                "pagamento": {"linha_digitavel": "PIXCODE", "tipo_interno": "pix"},
+            }
+        }
+
+        with mock.patch.dict(
+            "os.environ", {"WHATSAPP_TEST_NUMBER": "", "NUMBER_TEST": "", "NUMBER_TESTE": ""}
+        ), mock.patch.object(webhook, "send_whats_message") as send_mock:
+            result = webhook.process_webhook(payload)
+            self.assertEqual(
+                result, {"status": "skipped", "reason": "invalid_phone", "detail": "landline"}
+            )
+
+            phones.record_send_failure("5511988887777", 400, "ERR_WAPP_INVALID_CONTACT")
+            payload["data"]["cliente"]["telefone1"] = "(11)98888-7777"
+            result = webhook.process_webhook(payload)
+            self.assertEqual(result, {"status": "skipped", "reason": "no_whatsapp"})
+
+            send_mock.assert_not_called()
+            self.assertFalse(storage.is_order_processed("4242"))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,168 @@
+import json
+import threading
+import time
+import unittest
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from unittest import mock
+from urllib.parse import parse_qs, urlparse
+
+from app.wbuy import jobs, polling, storage
+from tests import isolated_storage
+
+
+def _order(order_id):
+    return {
+        "id": str(order_id),
+        "cliente": {"nome": f"Cliente {order_id}", "telefone1": "(11)98888-7777"},
+        "valor_total": {"total": "10.0"},
+        "produtos": [],
+        "pagamento": {"linha_digitavel": "PIXCODE", "tipo_interno": "pix"},
+    }
+
+
+class _WBuyStub(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    orders = []
+    failing = set()
+    detail_calls = []
+    active = 0
+    peak = 0
+    lock = threading.Lock()
+
+    def _reply(self, status, data):
+        body = json.dumps(data).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        if url.path == "/api/v1/order":
+            query = parse_qs(url.query)
+            page, limit = int(query["page"][0]), int(query["limit"][0])
+            ids = sorted(self.orders, reverse=True)[(page - 1) * limit : page * limit]
+            self._reply(200, {"data": [{"id": str(order_id)} for order_id in ids]})
+            return
+
+        order_id = int(url.path.rsplit("/", 1)[1])
+        with self.lock:
+            type(self).detail_calls.append(order_id)
+            type(self).active += 1
+            type(self).peak = max(type(self).peak, type(self).active)
+        time.sleep(0.05)
+        with self.lock:
+            type(self).active -= 1
+
+        if order_id in self.failing:
+            self._reply(500, {"error": "boom"})
+        else:
+            self._reply(200, {"data": [_order(order_id)]})
+
+    def log_message(self, format, *args):
+        pass
+
+
+class TestReconciler(unittest.TestCase):
+    def setUp(self):
+        _WBuyStub.orders = list(range(101, 113))
+        _WBuyStub.failing = set()
+        _WBuyStub.detail_calls = []
+        _WBuyStub.peak = 0
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), _WBuyStub)
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+        self.enterContext(isolated_storage())
+        self.enterContext(
+            mock.patch.dict(
+                "os.environ",
+                {
+                    "WBUY_API_URL": f"http://127.0.0.1:{self.server.server_address[1]}/api/v1",
+                    "WBUY_POLL_PAGE_SIZE": "5",
+                    "WBUY_POLL_CONCURRENCY": "3",
+                    "WHATICKET_MAX_RETRIES": "0",
+                },
+            )
+        )
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def _queued_ids(self):
+        ids = []
+        while True:
+            job = jobs.claim_next()
+            if job is None:
+                return sorted(ids)
+            ids.append(job.payload["data"]["id"])
+            jobs.complete(job)
+
+    def test_queues_only_orders_missing_from_processed_store(self):
+        storage.claim_order("105")
+        storage.claim_order("110")
+
+        result = polling.reconcile()
+
+        self.assertEqual(result["pages"], 3)
+        self.assertEqual(result["queued"], 10)
+        self.assertNotIn(105, _WBuyStub.detail_calls)
+        self.assertEqual(
+            self._queued_ids(), [str(n) for n in range(101, 113) if n not in (105, 110)]
+        )
+        self.assertEqual(polling.get_cursor(), 112)
+        self.assertLessEqual(_WBuyStub.peak, 3)
+        self.assertGreater(_WBuyStub.peak, 1)
+
+    def test_cursor_limits_next_run_to_new_orders(self):
+        polling.reconcile()
+        self._queued_ids()
+        _WBuyStub.orders.extend([113, 114])
+        _WBuyStub.detail_calls = []
+
+        result = polling.reconcile()
+
+        self.assertEqual(result["pages"], 1)
+        self.assertEqual(sorted(_WBuyStub.detail_calls), [113, 114])
+        self.assertEqual(self._queued_ids(), ["113", "114"])
+
+    def test_failed_detail_keeps_cursor_before_it(self):
+        _WBuyStub.failing = {108}
+
+        result = polling.reconcile()
+
+        self.assertEqual(result["errors"], 1)
+        self.assertEqual(polling.get_cursor(), 107)
+
+    def test_page_budget_resumes_next_run_without_skipping_older_orders(self):
+        # 3 páginas de 5 por rodada não cobrem os 20 pedidos pendentes.
+        _WBuyStub.orders = list(range(101, 121))
+
+        with mock.patch.dict("os.environ", {"WBUY_POLL_MAX_PAGES": "3"}):
+            first = polling.reconcile()
+            self.assertEqual((first["queued"], first["pages"]), (15, 3))
+            self.assertEqual(polling.get_cursor(), 0)
+
+            # Pedidos pagos saem da lista e puxam os mais antigos uma página acima.
+            _WBuyStub.orders.remove(118)
+            _WBuyStub.orders.remove(112)
+            second = polling.reconcile()
+            self.assertEqual(second["queued"], 5)
+            self.assertEqual(polling.get_cursor(), 120)
+
+            _WBuyStub.orders.append(121)
+            third = polling.reconcile()
+
+        self.assertEqual(third["queued"], 1)
+        self.assertEqual(polling.get_cursor(), 121)
+        self.assertEqual(self._queued_ids(), sorted(str(n) for n in range(101, 122)))
+
+    def test_lease_allows_one_run_per_interval(self):
+        with mock.patch.dict("os.environ", {"WBUY_POLL_INTERVAL": "60"}):
+            self.assertIsNotNone(polling.run_once())
+            self.assertIsNone(polling.run_once())
+
+
+if __name__ == "__main__":
+    unittest.main()
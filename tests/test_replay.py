@@ -0,0 +1,100 @@
+import io
+import json
+import time
+import unittest
+from concurrent.futures import Future
+from contextlib import redirect_stdout
+from unittest import mock
+
+from app.wbuy import archive, replay, storage, webhook
+from tests import isolated_storage
+
+
+def _payload(order_id, phone="(11)98888-7777"):
+    return {
+        "data": {
+            "id": order_id,
+            "cliente": {"nome": "Cliente Replay", "telefone1": phone},
+            "valor_total": {"total": "10.0"},
+            "pagamento": {"linha_digitavel": "PIXCODE", "tipo_interno": "pix"},
+        }
+    }
+
+
+class TestReplay(unittest.TestCase):
+    def setUp(self):
+        self.enterContext(isolated_storage())
+        self.webhook_dir = storage.WEBHOOK_DIR
+
+        archive.append(json.dumps(_payload("1", "(11)90000-0001")).encode(), "1")
+        archive.append(b"nao e json", None)
+        archive.append(json.dumps(_payload("2")).encode(), "2")
+        archive.append(json.dumps(_payload("1", "(11)90000-0002")).encode(), "1")
+        # Formato antigo: raw_<UTC>.txt.
+        (self.webhook_dir / "raw_20240102030405000000.txt").write_text(
+            json.dumps(_payload("3"))
+        )
+
+    def test_collect_keeps_latest_webhook_per_order_across_processes(self):
+        units = replay.discover(self.webhook_dir)
+        self.assertEqual([unit.kind for unit in units], ["segment", "legacy"])
+
+        for processes in (1, 2):
+            candidates, invalid = replay.collect(units, None, None, processes)
+            self.assertEqual(invalid, 1)
+            self.assertEqual([candidate.order_id for candidate in candidates], ["3", "2", "1"])
+            self.assertEqual(
+                candidates[-1].payload["data"]["cliente"]["telefone1"], "(11)90000-0002"
+            )
+
+        candidates, _ = replay.collect(units, time.time() - 3600, None, 1)
+        self.assertEqual(sorted(candidate.order_id for candidate in candidates), ["1", "2"])
+
+    def test_plan_skips_processed_and_already_replayed_orders(self):
+        candidates, _ = replay.collect(replay.discover(self.webhook_dir), None, None, 1)
+        storage.mark_order_processed("2")
+        replay._record("rodada", "3", "ok")
+
+        actions, skipped = replay.plan(candidates, "rodada", revive_dead=False)
+
+        self.assertEqual([(action, c.order_id) for action, c in actions], [("process", "1")])
+        self.assertEqual(skipped, {"already_replayed": 1, "already_processed": 1})
+
+    def test_run_actions_records_results_for_resume(self):
+        candidates, _ = replay.collect(replay.discover(self.webhook_dir), None, None, 1)
+        actions = [("process", candidate) for candidate in candidates]
+        pending = Future()
+        results = {
+            "3": {"status": "skipped", "reason": "invalid_phone"},
+            "2": pending,
+            "1": {"status": "queued"},
+        }
+        pending.set_result({"status": "ok"})
+
+        def process(payload, wait):
+            return results[payload["data"]["id"]]
+
+        progress = replay.Progress(3, io.StringIO())
+        with mock.patch.object(webhook, "process_webhook", side_effect=process) as process_mock:
+            counts = replay.run_actions(actions, "rodada", rate=0, concurrency=2, progress=progress)
+
+        self.assertEqual(process_mock.call_count, 3)
+        self.assertEqual(counts, {"skipped:invalid_phone": 1, "ok": 1, "queued": 1})
+        self.assertEqual(
+            replay.replayed("rodada"), {"3": "skipped:invalid_phone", "2": "ok", "1": "queued"}
+        )
+
+    def test_dry_run_lists_actions_without_sending(self):
+        output = io.StringIO()
+        with mock.patch.object(webhook, "process_webhook") as process_mock, redirect_stdout(output):
+            code = replay.main(["--dry-run", "--processes", "1"])
+
+        self.assertEqual(code, 0)
+        process_mock.assert_not_called()
+        lines = output.getvalue().splitlines()
+        self.assertIn("a reprocessar: 3", lines[0])
+        self.assertEqual([line.split()[1] for line in lines[1:]], ["3", "2", "1"])
+
+
+if __name__ == "__main__":
+    unittest.main()
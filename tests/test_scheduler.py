@@ -0,0 +1,154 @@
+import tempfile
+import threading
+import time
+import unittest
+from pathlib import Path
+from unittest import mock
+
+from app.wbuy import scheduler as scheduler_module
+from app.wbuy.scheduler import Delay, Scheduler, SharedTokenBucket, TokenBucket
+
+
+class TestScheduler(unittest.TestCase):
+    def _recorder(self, events, lock):
+        def record(label):
+            def step():
+                with lock:
+                    events.append((label, time.monotonic()))
+
+            return step
+
+        return record
+
+    def test_keeps_order_and_gap_per_phone_but_interleaves_phones(self):
+        events = []
+        record = self._recorder(events, threading.Lock())
+        scheduler = Scheduler(gap=0.1, rate=0, threads=4)
+
+        first = scheduler.submit("A", [record("a1"), record("a2"), record("a3")])
+        second = scheduler.submit("B", [record("b1"), record("b2")])
+        first.result(timeout=5)
+        second.result(timeout=5)
+
+        labels = [label for label, _ in events]
+        self.assertEqual([label for label in labels if label.startswith("a")], ["a1", "a2", "a3"])
+        self.assertLess(labels.index("b1"), labels.index("a2"))
+
+        times = dict(events)
+        self.assertGreaterEqual(times["a2"] - times["a1"], 0.09)
+        self.assertGreaterEqual(times["a3"] - times["a2"], 0.09)
+
+    def test_delay_step_postpones_next_step(self):
+        events = []
+        record = self._recorder(events, threading.Lock())
+        scheduler = Scheduler(gap=0.0, rate=0, threads=2)
+
+        result = scheduler.submit("A", [record("a1"), Delay(0.2), record("a2"), Delay(0.05)])
+
+        self.assertIsNone(result.result(timeout=5))
+        times = dict(events)
+        self.assertGreaterEqual(times["a2"] - times["a1"], 0.19)
+
+    def test_sequences_for_same_phone_do_not_overlap(self):
+        events = []
+        record = self._recorder(events, threading.Lock())
+        scheduler = Scheduler(gap=0.0, rate=0, threads=4)
+
+        first = scheduler.submit("A", [record("x1"), record("x2")])
+        second = scheduler.submit("A", [record("y1"), record("y2")])
+        second.result(timeout=5)
+        first.result(timeout=5)
+
+        self.assertEqual([label for label, _ in events], ["x1", "x2", "y1", "y2"])
+
+    def test_step_returning_dict_aborts_sequence(self):
+        calls = []
+        scheduler = Scheduler(gap=0.0, rate=0)
+
+        future = scheduler.submit(
+            "A",
+            [
+                lambda: calls.append(1),
+                lambda: {"status": "error", "reason": "boleto_download_failed"},
+                lambda: calls.append(3),
+            ],
+        )
+
+        self.assertEqual(future.result(timeout=5)["reason"], "boleto_download_failed")
+        self.assertEqual(calls, [1])
+
+    def test_step_exception_is_propagated(self):
+        scheduler = Scheduler(gap=0.0, rate=0)
+
+        def boom():
+            raise RuntimeError("falhou")
+
+        future = scheduler.submit("A", [boom])
+
+        with self.assertRaises(RuntimeError):
+            future.result(timeout=5)
+
+    def test_urgent_class_runs_while_slow_class_is_saturated(self):
+        started, release = threading.Event(), threading.Event()
+        events = []
+        record = self._recorder(events, threading.Lock())
+        scheduler = Scheduler(gap=0.0, rate=0, threads=1)
+
+        def slow_step():
+            started.set()
+            release.wait()
+
+        slow = [scheduler.submit(f"B{index}", [slow_step], "bank_billet") for index in range(3)]
+        self.assertTrue(started.wait(timeout=5))
+        urgent = scheduler.submit("P", [record("pix")], "pix")
+
+        self.assertIsNone(urgent.result(timeout=5))
+        self.assertEqual(scheduler.stats()["bank_billet"], {"ready": 2, "running": 1, "threads": 1})
+        release.set()
+        for future in slow:
+            future.result(timeout=5)
+
+    def test_tokens_go_to_the_most_urgent_ready_class(self):
+        events = []
+        record = self._recorder(events, threading.Lock())
+        scheduler = Scheduler(gap=0.0, rate=20.0, burst=1.0, threads=4)
+        scheduler.bucket.try_acquire()
+
+        with scheduler._cond:
+            futures = [
+                scheduler.submit(f"B{index}", [record("boleto")], "bank_billet") for index in range(3)
+            ]
+            futures.append(scheduler.submit("P", [record("pix")], "pix"))
+        for future in futures:
+            future.result(timeout=5)
+
+        self.assertEqual([label for label, _ in events][0], "pix")
+
+    def test_token_bucket_limits_rate(self):
+        bucket = TokenBucket(rate=2.0, capacity=2.0)
+        now = time.monotonic()
+
+        self.assertEqual(bucket.try_acquire(now), 0.0)
+        self.assertEqual(bucket.try_acquire(now), 0.0)
+        self.assertAlmostEqual(bucket.try_acquire(now), 0.5, places=3)
+        self.assertEqual(bucket.try_acquire(now + 0.5), 0.0)
+
+    def test_shared_bucket_limits_all_processes_together(self):
+        with tempfile.TemporaryDirectory() as directory, mock.patch.object(
+            scheduler_module, "RATE_DB", Path(directory) / "ratelimit.db"
+        ):
+            # Dois workers: instâncias separadas, sem estado em memória em comum.
+            first = SharedTokenBucket("whaticket", rate=2.0, capacity=2.0)
+            second = SharedTokenBucket("whaticket", rate=2.0, capacity=2.0)
+            other = SharedTokenBucket("whaticket:loja2", rate=2.0, capacity=2.0)
+            now = time.time()
+
+            self.assertEqual(first.try_acquire(now), 0.0)
+            self.assertEqual(second.try_acquire(now), 0.0)
+            self.assertAlmostEqual(first.try_acquire(now), 0.5, places=3)
+            self.assertEqual(second.try_acquire(now + 0.5), 0.0)
+            self.assertEqual(other.try_acquire(now), 0.0)
+
+
+if __name__ == "__main__":
+    unittest.main()
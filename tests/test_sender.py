@@ -0,0 +1,207 @@
+import asyncio
+import json
+import time
+import unittest
+from unittest import mock
+
+import httpx
+
+from app.wbuy import sender, webhook
+from tests import isolated_storage
+
+
+class TestDeliveryEngine(unittest.TestCase):
+    def setUp(self):
+        self.requests = []
+        self.downloads = 0
+        self.enterContext(isolated_storage())
+
+        async def handler(request):
+            if request.method == "GET":
+                if "missing" in str(request.url):
+                    return httpx.Response(404, text="not found")
+                self.downloads += 1
+                return httpx.Response(200, content=b"%PDF-1.4")
+
+            await asyncio.sleep(0.05)
+            if request.headers["content-type"].startswith("application/json"):
+                self.requests.append(json.loads(request.content)["body"])
+            else:
+                self.requests.append("media")
+            return httpx.Response(200, json={"ok": True})
+
+        self.engine = sender.DeliveryEngine(
+            "http://whaticket.local/api/messages/send",
+            "TOKEN",
+            gap=0,
+            rate=0,
+            transport=httpx.MockTransport(handler),
+        )
+
+    def tearDown(self):
+        self.engine.close()
+
+    def test_run_sequence_sends_steps_in_order(self):
+        steps = [
+            {"kind": "text", "body": "m1", "label": "mensagem 1"},
+            {"kind": "text", "body": "m2", "label": "mensagem 2"},
+            {"kind": "boleto", "url": "http://wbuy.local/boleto.pdf"},
+            {"kind": "text", "body": "fim", "label": "mensagem final"},
+        ]
+
+        result = self.engine.submit_sequence("5511988887777", steps).result(timeout=5)
+
+        self.assertIsNone(result)
+        self.assertEqual(self.requests, ["m1", "m2", "media", "fim"])
+
+        self.engine.submit_sequence("5511988887777", steps[2:3]).result(timeout=5)
+        self.assertEqual(self.downloads, 1)
+        self.assertEqual(self.requests[-1], "media")
+
+    def test_boleto_download_failure_aborts_sequence(self):
+        steps = [
+            {"kind": "boleto", "url": "http://wbuy.local/missing.pdf"},
+            {"kind": "text", "body": "fim", "label": "mensagem final"},
+        ]
+
+        result = self.engine.submit_sequence("5511988887777", steps).result(timeout=5)
+
+        self.assertEqual(result["reason"], "boleto_download_failed")
+        self.assertEqual(self.requests, [])
+
+    def test_many_orders_run_concurrently_on_one_loop(self):
+        steps = [{"kind": "text", "body": "m", "label": "mensagem"}] * 3
+        started = time.monotonic()
+
+        futures = [
+            self.engine.submit_sequence(f"55119{index:08d}", steps) for index in range(200)
+        ]
+        for future in futures:
+            future.result(timeout=10)
+
+        self.assertEqual(len(self.requests), 600)
+        # 600 envios de 50 ms em série levariam 30 s.
+        self.assertLess(time.monotonic() - started, 5)
+
+    def test_same_phone_keeps_gap_between_messages(self):
+        self.engine._gap = 0.1
+        steps = [{"kind": "text", "body": "m", "label": "mensagem"}] * 2
+        started = time.monotonic()
+
+        first = self.engine.submit_sequence("5511988887777", steps)
+        second = self.engine.submit_sequence("5511988887777", steps)
+        first.result(timeout=5)
+        second.result(timeout=5)
+
+        self.assertGreaterEqual(time.monotonic() - started, 0.3)
+
+    def test_send_whatsapp_message_does_not_repoint_shared_engine(self):
+        seen = []
+
+        async def handler(request):
+            seen.append((str(request.url), request.headers["authorization"]))
+            return httpx.Response(200, json={"ok": True})
+
+        self.engine.client = httpx.AsyncClient(transport=httpx.MockTransport(handler))
+
+        with sender.settings.override(
+            whaticket_api_url="http://legado.local/send", whaticket_token="LEGADO"
+        ), mock.patch.dict(
+            "os.environ", {"WHATSAPP_TEST_NUMBER": "", "NUMBER_TEST": "", "NUMBER_TESTE": ""}
+        ), mock.patch.object(
+            sender, "get_engine", return_value=self.engine
+        ):
+            result = sender.send_whatsapp_message("5511988887777", "oi")
+
+        self.assertEqual(result, {"ok": True})
+        self.assertEqual(seen, [("http://legado.local/send", "Bearer LEGADO")])
+        self.assertEqual(self.engine.api_url, "http://whaticket.local/api/messages/send")
+        self.assertEqual(self.engine.token, "TOKEN")
+
+    def test_send_whatsapp_message_honors_every_test_number_variable(self):
+        seen = []
+
+        async def handler(request):
+            seen.append(json.loads(request.content)["number"])
+            return httpx.Response(200, json={"ok": True})
+
+        self.engine.client = httpx.AsyncClient(transport=httpx.MockTransport(handler))
+
+        with sender.settings.override(whaticket_token="TOKEN"), mock.patch.dict(
+            "os.environ",
+            {"WHATSAPP_TEST_NUMBER": "", "NUMBER_TEST": "5511977776666", "NUMBER_TESTE": ""},
+        ), mock.patch.object(sender, "get_engine", return_value=self.engine):
+            sender.send_whatsapp_message("5511988887777", "oi")
+
+        self.assertEqual(seen, ["5511977776666"])
+
+    def test_boleto_upload_retry_replays_spool_without_new_download(self):
+        uploads = []
+
+        async def handler(request):
+            if request.method == "GET":
+                self.downloads += 1
+                return httpx.Response(
+                    200,
+                    headers={"Content-Type": "application/pdf"},
+                    stream=httpx.ByteStream(b"%PDF-1.4\n%%EOF"),
+                )
+            body = await request.aread()
+            uploads.append(b"%PDF-1.4\n%%EOF" in body)
+            if len(uploads) == 1:
+                return httpx.Response(503, text="busy")
+            return httpx.Response(200, json={"ok": True})
+
+        self.engine.client = httpx.AsyncClient(transport=httpx.MockTransport(handler))
+        step = {"kind": "boleto", "url": "http://wbuy.local/retry.pdf"}
+
+        with mock.patch.dict("os.environ", {"WBUY_BOLETO_CACHE": "0"}):
+            result = self.engine.submit_sequence("5511988887777", [step]).result(timeout=5)
+
+        self.assertIsNone(result)
+        self.assertEqual(uploads, [True, True])
+        self.assertEqual(self.downloads, 1)
+
+    def test_boleto_upload_is_not_retried_without_spool(self):
+        async def handler(request):
+            if request.method == "GET":
+                self.downloads += 1
+                return httpx.Response(200, content=b"%PDF-1.4")
+            self.requests.append("media")
+            return httpx.Response(503, text="busy")
+
+        self.engine.client = httpx.AsyncClient(transport=httpx.MockTransport(handler))
+        step = {"kind": "boleto", "url": "http://wbuy.local/nospool.pdf"}
+
+        with mock.patch.dict(
+            "os.environ", {"WBUY_BOLETO_CACHE": "0", "WHATICKET_MEDIA_SPOOL": "0"}
+        ):
+            result = self.engine.submit_sequence("5511988887777", [step]).result(timeout=5)
+
+        self.assertEqual(result["status_code"], 503)
+        self.assertEqual(self.requests, ["media"])
+
+    def test_process_webhook_uses_engine_when_enabled(self):
+        payload = {
+            "data": {
+                "id": "777",
+                "cliente": {"nome": "Cliente Async", "telefone1": "(11)98888-7777"},
+                "valor_total": {"total": "10.0"},
+                "produtos": [],
+                "pagamento": {"linha_digitavel": "PIXCODE", "tipo_interno": "pix"},
+            }
+        }
+
+        with mock.patch.dict(
+            "os.environ",
+            {"WHATICKET_ENGINE": "async", "WHATSAPP_TEST_NUMBER": "", "NUMBER_TEST": ""},
+        ), mock.patch.object(sender, "get_engine", return_value=self.engine):
+            result = webhook.process_webhook(payload)
+
+        self.assertEqual(result, {"status": "ok"})
+        closing = webhook.templates.get("pix").render(webhook.Order.from_payload(payload))[-1]
+        self.assertEqual(self.requests[1:], ["PIXCODE", closing["body"]])
+
+
+if __name__ == "__main__":
+    unittest.main()
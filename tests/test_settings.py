@@ -0,0 +1,52 @@
+import subprocess
+import sys
+import unittest
+from unittest import mock
+
+from app.wbuy import settings
+
+
+class TestSettings(unittest.TestCase):
+    def test_reload_rereads_environment_and_runs_hooks(self):
+        seen = []
+        hook = settings.on_reload(seen.append)
+        try:
+            with mock.patch.dict(
+                "os.environ",
+                {"TOKEN_DO_ENV": "", "WHATICKET_TOKEN": "primeiro", "TOKEN_WHATS": "velho"},
+            ):
+                self.assertEqual(settings.reload(dotenv=False).whaticket_token, "primeiro")
+                with mock.patch.dict("os.environ", {"WHATICKET_TOKEN": "segundo"}):
+                    current = settings.reload(dotenv=False)
+        finally:
+            settings._hooks.remove(hook)
+            settings.reload(dotenv=False)
+
+        self.assertEqual(current.whaticket_token, "segundo")
+        self.assertIs(settings.get(), settings._current)
+        self.assertEqual([config.whaticket_token for config in seen], ["primeiro", "segundo"])
+
+    def test_override_is_temporary(self):
+        before = settings.get()
+        with settings.override(whaticket_token="TOKEN") as config:
+            self.assertEqual(settings.get().whaticket_token, "TOKEN")
+            self.assertEqual(config.whaticket_api_url, before.whaticket_api_url)
+        self.assertIs(settings.get(), before)
+
+    def test_importing_app_does_not_create_flask_app(self):
+        code = (
+            "import sys, app\n"
+            "assert 'flask' not in sys.modules, 'flask'\n"
+            "assert 'requests' not in sys.modules, 'requests'\n"
+            "assert 'httpx' not in sys.modules, 'httpx'\n"
+            "import app.wbuy.webhook\n"
+            "assert 'requests' not in sys.modules, 'webhook'\n"
+            "assert app.app is app.app\n"
+            "assert 'flask' in sys.modules\n"
+        )
+        result = subprocess.run([sys.executable, "-c", code], capture_output=True, text=True)
+        self.assertEqual(result.returncode, 0, result.stderr)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,59 @@
+import multiprocessing
+import tempfile
+import time
+import unittest
+from pathlib import Path
+from unittest import mock
+
+from app.wbuy import singleflight
+
+
+def _acquire_in_child(db_path, key, results):
+    with mock.patch.object(singleflight, "SINGLEFLIGHT_DB", Path(db_path)):
+        results.put(singleflight.acquire(key))
+
+
+class TestSingleflight(unittest.TestCase):
+    def setUp(self):
+        self.temp_dir = tempfile.TemporaryDirectory()
+        self.db_path = Path(self.temp_dir.name) / "singleflight.db"
+        self.db_patcher = mock.patch.object(singleflight, "SINGLEFLIGHT_DB", self.db_path)
+        self.db_patcher.start()
+
+    def tearDown(self):
+        self.db_patcher.stop()
+        self.temp_dir.cleanup()
+
+    def test_duplicate_is_resolved_in_memory(self):
+        self.assertTrue(singleflight.acquire("10"))
+
+        with mock.patch.object(singleflight, "_conn") as conn_mock:
+            self.assertFalse(singleflight.acquire("10"))
+        conn_mock.assert_not_called()
+        self.assertTrue(singleflight.held("10"))
+
+    def test_other_process_sees_the_lease(self):
+        self.assertTrue(singleflight.acquire("11"))
+
+        results = multiprocessing.get_context("fork").Queue()
+        child = multiprocessing.get_context("fork").Process(
+            target=_acquire_in_child, args=(str(self.db_path), "11", results)
+        )
+        child.start()
+        child.join(10)
+
+        self.assertFalse(results.get(timeout=5))
+
+    def test_expired_lease_is_taken_over_and_release_frees_key(self):
+        self.assertTrue(singleflight.acquire("12", ttl=0.05))
+        time.sleep(0.1)
+        self.assertTrue(singleflight.acquire("12"))
+
+        singleflight.release("12")
+
+        self.assertFalse(singleflight.held("12"))
+        self.assertTrue(singleflight.acquire("12"))
+
+
+if __name__ == "__main__":
+    unittest.main()
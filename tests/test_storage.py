@@ -0,0 +1,130 @@
+import sqlite3
+import time
+import unittest
+from unittest import mock
+
+from app.wbuy import processed_cache, storage
+from tests import isolated_storage
+
+
+class TestProcessedOrders(unittest.TestCase):
+    def setUp(self):
+        self.enterContext(isolated_storage())
+        self.processed_file = storage.PROCESSED_FILE
+
+    def test_claim_order_is_granted_only_once(self):
+        self.assertTrue(storage.claim_order("123"))
+        self.assertFalse(storage.claim_order("123"))
+        self.assertTrue(storage.is_order_processed("123"))
+
+    def test_release_order_allows_new_claim(self):
+        storage.claim_order("123")
+        storage.release_order("123")
+
+        self.assertFalse(storage.is_order_processed("123"))
+        self.assertTrue(storage.claim_order("123"))
+
+    def test_legacy_text_file_is_migrated_once(self):
+        self.processed_file.write_text("111\n222\n\n")
+
+        self.assertTrue(storage.is_order_processed("111"))
+        self.assertTrue(storage.is_order_processed("222"))
+        self.assertFalse(self.processed_file.exists())
+        self.assertTrue(self.processed_file.with_name("processed_orders.txt.migrated").exists())
+
+    def test_prune_removes_orders_older_than_ttl(self):
+        with mock.patch.object(storage.time, "time", return_value=time.time() - 10 * 86400):
+            storage.mark_order_processed("old")
+        storage.mark_order_processed("new")
+
+        with mock.patch.dict("os.environ", {"WBUY_PROCESSED_TTL_DAYS": "7"}):
+            removed = storage.prune_processed_orders()
+
+        self.assertEqual(removed, 1)
+        self.assertFalse(storage.is_order_processed("old"))
+        self.assertTrue(storage.is_order_processed("new"))
+
+    def test_prune_is_noop_without_ttl(self):
+        storage.mark_order_processed("kept")
+
+        self.assertEqual(storage.prune_processed_orders(), 0)
+        self.assertTrue(storage.is_order_processed("kept"))
+
+    def test_prune_trims_change_log_without_ttl(self):
+        for order_id in ("1", "2", "3", "4", "5"):
+            storage.mark_order_processed(order_id)
+
+        with mock.patch.dict("os.environ", {"WBUY_PROCESSED_CHANGES_KEPT": "2"}):
+            self.assertEqual(storage.prune_processed_orders(), 0)
+
+        connection = storage._processed_conn()
+        changes = connection.execute("SELECT order_id FROM processed_changes ORDER BY seq")
+        self.assertEqual([row[0] for row in changes], ["4", "5"])
+        self.assertTrue(all(storage.is_order_processed(str(n)) for n in range(1, 6)))
+
+    def test_periodic_prune_also_expires_delivery_log(self):
+        with mock.patch.object(storage, "_last_prune", 0.0), mock.patch(
+            "app.wbuy.delivery_log.prune"
+        ) as prune_deliveries:
+            storage.claim_order("123")
+            storage.claim_order("456")
+
+        prune_deliveries.assert_called_once_with()
+
+    @mock.patch.dict("os.environ", {"WBUY_PROCESSED_CACHE_SYNC_SECONDS": "60"})
+    def test_negative_lookups_are_answered_without_io(self):
+        storage.mark_order_processed("old")
+        self.assertTrue(storage.is_order_processed("old"))
+
+        with mock.patch.object(storage, "_processed_conn", side_effect=AssertionError("I/O")):
+            for index in range(100):
+                self.assertFalse(storage.is_order_processed(f"novo-{index}"))
+            self.assertTrue(storage.is_order_processed("old"))
+
+        stats = storage.cache_stats()
+        self.assertEqual((stats["negative"], stats["lru"], stats["store_hit"]), (100, 1, 1))
+        self.assertAlmostEqual(stats["hit_rate"], 101 / 102, places=4)
+
+    @mock.patch.dict("os.environ", {"WBUY_PROCESSED_CACHE_SYNC_SECONDS": "0"})
+    def test_writes_from_other_workers_invalidate_the_cache(self):
+        storage.mark_order_processed("123")
+        self.assertTrue(storage.is_order_processed("123"))
+
+        # Outro worker: conexão própria, sem passar pelo cache deste processo.
+        other = sqlite3.connect(storage.PROCESSED_DB, isolation_level=None)
+        other.execute("DELETE FROM processed_orders WHERE order_id = '123'")
+        other.execute("INSERT INTO processed_orders VALUES ('456', 0)")
+        other.close()
+
+        self.assertFalse(storage.is_order_processed("123"))
+        self.assertTrue(storage.is_order_processed("456"))
+
+        self.assertEqual(storage.cache_stats()["store_miss"], 1)
+
+    @mock.patch.dict("os.environ", {"WBUY_PROCESSED_CACHE_SYNC_SECONDS": "0"})
+    def test_cache_reloads_when_change_log_was_trimmed(self):
+        storage.mark_order_processed("a")
+        self.assertTrue(storage.is_order_processed("a"))
+        reloads = storage.cache_stats()["reloads"]
+
+        other = sqlite3.connect(storage.PROCESSED_DB, isolation_level=None)
+        other.execute("INSERT INTO processed_orders VALUES ('b', 0)")
+        other.execute("INSERT INTO processed_orders VALUES ('c', 0)")
+        other.execute("DELETE FROM processed_changes WHERE order_id = 'b'")
+        other.close()
+
+        self.assertTrue(storage.is_order_processed("b"))
+        self.assertEqual(storage.cache_stats()["reloads"], reloads + 1)
+
+    def test_bloom_filter_keeps_configured_false_positive_rate(self):
+        bloom = processed_cache.BloomFilter(1000, 0.01)
+        for index in range(1000):
+            bloom.add(f"pedido-{index}")
+
+        self.assertTrue(all(f"pedido-{index}" in bloom for index in range(1000)))
+        false_positives = sum(f"outro-{index}" in bloom for index in range(10000))
+        self.assertLess(false_positives / 10000, 0.02)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,96 @@
+import json
+import tempfile
+import unittest
+from pathlib import Path
+from unittest import mock
+
+from app.wbuy import models, templates
+
+
+class TestTemplates(unittest.TestCase):
+    def setUp(self):
+        self.temp_dir = tempfile.TemporaryDirectory()
+        self.directory = Path(self.temp_dir.name)
+        self._write("_base.json", {"messages": {"oi": "Oi, {first_name}! {instruction}"}})
+
+    def tearDown(self):
+        self.temp_dir.cleanup()
+
+    def _write(self, name, data):
+        (self.directory / name).write_text(json.dumps(data), encoding="utf-8")
+
+    def _order(self, kind="credit_card", code="", link=""):
+        return models.Order(
+            "42",
+            "Ana Maria",
+            "11988887777",
+            "10.0",
+            (models.Item("Vaso", "2"),),
+            models.Payment(kind, code, link),
+        )
+
+    def test_new_payment_type_only_needs_a_file(self):
+        self._write(
+            "credit_card.json",
+            {
+                "variables": {"instruction": "Pedido {order_id} aprovado."},
+                "steps": [
+                    {"kind": "text", "message": "oi", "label": "mensagem 1"},
+                    {"kind": "delay", "seconds": 2},
+                    {"kind": "text", "body": "Itens:{items_block}"},
+                ],
+            },
+        )
+
+        compiled = templates.compile_directory(self.directory)
+
+        self.assertEqual(list(compiled), ["credit_card"])
+        self.assertEqual(compiled["credit_card"].requires, ())
+        self.assertEqual(
+            compiled["credit_card"].render(self._order()),
+            [
+                {"kind": "text", "body": "Oi, Ana! Pedido 42 aprovado.", "label": "mensagem 1"},
+                {"kind": "delay", "seconds": 2.0},
+                {"kind": "text", "body": "Itens:\n- Vaso (qtd 2)", "label": "mensagem"},
+            ],
+        )
+
+    def test_requires_payment_fields_used_by_steps(self):
+        self._write(
+            "boleto.json",
+            {"steps": [{"kind": "code"}, {"kind": "media", "url": "{payment_link}"}]},
+        )
+
+        template = templates.compile_directory(self.directory)["boleto"]
+
+        self.assertEqual(template.requires, ("code", "link"))
+        self.assertEqual(
+            template.render(self._order("boleto", "123", "https://x/b.pdf"))[1],
+            {"kind": "boleto", "url": "https://x/b.pdf", "filename": "boleto.pdf"},
+        )
+
+    def test_unknown_field_fails_at_load(self):
+        self._write("pix.json", {"steps": [{"kind": "text", "body": "{cupom}"}]})
+
+        with self.assertRaises(templates.TemplateError):
+            templates.compile_directory(self.directory)
+
+    def test_shipped_templates_compile(self):
+        compiled = templates.compile_directory(templates.TEMPLATES_DIR)
+
+        self.assertEqual(compiled["pix"].requires, ("code",))
+        self.assertEqual(compiled["bank_billet"].requires, ("code", "link"))
+
+    def test_templates_dir_can_be_overridden(self):
+        self._write("credit_card.json", {"steps": [{"kind": "text", "body": "ok"}]})
+
+        with mock.patch.dict("os.environ", {"WBUY_TEMPLATES_DIR": str(self.directory)}):
+            try:
+                self.assertEqual(list(templates.load(reload=True)), ["credit_card"])
+            finally:
+                with mock.patch.dict("os.environ", {"WBUY_TEMPLATES_DIR": ""}):
+                    templates.load(reload=True)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,170 @@
+import json
+import os
+import unittest
+from unittest import mock
+
+from app import create_app
+from app.wbuy import jobs, storage, tenants, webhook
+from tests import isolated_storage
+
+
+def _payload(order_id="1"):
+    return {
+        "data": {
+            "id": order_id,
+            "cliente": {"nome": "Ana Maria", "telefone1": "(11)98888-7777"},
+            "valor_total": {"total": "10.0"},
+            "pagamento": {"linha_digitavel": "PIXCODE", "tipo_interno": "pix"},
+        }
+    }
+
+
+class TestTenants(unittest.TestCase):
+    def setUp(self):
+        self.temp = self.enterContext(isolated_storage())
+        self.tenants_file = self.temp / "tenants.json"
+        (self.temp / "loja2").mkdir()
+        (self.temp / "loja2" / "_base.json").write_text(
+            json.dumps({"messages": {"saudacao": "Olá, {first_name}! Pedido {order_id}."}}),
+            encoding="utf-8",
+        )
+        self._write_tenants(
+            {
+                "loja2": {
+                    "whaticket_api_url": "https://loja2.example/api/messages/send",
+                    "whaticket_token_env": "LOJA2_TOKEN",
+                    "templates_dir": "loja2",
+                    "rate_limit": 2,
+                    "pool_size": 3,
+                }
+            }
+        )
+        # Cleanups rodam ao contrário: o ambiente volta antes do reload.
+        self.addCleanup(tenants.load, reload=True)
+        self.enterContext(
+            mock.patch.dict(
+                "os.environ",
+                {
+                    "WBUY_TENANTS_FILE": str(self.tenants_file),
+                    "WBUY_TENANTS_CHECK_SECONDS": "0",
+                    "LOJA2_TOKEN": "TOKEN2",
+                    "WHATSAPP_TEST_NUMBER": "",
+                    "NUMBER_TEST": "",
+                    "NUMBER_TESTE": "",
+                },
+            )
+        )
+        tenants.load(reload=True)
+        self.client = create_app().test_client()
+
+    def _write_tenants(self, data):
+        self.tenants_file.write_text(json.dumps(data), encoding="utf-8")
+
+    def _touch(self):
+        # Garante mtime diferente mesmo em sistemas de arquivos com resolução grossa.
+        stat = self.tenants_file.stat()
+        os.utime(self.tenants_file, (stat.st_atime, stat.st_mtime + 10))
+
+    def test_load_reads_file_and_follows_changes(self):
+        tenant = tenants.get("loja2")
+
+        self.assertEqual(tenant.settings.whaticket_token, "TOKEN2")
+        self.assertEqual(
+            tenant.settings.whaticket_api_url, "https://loja2.example/api/messages/send"
+        )
+        self.assertEqual(tenant.templates_dir, (self.temp / "loja2").resolve())
+        self.assertEqual((tenant.rate_limit, tenant.pool_size), (2.0, 3))
+        self.assertIs(tenants.load(), tenants.load())
+
+        self._write_tenants({"loja3": {"whaticket_token": "TOKEN3"}})
+        self._touch()
+        self.assertEqual(tenants.names(), ["loja3"])
+
+        self.tenants_file.write_text("{", encoding="utf-8")
+        self._touch()
+        self.assertEqual(tenants.names(), ["loja3"])
+
+    def test_scoped_keys_round_trip(self):
+        self.assertEqual(tenants.scoped("42"), "42")
+        self.assertEqual(tenants.scoped("42", "loja2"), "loja2:42")
+        self.assertEqual(tenants.split("loja2:42"), ("loja2", "42"))
+        self.assertEqual(tenants.split("42"), (tenants.DEFAULT, "42"))
+        self.assertEqual(tenants.of_payload({"delivery_retry": "loja2:42"}), "loja2")
+        self.assertEqual(tenants.of_payload({**_payload(), tenants.PAYLOAD_KEY: "loja2"}), "loja2")
+
+        with tenants.bind("loja2"):
+            self.assertEqual(tenants.scoped("42"), "loja2:42")
+            self.assertEqual(webhook.settings.get().whaticket_token, "TOKEN2")
+        with self.assertRaises(KeyError):
+            with tenants.bind("desconhecida"):
+                pass
+
+    def test_unknown_tenant_is_rejected_with_404(self):
+        response = self.client.post("/wbuy/desconhecida/webhook", json=_payload())
+
+        self.assertEqual(response.status_code, 404)
+        self.assertEqual(response.get_json(), {"status": "rejected", "reason": "unknown_tenant"})
+        self.assertEqual(jobs.depth()["pending"], 0)
+
+    def test_same_order_id_in_two_tenants_is_queued_twice(self):
+        default = self.client.post("/wbuy/webhook", json=_payload())
+        tenant = self.client.post("/wbuy/loja2/webhook", json=_payload())
+
+        self.assertEqual(default.get_json()["status"], "queued")
+        self.assertEqual(tenant.status_code, 202)
+        self.assertEqual(tenant.get_json()["status"], "queued")
+        self.assertEqual(jobs.depth()["pending"], 2)
+
+        handler = mock.Mock()
+        jobs.run_next(handler)
+        jobs.run_next(handler)
+        payloads = [call.args[0] for call in handler.call_args_list]
+        self.assertEqual(payloads, [_payload(), {**_payload(), tenants.PAYLOAD_KEY: "loja2"}])
+
+    def test_tenant_order_uses_tenant_account_templates_and_namespace(self):
+        response = mock.Mock(ok=True, status_code=200, text="ok")
+        response.json.return_value = {"ok": True}
+
+        with webhook.settings.override(whaticket_token="TOKEN"), mock.patch(
+            "app.wbuy.webhook.http_client.request", return_value=response
+        ) as request_mock:
+            tenant_result = webhook.run_job({**_payload(), tenants.PAYLOAD_KEY: "loja2"})
+            tenant_calls = list(request_mock.call_args_list)
+            request_mock.reset_mock()
+            default_result = webhook.run_job(_payload())
+            default_calls = list(request_mock.call_args_list)
+
+        self.assertEqual(tenant_result, {"status": "ok"})
+        self.assertEqual(default_result, {"status": "ok"})
+        self.assertEqual(len(tenant_calls), 3)
+        for args, kwargs in tenant_calls:
+            self.assertEqual(args[1], "https://loja2.example/api/messages/send")
+            self.assertEqual(kwargs["headers"]["Authorization"], "Bearer TOKEN2")
+        self.assertEqual(tenant_calls[0].kwargs["json"]["body"], "Olá, Ana! Pedido 1.")
+
+        self.assertEqual(len(default_calls), 3)
+        self.assertEqual(default_calls[0].kwargs["headers"]["Authorization"], "Bearer TOKEN")
+        self.assertTrue(default_calls[0].kwargs["json"]["body"].startswith("Oi, Ana!"))
+        self.assertTrue(storage.is_order_processed("1"))
+        self.assertTrue(storage.is_order_processed("loja2:1"))
+
+    def test_payload_is_validated_with_tenant_templates(self):
+        (self.temp / "loja2" / "pix.json").write_text(
+            json.dumps({"steps": [{"kind": "text", "body": "Pague em {payment_link}"}]}),
+            encoding="utf-8",
+        )
+        tenants.load(reload=True)
+
+        rejected = self.client.post("/wbuy/loja2/webhook", json=_payload())
+        accepted = self.client.post("/wbuy/webhook", json=_payload())
+        skipped = webhook.process_webhook({**_payload("2"), tenants.PAYLOAD_KEY: "loja2"})
+
+        self.assertEqual(rejected.status_code, 422)
+        self.assertEqual(rejected.get_json()["field"], "data.pagamento.paymentLink")
+        self.assertEqual(accepted.status_code, 202)
+        self.assertEqual(skipped["reason"], "invalid_payload")
+        self.assertFalse(storage.is_order_processed("loja2:2"))
+
+
+if __name__ == "__main__":
+    unittest.main()
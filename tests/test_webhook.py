@@ -1,36 +1,108 @@
-import tempfile
+import json
 import unittest
-from pathlib import Path
 from unittest import mock
 
 from app import create_app
-from app.wbuy import webhook
+from app.wbuy import jobs, webhook
+from tests import isolated_storage
 
 
 class TestWebhook(unittest.TestCase):
     def setUp(self):
         self.app = create_app()
         self.client = self.app.test_client()
-        self.temp_dir = tempfile.TemporaryDirectory()
-        self.processed_file = Path(self.temp_dir.name) / "processed_orders.txt"
-        self.processed_patcher = mock.patch.object(
-            webhook.storage, "PROCESSED_FILE", self.processed_file
-        )
-        self.processed_patcher.start()
-
-    def tearDown(self):
-        self.processed_patcher.stop()
-        self.temp_dir.cleanup()
+        self.temp = self.enterContext(isolated_storage())
 
-    def test_handle_webhook_processes_payload_and_returns_ok(self):
-        payload = {"data": {}}
+    def test_handle_webhook_queues_payload_and_returns_accepted(self):
+        payload = {
+            "data": {
+                "id": "1",
+                "cliente": {"nome": "Cliente", "telefone1": "(11)98888-7777"},
+                "valor_total": {"total": "10.0"},
+                "pagamento": {"linha_digitavel": "PIXCODE", "tipo_interno": "pix"},
+            }
+        }
 
         with mock.patch("app.wbuy.webhook.process_webhook") as process_mock:
             response = self.client.post("/wbuy/webhook", json=payload)
 
+        self.assertEqual(response.status_code, 202)
+        self.assertEqual(response.get_json()["status"], "queued")
+        process_mock.assert_not_called()
+        self.assertEqual(jobs.depth()["pending"], 1)
+        records = list(webhook.archive.iter_records())
+        self.assertEqual([json.loads(record.payload) for record in records], [payload])
+
+        handler = mock.Mock()
+        self.assertTrue(jobs.run_next(handler))
+        handler.assert_called_once_with(payload)
+        self.assertEqual(jobs.depth()["pending"], 0)
+
+    def test_handle_webhook_coalesces_repeated_webhooks_for_same_order(self):
+        payload = {
+            "data": {
+                "id": "7",
+                "cliente": {"nome": "Cliente", "telefone1": "(11)98888-7777"},
+                "valor_total": {"total": "10.0"},
+                "pagamento": {"linha_digitavel": "PIXCODE", "tipo_interno": "pix"},
+            }
+        }
+
+        first = self.client.post("/wbuy/webhook", json=payload)
+        with mock.patch.object(webhook.singleflight, "_conn") as conn_mock:
+            second = self.client.post("/wbuy/webhook", json=payload)
+
+        self.assertEqual(first.get_json()["status"], "queued")
+        self.assertEqual(second.status_code, 202)
+        self.assertEqual(second.get_json(), {"status": "coalesced", "order_id": "7"})
+        conn_mock.assert_not_called()
+        self.assertEqual(jobs.depth()["pending"], 1)
+        self.assertEqual(len(list(webhook.archive.iter_records())), 2)
+
+    def test_handle_webhook_rejects_malformed_payload_without_queueing(self):
+        response = self.client.post("/wbuy/webhook", json={"data": {"id": "2"}})
+
+        self.assertEqual(response.status_code, 422)
+        self.assertEqual(
+            response.get_json(),
+            {"status": "rejected", "reason": "invalid_payload", "field": "data.cliente"},
+        )
+        self.assertEqual(jobs.depth()["pending"], 0)
+        self.assertIsNotNone(webhook.archive.load("2"))
+
+    def test_process_webhook_skips_malformed_payload_before_claiming(self):
+        payload = {"data": {"id": "3", "cliente": {"nome": "Cliente"}}}
+
+        with mock.patch.object(webhook.storage, "is_order_processed") as processed_mock:
+            result = webhook.process_webhook(payload)
+
+        processed_mock.assert_not_called()
+        self.assertEqual(result["reason"], "invalid_payload")
+
+    def test_process_webhook_skips_payment_type_without_template(self):
+        payload = {
+            "data": {
+                "id": "4",
+                "cliente": {"nome": "Cliente", "telefone1": "(11)98888-7777"},
+                "valor_total": {"total": "10.0"},
+                "pagamento": {"tipo_interno": "credit_card"},
+            }
+        }
+
+        with mock.patch("app.wbuy.webhook.send_whats_message") as send_mock:
+            result = webhook.process_webhook(payload)
+
+        send_mock.assert_not_called()
+        self.assertEqual(result, {"status": "skipped", "reason": "unsupported_payment"})
+        self.assertFalse(webhook.storage.is_order_processed("4"))
+
+    def test_healthcheck_reports_queue_depth(self):
+        jobs.enqueue({"data": {}})
+
+        response = self.client.get("/wbuy")
+
         self.assertEqual(response.status_code, 200)
-        self.assertEqual(response.get_json(), {"status": "ok"})
-        process_mock.assert_called_once_with(payload)
+        self.assertEqual(response.get_json()["queue"]["pending"], 1)
 
     def test_process_webhook_builds_and_sends_messages_pix(self):
         payload = {
@@ -51,22 +123,27 @@ class TestWebhook(unittest.TestCase):
             }
         }
 
-        with mock.patch("app.wbuy.webhook.send_whats_message") as send_mock, mock.patch(
-            "app.wbuy.webhook.time.sleep"
-        ) as sleep_mock:
+        with mock.patch("app.wbuy.webhook.send_whats_message") as send_mock:
             webhook.process_webhook(payload)
 
         expected_phone = "5516996246673"
         lista_itens = "- Banco Indiano Madeira Entalhada e Ferro com Encosto 50 cm (qtd 1)"
-        expected_msg_1 = webhook.build_msg_1(
-            "Osmar",
-            "10490102",
-            "249.9",
-            lista_itens,
-            "Para concluir rapidinho, é só pagar usando o Pix Copia e Cola abaixo:",
+        expected_msg_1 = (
+            "Oi, Osmar! 🌺✨\n"
+            "Aqui é a Carol da Sarat.\n"
+            "Espero que esteja tudo bem?\n"
+            "Que alegria ver seu pedido chegando pra gente 💛\n"
+            "Aqui estão os dados certinhos do seu pedido 10490102:\n\n"
+            "📦 Pedido: 10490102\n"
+            "🧾 Valor total: R$ 249.9\n"
+            f"🛍️ Itens:\n{lista_itens}\n\n"
+            "Para concluir rapidinho, é só pagar usando o Pix Copia e Cola abaixo:"
+        )
+        expected_msg_2 = "0002010102122677PIXCODE"
+        expected_msg_final = (
+            "E se tiver qualquer dúvida ou dificuldade pode chamar a gente por aqui mesmo.\n"
+            "🙏🏻🙏🏻🙏🏻"
         )
-        expected_msg_2 = webhook.build_msg_2("0002010102122677PIXCODE")
-        expected_msg_final = webhook.build_closing_message()
 
         self.assertEqual(
             send_mock.call_args_list,
@@ -76,7 +153,6 @@ class TestWebhook(unittest.TestCase):
                 mock.call(expected_phone, expected_msg_final),
             ],
         )
-        sleep_mock.assert_has_calls([mock.call(1), mock.call(1)])
 
     def test_process_webhook_handles_boleto_flow_and_order(self):
         payload = {
@@ -101,12 +177,16 @@ class TestWebhook(unittest.TestCase):
             events.append(body)
             return {"status": "sent", "number": number, "body": body}
 
+        uploaded = []
+
         def fake_send_media(number, file_bytes, filename):
             events.append("media")
+            uploaded.append(b"".join(file_bytes))
             return {"status": "media", "number": number, "filename": filename}
 
         pdf_response = mock.Mock()
-        pdf_response.content = b"%PDF-1.4"
+        pdf_response.iter_content.return_value = iter([b"%PDF-1.4", b"\n%%EOF"])
+        pdf_response.headers = {"Content-Type": "application/pdf"}
         pdf_response.ok = True
         pdf_response.status_code = 200
         pdf_response.text = "ok"
@@ -127,22 +207,22 @@ class TestWebhook(unittest.TestCase):
             mock.patch(
                 "app.wbuy.webhook.send_whats_media", side_effect=fake_send_media
             ) as media_mock,
-            mock.patch("app.wbuy.webhook.requests.get", return_value=pdf_response) as get_mock,
-            mock.patch("app.wbuy.webhook.time.sleep") as sleep_mock,
+            mock.patch(
+                "app.wbuy.webhook.http_client.request", return_value=pdf_response
+            ) as get_mock,
         ):
             webhook.process_webhook(payload)
 
-        lista_itens = "- Produto Teste (qtd 2)"
         expected_phone = "5511988887777"
-        expected_msg_1 = webhook.build_msg_1(
-            "Cliente",
-            "55555",
-            "100.0",
-            lista_itens,
-            "Para concluir rapidinho, é só pagar usando o código de barras abaixo:",
+        rendered = webhook.templates.get("bank_billet").render(webhook.Order.from_payload(payload))
+        expected_msg_1, expected_msg_2, expected_msg_final = (
+            step["body"] for step in rendered if step["kind"] == "text"
+        )
+        self.assertIn("🛍️ Itens:\n- Produto Teste (qtd 2)\n\n", expected_msg_1)
+        self.assertTrue(
+            expected_msg_1.endswith("é só pagar usando o código de barras abaixo:")
         )
-        expected_msg_2 = webhook.build_msg_2("1234567890")
-        expected_msg_final = webhook.build_closing_message()
+        self.assertEqual(expected_msg_2, "1234567890")
 
         self.assertEqual(events, [expected_msg_1, expected_msg_2, "media", expected_msg_final])
         self.assertEqual(
@@ -153,9 +233,69 @@ class TestWebhook(unittest.TestCase):
                 mock.call(expected_phone, expected_msg_final),
             ],
         )
-        media_mock.assert_called_once_with(expected_phone, b"%PDF-1.4", "boleto.pdf")
-        sleep_mock.assert_has_calls([mock.call(1), mock.call(1), mock.call(1)])
-        get_mock.assert_called_once_with("https://example.com/boleto.pdf", stream=True, timeout=30)
+        media_mock.assert_called_once_with(expected_phone, mock.ANY, "boleto.pdf")
+        self.assertEqual(uploaded, [b"%PDF-1.4\n%%EOF"])
+        get_mock.assert_called_once_with(
+            "GET", "https://example.com/boleto.pdf", stream=True, headers={}
+        )
+
+    def test_boleto_step_uses_filename_from_template(self):
+        templates_dir = self.temp / "templates"
+        templates_dir.mkdir()
+        (templates_dir / "bank_billet.json").write_text(
+            json.dumps(
+                {
+                    "steps": [
+                        {"kind": "media", "url": "{payment_link}", "filename": "fatura.pdf"}
+                    ]
+                }
+            ),
+            encoding="utf-8",
+        )
+        payload = {
+            "data": {
+                "id": "55556",
+                "cliente": {"nome": "Cliente Boleto", "telefone1": "(11)98888-7777"},
+                "valor_total": {"total": "100.0"},
+                "pagamento": {
+                    "linha_digitavel": "1234567890",
+                    "paymentLink": "https://example.com/boleto.pdf",
+                    "tipo_interno": "bank_billet",
+                },
+            }
+        }
+        pdf_response = mock.Mock(ok=True, status_code=200, text="ok")
+        pdf_response.iter_content.return_value = iter([b"%PDF-1.4", b"\n%%EOF"])
+        pdf_response.headers = {"Content-Type": "application/pdf"}
+
+        def fake_send_media(number, file_bytes, filename):
+            b"".join(file_bytes)
+            return {"status": "media", "number": number, "filename": filename}
+
+        with (
+            mock.patch.dict(
+                "os.environ",
+                {
+                    "WBUY_TEMPLATES_DIR": str(templates_dir),
+                    "WHATSAPP_TEST_NUMBER": "",
+                    "NUMBER_TEST": "",
+                    "NUMBER_TESTE": "",
+                },
+            ),
+            mock.patch(
+                "app.wbuy.webhook.send_whats_media", side_effect=fake_send_media
+            ) as media_mock,
+            mock.patch("app.wbuy.webhook.http_client.request", return_value=pdf_response),
+        ):
+            try:
+                webhook.templates.load(reload=True)
+                result = webhook.process_webhook(payload)
+            finally:
+                with mock.patch.dict("os.environ", {"WBUY_TEMPLATES_DIR": ""}):
+                    webhook.templates.load(reload=True)
+
+        self.assertEqual(result, {"status": "ok"})
+        media_mock.assert_called_once_with("5511988887777", mock.ANY, "fatura.pdf")
 
     def test_process_webhook_skips_duplicate_orders(self):
         payload = {
@@ -181,20 +321,20 @@ class TestWebhook(unittest.TestCase):
             mock.patch(
                 "app.wbuy.webhook.send_whats_message", side_effect=fake_send_message
             ),
-            mock.patch("app.wbuy.webhook.time.sleep"),
         ):
-            webhook.process_webhook(payload)
-            webhook.process_webhook(payload)
+            first = webhook.process_webhook(payload)
+            second = webhook.process_webhook(payload)
 
         self.assertEqual(len(events), 3)
-        self.assertTrue(self.processed_file.exists())
-        self.assertEqual(self.processed_file.read_text().splitlines(), ["10490102"])
+        self.assertEqual(first, {"status": "ok"})
+        self.assertEqual(second, {"status": "skipped", "reason": "already_processed"})
+        self.assertTrue(webhook.storage.is_order_processed("10490102"))
 
     def test_send_whats_media_posts_file(self):
         file_bytes = b"pdf-bytes"
 
-        with mock.patch.object(webhook, "WHATICKET_TOKEN", "TOKEN"), mock.patch(
-            "app.wbuy.webhook.requests.post"
+        with webhook.settings.override(whaticket_token="TOKEN"), mock.patch(
+            "app.wbuy.webhook.http_client.request"
         ) as post_mock:
             response_mock = mock.Mock()
             response_mock.json.return_value = {"ok": True}
@@ -212,6 +352,23 @@ class TestWebhook(unittest.TestCase):
         self.assertIn("medias", kwargs["files"])
         self.assertEqual(kwargs["files"]["medias"][0], "boleto.pdf")
 
+    def test_send_whats_bulk_marks_messages_without_result_as_failed(self):
+        messages = [{"number": "5511999999999", "body": f"m{index}"} for index in range(2)]
+        response_mock = mock.Mock(ok=True, status_code=200, text="{}")
+
+        with webhook.settings.override(whaticket_token="TOKEN"), mock.patch(
+            "app.wbuy.webhook.http_client.request", return_value=response_mock
+        ):
+            response_mock.json.return_value = {"queued": True}
+            without_results = webhook.send_whats_bulk(messages)
+            response_mock.json.return_value = {"results": [{"id": 1}]}
+            short_results = webhook.send_whats_bulk(messages)
+
+        missing = {"status": "error", "reason": "missing_bulk_result"}
+        self.assertEqual(without_results, [missing, missing])
+        self.assertEqual(short_results, [{"id": 1}, missing])
+        self.assertTrue(webhook.delivery_log.is_failure(short_results[1]))
+
     def test_uses_test_number_when_env_present(self):
         payload = {
             "data": {
@@ -228,9 +385,7 @@ class TestWebhook(unittest.TestCase):
 
         with mock.patch.dict(
             "os.environ", {"NUMBER_TEST": "5511999888777"}, clear=False
-        ), mock.patch("app.wbuy.webhook.send_whats_message") as send_mock, mock.patch(
-            "app.wbuy.webhook.time.sleep"
-        ):
+        ), mock.patch("app.wbuy.webhook.send_whats_message") as send_mock:
             webhook.process_webhook(payload)
 
         send_mock.assert_any_call(mock.ANY, mock.ANY)
@@ -243,21 +398,6 @@ class TestWebhook(unittest.TestCase):
         self.assertEqual(webhook.normalize_phone("5516996246673"), "5516996246673")
         self.assertEqual(webhook.normalize_phone("16996246673"), "5516996246673")
 
-    def test_test_number_prefers_whatsapp_env_then_number_test(self):
-        with mock.patch.dict(
-            "os.environ",
-            {"NUMBER_TEST": "5511111111111", "WHATSAPP_TEST_NUMBER": "5522222222222"},
-            clear=False,
-        ):
-            self.assertEqual(webhook._get_test_number(), "5522222222222")
-
-        with mock.patch.dict(
-            "os.environ",
-            {"NUMBER_TEST": "5511111111111"},
-            clear=False,
-        ):
-            self.assertEqual(webhook._get_test_number(), "5511111111111")
-
     def test_process_webhook_skips_when_phone_missing(self):
         payload = {
             "data": {
@@ -276,18 +416,17 @@ class TestWebhook(unittest.TestCase):
                 clear=False,
             ),
             mock.patch("app.wbuy.webhook.send_whats_message") as send_mock,
-            mock.patch("app.wbuy.webhook.time.sleep"),
         ):
             result = webhook.process_webhook(payload)
 
         send_mock.assert_not_called()
-        self.assertFalse(self.processed_file.exists())
+        self.assertFalse(webhook.storage.is_order_processed("999999"))
         self.assertEqual(result, {"status": "skipped", "reason": "missing_phone"})
 
     def test_send_whats_message_rejects_missing_number(self):
         with (
-            mock.patch.object(webhook, "WHATICKET_TOKEN", "TOKEN"),
-            mock.patch("app.wbuy.webhook.requests.post") as post_mock,
+            webhook.settings.override(whaticket_token="TOKEN"),
+            mock.patch("app.wbuy.webhook.http_client.request") as post_mock,
         ):
             response = webhook.send_whats_message("", "body")
 